@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Measures the time spent reordering the server-side attention cache of one block during beam search.
+Before each step, rows of the cache take the hypotheses chosen by the client (hypo_ids). Reordering the whole cache
+copies max_length tokens of every row on every step, while TransformerBackend._reorder_cache_inplace copies only
+the tokens that are already filled, in the rows that take another row's hypothesis.
+"""
+
+import argparse
+from time import perf_counter
+
+import numpy as np
+import torch
+from hypermind.utils.logging import get_logger
+
+from subnet.constants import DTYPE_MAP
+
+logger = get_logger()
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu", help="Device")
+    parser.add_argument("--torch_dtype", type=str, default="float16", help="Torch dtype")
+    parser.add_argument("--num_beams", type=int, default=4, help="Number of beams")
+    parser.add_argument("--num_kv_heads", type=int, default=8, help="Number of key/value heads")
+    parser.add_argument("--head_dim", type=int, default=128, help="Attention head dimension")
+    parser.add_argument("--max_lengths", type=int, nargs="+", default=[2048, 8192], help="Allocated cache lengths")
+    parser.add_argument("--prompt_length", type=int, default=20, help="Number of tokens before beam search")
+    parser.add_argument("--new_tokens", type=int, default=128, help="Number of beam search steps")
+    parser.add_argument("--warmup_steps", type=int, default=10, help="Number of warmup steps")
+    args = parser.parse_args()
+
+    dtype = DTYPE_MAP[args.torch_dtype]
+    if args.device == "cpu" and dtype == torch.float16:
+        dtype = torch.float32  # some CPU kernels do not support float16
+
+    for max_length in args.max_lengths:
+        full_ms = benchmark_reorder(max_length, dtype, args, prefix_only=False) * 1000
+        prefix_ms = benchmark_reorder(max_length, dtype, args, prefix_only=True) * 1000
+        logger.info(
+            f"{max_length=}, num_beams={args.num_beams}: whole cache {full_ms:.3f} ms/step, "
+            f"filled prefix {prefix_ms:.3f} ms/step (speedup {full_ms / prefix_ms:.2f}x)"
+        )
+
+
+@torch.inference_mode()
+def benchmark_reorder(max_length: int, dtype: torch.dtype, args: argparse.Namespace, prefix_only: bool) -> float:
+    """:returns: mean time of reordering keys and values for one step in seconds"""
+    device = torch.device(args.device)
+    shape = (args.num_beams, args.num_kv_heads, max_length, args.head_dim)
+    cache_tensors = [torch.randn(shape, dtype=dtype, device=device) for _ in range(2)]
+    generator = torch.Generator().manual_seed(0)
+
+    step_times = []
+    for step in range(args.warmup_steps + args.new_tokens):
+        prefix_length = args.prompt_length + max(0, step - args.warmup_steps)
+        # Beam search keeps the best continuations, so some beams are duplicated and others are dropped
+        hypo_ids = torch.randint(args.num_beams, (args.num_beams,), generator=generator).sort().values
+        _synchronize(device)
+        start_time = perf_counter()
+
+        if prefix_only:
+            changed_rows = torch.nonzero(hypo_ids != torch.arange(args.num_beams)).flatten()
+            if len(changed_rows) > 0:
+                target, source = changed_rows.to(device), hypo_ids[changed_rows].to(device)
+                for cache_tensor in cache_tensors:
+                    prefix = cache_tensor[:, :, :prefix_length]
+                    prefix[target] = prefix[source]
+        else:
+            for cache_tensor in cache_tensors:
+                cache_tensor[...] = cache_tensor[hypo_ids.to(device)]
+
+        _synchronize(device)
+        if step >= args.warmup_steps:
+            step_times.append(perf_counter() - start_time)
+    return np.mean(step_times)
+
+
+def _synchronize(device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+if __name__ == "__main__":
+    main()
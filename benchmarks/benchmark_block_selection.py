@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Measures the time a server spends on choosing blocks during rebalancing in a synthetic swarm.
+For each server, should_choose_other_blocks() finds the best start for this server's span with _choose_best_start().
+We time one such pass over all servers with the current implementation and with the reference one,
+which sorts throughputs in every window, and check that both choose the same blocks.
+"""
+
+import argparse
+from time import perf_counter
+
+import numpy as np
+from hypermind.utils.logging import get_logger
+
+from subnet.server.block_selection import _choose_best_start
+
+logger = get_logger()
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--num_spans", type=int, default=1000, help="Number of servers in the swarm")
+    parser.add_argument("--total_blocks", type=int, default=126, help="Number of blocks in the model")
+    parser.add_argument("--max_span_length", type=int, default=32, help="Maximum number of blocks per server")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    lengths = rng.integers(1, args.max_span_length + 1, size=args.num_spans)
+    starts = rng.integers(0, args.total_blocks - lengths + 1)
+    span_throughputs = rng.lognormal(mean=0.0, sigma=1.0, size=args.num_spans)
+
+    throughputs = np.zeros(args.total_blocks)
+    for start, length, throughput in zip(starts, lengths, span_throughputs):
+        throughputs[start : start + length] += throughput
+
+    results = {}
+    for name, choose_best_start in [("sliding", _choose_best_start), ("reference", _choose_best_start_reference)]:
+        start_time = perf_counter()
+        results[name] = [choose_best_start(throughputs, length) for length in lengths]
+        elapsed = perf_counter() - start_time
+        logger.info(
+            f"{name}: {elapsed:.3f} sec for {args.num_spans} spans over {args.total_blocks} blocks "
+            f"({elapsed / args.num_spans * 1000:.3f} ms per span)"
+        )
+    assert results["sliding"] == results["reference"], "Implementations chose different blocks"
+
+
+def _choose_best_start_reference(throughputs: np.ndarray, num_blocks: int) -> int:
+    options = ((sorted(throughputs[i : i + num_blocks]), i) for i in range(0, len(throughputs) - num_blocks + 1))
+    return min(options)[-1]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+Measures the latency of TransformerBackend.inference_step for one new token after a prefix of a given length,
+i.e. what the layout of the server-side attention cache costs on every step of generation.
+The BLOOM layout stores keys as [batch, kv_heads, head_dim, length], so Llama-like attention has to transpose them
+(and the kernel copies them into a contiguous buffer) on every step. Now, each model family stores its cache in its
+native layout. To compare with the code before this change, pass the revision before it with --compare_with:
+the benchmark then runs again in a subprocess with a git worktree of that revision on PYTHONPATH.
+
+The blocks have the architecture of --models but random weights, so only the configs are downloaded.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+from typing import Dict
+
+import numpy as np
+import torch
+from hypermind import BatchTensorDescriptor
+from hypermind.utils.logging import get_logger
+
+import subnet
+from subnet.constants import DTYPE_MAP
+from subnet.data_structures import InferenceMetadata
+from subnet.server.backend import TransformerBackend
+from subnet.server.block_utils import get_model_block
+from subnet.server.memory_cache import MemoryCache
+from subnet.utils.auto_config import AutoDistributedConfig
+from subnet.utils.convert_block import QuantType, convert_block
+
+logger = get_logger()
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--models", type=str, nargs="+", required=True, help="Models (e.g., a Llama and a BLOOM one)")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu", help="Device")
+    parser.add_argument("--torch_dtype", type=str, default="float16", help="Torch dtype")
+    parser.add_argument("--batch_size", type=int, default=1, help="Batch size")
+    parser.add_argument("--prefix_lengths", type=int, nargs="+", default=[1, 512, 2048], help="Prefix lengths")
+    parser.add_argument("--n_steps", type=int, default=100, help="Number of benchmark steps")
+    parser.add_argument("--warmup_steps", type=int, default=10, help="Number of warmup steps")
+    parser.add_argument("--compare_with", type=str, default=None, help="Git revision to compare with")
+    parser.add_argument("--results_path", type=str, default=None, help="Save the step times to this JSON file")
+    parser.add_argument("--token", type=str, default=None, help="Hugging Face hub auth token for .from_pretrained()")
+    args = parser.parse_args()
+
+    baseline_times = None
+    if args.compare_with is not None:
+        baseline_times = run_at_revision(args.compare_with, args)
+
+    logger.info(f"Benchmarking subnet from {os.path.dirname(subnet.__file__)}")
+    step_times = {model: benchmark_model(model, args) for model in args.models}
+    if args.results_path is not None:
+        with open(args.results_path, "w") as f:
+            json.dump(step_times, f)
+
+    for model, times in step_times.items():
+        for prefix_length, step_time in times.items():
+            message = f"{model}, prefix_length={prefix_length}: {step_time * 1000:.3f} ms/step"
+            if baseline_times is not None:
+                baseline_time = baseline_times[model][prefix_length]
+                message += (
+                    f", {args.compare_with}: {baseline_time * 1000:.3f} ms/step "
+                    f"(speedup {baseline_time / step_time:.2f}x)"
+                )
+            logger.info(message)
+
+
+def run_at_revision(revision: str, args: argparse.Namespace) -> Dict[str, Dict[str, float]]:
+    """Run this benchmark with the code of another git revision, :returns: its step times"""
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    argv = ["--models", *args.models, "--prefix_lengths", *map(str, args.prefix_lengths)]
+    for name in ("device", "torch_dtype", "batch_size", "n_steps", "warmup_steps", "token"):
+        if getattr(args, name) is not None:
+            argv += [f"--{name}", str(getattr(args, name))]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        worktree_dir, results_path = os.path.join(tmp_dir, "worktree"), os.path.join(tmp_dir, "results.json")
+        subprocess.run(["git", "-C", repo_dir, "worktree", "add", "--detach", worktree_dir, revision], check=True)
+        try:
+            env = dict(os.environ, PYTHONPATH=os.path.join(worktree_dir, "src"))
+            subprocess.run([sys.executable, __file__, *argv, "--results_path", results_path], env=env, check=True)
+            with open(results_path) as f:
+                return json.load(f)
+        finally:
+            subprocess.run(["git", "-C", repo_dir, "worktree", "remove", "--force", worktree_dir], check=True)
+
+
+def benchmark_model(model: str, args: argparse.Namespace) -> Dict[str, float]:
+    """:returns: mean time of one step in seconds for each prefix length (JSON keys are strings)"""
+    device = torch.device(args.device)
+    dtype = DTYPE_MAP[args.torch_dtype]
+    if device.type == "cpu" and dtype == torch.float16:
+        dtype = torch.float32  # some CPU kernels do not support float16
+
+    config = AutoDistributedConfig.from_pretrained(model, token=args.token)
+    block = get_model_block(config).to(dtype)
+    block = convert_block(block, 0, config, (device,), device, quant_type=QuantType.NONE, freeze=True)
+    schema = (BatchTensorDescriptor(1, 2048, config.hidden_size, dtype=dtype),)
+    backend = TransformerBackend(
+        f"{model}.0",
+        block,
+        config=config,
+        memory_cache=MemoryCache(max_size_bytes=None),
+        backend_dtype=dtype,
+        max_chunk_size_bytes=256 * 1024 * 1024,
+        args_schema=schema,
+        kwargs_schema={},
+        outputs_schema=schema,
+        min_batch_size=1,
+        max_batch_size=2048,
+    )
+    return {
+        str(prefix_length): asyncio.run(benchmark_steps(backend, prefix_length, dtype, args))
+        for prefix_length in args.prefix_lengths
+    }
+
+
+async def benchmark_steps(
+    backend: TransformerBackend, prefix_length: int, dtype: torch.dtype, args: argparse.Namespace
+) -> float:
+    """:returns: mean time of one inference step after prefix_length tokens in seconds"""
+    device, memory_cache = torch.device(args.device), backend.memory_cache
+    batch_size, hidden_size = args.batch_size, backend.config.hidden_size
+    max_length = prefix_length + args.warmup_steps + args.n_steps
+    descriptors = backend.get_inference_cache_descriptors(batch_size=batch_size, max_length=max_length)
+
+    memory_cache.runtime_pid += 1  # pretend we're a connection handler
+    async with memory_cache.allocate_cache(*descriptors, timeout=0) as handles:
+        memory_cache.runtime_pid -= 1  # pretend we're the runtime
+        no_hypo_ids = torch.empty(0, dtype=torch.int64)
+        prefix = torch.randn(batch_size, prefix_length, hidden_size, dtype=dtype, device=device)
+        backend.inference_step(prefix, no_hypo_ids, InferenceMetadata(backend.name, 0, tuple(handles), None))
+
+        step_times = []
+        for step in range(args.warmup_steps + args.n_steps):
+            hidden_states = torch.randn(batch_size, 1, hidden_size, dtype=dtype, device=device)
+            inference_info = InferenceMetadata(backend.name, prefix_length + step, tuple(handles), None)
+            _synchronize(device)
+            start_time = perf_counter()
+
+            backend.inference_step(hidden_states, no_hypo_ids, inference_info)
+
+            _synchronize(device)
+            if step >= args.warmup_steps:
+                step_times.append(perf_counter() - start_time)
+        memory_cache.runtime_pid += 1  # free the cache as a connection handler
+    memory_cache.runtime_pid -= 1
+    return float(np.mean(step_times))
+
+
+def _synchronize(device: torch.device):
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+if __name__ == "__main__":
+    main()
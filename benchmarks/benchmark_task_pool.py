@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""
+Measures the round-trip latency of a task sent from a ConnectionHandler to the runtime: from submit_task() until
+the outputs are available in the handler. We compare passing tensors through pickling (default) and through
+a SharedTensorRing (see subnet/server/shared_memory.py).
+A forked process plays the role of a ConnectionHandler and submits tasks one by one with hidden states of shape
+1 x seq_length x hidden_size, e.g. 1 x 1 x hidden_size for an inference step and 1 x 2048 x hidden_size for a prefill.
+The runtime runs in the main process with a pool that only copies its input, so we measure the transport overhead.
+"""
+
+import argparse
+import multiprocessing as mp
+import statistics
+from time import perf_counter
+
+import torch
+from hypermind.moe.server.runtime import Runtime
+from hypermind.utils.logging import get_logger
+
+from subnet.constants import DTYPE_MAP
+from subnet.server.shared_memory import SharedTensorRing, set_local_ring
+from subnet.server.task_pool import PrioritizedTaskPool
+from subnet.utils.misc import get_size_in_bytes
+
+logger = get_logger()
+
+
+class _DummyBackend:
+    def __init__(self, pools):
+        self.pools = pools
+
+    def get_pools(self):
+        return self.pools
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--hidden_size", type=int, default=8192, help="Hidden size of the model")
+    parser.add_argument("--torch_dtype", type=str, default="float16", help="Dtype of hidden states")
+    parser.add_argument("--seq_lengths", type=int, nargs="+", default=[1, 2048], help="Lengths of hidden states")
+    parser.add_argument("--num_steps", type=int, default=200, help="Number of tasks for each measurement")
+    parser.add_argument("--warmup_steps", type=int, default=10, help="Number of tasks before each measurement")
+    args = parser.parse_args()
+
+    torch_dtype = DTYPE_MAP[args.torch_dtype]
+    max_length = max(args.seq_lengths)
+    slot_size = 2 * max_length * args.hidden_size * get_size_in_bytes(torch_dtype) + 4096
+    ring = SharedTensorRing(num_slots=1, slot_size=slot_size)  # The ring is created before forking the "handler"
+    pool = PrioritizedTaskPool(lambda x: (x.clone(),), name="benchmark", max_batch_size=max_length)
+
+    runtime = Runtime({"0": _DummyBackend([pool])}, prefetch_batches=0)
+    results_queue = mp.SimpleQueue()
+    proc = mp.context.ForkProcess(target=_measure, args=(args, torch_dtype, pool, ring, runtime.ready, results_queue))
+    proc.start()
+    runtime.start()
+    proc.join()
+    runtime.shutdown()
+
+    while not results_queue.empty():
+        transport, seq_length, latencies = results_queue.get()
+        logger.info(
+            f"{transport}, hidden states 1x{seq_length}x{args.hidden_size}: "
+            f"median {statistics.median(latencies) * 1e6:.0f} us, mean {statistics.mean(latencies) * 1e6:.0f} us, "
+            f"max {max(latencies) * 1e6:.0f} us per round trip"
+        )
+
+
+def _measure(args, torch_dtype, pool, ring, runtime_ready, results_queue):
+    runtime_ready.wait()
+    for transport, local_ring in [("pickling", None), ("shared memory ring", ring)]:
+        set_local_ring(local_ring)
+        for seq_length in args.seq_lengths:
+            hidden_states = torch.randn(1, seq_length, args.hidden_size, dtype=torch_dtype)
+            latencies = []
+            for step in range(args.warmup_steps + args.num_steps):
+                start_time = perf_counter()
+                (outputs,) = pool.submit_task(hidden_states).result()
+                if step >= args.warmup_steps:
+                    latencies.append(perf_counter() - start_time)
+            assert torch.equal(outputs, hidden_states)
+            results_queue.put((transport, seq_length, latencies))
+
+
+if __name__ == "__main__":
+    main()
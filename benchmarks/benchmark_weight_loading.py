@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+"""
+Measures how fast a server loads its blocks from a local checkpoint and how much host memory it takes.
+We write a synthetic sharded Llama checkpoint to a temporary directory, then load N blocks (a) with
+load_pretrained_block() and one ModelWeightIndex shared by all blocks, as the server does, and (b) with the reference
+implementation that finds the index file, parses it, and opens the shards again for every block.
+Each mode runs in a separate process, so that peak RSS is measured independently. Since the checkpoint was just
+written, it is likely to be in the OS page cache: this benchmark measures the overhead of loading rather than the disk.
+"""
+
+import argparse
+import json
+import multiprocessing as mp
+import os
+import resource
+import tempfile
+from time import perf_counter
+
+import torch
+from accelerate import init_empty_weights
+from accelerate.utils import set_module_tensor_to_device
+from hypermind.utils.logging import get_logger
+from safetensors.torch import save_file
+
+from subnet.constants import DTYPE_MAP
+from subnet.models.llama import DistributedLlamaConfig
+from subnet.server.block_utils import get_model_block
+from subnet.server.from_pretrained import (
+    ModelWeightIndex,
+    _find_index_file,
+    _load_state_dict_from_repo_file,
+    load_pretrained_block,
+)
+from subnet.utils.disk_cache import DEFAULT_CACHE_DIR
+
+logger = get_logger()
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("--num_blocks", type=int, default=16, help="Number of blocks to load")
+    parser.add_argument("--blocks_per_shard", type=int, default=4, help="Number of blocks in each checkpoint shard")
+    parser.add_argument("--hidden_size", type=int, default=2048, help="Hidden size of the synthetic model")
+    parser.add_argument("--checkpoint_dtype", type=str, default="float16", help="Dtype of the saved weights")
+    parser.add_argument("--torch_dtype", type=str, default="float16", help="Dtype the blocks are loaded in")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as model_path:
+        config = _make_checkpoint(model_path, args)
+        logger.info(f"Saved {args.num_blocks} blocks to {model_path}")
+
+        ctx = mp.get_context("spawn")
+        for name in ["shared index", "reference"]:
+            with ctx.Pool(1) as pool:
+                elapsed, peak_rss = pool.apply(
+                    _load_blocks, (model_path, config, DTYPE_MAP[args.torch_dtype], args.num_blocks, name)
+                )
+            logger.info(
+                f"{name}: loaded {args.num_blocks} blocks in {elapsed:.3f} sec "
+                f"({elapsed / args.num_blocks * 1000:.1f} ms per block), peak RSS {peak_rss / 2**20:.0f} MiB"
+            )
+
+
+def _make_checkpoint(model_path: str, args: argparse.Namespace) -> DistributedLlamaConfig:
+    checkpoint_dtype = DTYPE_MAP[args.checkpoint_dtype]
+    config = DistributedLlamaConfig(
+        hidden_size=args.hidden_size,
+        intermediate_size=args.hidden_size * 8 // 3,
+        num_attention_heads=args.hidden_size // 128,
+        num_key_value_heads=args.hidden_size // 128,
+        num_hidden_layers=args.num_blocks,
+        torch_dtype=checkpoint_dtype,
+    )
+    config.save_pretrained(model_path)
+
+    weight_map = {}
+    for shard_start in range(0, args.num_blocks, args.blocks_per_shard):
+        filename = f"model-{shard_start // args.blocks_per_shard:05d}.safetensors"
+        shard = {}
+        for block_index in range(shard_start, min(shard_start + args.blocks_per_shard, args.num_blocks)):
+            for name, param in get_model_block(config, layer_idx=block_index).state_dict().items():
+                shard[f"{config.block_prefix}.{block_index}.{name}"] = param.to(checkpoint_dtype)
+        save_file(shard, f"{model_path}/{filename}")
+        weight_map.update({key: filename for key in shard})
+    with open(f"{model_path}/model.safetensors.index.json", "w") as f:
+        json.dump(dict(metadata={}, weight_map=weight_map), f)
+    return config
+
+
+def _load_blocks(model_path: str, config, torch_dtype: torch.dtype, num_blocks: int, name: str):
+    start_time = perf_counter()
+    if name == "shared index":
+        weight_index = ModelWeightIndex(model_path)
+        blocks = [
+            load_pretrained_block(
+                model_path, block_index, config=config, torch_dtype=torch_dtype, weight_index=weight_index
+            )
+            for block_index in range(num_blocks)
+        ]
+    else:
+        blocks = [
+            _load_pretrained_block_reference(model_path, block_index, config=config, torch_dtype=torch_dtype)
+            for block_index in range(num_blocks)
+        ]
+    for block in blocks:
+        for param in block.parameters():
+            param.sum()  # Memory-mapped weights are read lazily, so we access them to include reading in the time
+    elapsed = perf_counter() - start_time
+    return elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024  # ru_maxrss is in KiB on Linux
+
+
+def _load_pretrained_block_reference(model_path: str, block_index: int, *, config, torch_dtype: torch.dtype):
+    index_file = _find_index_file(model_path, cache_dir=DEFAULT_CACHE_DIR)
+    with open(os.path.join(model_path, index_file)) as f:
+        weight_map = json.load(f)["weight_map"]
+
+    block_prefix = f"{config.block_prefix}.{block_index}."
+    state_dict = {}
+    for filename in {filename for key, filename in weight_map.items() if key.startswith(block_prefix)}:
+        shard_state_dict = _load_state_dict_from_repo_file(
+            model_path, filename, block_prefix=block_prefix, cache_dir=DEFAULT_CACHE_DIR
+        )
+        state_dict.update({key[len(block_prefix) :]: param for key, param in shard_state_dict.items()})
+
+    with init_empty_weights():
+        block = get_model_block(config, layer_idx=block_index)
+    for param_name, _ in block.named_parameters():
+        param = state_dict[param_name].to(torch_dtype)
+        set_module_tensor_to_device(block, param_name, "cpu", value=param, dtype=param.dtype)
+    return block
+
+
+if __name__ == "__main__":
+    main()
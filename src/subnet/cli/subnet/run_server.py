@@ -63,6 +63,12 @@ def main():
 
     parser.add_argument('--num_handlers', type=int, default=8, required=False,
                         help='server will use this many processes to handle incoming requests')
+    parser.add_argument('--num_shm_slots', type=int, default=8,
+                        help='Each request handler passes tensors to the runtime through a shared memory buffer with '
+                             'this many slots that are reused across requests. Use 0 to disable')
+    parser.add_argument('--shm_slot_tokens', type=int, default=16,
+                        help='Each shared memory slot fits hidden states of this many tokens (batch size * length). '
+                             'Larger requests (e.g., prefills) allocate shared memory for every tensor')
     parser.add_argument('--prefetch_batches', type=int, default=1, required=False,
                         help='Pre-form this many subsequent batches while GPU is processing the current one')
     parser.add_argument('--sender_threads', type=int, default=1, required=False,
@@ -81,6 +87,60 @@ def main():
     parser.add_argument('--attn_cache_tokens', type=int, default=None,
                         help='The number of past attention key/value pairs that will be stored between inference steps. '
                              'Default: 16384 for models with multi-query attention (based on Llama 2, Falcon), 4096 for others')
+    parser.add_argument('--continuous_batching', action='store_true',
+                        help='Process short inference steps of different sessions in the same batch. '
+                             'Improves throughput when the server serves many concurrent sessions')
+    parser.add_argument('--max_batched_sessions', type=int, default=16,
+                        help='With --continuous_batching, batch inference steps of at most this many sessions together')
+    parser.add_argument('--max_coalesced_tasks', type=int, default=1,
+                        help='Process up to this many concurrent forward (or backward) requests with the same adapter '
+                             'and similar lengths as one padded batch of at most --max_batch_size tokens. '
+                             'Improves throughput when many clients fine-tune with small batches. Default: 1 (disabled)')
+    parser.add_argument('--coalescing_window', type=float, default=0.005,
+                        help='With --max_coalesced_tasks, wait up to this many seconds after a forward/backward '
+                             'request arrives for other requests to batch it with')
+    parser.add_argument('--attn_impl', type=str, default=None, choices=['eager', 'sdpa'],
+                        help='Attention implementation: "sdpa" uses torch.nn.functional.scaled_dot_product_attention '
+                             'with grouped keys/values (lower peak memory, allows larger prefill chunks), '
+                             '"eager" computes attention with explicit matmul and softmax. Default: model default')
+    parser.add_argument('--max_prefill_chunk_tokens', type=int, default=1024,
+                        help='Split long inference steps (e.g. prefills of long prompts) into chunks of at most this '
+                             'many tokens, so that short steps of other sessions can run between the chunks. '
+                             'This bounds the latency of one runtime iteration')
+    parser.add_argument('--activation_cache_size', type=str, default=None,
+                        help='Keep the intermediate hidden states of forward requests that send an activation_cache_key '
+                             'in a shared buffer of this size, so that their backward requests skip recomputing the '
+                             'forward pass. Example: 4GiB. Default: disabled')
+    parser.add_argument('--activation_cache_ttl', type=float, default=60,
+                        help='Drop the hidden states kept for a backward request after this many seconds')
+    parser.add_argument('--fair_share_rate', type=float, default=None,
+                        help='Share the server between remote peers: once a peer uses more than this many tokens per '
+                             'second (times the number of blocks), its requests go after the requests of other peers. '
+                             'Default: disabled')
+    parser.add_argument('--fair_share_burst', type=float, default=None,
+                        help='With --fair_share_rate, a peer that was idle may use up to this many tokens (times '
+                             'the number of blocks) at once. Default: 10 seconds of --fair_share_rate')
+    parser.add_argument('--prefix_cache_fraction', type=float, default=0.0,
+                        help='Reuse attention keys/values of common prefixes (e.g. system prompts) across inference '
+                             'sessions. Cached prefixes may take up to this fraction of the attention cache and are '
+                             'evicted when sessions need the memory. Default: 0 (disabled)')
+    parser.add_argument('--kv_cache_dtype', type=str, default=None, choices=['int8'],
+                        help='Store attention caches in this dtype with a scale per head and token, so that more '
+                             'inference sessions fit into the cache (e.g., ~1.97x for float16 models with '
+                             'head_dim = 128). Default: store them in --torch_dtype')
+    parser.add_argument('--kv_offload_host_memory', type=str, default=None,
+                        help='Move attention caches of idle inference sessions to pinned host memory, taking up to '
+                             'this much memory. Example: 16GiB. Default: disabled')
+    parser.add_argument('--kv_offload_disk_space', type=str, default=None,
+                        help='Move attention caches of idle sessions that do not fit into --kv_offload_host_memory '
+                             'to files in {cache_dir}/kv_offload, taking up to this much disk space. '
+                             'Example: 100GB. Default: disabled')
+    parser.add_argument('--kv_offload_idle_timeout', type=float, default=60,
+                        help='Attention caches of sessions that did not run an inference step for this many seconds '
+                             'may be offloaded. They are moved back to the device on the next step')
+    parser.add_argument('--kv_offload_policy', type=str, default='idle', choices=['idle', 'on_demand'],
+                        help='"idle" offloads the caches of all idle sessions, "on_demand" offloads them '
+                             '(least recently used first) only when other sessions wait for memory')
 
     parser.add_argument('--cache_dir', type=str, default=None,
                         help='Path to a directory in which a downloaded pretrained model configuration should be cached if the standard cache should not be used.')
@@ -93,6 +153,18 @@ def main():
                              "However, this worst case is unlikely, expect the server to consume "
                              "the disk space equal to 2-4x of your GPU memory on average.")
 
+    parser.add_argument('--num_loading_threads', type=int, default=4,
+                        help='Read this many blocks from disk concurrently while the server starts. '
+                             'Reading blocks overlaps with quantizing and moving the previous blocks to the device')
+    parser.add_argument('--max_loading_memory', type=str, default=None,
+                        help='Maximal host memory taken by the blocks that were read but not moved to the device yet '
+                             'while the server starts. Example: 8GB, 16GiB. Default: unlimited '
+                             '(at most about num_loading_threads + 2 blocks)')
+
+    parser.add_argument('--no_converted_block_cache', action='store_false', dest='use_converted_block_cache',
+                        help='Do not cache converted (cast, quantized, split between GPUs) blocks on disk. '
+                             'By default, they are cached in --cache_dir, so that restarts do not convert them again')
+
     parser.add_argument('--device', type=str, default=None, required=False,
                         help='all blocks will use this device in torch notation; default: cuda if available else cpu')
     parser.add_argument("--torch_dtype", type=str, choices=DTYPE_MAP.keys(), default="auto",
@@ -146,6 +218,9 @@ def main():
                              "on each check for debugging purposes.")
     parser.add_argument("--mean_balance_check_period", type=float, default=60,
                         help="Check the swarm's balance every N seconds (and rebalance it if necessary)")
+    parser.add_argument('--no_incremental_rebalancing', action='store_false', dest='incremental_rebalancing',
+                        help='Restart the server with all blocks when it moves to other blocks. By default, the blocks '
+                             'that stay in the span keep serving, and only the new blocks are loaded')
 
     parser.add_argument('--quant_type', type=str, default=None, choices=[choice.name.lower() for choice in QuantType],
                         help="Quantize blocks to 8-bit (int8 from the LLM.int8() paper) or "
@@ -203,6 +278,18 @@ def main():
         max_disk_space, (int, type(None))
     ), "Unrecognized value for --max_disk_space. Correct examples: 1.5GB or 1500MB or 1572864000 (bytes)"
 
+    max_loading_memory = args.pop("max_loading_memory")
+    if max_loading_memory is not None:
+        max_loading_memory = parse_size(max_loading_memory)
+
+    kv_offload_host_memory = args.pop("kv_offload_host_memory")
+    kv_offload_host_bytes = parse_size(kv_offload_host_memory) if kv_offload_host_memory is not None else 0
+    kv_offload_disk_space = args.pop("kv_offload_disk_space")
+    kv_offload_disk_bytes = parse_size(kv_offload_disk_space) if kv_offload_disk_space is not None else 0
+
+    activation_cache_size = args.pop("activation_cache_size")
+    activation_cache_bytes = parse_size(activation_cache_size) if activation_cache_size is not None else 0
+
     if args.pop("new_swarm"):
         args["initial_peers"] = []
 
@@ -222,6 +309,10 @@ def main():
         announce_maddrs=announce_maddrs,
         compression=compression,
         max_disk_space=max_disk_space,
+        max_loading_memory=max_loading_memory,
+        kv_offload_host_bytes=kv_offload_host_bytes,
+        kv_offload_disk_bytes=kv_offload_disk_bytes,
+        activation_cache_bytes=activation_cache_bytes,
     )
     try:
         server.run()
@@ -96,6 +96,11 @@ def main():
     parser.add_argument('--attn_cache_tokens', type=int, default=None,
                         help='The number of past attention key/value pairs that will be stored between inference steps. '
                              'Default: 16384 for models with multi-query attention (based on Llama 2, Falcon), 4096 for others')
+    parser.add_argument('--continuous_batching', action='store_true',
+                        help='Process short inference steps of different sessions in the same batch. '
+                             'Improves throughput when the server serves many concurrent sessions')
+    parser.add_argument('--max_batched_sessions', type=int, default=16,
+                        help='With --continuous_batching, batch inference steps of at most this many sessions together')
 
     parser.add_argument('--cache_dir', type=str, default=None,
                         help='Path to a directory in which a downloaded pretrained model configuration should be cached if the standard cache should not be used.')
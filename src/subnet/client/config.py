@@ -29,6 +29,7 @@ class ClientConfig:
     min_backoff: float = 1  # after a repeated failure, sleep for this many seconds times 2 ** (num_failures - 1)
     max_backoff: float = 60  # limit maximal sleep time between retries to this value
     ban_timeout: float = 15  # when a remote peer fails to respond, prevent routing to that peer for this many seconds
+    deadline: Optional[float] = None  # servers refuse requests (or inference steps) they can't finish in this many sec
     active_adapter: Optional[str] = None  # name of active LoRA adapter (usually, Hugging Face repo)
 
     max_pinged: int = 3  # max servers to ping from each sequence side, per update
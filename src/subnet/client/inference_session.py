@@ -353,7 +353,7 @@ class InferenceSession:
                     break
                 except Exception as e:
                     self._sequence_manager.on_request_failure(
-                        server_session.span.peer_id if server_session is not None else None
+                        server_session.span.peer_id if server_session is not None else None, exception=e
                     )
                     if attempt_no + 1 == self._sequence_manager.config.max_retries or attempt_no + 1 >= max_retries:
                         raise
@@ -435,7 +435,7 @@ class InferenceSession:
                     break
                 except Exception as e:
                     self._sequence_manager.on_request_failure(
-                        server_session.span.peer_id if server_session is not None else None
+                        server_session.span.peer_id if server_session is not None else None, exception=e
                     )
                     if attempt_no + 1 == self._sequence_manager.config.max_retries or attempt_no + 1 >= max_retries:
                         raise
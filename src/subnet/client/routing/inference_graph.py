@@ -0,0 +1,180 @@
+"""
+A cached graph of inference routes through remote servers, used by RemoteSequenceManager to find fast routes.
+
+A route visits nodes (span, block), where a node means "the inputs of this block are at the server of this span".
+Edges either compute a block on the same server or send the activations from a server whose span ends at this block
+to another server that holds this block. Since all edges go from one block to the next one or from spans ending at
+a block to spans containing it, the graph is a DAG ordered by blocks, and we find shortest paths with dynamic
+programming over blocks in O(V + E) using numpy arrays instead of running Dijkstra on a dict-of-dicts graph.
+
+The graph structure is built once for a given set of spans and reused across make_sequence() calls. When a server
+updates its info (e.g., inference RPS or pings to other servers) without changing its span, we only patch the costs
+of this server's edges. Costs that depend on a particular request (client-server RTTs, whether servers have enough
+attention cache) are applied when searching for the path.
+"""
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from hypermind import PeerID
+
+from subnet.data_structures import RemoteSpanInfo
+
+
+class InferenceGraph:
+    """
+    :param rtt_to_delay: converts round-trip time in seconds (or None if unknown) to network delay in seconds
+    :param has_cache_for: checks if a span's server has enough attention cache for the given number of tokens
+    :param overhead_delay: serialization overhead added to each hop to a server (empirically measured)
+    :param default_inference_rps: used when a server does not report its inference RPS
+    :param alloc_delay: penalty for sending requests to servers without enough attention cache left
+    """
+
+    def __init__(
+        self,
+        *,
+        rtt_to_delay: Callable[[Optional[float]], float],
+        has_cache_for: Callable[[RemoteSpanInfo, Optional[int]], bool],
+        overhead_delay: float = 0.018,
+        default_inference_rps: float = 300,
+        alloc_delay: float = 10,
+    ):
+        self.rtt_to_delay, self.has_cache_for = rtt_to_delay, has_cache_for
+        self.overhead_delay = overhead_delay
+        self.default_inference_rps = default_inference_rps
+        self.alloc_delay = alloc_delay
+        self.version: Optional[int] = None  # version of RemoteSequenceInfo this graph was built for
+        self.spans: List[RemoteSpanInfo] = []
+        self._span_bounds: List[Tuple[PeerID, int, int]] = []
+
+    def update_(self, spans: Sequence[RemoteSpanInfo], spans_containing_block: Sequence[List[RemoteSpanInfo]]):
+        """Rebuild the graph if the set of spans has changed, otherwise patch costs of the spans that were updated"""
+        span_bounds = [(span.peer_id, span.start, span.end) for span in spans]
+        if span_bounds != self._span_bounds or len(spans_containing_block) != self.num_blocks:
+            self._build(spans, spans_containing_block)
+            return
+
+        for span_index, span in enumerate(spans):
+            if span is not self.spans[span_index]:
+                self.spans[span_index] = span
+                self._update_span_costs(span_index)
+
+    @property
+    def num_blocks(self) -> int:
+        return len(self._containing) if self.spans else 0
+
+    def _build(self, spans: Sequence[RemoteSpanInfo], spans_containing_block: Sequence[List[RemoteSpanInfo]]):
+        self.spans = list(spans)
+        self._span_bounds = [(span.peer_id, span.start, span.end) for span in spans]
+        span_indices = {span.peer_id: span_index for span_index, span in enumerate(spans)}
+        num_blocks = len(spans_containing_block)
+
+        # _containing[b] are indices of spans holding block b, _ending[b] are indices of spans that end at block b
+        self._containing = [
+            np.array([span_indices[span.peer_id] for span in block_spans], dtype=np.int64)
+            for block_spans in spans_containing_block
+        ]
+        ends = np.array([span.end for span in spans], dtype=np.int64)
+        self._ending = [np.flatnonzero(ends == block_idx) for block_idx in range(num_blocks + 1)]
+
+        # For each block b > 0, positions of the same spans among the nodes of block b - 1 (or -1 if a span starts at b)
+        self._continuing_from = [None]
+        self._ending_from = [None]
+        for block_idx in range(1, num_blocks + 1):
+            prev_positions = {span_index: pos for pos, span_index in enumerate(self._containing[block_idx - 1])}
+            if block_idx < num_blocks:
+                self._continuing_from.append(
+                    np.array([prev_positions.get(i, -1) for i in self._containing[block_idx]], dtype=np.int64)
+                )
+            self._ending_from.append(np.array([prev_positions[i] for i in self._ending[block_idx]], dtype=np.int64))
+
+        self._compute_costs = np.zeros(len(spans))
+        self._switch_costs = [None] * num_blocks  # [b]: costs of edges from _ending[b] to _containing[b]
+        for block_idx in range(1, num_blocks):
+            self._switch_costs[block_idx] = np.zeros((len(self._ending[block_idx]), len(self._containing[block_idx])))
+        for span_index in range(len(spans)):
+            self._update_span_costs(span_index)
+
+    def _update_span_costs(self, span_index: int):
+        span = self.spans[span_index]
+        inference_rps = span.server_info.inference_rps
+        if inference_rps is None:
+            inference_rps = self.default_inference_rps
+        self._compute_costs[span_index] = 1.0 / inference_rps
+
+        if span.end >= len(self._containing):
+            return  # this span ends at the last block, there are no servers to switch to
+        row = np.flatnonzero(self._ending[span.end] == span_index)[0]
+        next_pings = span.server_info.next_pings
+        for col, next_span_index in enumerate(self._containing[span.end]):
+            rtt = None
+            if next_pings is not None:
+                rtt = next_pings.get(self.spans[next_span_index].peer_id.to_base58())
+            self._switch_costs[span.end][row, col] = self.rtt_to_delay(rtt) + self.overhead_delay
+
+    def find_path(
+        self,
+        start_index: int,
+        end_index: int,
+        *,
+        client_server_rtts: Dict[PeerID, float],
+        cache_tokens_needed: Optional[int],
+    ) -> Tuple[List[RemoteSpanInfo], float]:
+        """
+        Find the sequence of servers that runs blocks [start_index, end_index) with the minimal expected latency
+
+        :note: all blocks in this range must be served by at least one span
+        :returns: a list of spans (trimmed to the blocks they should run) and the expected latency in seconds
+        """
+        assert 0 <= start_index < end_index <= self.num_blocks
+        alloc_penalties = np.array(
+            [0.0 if self.has_cache_for(span, cache_tokens_needed) else self.alloc_delay for span in self.spans]
+        )
+
+        # Client -> server network delays
+        nodes = self._containing[start_index]
+        costs = np.array([self.rtt_to_delay(client_server_rtts.get(self.spans[i].peer_id)) for i in nodes])
+        costs += self.overhead_delay + alloc_penalties[nodes]
+
+        switched_from = {}  # block_idx -> for each node of the block, position in _ending[block_idx] or -1
+        for block_idx in range(start_index + 1, end_index):
+            arrived_costs = costs + self._compute_costs[nodes]
+            nodes = self._containing[block_idx]
+            continuing_from = self._continuing_from[block_idx]
+
+            costs = np.full(len(nodes), np.inf)
+            continuing = continuing_from >= 0
+            costs[continuing] = arrived_costs[continuing_from[continuing]]
+
+            switched_from[block_idx] = np.full(len(nodes), -1, dtype=np.int64)
+            ending_positions = self._ending_from[block_idx]
+            if len(ending_positions) > 0:
+                switch_costs = arrived_costs[ending_positions, None] + self._switch_costs[block_idx]
+                switch_costs += alloc_penalties[nodes][None, :]
+                best_sources = switch_costs.argmin(axis=0)
+                best_switch_costs = switch_costs[best_sources, np.arange(len(nodes))]
+                should_switch = best_switch_costs < costs
+                costs[should_switch] = best_switch_costs[should_switch]
+                switched_from[block_idx][should_switch] = best_sources[should_switch]
+
+        # Server -> client network delays
+        costs = costs + self._compute_costs[nodes]
+        costs += np.array([self.rtt_to_delay(client_server_rtts.get(self.spans[i].peer_id)) for i in nodes])
+
+        position = int(costs.argmin())
+        total_cost = float(costs[position])
+        span_sequence, span_end = [], end_index
+        for block_idx in range(end_index - 1, start_index, -1):
+            source = switched_from[block_idx][position]
+            if source >= 0:
+                span_index = self._containing[block_idx][position]
+                span_sequence.append(self._make_span(span_index, block_idx, span_end))
+                span_end = block_idx
+                position = self._ending_from[block_idx][source]
+            else:
+                position = self._continuing_from[block_idx][position]
+        span_sequence.append(self._make_span(self._containing[start_index][position], start_index, span_end))
+        return span_sequence[::-1], total_cost
+
+    def _make_span(self, span_index: int, start: int, end: int) -> RemoteSpanInfo:
+        span = self.spans[span_index]
+        return RemoteSpanInfo(span.peer_id, start, end, span.server_info)
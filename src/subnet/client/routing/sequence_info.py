@@ -1,8 +1,9 @@
 import dataclasses
 import time
-from typing import Iterable, List, Optional, Tuple
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 
-from hypermind import get_logger
+from hypermind import PeerID, get_logger
 
 from subnet.data_structures import ModuleUID, RemoteModuleInfo, RemoteSpanInfo, ServerState
 from subnet.utils.dht import compute_spans
@@ -26,6 +27,11 @@ class RemoteSequenceInfo:
     spans_by_priority: List[RemoteSpanInfo]
     spans_containing_block: Tuple[List[RemoteSpanInfo], ...]
     last_updated_time: Optional[float]
+    version: int = 0  # incremented whenever spans change, can be used to invalidate caches derived from spans
+
+    # DHT records of each peer as [(block_index, server_info), ...] and the sort keys of their spans, see update_
+    _peer_records: Dict[PeerID, List[tuple]] = dataclasses.field(default_factory=dict, repr=False)
+    _span_keys: Dict[PeerID, tuple] = dataclasses.field(default_factory=dict, repr=False)
 
     @classmethod
     def make_empty(cls, block_uids: Iterable[ModuleUID]) -> "RemoteSequenceInfo":
@@ -37,31 +43,73 @@ class RemoteSequenceInfo:
     def __getitem__(self, ix: slice):
         assert isinstance(ix, slice)
         block_uids, block_infos = self.block_uids[ix], self.block_infos[ix]
-        spans_by_priority, spans_containing_block = self._sort_spans(block_infos)
-        return RemoteSequenceInfo(
-            block_uids, block_infos, spans_by_priority, spans_containing_block, self.last_updated_time
-        )
+        sequence_info = RemoteSequenceInfo(block_uids, block_infos, [], tuple([] for _ in block_uids), None)
+        sequence_info.update_(block_infos)  # note: block infos are shared with this sequence info
+        sequence_info.last_updated_time = self.last_updated_time
+        return sequence_info
 
     def __len__(self):
         return len(self.block_uids)
 
     def update_(self, new_block_infos: List[RemoteModuleInfo]):
+        """Update block infos with new DHT records, recomputing only the spans of the peers whose records changed"""
         assert len(new_block_infos) == len(self.block_uids)
+        peer_records = defaultdict(list)
         for block_index, (uid, info) in enumerate(zip(self.block_uids, new_block_infos)):
             assert uid == info.uid, f"The DHT entry for {uid} actually points to {info.uid}"
             self.block_infos[block_index].servers = info.servers
+            for peer_id, server_info in info.servers.items():
+                peer_records[peer_id].append((block_index, server_info))
 
-        self.spans_by_priority, self.spans_containing_block = self._sort_spans(self.block_infos)
+        changed_peers = {
+            peer_id
+            for peer_id in peer_records.keys() | self._peer_records.keys()
+            if peer_records.get(peer_id) != self._peer_records.get(peer_id)
+        }
+        self._peer_records = dict(peer_records)
+        if changed_peers:
+            self._update_spans_(changed_peers)
+            self.version += 1
         self.last_updated_time = time.perf_counter()
 
-    @staticmethod
-    def _sort_spans(block_infos: List[RemoteModuleInfo]):
-        spans_by_priority = list(compute_spans(block_infos, min_state=ServerState.ONLINE).values())
-        spans_by_priority.sort(key=lambda span: span.length, reverse=True)
+    def _update_spans_(self, changed_peers: Set[PeerID]):
+        # compute_spans() processes each peer independently, so we only run it for the records of changed peers
+        changed_block_infos = [
+            RemoteModuleInfo(
+                info.uid,
+                {peer_id: server_info for peer_id, server_info in info.servers.items() if peer_id in changed_peers},
+            )
+            for info in self.block_infos
+        ]
+        new_spans = compute_spans(changed_block_infos, min_state=ServerState.ONLINE)
 
-        spans_containing_block = tuple([] for _ in range(len(block_infos)))
-        for span in spans_by_priority:
-            for block_index in range(span.start, span.end):
-                spans_containing_block[block_index].append(span)
+        spans = {span.peer_id: span for span in self.spans_by_priority if span.peer_id not in changed_peers}
+        spans.update(new_spans)
+        affected_blocks = set()
+        for span in self.spans_by_priority:
+            if span.peer_id in changed_peers:
+                affected_blocks.update(range(span.start, span.end))
+        for span in new_spans.values():
+            affected_blocks.update(range(span.start, span.end))
+        for peer_id in changed_peers:
+            self._span_keys.pop(peer_id, None)
+        for peer_id in new_spans:
+            self._span_keys[peer_id] = self._get_span_key(new_spans[peer_id], self._peer_records[peer_id])
 
-        return spans_by_priority, spans_containing_block
+        self.spans_by_priority = sorted(spans.values(), key=lambda span: self._span_keys[span.peer_id])
+        for block_index in affected_blocks:
+            block_spans = [
+                span for span in self.spans_containing_block[block_index] if span.peer_id not in changed_peers
+            ]
+            block_spans.extend(span for span in new_spans.values() if span.start <= block_index < span.end)
+            block_spans.sort(key=lambda span: self._span_keys[span.peer_id])
+            self.spans_containing_block[block_index][:] = block_spans
+
+    @staticmethod
+    def _get_span_key(span: RemoteSpanInfo, records: List[tuple]) -> tuple:
+        # Longer spans go first, then spans go in the order of compute_spans() results for the entire sequence,
+        # that is, by the first block where the peer is online, then by peer_id
+        first_block = min(
+            block_index for block_index, server_info in records if server_info.state.value >= ServerState.ONLINE.value
+        )
+        return -span.length, first_block, span.peer_id
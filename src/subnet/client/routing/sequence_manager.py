@@ -11,7 +11,6 @@ import warnings
 from typing import Any, Dict, List, Optional, Sequence, Set, Union
 from weakref import WeakMethod
 
-import dijkstar
 import numpy as np
 from hypermind import DHT, P2P, MSGPackSerializer, PeerID
 from hypermind.dht.node import Blacklist
@@ -24,10 +23,12 @@ from hypermind.utils.auth import POSAuthorizer, POSAuthorizerLive
 from cryptography.hazmat.primitives.asymmetric import ed25519
 
 from subnet.client.config import ClientConfig
+from subnet.client.routing.inference_graph import InferenceGraph
 from subnet.client.routing.sequence_info import RemoteSequenceInfo
 from subnet.client.routing.spending_policy import NoSpendingPolicy
 from subnet.data_structures import ModuleUID, RemoteSpanInfo, ServerState
 from subnet.server.handler import TransformerConnectionHandler
+from subnet.server.task_pool import get_retry_after
 from subnet.substrate.config import SubstrateConfigCustom
 from subnet.utils.dht import get_remote_module_infos
 from subnet.utils.ping import PingAggregator
@@ -61,6 +62,7 @@ class SequenceManagerState:
     sequence_info: Optional[RemoteSequenceInfo] = None
     rpc_info: Optional[dict] = None
     banned_peers: Optional[Blacklist] = None
+    busy_peers: Optional[Dict[PeerID, float]] = None  # peers that refused requests, until time.monotonic() values
 
     def __getitem__(self, ix: Union[int, slice]) -> SequenceManagerState:
         return dataclasses.replace(self, sequence_info=self.sequence_info[ix])
@@ -132,9 +134,12 @@ class RemoteSequenceManager:
         self.blocked_servers = self._peer_ids_to_set(config.blocked_servers)
 
         self.ping_aggregator = PingAggregator(dht)
+        self._inference_graph = InferenceGraph(rtt_to_delay=self._rtt_to_delay, has_cache_for=self._has_cache_for)
 
         if state.banned_peers is None:
             state.banned_peers = Blacklist(base_time=config.ban_timeout, backoff_rate=2.0)
+        if state.busy_peers is None:
+            state.busy_peers = {}
         if state.sequence_info is None:
             state.sequence_info = RemoteSequenceInfo.make_empty(block_uids)
 
@@ -212,94 +217,27 @@ class RemoteSequenceManager:
             ]
             if missing_blocks:
                 raise MissingBlocksError(missing_blocks)
-            server_infos = {
-                span.peer_id: span.server_info
-                for block_idx in range(start_index, end_index)
-                for span in self.state.sequence_info.spans_containing_block[block_idx]
-            }
 
-            graph = self._build_inference_graph(start_index, end_index, cache_tokens_needed=cache_tokens_needed)
+            graph = self._get_inference_graph()
+            span_sequence, total_cost = graph.find_path(
+                start_index,
+                end_index,
+                client_server_rtts=self.ping_aggregator.to_dict(),
+                cache_tokens_needed=cache_tokens_needed,
+            )
 
-        path = dijkstar.find_path(graph, "start", "end")
-        logger.debug(f"Path info: {path}")
+        logger.debug(f"Path info: {span_sequence}, total cost: {total_cost}")
         if start_index == 0 and end_index == len(self):
-            logger.debug(f"Expected speed: {1 / path.total_cost:.1f} steps/sec")
-
-        span_sequence = []
-        for peer_id, block_idx in path.nodes[1:-1]:
-            if not span_sequence or span_sequence[-1].peer_id != peer_id:
-                span_sequence.append(RemoteSpanInfo(peer_id, block_idx, block_idx, server_infos[peer_id]))
-            else:
-                span_sequence[-1].end = block_idx
-
-        # Remove empty spans that can appear if we don't force to go to the end of each server and network delay
-        # don't follow triangle inequality (delay(A, B) + delay(B, C) < delay(A, C)) due to measurement errors
-        span_sequence = [span for span in span_sequence if span.length > 0]
-
+            logger.debug(f"Expected speed: {1 / total_cost:.1f} steps/sec")
         return span_sequence
 
-    def _build_inference_graph(
-        self,
-        start_index: int,
-        end_index: int,
-        *,
-        cache_tokens_needed: Optional[int],
-        overhead_delay: float = 0.018,  # Serialization overhead (empirically measured)
-        default_inference_rps: float = 300,  # If inference RPS unknown
-        alloc_delay: float = 10,  # If not enough cache left, we penalize the edge
-    ) -> dijkstar.Graph:
-        missing_blocks = [
-            block_idx
-            for block_idx in range(start_index, end_index)
-            if not self.state.sequence_info.spans_containing_block[block_idx]
-        ]
-        if missing_blocks:
-            raise MissingBlocksError(missing_blocks)
-
-        client_server_rtts = self.ping_aggregator.to_dict()
-
-        graph = dijkstar.Graph()
-
-        # Clent -> server network delays
-        for span in self.state.sequence_info.spans_containing_block[start_index]:
-            delay = self._rtt_to_delay(client_server_rtts.get(span.peer_id))
-            delay += overhead_delay
-            if not self._has_cache_for(span, cache_tokens_needed):
-                delay += alloc_delay
-            graph.add_edge("start", (span.peer_id, start_index), delay)
-
-        # Server -> client network delays
-        for span in self.state.sequence_info.spans_containing_block[end_index - 1]:
-            delay = self._rtt_to_delay(client_server_rtts.get(span.peer_id))
-            graph.add_edge((span.peer_id, end_index), "end", delay)
-
-        # Server -> server network delays
-        for block_idx in range(start_index + 1, end_index):
-            for cur_span in self.state.sequence_info.spans_containing_block[block_idx - 1]:
-                if cur_span.end != block_idx:
-                    # If we choose a server, we force to go to the end of it before switching to a new one
-                    # to avoid O(N^2) graphs for N servers
-                    continue
-
-                for next_span in self.state.sequence_info.spans_containing_block[block_idx]:
-                    rtt = None
-                    if cur_span.server_info.next_pings is not None:
-                        rtt = cur_span.server_info.next_pings.get(next_span.peer_id.to_base58())
-                    delay = self._rtt_to_delay(rtt)
-                    delay += overhead_delay
-                    if not self._has_cache_for(next_span, cache_tokens_needed):
-                        delay += alloc_delay
-                    graph.add_edge((cur_span.peer_id, block_idx), (next_span.peer_id, block_idx), delay)
-
-        # Compute delays
-        for span in self.state.sequence_info.spans_by_priority:
-            for block_idx in range(max(span.start, start_index), min(span.end, end_index)):
-                inference_rps = span.server_info.inference_rps
-                if inference_rps is None:
-                    inference_rps = default_inference_rps
-                graph.add_edge((span.peer_id, block_idx), (span.peer_id, block_idx + 1), 1.0 / inference_rps)
-
-        return graph
+    def _get_inference_graph(self) -> InferenceGraph:
+        """Return the routing graph for the current spans, rebuilding or patching it if spans were updated"""
+        sequence_info = self.state.sequence_info
+        if self._inference_graph.version != sequence_info.version:
+            self._inference_graph.update_(sequence_info.spans_by_priority, sequence_info.spans_containing_block)
+            self._inference_graph.version = sequence_info.version
+        return self._inference_graph
 
     @staticmethod
     def _rtt_to_delay(
@@ -377,11 +315,11 @@ class RemoteSequenceManager:
                 and (self.blocked_servers is None or peer_id not in self.blocked_servers)
             }
 
-            # Remove temporarily banned peers, unless there are no peers left
+            # Remove temporarily banned and busy peers, unless there are no peers left
             valid_servers = {
                 peer_id: server_info
                 for peer_id, server_info in block_info.servers.items()
-                if peer_id not in self.state.banned_peers
+                if peer_id not in self.state.banned_peers and not self._is_busy(peer_id)
             }
             if len(valid_servers) < len(block_info.servers):
                 if valid_servers:
@@ -409,9 +347,18 @@ class RemoteSequenceManager:
 
         self.ready.set()
 
-    def on_request_failure(self, peer_id: Optional[PeerID]):
-        """remove a given peer from the routing table. If the routing is no longer possible, trigger an update"""
-        if peer_id is not None:
+    def on_request_failure(self, peer_id: Optional[PeerID], exception: Optional[BaseException] = None):
+        """
+        remove a given peer from the routing table. If the routing is no longer possible, trigger an update
+
+        :param exception: the error of the failed request; if the peer refused it since it would miss the deadline
+          (see ClientConfig.deadline), we avoid the peer for as long as it suggests instead of banning it
+        """
+        retry_after = get_retry_after(exception) if exception is not None else None
+        if peer_id is not None and retry_after is not None:
+            logger.debug(f"Peer {peer_id} is busy, avoiding it for {retry_after:.3f} sec")
+            self.state.busy_peers[peer_id] = time.monotonic() + retry_after
+        elif peer_id is not None:
             logger.debug(f"Peer {peer_id} did not respond, banning it temporarily")
             self.state.banned_peers.register_failure(peer_id)
         with self.lock_changes:
@@ -428,6 +375,13 @@ class RemoteSequenceManager:
         """if peer has a failure streak, clear that streak"""
         self.state.banned_peers.register_success(peer_id)
 
+    def _is_busy(self, peer_id: PeerID) -> bool:
+        busy_until = self.state.busy_peers.get(peer_id)
+        if busy_until is not None and busy_until <= time.monotonic():
+            self.state.busy_peers.pop(peer_id, None)
+            busy_until = None
+        return busy_until is not None
+
     def __len__(self):
         return len(self.block_uids)
 
@@ -476,7 +430,7 @@ class RemoteSequenceManager:
                 self.on_request_success(peer_id)
                 break
             except Exception as e:
-                self.on_request_failure(peer_id)
+                self.on_request_failure(peer_id, exception=e)
                 if attempt_no + 1 == self.config.max_retries:
                     raise
                 delay = self.get_retry_delay(attempt_no)
@@ -508,6 +462,7 @@ class RemoteSequenceManager:
             points=self.policy.get_points(protocol, *args, **kwargs),
             active_adapter=self.config.active_adapter,
             args_structure=args_structure,
+            deadline=self.config.deadline,
         )
 
     def shutdown(self):
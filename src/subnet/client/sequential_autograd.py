@@ -2,7 +2,9 @@
 A PyTorch autograd function that runs forward/backward on a sequence of remote servers in a fault-tolerant manner
 """
 import asyncio
+import dataclasses
 import itertools
+import uuid
 from collections import deque
 from typing import List, Optional, Sequence, Tuple
 
@@ -29,11 +31,15 @@ async def sequential_forward(
     sequence_manager: RemoteSequenceManager,
     start_index: int = 0,
     end_index: Optional[int] = None,
+    cache_activations: bool = False,
 ) -> Tuple[torch.Tensor, Sequence[torch.Tensor], Sequence[RemoteSpanInfo]]:
     """
     Constructs a routing path from <start_index> to <end_index>.
     Performs chained forward for each subsequence of blocks on the path.
     If some subsequence fails, reconstructs the remaining path and tries to finish the forward.
+
+    :param cache_activations: ask servers to keep intermediate activations for a backward pass that follows,
+      the returned spans hold the keys that sequential_backward sends to reuse them
     """
 
     assert isinstance(inputs, torch.Tensor) and inputs.ndim == 3, f"{type(inputs)}: {inputs.ndim}"
@@ -66,6 +72,8 @@ async def sequential_forward(
                     logger.debug(f"Found path from block {block_idx} to {end_index} via {len(sequences)} servers")
 
                 span = sequences.popleft()
+                if cache_activations:
+                    span = dataclasses.replace(span, activation_cache_key=uuid.uuid4().hex)
 
                 stub = TransformerConnectionHandler.get_stub(sequence_manager.state.p2p, span.peer_id)
                 flat_tensors, args_structure = pack_args_kwargs(inputs, prompts[span.start : span.end])
@@ -74,6 +82,8 @@ async def sequential_forward(
                 metadata = sequence_manager.get_request_metadata(
                     "rpc_forward", args_structure, span_uids, *flat_tensors
                 )
+                if span.activation_cache_key is not None:
+                    metadata["activation_cache_key"] = span.activation_cache_key
                 (outputs,) = await run_remote_forward(
                     span_uids,
                     stub,
@@ -95,7 +105,7 @@ async def sequential_forward(
                 sequence_manager.on_request_success(span.peer_id)
                 break
             except Exception as e:
-                sequence_manager.on_request_failure(span.peer_id if span is not None else None)
+                sequence_manager.on_request_failure(span.peer_id if span is not None else None, exception=e)
                 if attempt_no + 1 == sequence_manager.config.max_retries:
                     raise
                 delay = sequence_manager.get_retry_delay(attempt_no)
@@ -141,7 +151,12 @@ async def sequential_backward(
             try:
                 if attempt_no >= 1:
                     _, backup_inputs, backup_sequences = await sequential_forward(
-                        inputs, prompts, sequence_manager, start_index=span.start, end_index=span.end
+                        inputs,
+                        prompts,
+                        sequence_manager,
+                        start_index=span.start,
+                        end_index=span.end,
+                        cache_activations=True,
                     )
                     assert len(backup_inputs) == len(backup_sequences)
                     assert backup_sequences[0].start == span.start
@@ -162,6 +177,8 @@ async def sequential_backward(
                 metadata = sequence_manager.get_request_metadata(
                     "rpc_backward", args_structure, span_uids, *flat_tensors, peer_id=span.peer_id
                 )
+                if span.activation_cache_key is not None:
+                    metadata["activation_cache_key"] = span.activation_cache_key
                 grad_outputs, *span_grad_prompts = await run_remote_backward(
                     span_uids,
                     stub,
@@ -175,7 +192,7 @@ async def sequential_backward(
                 sequence_manager.on_request_success(span.peer_id)
                 break
             except Exception as e:
-                sequence_manager.on_request_failure(span.peer_id if span is not None else None)
+                sequence_manager.on_request_failure(span.peer_id if span is not None else None, exception=e)
                 if attempt_no + 1 == sequence_manager.config.max_retries:
                     raise
                 delay = sequence_manager.get_retry_delay(attempt_no)
@@ -196,11 +213,11 @@ async def sequential_backward(
     return grad_outputs, grad_prompts
 
 
-async def _gather_forward(input_batches, prompt_batches, sequence_manager):
+async def _gather_forward(input_batches, prompt_batches, sequence_manager, cache_activations=False):
     """Wrapper for asyncio.gather to perform parallel sequential forwards"""
     return await asyncio.gather(
         *[
-            sequential_forward(input_batch, prompt_batch, sequence_manager)
+            sequential_forward(input_batch, prompt_batch, sequence_manager, cache_activations=cache_activations)
             for input_batch, prompt_batch in zip(input_batches, prompt_batches)
         ]
     )
@@ -236,7 +253,10 @@ class _RemoteSequentialAutogradFunction(torch.autograd.Function):
             prompt_batches: Sequence[torch.Tensor] = prompts.detach().split(batch_size, dim=1)
 
         sequence_manager.rpc_info  # lazy init
-        outputs = RemoteExpertWorker.run_coroutine(_gather_forward(input_batches, prompt_batches, sequence_manager))
+        cache_activations = any(ctx.needs_input_grad[:2])  # backward() will be called only if we need gradients
+        outputs = RemoteExpertWorker.run_coroutine(
+            _gather_forward(input_batches, prompt_batches, sequence_manager, cache_activations)
+        )
         assert len(outputs) == len(input_batches)
 
         output_batches = [output[0] for output in outputs]
@@ -36,6 +36,13 @@ class ServerState(Enum):
     ONLINE = 2
 
 
+class CacheLayout(Enum):
+    """Layout of attention keys in the server-side attention cache, declared by each block class as cache_layout"""
+
+    BLOOM = "bloom"  # keys: [batch, num_kv_heads, head_dim, length], values: [batch, num_kv_heads, length, head_dim]
+    LLAMA = "llama"  # keys and values: [batch, num_kv_heads, length, head_dim], as consumed by Llama-like attention
+
+
 RPS = pydantic.confloat(ge=0, allow_inf_nan=False, strict=True)
 
 
@@ -90,6 +97,7 @@ class RemoteSpanInfo:
     start: int
     end: int
     server_info: ServerInfo
+    activation_cache_key: Optional[str] = None  # if set, the peer may keep the span's activations for backward
 
     @property
     def length(self) -> int:
@@ -115,3 +123,6 @@ class InferenceMetadata:
     prefix_length: int
     cache_handles: Tuple[Handle, ...]
     active_adapter: Optional[str]
+    prefix_keys: Tuple[bytes, ...] = ()  # keys of full pages of the inputs to look up in the prefix cache, if any
+    attention_sinks: int = 0  # sliding-window sessions never evict this many first tokens of the cache
+    num_evicted: int = 0  # before this step, drop as many tokens after the sinks (the cache held prefix + num_evicted)
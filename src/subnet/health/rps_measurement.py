@@ -0,0 +1,106 @@
+"""
+Measures the inference RPS of many subnet peers concurrently, see IncentivesProtocol.measure_rps.
+
+Each peer is measured by a blocking function (it runs a client-side inference session) in a worker thread,
+so up to max_concurrency peers are measured at the same time over one shared DHT/P2P instance.
+A peer that takes longer than peer_timeout is cancelled: its worker stops after the current step and the peer
+gets no result. Results are reported via on_result as soon as each peer is measured, so that they can be stored
+to the DHT incrementally instead of after the whole scoring round.
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import hypermind
+import torch
+
+logger = hypermind.get_logger(__name__)
+
+RPSResult = Dict[str, Any]
+MeasurePeerFn = Callable[[dict, threading.Event], Optional[RPSResult]]
+
+
+def time_inference_steps(
+    session,
+    inputs: torch.Tensor,
+    n_steps: int,
+    warmup_steps: int,
+    cancel_event: Optional[threading.Event] = None,
+) -> Optional[List[float]]:
+    """
+    Run inference steps with the same inputs and measure the time of each step spent on the remote servers
+
+    :param session: an InferenceSession (or anything with a compatible timed_step method)
+    :param warmup_steps: the first steps are not timed since servers may be warming up
+    :param cancel_event: if set, stop after the current step
+    :returns: the time of each step after warmup in seconds, or None if a step failed or the measurement was cancelled
+    """
+    time_steps = []
+    for step in range(n_steps):
+        if cancel_event is not None and cancel_event.is_set():
+            return None
+        try:
+            step_time, _outputs = session.timed_step(inputs, max_retries=0)
+        except Exception as e:
+            logger.warning(f"RPS Exception {e}", exc_info=True)
+            return None
+        if step >= warmup_steps:
+            time_steps.append(step_time)
+    return time_steps
+
+
+async def measure_peers_concurrently(
+    server_rows: Sequence[dict],
+    measure_peer: MeasurePeerFn,
+    *,
+    max_concurrency: int = 8,
+    peer_timeout: float = 300.0,
+    on_result: Optional[Callable[[RPSResult], None]] = None,
+) -> List[Optional[RPSResult]]:
+    """
+    Measure all peers with at most max_concurrency peers at a time
+
+    :param server_rows: the rows of the model report, one per peer
+    :param measure_peer: a blocking function(server_row, cancel_event) that measures one peer and returns its result
+      (or None on failure); it should stop soon after cancel_event is set
+    :param max_concurrency: the maximum number of peers measured at the same time
+    :param peer_timeout: cancel the measurement of a peer if it takes longer than this many seconds
+    :param on_result: called in the event loop thread with each successful result as soon as it is ready
+    :returns: the results in the order of server_rows, None for the peers that failed or timed out
+    """
+    assert max_concurrency > 0, "max_concurrency must be positive"
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(max_concurrency)
+    executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="RPSMeasurement")
+
+    async def _measure_one(server_row: dict) -> Optional[RPSResult]:
+        async with semaphore:
+            cancel_event = threading.Event()
+            start_time = time.perf_counter()
+            future = loop.run_in_executor(executor, measure_peer, server_row, cancel_event)
+            try:
+                done, _ = await asyncio.wait({future}, timeout=peer_timeout)
+                if not done:
+                    logger.warning(f"Measuring RPS of {server_row['peer_id']} took over {peer_timeout} sec, cancelling")
+                    cancel_event.set()
+                    await asyncio.wait({future})  # keep the slot taken until the worker actually stops
+                    return None
+                result = future.result()
+            except asyncio.CancelledError:
+                cancel_event.set()
+                raise
+            except Exception as e:
+                logger.warning(f"Failed to measure RPS of {server_row['peer_id']}: {e}", exc_info=True)
+                return None
+
+            logger.debug(f"Measured RPS of {server_row['peer_id']} in {time.perf_counter() - start_time:.1f} sec")
+            if result is not None and on_result is not None:
+                on_result(result)
+            return result
+
+    try:
+        return await asyncio.gather(*[_measure_one(server_row) for server_row in server_rows])
+    finally:
+        executor.shutdown(wait=False)
@@ -13,6 +13,8 @@ from subnet.utils.misc import is_dummy
 
 
 class WrappedBloomBlock(BloomBlock):
+    supports_padding_mask = True  # attention_mask may mark padded cache positions of sessions batched together
+
     def forward(
         self,
         hidden_states: torch.Tensor,
@@ -22,7 +24,6 @@ class WrappedBloomBlock(BloomBlock):
         layer_past: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
         **kwargs
     ):
-        assert attention_mask is None, "Non-causal attention masks are not supported yet"
         batch_size, seq_length = hidden_states.shape[:2]
         if layer_past is not None and is_dummy(layer_past[0]):
             # Bloom cannot use cache if it was misconsctructed(e.g. Dummy tensors)
@@ -30,7 +31,13 @@ class WrappedBloomBlock(BloomBlock):
             layer_past = None
         past_length = 0 if layer_past is None else layer_past[0].shape[-1]
         seq_length_with_past = seq_length + past_length
-        attention_mask = torch.ones((batch_size, seq_length_with_past), device=hidden_states.device)
+        if attention_mask is None:
+            attention_mask = torch.ones((batch_size, seq_length_with_past), device=hidden_states.device)
+        else:
+            # A [batch_size, seq_length_with_past] mask that is False for padding, see batched_inference_step().
+            # ALiBi positions are counted over the unmasked tokens, so they are the same as without padding
+            assert attention_mask.shape == (batch_size, seq_length_with_past), "expected a 2D padding mask"
+            attention_mask = attention_mask.to(torch.float32)
         if alibi is None:
             alibi = build_alibi_tensor(attention_mask, num_heads=self.num_heads, dtype=hidden_states.dtype)
         attention_mask = _prepare_4d_causal_attention_mask(
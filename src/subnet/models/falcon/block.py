@@ -23,6 +23,8 @@ from transformers.models.falcon.modeling_falcon import (
     rotate_half,
 )
 
+from subnet.data_structures import CacheLayout
+
 KVCache = Tuple[torch.Tensor, torch.Tensor]
 INFERENCE_MAX_LENGTH = 8192
 
@@ -44,6 +46,8 @@ class OptimizedFalconRotaryEmbedding(nn.Module):
         self.static_outputs = None
 
     def _optimized_apply_rotary(self, query, key, cos, sin):
+        if self.cuda_graph is not None and self.input_surface[0].shape != query.shape:
+            return apply_rotary(query, key, cos, sin)  # the graph was captured for another batch size
         if self.cuda_graph is None:
             self.cuda_graph = torch.cuda.CUDAGraph()
             self.input_surface = (query, key, cos, sin)
@@ -153,6 +157,8 @@ class OptimizedFalconAttention(FalconAttention):
             self.static_outputs = None
 
     def _optimized_split_heads(self, fused_qkv):
+        if self.split_graph is not None and self.input_surface.shape != fused_qkv.shape:
+            return self._split_heads(fused_qkv)  # the graph was captured for another batch size
         if self.split_graph is None:
             self.split_graph = torch.cuda.CUDAGraph()
             self.input_surface = fused_qkv
@@ -180,6 +186,8 @@ class OptimizedFalconAttention(FalconAttention):
         head_mask: Optional[torch.Tensor] = None,
         use_cache: bool = False,
         output_attentions: bool = False,
+        kv_cache: Optional[KVCache] = None,
+        prefix_length: int = 0,
     ):
         assert not output_attentions
 
@@ -207,9 +215,18 @@ class OptimizedFalconAttention(FalconAttention):
         )
         value_layer = value_layer.transpose(1, 2).reshape(batch_size * num_kv_heads, query_length, self.head_dim)
 
-        past_kv_length = 0 if layer_past is None else layer_past[0].shape[1]
+        if kv_cache is not None:
+            past_kv_length = prefix_length
+        else:
+            past_kv_length = 0 if layer_past is None else layer_past[0].shape[1]
         query_layer, key_layer = self.maybe_rotary(query_layer, key_layer, past_kv_length)
 
+        if kv_cache is not None:
+            attn_output = self._attend_to_inplace_cache(
+                query_layer, key_layer, value_layer, attention_mask, alibi, kv_cache, prefix_length
+            )
+            return self.dense(attn_output), None
+
         if layer_past is not None:
             past_key, past_value = layer_past
             # concatenate along seq_length dimension:
@@ -282,6 +299,51 @@ class OptimizedFalconAttention(FalconAttention):
             else:
                 return output_tensor, present
 
+    def _attend_to_inplace_cache(
+        self,
+        query_layer: torch.Tensor,
+        key_layer: torch.Tensor,
+        value_layer: torch.Tensor,
+        attention_mask: torch.Tensor,
+        alibi: Optional[torch.Tensor],
+        kv_cache: KVCache,
+        prefix_length: int,
+    ) -> torch.Tensor:
+        """
+        Write new keys/values into preallocated cache tensors and attend to the first {prefix_length + query_length}
+        tokens of the cache through a view, so that the cached prefix is never copied
+
+        :param query_layer: queries of shape [batch_size * num_heads, query_length, head_dim], same for keys/values
+        :param kv_cache: keys and values, both of shape [batch, num_kv_heads, max_length, head_dim]
+        :returns: attention output of shape [batch_size, query_length, num_heads * head_dim]
+        """
+        key_cache, value_cache = kv_cache
+        batch_size, num_kv_heads = key_cache.shape[:2]
+        num_groups = self.num_heads // num_kv_heads
+        query_length = query_layer.shape[1]
+        kv_length = prefix_length + query_length
+
+        # Keys and values are repeated for all query heads in a group, so we only store one copy per group
+        key_layer = key_layer.view(batch_size, num_kv_heads, num_groups, query_length, self.head_dim)[:, :, 0]
+        value_layer = value_layer.view(batch_size, num_kv_heads, num_groups, query_length, self.head_dim)[:, :, 0]
+        key_cache[:, :, prefix_length:kv_length, :] = key_layer
+        value_cache[:, :, prefix_length:kv_length, :] = value_layer
+
+        # Group query heads by their key/value head instead of repeating keys and values
+        query_layer = query_layer.view(batch_size, num_kv_heads, num_groups * query_length, self.head_dim)
+        attention_scores = query_layer @ key_cache[:, :, :kv_length, :].transpose(-1, -2)
+        attention_scores = attention_scores.view(batch_size, self.num_heads, query_length, kv_length).float()
+        if alibi is not None:
+            attention_scores = attention_scores + alibi.view(batch_size, self.num_heads, 1, -1)
+        attention_mask_float = (attention_mask * 1.0).masked_fill(attention_mask, float("-1e9"))
+        attention_probs = F.softmax(attention_scores * self.inv_norm_factor + attention_mask_float, dim=-1)
+        attention_probs = attention_probs.to(query_layer.dtype)
+
+        attention_probs = attention_probs.view(batch_size, num_kv_heads, num_groups * query_length, kv_length)
+        attn_output = attention_probs @ value_cache[:, :, :kv_length, :]
+        attn_output = attn_output.view(batch_size, self.num_heads, query_length, self.head_dim)
+        return attn_output.permute(0, 2, 1, 3).reshape(batch_size, query_length, self.num_heads * self.head_dim)
+
 
 class OptimizedFalconDecoderLayer(FalconDecoderLayer):
     def __init__(self, config: FalconConfig):
@@ -345,6 +407,8 @@ class OptimizedFalconDecoderLayer(FalconDecoderLayer):
         head_mask: Optional[torch.Tensor] = None,
         use_cache: bool = False,
         output_attentions: bool = False,
+        kv_cache: Optional[KVCache] = None,
+        prefix_length: int = 0,
     ):
         residual = hidden_states
 
@@ -365,6 +429,8 @@ class OptimizedFalconDecoderLayer(FalconDecoderLayer):
             head_mask=head_mask,
             use_cache=use_cache,
             output_attentions=output_attentions,
+            kv_cache=kv_cache,
+            prefix_length=prefix_length,
         )
 
         attention_output = attn_outputs[0]
@@ -396,6 +462,10 @@ class OptimizedFalconDecoderLayer(FalconDecoderLayer):
 
 
 class WrappedFalconBlock(OptimizedFalconDecoderLayer):
+    supports_inplace_cache = True  # kv_cache tensors can be updated in-place, see OptimizedFalconAttention
+    cache_layout = CacheLayout.LLAMA  # layer_past keys and values: [batch * num_kv_heads, length, head_dim]
+    supports_sdpa = True  # attention uses scaled_dot_product_attention unless the model uses ALiBi
+
     def forward(
         self,
         hidden_states: torch.Tensor,
@@ -404,15 +474,28 @@ class WrappedFalconBlock(OptimizedFalconDecoderLayer):
         alibi: Optional[torch.Tensor] = None,
         layer_past: Optional[KVCache] = None,
         use_cache: bool = False,
+        kv_cache: Optional[KVCache] = None,
+        prefix_length: int = 0,
         **kwargs,
     ):
+        """
+        :param kv_cache: if specified, preallocated (keys, values) tensors in the backend's layout; new keys/values
+          are written into them in-place at {prefix_length} and no layer_past is returned (use instead of layer_past)
+        :param prefix_length: the number of tokens already stored in kv_cache
+        """
         assert attention_mask is None
 
         batch_size, seq_length = hidden_states.shape[:2]
 
-        if layer_past is not None:
-            layer_past = self._reorder_cache_from_bloom_to_falcon(layer_past)
-        past_length = 0 if layer_past is None else layer_past[0].shape[1]
+        if kv_cache is not None:
+            assert layer_past is None
+            use_cache = False  # the new keys and values are already in kv_cache
+            kwargs.update(kv_cache=kv_cache, prefix_length=prefix_length)
+            past_length = prefix_length
+        else:
+            if layer_past is not None:
+                layer_past = self._expand_cache(layer_past)
+            past_length = 0 if layer_past is None else layer_past[0].shape[1]
         seq_length_with_past = seq_length + past_length
 
         attention_mask = torch.ones((batch_size, seq_length_with_past), device=hidden_states.device)
@@ -432,15 +515,13 @@ class WrappedFalconBlock(OptimizedFalconDecoderLayer):
 
         if use_cache:
             present_key_value = outputs[-1]
-            present_key_value = self._reorder_cache_from_falcon_to_bloom(present_key_value)
+            present_key_value = self._collapse_cache(present_key_value)
             outputs = outputs[:-1] + (present_key_value,)
 
         return outputs
 
-    def _reorder_cache_from_bloom_to_falcon(self, key_value: KVCache) -> KVCache:
+    def _expand_cache(self, key_value: KVCache) -> KVCache:
         key_states, value_states = key_value
-
-        key_states = key_states.permute(0, 2, 1)
         assert key_states.shape == value_states.shape  # Both are [batch_size * num_kv_heads, seq_len, head_dim]
 
         if self.config.new_decoder_architecture:
@@ -449,7 +530,7 @@ class WrappedFalconBlock(OptimizedFalconDecoderLayer):
 
         return (key_states, value_states)
 
-    def _reorder_cache_from_falcon_to_bloom(self, key_value: KVCache) -> KVCache:
+    def _collapse_cache(self, key_value: KVCache) -> KVCache:
         key_states, value_states = key_value
 
         if self.config.new_decoder_architecture:
@@ -457,8 +538,6 @@ class WrappedFalconBlock(OptimizedFalconDecoderLayer):
             value_states = self._collapse_states(value_states)
 
         assert key_states.shape == value_states.shape  # Both are [batch_size * num_kv_heads, seq_len, head_dim]
-        key_states = key_states.permute(0, 2, 1)
-
         return (key_states, value_states)
 
     def _expand_states(self, state: torch.Tensor) -> torch.Tensor:
@@ -20,6 +20,7 @@ from transformers.models.llama.modeling_llama import (
     rotate_half,
 )
 
+from subnet.data_structures import CacheLayout
 from subnet.utils.cuda_graphs import make_inference_graphed_callable
 
 
@@ -32,14 +33,15 @@ def apply_rotary_pos_emb(q, k, cos, sin):
 class OptimizedLlamaAttention(LlamaAttention):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self._rotary_graph = None
+        self._rotary_graphs = {}  # one graph per input shape, since sessions may be batched together
 
     def _optimized_apply_rotary(self, query_states, key_states, cos, sin):
-        if self._rotary_graph is None:
-            self._rotary_graph = make_inference_graphed_callable(
+        graph_key = (query_states.shape, key_states.shape, cos.shape)
+        if graph_key not in self._rotary_graphs:
+            self._rotary_graphs[graph_key] = make_inference_graphed_callable(
                 apply_rotary_pos_emb, sample_args=(query_states, key_states, cos, sin)
             )
-        return self._rotary_graph(query_states, key_states, cos, sin)
+        return self._rotary_graphs[graph_key](query_states, key_states, cos, sin)
 
     def forward(
         self,
@@ -50,6 +52,8 @@ class OptimizedLlamaAttention(LlamaAttention):
         output_attentions: bool = False,
         use_cache: bool = False,
         cache_position: Optional[torch.LongTensor] = None,
+        kv_cache: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        prefix_length: int = 0,
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
         assert not output_attentions
         if position_ids is None:
@@ -94,25 +98,32 @@ class OptimizedLlamaAttention(LlamaAttention):
         else:
             query_states, key_states = apply_rotary_pos_emb(query_states, key_states, cos, sin)
 
-        if past_key_value is not None:
-            # reuse k, v, self_attention
-            key_states = torch.cat([past_key_value[0], key_states], dim=2)
-            value_states = torch.cat([past_key_value[1], value_states], dim=2)
+        if kv_cache is not None:
+            key_states, value_states = self._append_to_inplace_cache(key_states, value_states, kv_cache, prefix_length)
+            past_key_value = None
+        else:
+            if past_key_value is not None:
+                # reuse k, v, self_attention
+                key_states = torch.cat([past_key_value[0], key_states], dim=2)
+                value_states = torch.cat([past_key_value[1], value_states], dim=2)
 
-        past_key_value = (key_states, value_states) if use_cache else None
+            past_key_value = (key_states, value_states) if use_cache else None
 
-        # repeat k/v heads if n_kv_heads < n_heads
-        key_states = repeat_kv(key_states, self.num_key_value_groups)
-        value_states = repeat_kv(value_states, self.num_key_value_groups)
+        if kv_cache is not None or self.config._attn_implementation == "sdpa":
+            attn_output = self._grouped_attention(query_states, key_states, value_states, attention_mask)
+        else:
+            # repeat k/v heads if n_kv_heads < n_heads
+            key_states = repeat_kv(key_states, self.num_key_value_groups)
+            value_states = repeat_kv(value_states, self.num_key_value_groups)
 
-        attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
+            attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
 
-        if attention_mask is not None:
-            attn_weights = attn_weights + attention_mask
+            if attention_mask is not None:
+                attn_weights = attn_weights + attention_mask
 
-        # upcast attention to fp32
-        attn_weights = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32).to(query_states.dtype)
-        attn_output = torch.matmul(attn_weights, value_states)
+            # upcast attention to fp32
+            attn_weights = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32).to(query_states.dtype)
+            attn_output = torch.matmul(attn_weights, value_states)
 
         attn_output = attn_output.transpose(1, 2).contiguous()
         attn_output = attn_output.reshape(bsz, q_len, self.hidden_size)
@@ -126,6 +137,74 @@ class OptimizedLlamaAttention(LlamaAttention):
 
         return attn_output, None, past_key_value
 
+    def _append_to_inplace_cache(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        kv_cache: Tuple[torch.Tensor, torch.Tensor],
+        prefix_length: int,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Write new keys/values into preallocated cache tensors at {prefix_length}
+
+        :param kv_cache: keys and values, both of shape [batch, num_kv_heads, max_length, head_dim]
+        :returns: views of the first {prefix_length + q_len} tokens of the cache, so the prefix is never copied
+        """
+        key_cache, value_cache = kv_cache
+        kv_length = prefix_length + key_states.shape[2]
+        key_cache[:, :, prefix_length:kv_length, :] = key_states
+        value_cache[:, :, prefix_length:kv_length, :] = value_states
+        return key_cache[:, :, :kv_length, :], value_cache[:, :, :kv_length, :]
+
+    def shift_key_positions(self, key_states: torch.Tensor, offset: int) -> torch.Tensor:
+        """
+        Re-rotate cached keys as if they were computed at {offset} positions later (or earlier, if offset < 0).
+        Rotary embeddings of positions p and p + offset differ by a rotation by offset, so we need not recompute keys.
+
+        :param key_states: keys that already have rotary embeddings applied, of shape [..., head_dim]
+        :returns: new keys of the same shape and dtype (computed in float32, so that repeated shifts stay accurate)
+        """
+        freqs = self.rotary_emb.inv_freq.float() * offset  # applied directly, so that dynamic scaling is not updated
+        emb = torch.cat((freqs, freqs), dim=-1).to(key_states.device)
+        shifted = key_states.float() * emb.cos() + rotate_half(key_states.float()) * emb.sin()
+        return shifted.to(key_states.dtype)
+
+    def _grouped_attention(
+        self,
+        query_states: torch.Tensor,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        attention_mask: Optional[torch.Tensor],
+    ) -> torch.Tensor:
+        """
+        Attend each group of query heads to its key/value head without repeating keys and values (see repeat_kv)
+
+        :param query_states: queries of shape [batch, num_heads, q_len, head_dim]
+        :param key_states: keys of shape [batch, num_kv_heads, kv_length, head_dim], same for values
+        :param attention_mask: additive mask of shape [batch, 1, q_len, kv_length] or None
+        :returns: attention output of shape [batch, num_heads, q_len, head_dim]
+        """
+        bsz, _, q_len, _ = query_states.shape
+        query_states = query_states.reshape(bsz, self.num_key_value_heads, self.num_key_value_groups * q_len, -1)
+
+        if self.config._attn_implementation == "sdpa":
+            if attention_mask is not None:
+                attention_mask = attention_mask.unsqueeze(2).expand(-1, -1, self.num_key_value_groups, -1, -1)
+                attention_mask = attention_mask.flatten(2, 3)
+            attn_output = F.scaled_dot_product_attention(
+                query_states, key_states, value_states, attn_mask=attention_mask, dropout_p=0.0
+            )
+        else:
+            attn_weights = torch.matmul(query_states, key_states.transpose(2, 3)) / math.sqrt(self.head_dim)
+            if attention_mask is not None:
+                attn_weights = attn_weights.view(bsz, self.num_key_value_heads, self.num_key_value_groups, q_len, -1)
+                attn_weights = (attn_weights + attention_mask.unsqueeze(2)).flatten(2, 3)
+
+            # upcast attention to fp32
+            attn_weights = nn.functional.softmax(attn_weights, dim=-1, dtype=torch.float32).to(query_states.dtype)
+            attn_output = torch.matmul(attn_weights, value_states)
+        return attn_output.reshape(bsz, self.num_heads, q_len, self.head_dim)
+
 
 class OptimizedLlamaDecoderLayer(LlamaDecoderLayer):
     def __init__(self, config: LlamaConfig):
@@ -137,22 +216,22 @@ class OptimizedLlamaDecoderLayer(LlamaDecoderLayer):
         self.input_layernorm = LlamaRMSNorm(config.hidden_size, eps=config.rms_norm_eps)
         self.post_attention_layernorm = LlamaRMSNorm(config.hidden_size, eps=config.rms_norm_eps)
 
-        self.pre_attn_graph = None
-        self.post_attn_graph = None
+        self.pre_attn_graphs = {}  # one graph per input shape, since sessions may be batched together
+        self.post_attn_graphs = {}
 
     def _optimized_input_layernorm(self, hidden_states):
-        if self.pre_attn_graph is None:
-            self.pre_attn_graph = make_inference_graphed_callable(
+        if hidden_states.shape not in self.pre_attn_graphs:
+            self.pre_attn_graphs[hidden_states.shape] = make_inference_graphed_callable(
                 self.input_layernorm.forward, sample_args=(hidden_states,)
             )
-        return self.pre_attn_graph(hidden_states)
+        return self.pre_attn_graphs[hidden_states.shape](hidden_states)
 
     def _optimized_output_layernorm(self, hidden_states):
-        if self.post_attn_graph is None:
-            self.post_attn_graph = make_inference_graphed_callable(
+        if hidden_states.shape not in self.post_attn_graphs:
+            self.post_attn_graphs[hidden_states.shape] = make_inference_graphed_callable(
                 self.post_attention_layernorm.forward, sample_args=(hidden_states,)
             )
-        return self.post_attn_graph(hidden_states)
+        return self.post_attn_graphs[hidden_states.shape](hidden_states)
 
     def forward(
         self,
@@ -223,6 +302,12 @@ class OptimizedLlamaDecoderLayer(LlamaDecoderLayer):
 
 
 class WrappedLlamaBlock(OptimizedLlamaDecoderLayer):
+    supports_padding_mask = True  # attention_mask may mark padded cache positions of sessions batched together
+    supports_inplace_cache = True  # kv_cache tensors can be updated in-place, see OptimizedLlamaAttention
+    cache_layout = CacheLayout.LLAMA  # layer_past keys and values: [batch * num_kv_heads, length, head_dim]
+    supports_sdpa = True  # --attn_impl sdpa avoids materializing attention logits
+    supports_attention_sinks = True  # cached keys can be moved to other positions, see shift_key_positions
+
     def forward(
         self,
         hidden_states: torch.Tensor,
@@ -231,8 +316,21 @@ class WrappedLlamaBlock(OptimizedLlamaDecoderLayer):
         position_ids: Optional[torch.LongTensor] = None,
         layer_past: Optional[Tuple[torch.Tensor]] = None,
         use_cache: bool = False,
+        kv_cache: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        prefix_length: int = 0,
         **kwargs,
     ) -> Tuple[torch.FloatTensor, Optional[Tuple[torch.FloatTensor, torch.FloatTensor]]]:
+        """
+        :param kv_cache: if specified, preallocated (keys, values) tensors in the backend's layout; new keys/values
+          are written into them in-place at {prefix_length} and no layer_past is returned (use instead of layer_past)
+        :param prefix_length: the number of tokens already stored in kv_cache
+        """
+        if kv_cache is not None:
+            assert layer_past is None and attention_mask is None and position_ids is None
+            return self._forward_with_inplace_cache(
+                hidden_states, *args, kv_cache=kv_cache, prefix_length=prefix_length, **kwargs
+            )
+
         batch_size, seq_length, _ = hidden_states.shape
 
         seq_length_with_past = seq_length
@@ -240,9 +338,9 @@ class WrappedLlamaBlock(OptimizedLlamaDecoderLayer):
 
         past_key_value = layer_past
         if past_key_value is not None:
-            past_key_values_length = past_key_value[0].shape[2]
+            past_key_values_length = past_key_value[0].shape[1]
             seq_length_with_past = seq_length_with_past + past_key_values_length
-            past_key_value = self._reorder_cache_from_bloom_to_llama(past_key_value, batch_size, past_key_values_length)
+            past_key_value = self._unflatten_cache(past_key_value, batch_size, past_key_values_length)
 
         assert position_ids is None
 
@@ -251,6 +349,9 @@ class WrappedLlamaBlock(OptimizedLlamaDecoderLayer):
             attention_mask = torch.ones(
                 (batch_size, seq_length_with_past), dtype=torch.bool, device=hidden_states.device
             )
+        else:
+            # Rows may be padded to a common prefix length, so positions are counted over non-padded tokens only
+            position_ids = (attention_mask.long().cumsum(-1) - 1)[:, -seq_length:]
         attention_mask = _prepare_4d_causal_attention_mask(
             attention_mask=attention_mask,
             input_shape=(batch_size, seq_length),
@@ -270,34 +371,65 @@ class WrappedLlamaBlock(OptimizedLlamaDecoderLayer):
 
         if use_cache:
             present_key_value = outputs[-1]
-            present_key_value = self._reorder_cache_from_llama_to_bloom(
-                present_key_value, batch_size, seq_length_with_past
-            )
+            present_key_value = self._flatten_cache(present_key_value, batch_size, seq_length_with_past)
             outputs = outputs[:-1] + (present_key_value,)
 
         return outputs
 
-    def _reorder_cache_from_bloom_to_llama(
+    def _forward_with_inplace_cache(
+        self,
+        hidden_states: torch.Tensor,
+        *args,
+        kv_cache: Tuple[torch.Tensor, torch.Tensor],
+        prefix_length: int,
+        **kwargs,
+    ) -> Tuple[torch.FloatTensor]:
+        batch_size, seq_length, _ = hidden_states.shape
+        position_ids = torch.arange(
+            prefix_length, prefix_length + seq_length, dtype=torch.long, device=hidden_states.device
+        ).unsqueeze(0)
+
+        attention_mask = None  # a single new token attends to all cached tokens, so it does not need a mask
+        if seq_length > 1:
+            attention_mask = _prepare_4d_causal_attention_mask(
+                attention_mask=torch.ones(
+                    (batch_size, prefix_length + seq_length), dtype=torch.bool, device=hidden_states.device
+                ),
+                input_shape=(batch_size, seq_length),
+                inputs_embeds=hidden_states,
+                past_key_values_length=prefix_length,
+            )
+
+        return super().forward(
+            hidden_states,
+            *args,
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            use_cache=False,
+            kv_cache=kv_cache,
+            prefix_length=prefix_length,
+            **kwargs,
+        )
+
+    def shift_key_positions(self, key_states: torch.Tensor, offset: int) -> torch.Tensor:
+        """Re-rotate keys from the cache (of shape [batch, num_kv_heads, length, head_dim]) by {offset} positions"""
+        return self.self_attn.shift_key_positions(key_states, offset)
+
+    def _unflatten_cache(
         self, key_value: Tuple[torch.Tensor], batch_size: int, seq_length: int
     ) -> Tuple[torch.Tensor]:
-        key_states, value_states = key_value
-        key_states = key_states.permute(0, 2, 1)
-        key_states = key_states.view(
-            batch_size, self.self_attn.num_key_value_heads, seq_length, self.self_attn.head_dim
-        )
-        value_states = value_states.view(*key_states.shape)
-        return (key_states, value_states)
+        """[batch * num_kv_heads, seq_length, head_dim] -> [batch, num_kv_heads, seq_length, head_dim], no copies"""
+        shape = (batch_size, self.self_attn.num_key_value_heads, seq_length, self.self_attn.head_dim)
+        return tuple(state.view(*shape) for state in key_value)
 
-    def _reorder_cache_from_llama_to_bloom(
+    def _flatten_cache(
         self, key_value: Tuple[torch.Tensor], batch_size: int, seq_length: int
     ) -> Tuple[torch.Tensor]:
-        key_states, value_states = key_value
-        value_states = value_states.view(
-            batch_size * self.self_attn.num_key_value_heads, seq_length, self.self_attn.head_dim
-        )
-        key_states = key_states.view(*value_states.shape)
-        key_states = key_states.permute(0, 2, 1)
-        return (key_states, value_states)
+        """[batch, num_kv_heads, seq_length, head_dim] -> [batch * num_kv_heads, seq_length, head_dim]"""
+        shape = (batch_size * self.self_attn.num_key_value_heads, seq_length, self.self_attn.head_dim)
+        # Without a past, new keys/values keep the [batch, seq_length, num_kv_heads] memory order, so they are copied
+        # if batch > 1; otherwise, they are concatenated with the past and need no copies
+        return tuple(state.reshape(*shape) for state in key_value)
 
 
 
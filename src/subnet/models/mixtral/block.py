@@ -1,16 +1,65 @@
-from typing import Optional, Tuple
+from typing import Any, Dict, Optional, Tuple
 
 import torch
 from transformers import MixtralConfig
-from transformers.cache_utils import DynamicCache
+from transformers.cache_utils import Cache, DynamicCache
 from transformers.modeling_attn_mask_utils import (
     _prepare_4d_causal_attention_mask,
     _prepare_4d_causal_attention_mask_for_sdpa,
 )
 from transformers.models.mixtral.modeling_mixtral import MixtralDecoderLayer
 
+from subnet.data_structures import CacheLayout
+
+
+class _InplaceKVCache(Cache):
+    """
+    A transformers Cache over preallocated key/value tensors of a single layer: update() writes new tokens into
+    the tensors in-place and returns views of the filled part, so the cached prefix is never copied
+
+    :param key_cache: keys of shape [batch, num_kv_heads, max_length, head_dim]
+    :param value_cache: values of the same shape as keys
+    :param prefix_length: the number of tokens already stored in the cache
+    """
+
+    def __init__(self, key_cache: torch.Tensor, value_cache: torch.Tensor, prefix_length: int, layer_idx: int):
+        super().__init__()
+        self.key_cache, self.value_cache = key_cache, value_cache
+        self.prefix_length, self.layer_idx = prefix_length, layer_idx
+
+    def update(
+        self,
+        key_states: torch.Tensor,
+        value_states: torch.Tensor,
+        layer_idx: int,
+        cache_kwargs: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        assert layer_idx == self.layer_idx
+        new_length = self.prefix_length + key_states.shape[-2]
+        self.key_cache[:, :, self.prefix_length : new_length, :] = key_states
+        self.value_cache[:, :, self.prefix_length : new_length, :] = value_states
+        return self.key_cache[:, :, :new_length, :], self.value_cache[:, :, :new_length, :]
+
+    def get_seq_length(self, layer_idx: Optional[int] = 0) -> int:
+        return self.prefix_length
+
+    def get_max_length(self) -> Optional[int]:
+        return None
+
+    def __getitem__(self, layer_idx: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        assert layer_idx == self.layer_idx
+        return (
+            self.key_cache[:, :, : self.prefix_length, :],
+            self.value_cache[:, :, : self.prefix_length, :],
+        )
+
 
 class WrappedMixtralBlock(MixtralDecoderLayer):
+    supports_padding_mask = True  # attention_mask may mark padded cache positions of sessions batched together
+    supports_inplace_cache = True  # kv_cache tensors can be updated in-place, see _InplaceKVCache
+    cache_layout = CacheLayout.LLAMA  # layer_past keys and values: [batch * num_kv_heads, length, head_dim]
+    supports_sdpa = True  # --attn_impl sdpa avoids materializing attention logits
+
     def __init__(self, config: MixtralConfig, layer_idx: int):
         super().__init__(config, layer_idx)
 
@@ -25,8 +74,15 @@ class WrappedMixtralBlock(MixtralDecoderLayer):
         attention_mask: Optional[torch.Tensor] = None,
         layer_past: Optional[Tuple[torch.Tensor]] = None,
         use_cache: bool = False,
+        kv_cache: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+        prefix_length: int = 0,
         **kwargs
     ):
+        """
+        :param kv_cache: if specified, preallocated (keys, values) tensors in the backend's layout; new keys/values
+          are written into them in-place at {prefix_length} and no layer_past is returned (use instead of layer_past)
+        :param prefix_length: the number of tokens already stored in kv_cache
+        """
         batch_size, seq_length, _ = hidden_states.shape
 
         seq_length_with_past = seq_length
@@ -34,15 +90,22 @@ class WrappedMixtralBlock(MixtralDecoderLayer):
 
         past_key_value = layer_past
 
-        if past_key_value is not None:
-            past_key_values_length = past_key_value[0].shape[2]
+        if kv_cache is not None:
+            assert layer_past is None and attention_mask is None
+            past_key_values_length = prefix_length
+            seq_length_with_past = seq_length_with_past + past_key_values_length
+            past_key_value = _InplaceKVCache(*kv_cache, prefix_length, self.layer_idx)
+            use_cache = False  # the new keys and values are already in kv_cache
+        elif past_key_value is not None:
+            past_key_values_length = past_key_value[0].shape[1]
             seq_length_with_past = seq_length_with_past + past_key_values_length
-            _past_key_value = self._reorder_cache_from_bloom(past_key_value, batch_size, past_key_values_length)
+            _past_key_value = self._unflatten_cache(past_key_value, batch_size, past_key_values_length)
             past_key_value = DynamicCache()
             past_key_value.key_cache = [torch.empty(0) for _ in range(self.layer_idx)] + [_past_key_value[0]]
             past_key_value.value_cache = [torch.empty(0) for _ in range(self.layer_idx)] + [_past_key_value[1]]
             past_key_value._seen_tokens = past_key_values_length
 
+        padding_mask = attention_mask
         if self._attn_implementation == "flash_attention_2":
             # 2d mask is passed through the layers
             attention_mask = attention_mask if (attention_mask is not None and 0 in attention_mask) else None
@@ -65,10 +128,17 @@ class WrappedMixtralBlock(MixtralDecoderLayer):
                 sliding_window=self.sliding_window,
             )
 
-        position_ids = torch.arange(
-            past_key_values_length, seq_length + past_key_values_length, dtype=torch.long, device=hidden_states.device
-        )
-        position_ids = position_ids.unsqueeze(0).view(-1, seq_length)
+        if padding_mask is not None:
+            # Rows may be padded to a common prefix length, so positions are counted over non-padded tokens only
+            position_ids = (padding_mask.long().cumsum(-1) - 1)[:, -seq_length:]
+        else:
+            position_ids = torch.arange(
+                past_key_values_length,
+                seq_length + past_key_values_length,
+                dtype=torch.long,
+                device=hidden_states.device,
+            )
+            position_ids = position_ids.unsqueeze(0).view(-1, seq_length)
 
         outputs = super().forward(
             hidden_states,
@@ -83,31 +153,19 @@ class WrappedMixtralBlock(MixtralDecoderLayer):
         if use_cache:
             present_key_value = outputs[-1]
             present_key_value = present_key_value[self.layer_idx]
-            present_key_value = self._reorder_cache_to_bloom(present_key_value, batch_size, seq_length_with_past)
+            present_key_value = self._flatten_cache(present_key_value, batch_size, seq_length_with_past)
             outputs = outputs[:-1] + (present_key_value,)
 
         return outputs
 
-    def _reorder_cache_from_bloom(
-        self, key_value: Tuple[torch.Tensor], batch_size: int, seq_length: int
-    ) -> Tuple[torch.Tensor]:
-        # TODO: Move to mixin
-        key_states, value_states = key_value
-        key_states = key_states.permute(0, 2, 1)
-        key_states = key_states.view(
-            batch_size, self.self_attn.num_key_value_heads, seq_length, self.self_attn.head_dim
-        )
-        value_states = value_states.view(*key_states.shape)
-        return (key_states, value_states)
-
-    def _reorder_cache_to_bloom(
-        self, key_value: Tuple[torch.Tensor], batch_size: int, seq_length: int
-    ) -> Tuple[torch.Tensor]:
-        # TODO: Move to mixin
-        key_states, value_states = key_value
-        value_states = value_states.view(
-            batch_size * self.self_attn.num_key_value_heads, seq_length, self.self_attn.head_dim
-        )
-        key_states = key_states.view(*value_states.shape)
-        key_states = key_states.permute(0, 2, 1)
-        return (key_states, value_states)
+    def _unflatten_cache(self, key_value: Tuple[torch.Tensor], batch_size: int, seq_length: int) -> Tuple[torch.Tensor]:
+        """[batch * num_kv_heads, seq_length, head_dim] -> [batch, num_kv_heads, seq_length, head_dim], no copies"""
+        shape = (batch_size, self.self_attn.num_key_value_heads, seq_length, self.self_attn.head_dim)
+        return tuple(state.view(*shape) for state in key_value)
+
+    def _flatten_cache(self, key_value: Tuple[torch.Tensor], batch_size: int, seq_length: int) -> Tuple[torch.Tensor]:
+        """[batch, num_kv_heads, seq_length, head_dim] -> [batch * num_kv_heads, seq_length, head_dim]"""
+        shape = (batch_size * self.self_attn.num_key_value_heads, seq_length, self.self_attn.head_dim)
+        # Without a past, new keys/values keep the [batch, seq_length, num_kv_heads] memory order, so they are copied
+        # if batch > 1; otherwise, they are concatenated with the past and need no copies
+        return tuple(state.reshape(*shape) for state in key_value)
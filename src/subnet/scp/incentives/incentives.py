@@ -1,6 +1,8 @@
 from ast import literal_eval
+import copy
 from functools import partial
 import math
+import threading
 from typing import Any, Dict, List, Optional
 import torch
 
@@ -25,6 +27,7 @@ from subnet.utils.auto_config import AutoDistributedConfig
 
 from subnet.health.config import *
 from subnet.health.health_v2 import fetch_health_state3
+from subnet.health.rps_measurement import measure_peers_concurrently, time_inference_steps
 
 from subnet.substrate.config import SubstrateConfigCustom
 from subnet.substrate.chain_functions import get_epoch_length
@@ -47,6 +50,8 @@ class IncentivesProtocol():
         subnet_id: Optional[int],
         substrate: Optional[SubstrateConfigCustom] = None,
         benchmark_rps: Optional[bool] = False,
+        max_concurrent_measurements: int = 8,
+        peer_timeout: float = 300.0,
         **kwargs
     ):
         super().__init__(**kwargs)
@@ -78,6 +83,8 @@ class IncentivesProtocol():
         self.rpc_url = rpc_url
         self.epoch_length = 0 if self.substrate is None else int(str(get_epoch_length(self.substrate.interface)))
         self.benchmark_rps = benchmark_rps
+        self.max_concurrent_measurements = max_concurrent_measurements
+        self.peer_timeout = peer_timeout
 
         self.dht = hypermind.DHT(
             initial_peers=initial_peers, 
@@ -140,7 +147,8 @@ class IncentivesProtocol():
 
     async def measure_rps(self, state_dict):
         """
-        Measures the inference RPS per peer in subnet
+        Measures the inference RPS per peer in subnet, up to ``max_concurrent_measurements`` peers at a time.
+        Results are stored to the DHT as soon as each peer is measured
         """
         config = AutoDistributedConfig.from_pretrained(
             "Orenguteng/Llama-3.1-8B-Lexi-Uncensored-V2",
@@ -158,35 +166,82 @@ class IncentivesProtocol():
             device = "cpu"
         device = torch.device(device)
 
-        for server in state_dict["model_report"]["server_rows"]:
-            start_block = server["span"].start
-            end_block = server["span"].end
-            peer_id = server["peer_id"]
-            config.allowed_servers = [peer_id]
-
-            blocks = RemoteSequential(
-                config, 
-                dht=self.dht, 
-                start_block=start_block,
-                end_block=end_block,
-                subnet_id=self.subnet_id,
-                identity_path=self.identity_path,
-                rpc=self.rpc_url
+        epoch = self.get_epoch()
+        key = b"".join([b"rps", str(epoch).encode()])  
+        subkey = b"protected_subkey" + self.record_validator.local_public_key
+
+        def _store_times(rps_data: Dict):
+            # The record under our subkey is overwritten with all results so far, so it grows as peers are measured
+            times.append(rps_data)
+            expiration_time = get_dht_time()+10
+            self.dht.run_coroutine(
+                partial(_store_rps, key=key, subkey=subkey, value=list(times), expiration_time=expiration_time),
+                return_future=True,
             )
 
-            blocks_served_ratio = (end_block - start_block) / num_blocks
-            n_steps = 24
-            n_steps = max(n_steps, int(n_steps / blocks_served_ratio))
-            scaling_factor1 = math.pow(blocks_served_ratio, 1-math.sqrt(blocks_served_ratio))
-            scaling_factor = (blocks_served_ratio / scaling_factor1)
-            
-            max_length = 100
-            max_length = max(n_steps, max_length)  
+        server_rows = state_dict["model_report"]["server_rows"]
+        rps_results = await measure_peers_concurrently(
+            server_rows,
+            partial(self.measure_peer, config=config, device=device, num_blocks=num_blocks),
+            max_concurrency=self.max_concurrent_measurements,
+            peer_timeout=self.peer_timeout,
+            on_result=_store_times,
+        )
+        for server, rps_data in zip(server_rows, rps_results):
+            if rps_data is not None:
+                server.update(rps_data)
 
-            warmup_steps = 5
-            n_tokens = 1
+        return state_dict
+
+    def measure_peer(
+        self,
+        server: Dict,
+        cancel_event: threading.Event,
+        *,
+        config,
+        device: torch.device,
+        num_blocks: int,
+    ) -> Optional[Dict]:
+        """
+        Measures the inference RPS of one peer, called in a worker thread by ``measure_peers_concurrently``
 
-            rps_data = await self.measure_inference_steps(
+        Args:
+            server (dict): The peer's row of the model report
+            cancel_event (threading.Event): Set if the measurement should stop after the current step
+            config: Distributed model config, copied to only allow this peer
+            device (torch.device):
+            num_blocks (int): Number of blocks in the model
+        """
+        start_block = server["span"].start
+        end_block = server["span"].end
+        peer_id = server["peer_id"]
+        config = copy.deepcopy(config)  # other peers are measured concurrently with their own allowed_servers
+        config.allowed_servers = [peer_id]
+
+        blocks = RemoteSequential(
+            config, 
+            dht=self.dht, 
+            start_block=start_block,
+            end_block=end_block,
+            subnet_id=self.subnet_id,
+            identity_path=self.identity_path,
+            rpc=self.rpc_url
+        )
+
+        blocks_served_ratio = (end_block - start_block) / num_blocks
+        n_steps = 24
+        n_steps = max(n_steps, int(n_steps / blocks_served_ratio))
+        scaling_factor1 = math.pow(blocks_served_ratio, 1-math.sqrt(blocks_served_ratio))
+        scaling_factor = (blocks_served_ratio / scaling_factor1)
+        
+        max_length = 100
+        max_length = max(n_steps, max_length)  
+
+        warmup_steps = 5
+        n_tokens = 1
+
+        try:
+            return self.measure_inference_steps(
                 blocks, 
                 device,
                 peer_id,
@@ -198,26 +253,13 @@ class IncentivesProtocol():
                 n_steps,
                 warmup_steps,
                 n_tokens,
-                config
+                config,
+                cancel_event=cancel_event,
             )
-            times.append(rps_data)
-
-            if rps_data is not None:
-                server.update(rps_data)
+        finally:
+            blocks.sequence_manager.shutdown()
 
-        epoch = self.get_epoch()
-        key = b"".join([b"rps", str(epoch).encode()])  
-        subkey = b"protected_subkey" + self.record_validator.local_public_key
-
-        expiration_time = get_dht_time()+10
-        self.dht.run_coroutine(
-            partial(_store_rps, key=key, subkey=subkey, value=times, expiration_time=expiration_time),
-            return_future=False,
-        )
-
-        return state_dict
-
-    async def measure_inference_steps(
+    def measure_inference_steps(
         self,
         blocks: RemoteSequential, 
         device: torch.device,
@@ -230,8 +272,9 @@ class IncentivesProtocol():
         n_steps: int,
         warmup_steps: int,
         n_tokens: int,
-        config
-    ) -> List:
+        config,
+        cancel_event: Optional[threading.Event] = None,
+    ) -> Optional[Dict]:
         """
         Measure each nodes RPS using empty tensors and store signed DHTRecord
 
@@ -248,29 +291,19 @@ class IncentivesProtocol():
             warmup_steps (int): Steps to not count in RPS for warming up servers
             n_tokens (int):
             config
+            cancel_event (threading.Event): If set, stop after the current step and return None
         """
         timed_result = None
-        time_steps = []
         device = torch.device(device)
         with torch.inference_mode():
             synchronize(device)
             torch.manual_seed(42)  
             with blocks.inference_session(max_length=max_length) as sess:
-                success = True
-                for _ in range(0, n_steps):
-                    try:
-                        time, outputs = sess.timed_step(torch.empty(1, n_tokens, config.hidden_size), max_retries=0)
-                        if _ >= warmup_steps:
-                            time_steps.append(time)
-                    except hypermind.p2p.p2p_daemon_bindings.utils.P2PHandlerError as e:
-                        logger.warning(f"RPS Exception {e}", exc_info=True)
-                        success = False
-                        break
-                    except Exception as e:
-                        logger.warning(f"RPS Exception {e}", exc_info=True)
-                        success = False
-                        break
-                
+                time_steps = time_inference_steps(
+                    sess, torch.empty(1, n_tokens, config.hidden_size), n_steps, warmup_steps, cancel_event
+                )
+                success = time_steps is not None
+
                 if success:
                     # Compute lower bound to 0 before running IQR
                     Q1 = np.percentile(time_steps, 25)
@@ -0,0 +1,171 @@
+"""
+A cache of intermediate hidden states shared by all ConnectionHandlers of a server, used to skip recomputing them.
+
+By default, rpc_backward runs the forward chain again to get the inputs of each block, so a training step costs the
+forward FLOPs twice. If the client sends an activation_cache_key with rpc_forward, we keep the inputs of every block of
+the span in this cache, and rpc_backward with the same key, inputs, and prompts reuses them instead of recomputing.
+The handler combines the client's key with the client's peer id, so other peers can neither use nor evict the entry.
+
+The client may send rpc_backward to any handler, so the cache lives in shared memory allocated before the handlers are
+forked. The hidden states are written to a ring buffer: new entries overwrite the oldest ones when the buffer is full,
+and entries expire after a TTL, since the client may never send rpc_backward (e.g., it runs inference without grads).
+A miss (unknown, expired, evicted, or mismatching entry) is not an error: rpc_backward just recomputes the forward.
+"""
+import ctypes
+import functools
+import hashlib
+import math
+import multiprocessing as mp
+import time
+from typing import Dict, List, Optional, Sequence
+
+import torch
+from hypermind.utils.logging import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_TTL = 60.0  # seconds between rpc_forward and rpc_backward of a training step
+DEFAULT_MAX_ENTRIES = 1024
+ALIGNMENT = 64  # bytes, enough to view any region of the buffer as a tensor of any dtype
+_EMPTY = 0
+_DTYPES = (torch.float32, torch.float16, torch.bfloat16)
+_OFFSET, _NUM_TENSORS, _DTYPE, _SHAPE, _PROMPTS_HASH = 0, 1, 2, slice(3, 6), 6  # columns of ActivationCache._entries
+
+
+class ActivationCache:
+    """
+    Keeps the inputs of the blocks of recent rpc_forward requests for rpc_backward, can be used by any process
+
+    :param max_size_bytes: the size of the shared buffer that holds hidden states, in bytes
+    :param ttl: entries expire this many seconds after they were stored
+    :param max_entries: the maximum number of entries stored at the same time
+    """
+
+    def __init__(self, max_size_bytes: int, ttl: float = DEFAULT_TTL, max_entries: int = DEFAULT_MAX_ENTRIES):
+        assert max_size_bytes > 0 and ttl > 0 and max_entries > 0, "cache size, ttl, and max_entries must be positive"
+        self.max_size_bytes, self.ttl, self.max_entries = _align(max_size_bytes), ttl, max_entries
+        self.buffer = torch.empty(self.max_size_bytes, dtype=torch.uint8).share_memory_()
+        self._keys = torch.full((max_entries,), _EMPTY, dtype=torch.int64).share_memory_()
+        self._entries = torch.zeros(max_entries, 7, dtype=torch.int64).share_memory_()
+        self._expiration_times = torch.zeros(max_entries, dtype=torch.float64).share_memory_()
+        self._head = mp.Value(ctypes.c_int64, 0, lock=False)  # the buffer offset where the next entry is written
+        self._num_hits = mp.Value(ctypes.c_int64, 0, lock=False)
+        self._num_misses = mp.Value(ctypes.c_int64, 0, lock=False)
+        self._lock = mp.Lock()
+
+    def store(self, key: str, tensors: Sequence[torch.Tensor], prompts: Optional[torch.Tensor] = None) -> bool:
+        """
+        Save copies of hidden states for a future pop(key, ...), return False if they do not fit into the cache
+
+        :param tensors: the inputs of the blocks of a span, tensors of the same shape [batch_size, seq_length, hid_size]
+        :param prompts: the prompts that were added to these inputs, pop() returns them only for the same prompts
+        """
+        shape, dtype = tensors[0].shape, tensors[0].dtype
+        if dtype not in _DTYPES or any(tensor.shape != shape or tensor.dtype != dtype for tensor in tensors):
+            return False
+        tensor_size = _align(tensors[0].numel() * tensors[0].element_size())
+        if tensor_size * len(tensors) > self.max_size_bytes:
+            return False
+
+        hashed_key = _hash_key(key)
+        with self._lock:
+            offset = self._head.value
+            if offset + tensor_size * len(tensors) > self.max_size_bytes:
+                offset = 0
+            end = offset + tensor_size * len(tensors)
+            entry_ends = self._entries[:, _OFFSET] + self._entries[:, _NUM_TENSORS] * self._get_tensor_sizes()
+            overlaps = (self._entries[:, _OFFSET] < end) & (entry_ends > offset)
+            self._keys[overlaps | (self._keys == hashed_key) | (self._expiration_times < time.monotonic())] = _EMPTY
+
+            free_indices = (self._keys == _EMPTY).nonzero()
+            if len(free_indices) > 0:
+                index = free_indices[0].item()
+            else:
+                index = self._expiration_times.argmin().item()  # all entries have the same TTL, so it is the oldest
+
+            for i, tensor in enumerate(tensors):
+                self._view(offset + i * tensor_size, shape, dtype).copy_(tensor)
+            self._entries[index, _OFFSET] = offset
+            self._entries[index, _NUM_TENSORS] = len(tensors)
+            self._entries[index, _DTYPE] = _DTYPES.index(dtype)
+            self._entries[index, _SHAPE] = torch.tensor(shape)
+            self._entries[index, _PROMPTS_HASH] = _hash_prompts(prompts)
+            self._expiration_times[index] = time.monotonic() + self.ttl
+            self._keys[index] = hashed_key
+            self._head.value = end
+        return True
+
+    def pop(
+        self, key: str, first_inputs: torch.Tensor, prompts: Optional[torch.Tensor] = None
+    ) -> Optional[List[torch.Tensor]]:
+        """
+        Take the hidden states stored with this key out of the cache and return their copies
+
+        :param first_inputs: the inputs of the first block, the stored hidden states are only returned if they begin
+          with the same tensor and were computed with the same prompts (otherwise, the key was reused for other
+          inputs, and the entry stays in the cache until it expires)
+        :returns: the tensors passed to store(), or None if the entry is missing, expired, evicted, or does not match
+        """
+        hashed_key, prompts_hash = _hash_key(key), _hash_prompts(prompts)
+        with self._lock:
+            tensors = None
+            indices = (self._keys == hashed_key).nonzero().flatten().tolist()
+            if indices and self._expiration_times[indices[0]].item() >= time.monotonic():
+                index = indices[0]
+                offset, num_tensors, dtype_index, *shape, entry_prompts_hash = self._entries[index].tolist()
+                shape, dtype = tuple(shape), _DTYPES[dtype_index]
+                tensor_size = _align(_get_nbytes(shape, dtype))
+                views = [self._view(offset + i * tensor_size, shape, dtype) for i in range(num_tensors)]
+                if entry_prompts_hash == prompts_hash and views[0].shape == first_inputs.shape:
+                    if views[0].dtype == first_inputs.dtype and torch.equal(views[0], first_inputs):
+                        tensors = [view.clone() for view in views]
+                        self._keys[index] = _EMPTY
+
+            if tensors is not None:
+                self._num_hits.value += 1
+            else:
+                self._num_misses.value += 1
+            return tensors
+
+    def get_stats(self) -> Dict[str, float]:
+        """Return the number of rpc_backward requests that reused (hits) or recomputed (misses) the forward pass"""
+        num_hits, num_misses = self._num_hits.value, self._num_misses.value
+        return dict(
+            activation_cache_hits=num_hits,
+            activation_cache_misses=num_misses,
+            activation_cache_hit_rate=num_hits / max(num_hits + num_misses, 1),
+        )
+
+    def _get_tensor_sizes(self) -> torch.Tensor:
+        element_sizes = torch.tensor([_get_element_size(dtype) for dtype in _DTYPES])[self._entries[:, _DTYPE]]
+        nbytes = self._entries[:, _SHAPE].prod(dim=1) * element_sizes
+        return -(-nbytes // ALIGNMENT) * ALIGNMENT
+
+    def _view(self, offset: int, shape: Sequence[int], dtype: torch.dtype) -> torch.Tensor:
+        return self.buffer[offset : offset + _get_nbytes(shape, dtype)].view(dtype).view(shape)
+
+
+def _hash_key(key: str) -> int:
+    hashed_key = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little", signed=True)
+    return hashed_key if hashed_key != _EMPTY else 1
+
+
+def _hash_prompts(prompts: Optional[torch.Tensor]) -> int:
+    if prompts is None or prompts.numel() == 0:  # no prompts or DUMMY
+        return _EMPTY
+    prompts_hash = hashlib.blake2b(f"{tuple(prompts.shape)} {prompts.dtype}".encode(), digest_size=8)
+    prompts_hash.update(prompts.detach().cpu().contiguous().view(torch.uint8).numpy().tobytes())
+    return int.from_bytes(prompts_hash.digest(), "little", signed=True)
+
+
+def _align(num_bytes: int) -> int:
+    return -(-num_bytes // ALIGNMENT) * ALIGNMENT
+
+
+def _get_nbytes(shape: Sequence[int], dtype: torch.dtype) -> int:
+    return math.prod(shape) * _get_element_size(dtype)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_element_size(dtype: torch.dtype) -> int:
+    return torch.empty((), dtype=dtype).element_size()
@@ -1,10 +1,12 @@
 from __future__ import annotations
 
+import dataclasses
 from collections import Counter
 from itertools import chain
-from typing import Any, Dict, Optional, Sequence, Tuple, Union
+from typing import Any, Dict, Hashable, List, Optional, Sequence, Tuple, Union
 
 import torch
+import torch.nn.functional as F
 from hypermind import BatchTensorDescriptor, TensorDescriptor
 from hypermind.moe.expert_uid import ExpertUID
 from hypermind.moe.server.module_backend import ModuleBackend
@@ -13,16 +15,26 @@ from tensor_parallel import TensorParallel
 from tensor_parallel.tensor_parallel import PerDeviceTensors
 from transformers import PretrainedConfig
 
-from subnet.data_structures import InferenceMetadata
+from subnet.data_structures import CacheLayout, InferenceMetadata
 from subnet.server.memory_cache import MemoryCache
-from subnet.server.task_pool import PrioritizedTaskPool
+from subnet.server.task_pool import PrioritizedTaskPool, Task, is_current_batch_cancelled
+from subnet.utils.kv_quantization import dequantize_kv, quantize_kv
 from subnet.utils.misc import get_size_in_bytes, is_dummy
 
 logger = get_logger(__name__)
 
 
 class TransformerBackend(ModuleBackend):
-    """A wrapper for a transformer block that can process requests for forward, backward and inference"""
+    """
+    A wrapper for a transformer block that can process requests for forward, backward and inference
+
+    :param kv_cache_dtype: if torch.int8, store attention caches in int8 with a scale per head and token
+      (see subnet/utils/kv_quantization.py); None (default) stores them in backend_dtype
+    :param max_coalesced_tasks: if greater than 1, forward (or backward) tasks with the same adapter and similar
+      lengths are padded and processed as one batch, up to this many tasks and max_batch_size tokens
+    :param coalescing_window: wait up to this many seconds after a forward/backward task was submitted
+      for other tasks to process it with (see PrioritizedTaskPool.max_batch_wait)
+    """
 
     _peft_module = None
 
@@ -33,6 +45,9 @@ class TransformerBackend(ModuleBackend):
         memory_cache: MemoryCache,
         backend_dtype: torch.dtype,
         max_chunk_size_bytes: int,
+        kv_cache_dtype: Optional[torch.dtype] = None,
+        max_coalesced_tasks: int = 1,
+        coalescing_window: float = 0.0,
         **kwargs,
     ):
         import subnet.utils.peft as _peft_module
@@ -55,15 +70,52 @@ class TransformerBackend(ModuleBackend):
         self.inference_pool = PrioritizedTaskPool(
             self.inference_step, max_batch_size=max_batch_size, device=device, name=f"{self.name}_inference"
         )  # note: inference_pools may be merged later, see merge_inference_pools_inplace
+        coalescing_kwargs = {}
+        if max_coalesced_tasks > 1:
+            coalescing_kwargs = dict(
+                max_tasks_per_batch=max_coalesced_tasks,
+                get_task_group=get_coalescing_group,
+                max_batch_wait=coalescing_window,
+            )
         self.forward_pool = PrioritizedTaskPool(
-            self.forward, max_batch_size=max_batch_size, device=device, name=f"{self.name}_forward"
+            self.forward_coalesced if max_coalesced_tasks > 1 else self.forward,
+            max_batch_size=max_batch_size,
+            device=device,
+            name=f"{self.name}_forward",
+            **coalescing_kwargs,
         )
         self.backward_pool = PrioritizedTaskPool(
-            self.backward, max_batch_size=max_batch_size, device=device, name=f"{self.name}_backward"
+            self.backward_coalesced if max_coalesced_tasks > 1 else self.backward,
+            max_batch_size=max_batch_size,
+            device=device,
+            name=f"{self.name}_backward",
+            **coalescing_kwargs,
         )
 
         self.dtype = backend_dtype
         self.dtype_bytes = get_size_in_bytes(self.dtype)
+        assert kv_cache_dtype in (None, torch.int8), f"Unsupported kv_cache_dtype: {kv_cache_dtype}"
+        # Quantized caches are followed by their scales: [keys, values, ..., key_scales, value_scales, ...]
+        self.is_cache_quantized = kv_cache_dtype == torch.int8
+        # Blocks that understand padding masks can be batched across sessions with different prefix lengths
+        self.supports_padded_batching = getattr(config.block_class, "supports_padding_mask", False)
+        # Blocks that support kv_cache= append new keys/values to the cache tensors themselves (single-device only)
+        self.supports_inplace_cache = (
+            len(self.module.module_shards) == 1
+            and getattr(config.block_class, "supports_inplace_cache", False)
+            and not self.is_cache_quantized
+        )
+        # Blocks that support --attn_impl sdpa do not materialize attention logits (unless they use ALiBi), as long as
+        # SDPA picks a memory-efficient kernel. We forbid the math kernel and stop relying on SDPA if that fails
+        self.uses_sdpa = (
+            config._attn_implementation == "sdpa"
+            and getattr(config.block_class, "supports_sdpa", False)
+            and not getattr(config, "alibi", False)
+        )
+        # Blocks that can move cached keys to other positions support sliding-window sessions with attention sinks
+        self.supports_attention_sinks = getattr(config.block_class, "supports_attention_sinks", False)
+        # Keys are stored in the layout that the block's attention consumes, so they need not be permuted every step
+        self.cache_layout = getattr(config.block_class, "cache_layout", CacheLayout.BLOOM)
         self.shard_num_heads = []
         for shard in self.module.module_shards:
             for submodule in shard.modules():
@@ -88,15 +140,24 @@ class TransformerBackend(ModuleBackend):
     def get_inference_cache_descriptors(self, batch_size: int, max_length: int) -> Sequence[TensorDescriptor]:
         """Create tensor descriptors for attention cache tensors used during inference_step"""
         head_dim = self.config.hidden_size // self.config.num_attention_heads
-        cache_tensors = []
+        cache_dtype = torch.int8 if self.is_cache_quantized else self.dtype
+        cache_tensors, cache_scales = [], []
         for device, num_heads in zip(self.module.devices, self.shard_num_heads):
             num_heads //= self.config.num_key_value_groups
             if hasattr(self.config, "num_key_value_heads"):
                 num_heads = self.config.num_key_value_heads
-            keys = TensorDescriptor((batch_size, num_heads, head_dim, max_length), dtype=self.dtype, device=device)
-            values = TensorDescriptor((batch_size, num_heads, max_length, head_dim), dtype=self.dtype, device=device)
+            values = TensorDescriptor((batch_size, num_heads, max_length, head_dim), dtype=cache_dtype, device=device)
+            if self.cache_layout == CacheLayout.BLOOM:
+                keys = TensorDescriptor((batch_size, num_heads, head_dim, max_length), dtype=cache_dtype, device=device)
+            else:
+                keys = TensorDescriptor(values.shape, dtype=cache_dtype, device=device)
             cache_tensors.extend((keys, values))
-        return cache_tensors
+            if self.is_cache_quantized:
+                for i, descr in enumerate((keys, values)):
+                    scales_shape = list(descr.shape)
+                    scales_shape[self._get_head_dim_index(i)] = 1
+                    cache_scales.append(TensorDescriptor(tuple(scales_shape), dtype=self.dtype, device=device))
+        return cache_tensors + cache_scales
 
     def forward(self, *inputs: Union[torch.Tensor, str]) -> Tuple[torch.Tensor, ...]:
         *inputs, active_adapter = inputs
@@ -108,6 +169,19 @@ class TransformerBackend(ModuleBackend):
         with self._peft_module.using_adapter(active_adapter):
             return super().backward(*inputs)
 
+    def forward_coalesced(self, *task_args: Sequence[Any]) -> Tuple[torch.Tensor, ...]:
+        """Run forward for several tasks from get_coalescing_group as one batch, return the outputs of each task"""
+        hidden_states = [inputs for inputs, _active_adapter in task_args]
+        (outputs,) = self.forward(_concat_padded(hidden_states), task_args[0][-1])
+        return _split_padded(outputs, hidden_states)
+
+    def backward_coalesced(self, *task_args: Sequence[Any]) -> Tuple[torch.Tensor, ...]:
+        """Run backward for several tasks from get_coalescing_group as one batch, return the gradients of each task"""
+        inputs = [task_inputs for task_inputs, _grad_outputs, _active_adapter in task_args]
+        grad_outputs = _concat_padded([task_grad_outputs for _inputs, task_grad_outputs, _ in task_args])
+        (grad_inputs,) = self.backward(_concat_padded(inputs), grad_outputs, task_args[0][-1])
+        return _split_padded(grad_inputs, inputs)
+
     @torch.inference_mode()
     def inference_step(
         self,
@@ -116,69 +190,328 @@ class TransformerBackend(ModuleBackend):
         inference_info: InferenceMetadata,
     ) -> Tuple[torch.Tensor, ...]:
         assert hidden_states.ndim == 3, "expected hidden states to be 3-dimensional: [batch_size, seq_len, hid_size]"
-        seq_len = hidden_states.shape[1]
-
         with self.memory_cache.use_cache(
             *inference_info.cache_handles
         ) as cache_tensors, self._peft_module.using_adapter(inference_info.active_adapter):
-            self._reorder_cache_inplace(cache_tensors, hypo_ids)
-
-            # We chunk the inputs so that peak memory for long sequences fits into `autograd_memory`
-            # reserved in `Server._choose_num_blocks()`. This saves us from OOMs if `max_chunk_size_bytes`
-            # is at least 4-6x less than `autograd_memory`.
-            max_chunk_length = self._estimate_max_chunk_length(hidden_states, inference_info)
-            output_hidden_states = torch.empty_like(hidden_states) if seq_len > max_chunk_length else None
+            self._reorder_cache_inplace(
+                cache_tensors, hypo_ids, inference_info.prefix_length + inference_info.num_evicted
+            )
+            if inference_info.num_evicted:
+                self._evict_tokens(cache_tensors, inference_info)
+            if inference_info.prefix_keys:
+                return (self._forward_with_prefix_cache(hidden_states, cache_tensors, inference_info),)
+            return (self._forward_with_cache(hidden_states, cache_tensors, inference_info),)
+
+    def _forward_with_cache(
+        self, hidden_states: torch.Tensor, cache_tensors: Sequence[torch.Tensor], inference_info: InferenceMetadata
+    ) -> torch.Tensor:
+        """Run the block on new tokens, attending to {inference_info.prefix_length} cached tokens and adding new ones"""
+        # We chunk the inputs so that peak memory for long sequences fits into `autograd_memory`
+        # reserved in `Server._choose_num_blocks()`. This saves us from OOMs if `max_chunk_size_bytes`
+        # is at least 4-6x less than `autograd_memory`.
+        max_chunk_length = self._estimate_max_chunk_length(hidden_states, inference_info)
+        if not self._relies_on_efficient_sdpa(hidden_states):
+            return self._forward_in_chunks(hidden_states, cache_tensors, inference_info, max_chunk_length)
+
+        try:
+            # The chunks are only small enough if SDPA doesn't fall back to the math kernel (e.g., due to the mask)
+            with torch.backends.cuda.sdp_kernel(enable_math=False):
+                return self._forward_in_chunks(hidden_states, cache_tensors, inference_info, max_chunk_length)
+        except RuntimeError as e:
+            if "No available kernel" not in str(e):
+                raise
+            logger.warning(f"{self.name} can't use memory-efficient attention, falling back to smaller chunks: {e}")
+            self.uses_sdpa = False
+        # The failed attempt could only write the keys/values of these tokens to the cache, so running it again is safe
+        return self._forward_with_cache(hidden_states, cache_tensors, inference_info)
+
+    def _forward_in_chunks(
+        self,
+        hidden_states: torch.Tensor,
+        cache_tensors: Sequence[torch.Tensor],
+        inference_info: InferenceMetadata,
+        max_chunk_length: int,
+    ) -> torch.Tensor:
+        seq_len = hidden_states.shape[1]
+        output_hidden_states = torch.empty_like(hidden_states) if seq_len > max_chunk_length else None
+        if not self.supports_inplace_cache:
             layer_past = self._select_layer_past(cache_tensors, inference_info.prefix_length)
-            for offset in range(0, seq_len, max_chunk_length):
-                hidden_states_chunk = hidden_states[:, offset : offset + max_chunk_length, :]
+        for offset in range(0, seq_len, max_chunk_length):
+            hidden_states_chunk = hidden_states[:, offset : offset + max_chunk_length, :]
+            if self.supports_inplace_cache:
+                # The block writes new keys/values into cache_tensors and attends to them without copying
+                (output_hidden_states_chunk,) = self.module.forward(
+                    hidden_states_chunk,
+                    kv_cache=tuple(cache_tensors),
+                    prefix_length=inference_info.prefix_length + offset,
+                )
+            else:
                 output_hidden_states_chunk, new_kvs = self.module.forward(
                     hidden_states_chunk, layer_past=layer_past, use_cache=True
                 )
-                if seq_len > max_chunk_length:
-                    output_hidden_states[:, offset : offset + max_chunk_length] = output_hidden_states_chunk
-                else:
-                    output_hidden_states = output_hidden_states_chunk  # saves one memcopy
                 layer_past = new_kvs
+            if seq_len > max_chunk_length:
+                output_hidden_states[:, offset : offset + max_chunk_length] = output_hidden_states_chunk
+            else:
+                output_hidden_states = output_hidden_states_chunk  # saves one memcopy
 
+        if not self.supports_inplace_cache:
             self._update_cache_inplace(cache_tensors, new_kvs, inference_info.prefix_length)
+        return output_hidden_states
+
+    def _forward_with_prefix_cache(
+        self, hidden_states: torch.Tensor, cache_tensors: Sequence[torch.Tensor], inference_info: InferenceMetadata
+    ) -> torch.Tensor:
+        """Reuse the longest chain of cached prefix pages, compute the remaining tokens and cache their full pages"""
+        assert inference_info.prefix_length == 0, "prefix pages can only be reused at the start of a session"
+        prefix_cache, page_size = self.memory_cache.prefix_cache, self.memory_cache.page_size
+
+        pages = prefix_cache.lookup(inference_info.prefix_keys)
+        for page_index, page in enumerate(pages):
+            # Cached pages are shared between sessions, so we copy them into the session's own cache
+            start, end = page_index * page_size, (page_index + 1) * page_size
+            for i, (cache_tensor, page_tensor) in enumerate(zip(cache_tensors, page.cache_tensors)):
+                self._select_tokens(i, cache_tensor, start, end).copy_(page_tensor)
+        outputs = [page.outputs for page in pages]
+
+        num_reused_tokens = len(pages) * page_size
+        if num_reused_tokens < hidden_states.shape[1]:
+            remaining_inputs = hidden_states[:, num_reused_tokens:]
+            remaining_info = dataclasses.replace(inference_info, prefix_length=num_reused_tokens)
+            outputs.append(self._forward_with_cache(remaining_inputs, cache_tensors, remaining_info))
+        output_hidden_states = torch.cat(outputs, dim=1)  # note: this also copies the outputs of cached pages
+
+        for page_index in range(len(pages), len(inference_info.prefix_keys)):
+            start, end = page_index * page_size, (page_index + 1) * page_size
+            page_tensors = [self._select_tokens(i, tensor, start, end) for i, tensor in enumerate(cache_tensors)]
+            page_key, page_outputs = inference_info.prefix_keys[page_index], output_hidden_states[:, start:end]
+            if not prefix_cache.store(page_key, page_tensors, page_outputs):
+                break  # pages after this one could not be found since lookup() needs the entire chain
+        return output_hidden_states
+
+    @torch.inference_mode()
+    def batched_inference_step(
+        self,
+        hidden_states: torch.Tensor,
+        hypo_ids: Sequence[torch.LongTensor],
+        inference_infos: Sequence[InferenceMetadata],
+    ) -> Tuple[torch.Tensor, ...]:
+        """
+        Run one inference step for several sessions in a single forward pass. The sessions' caches are gathered into
+        a batch padded to the longest prefix; if prefix lengths differ, the padding is excluded with an attention mask.
+
+        :param hidden_states: inputs of all sessions concatenated along the batch dimension
+        :param hypo_ids: beam search hypothesis ids for each session (or dummy tensors)
+        :param inference_infos: metadata for each session, in the same order as in hidden_states
+        :note: this method does not chunk inputs, it is meant for short inference steps only
+        :note: this method does not use the prefix cache, so steps with prefix_keys are never batched together
+        """
+        assert hidden_states.ndim == 3, "expected hidden states to be 3-dimensional: [batch_size, seq_len, hid_size]"
+        assert len(hypo_ids) == len(inference_infos)
+        assert not any(info.prefix_keys for info in inference_infos), "steps with prefix_keys must run alone"
+        seq_len = hidden_states.shape[1]
+        all_handles = tuple(chain.from_iterable(info.cache_handles for info in inference_infos))
+        prefix_lengths = [info.prefix_length for info in inference_infos]
+        if not self.supports_padded_batching:
+            assert len(set(prefix_lengths)) == 1, f"{type(self.module)} requires equal prefix lengths to batch sessions"
+
+        with self.memory_cache.use_cache(*all_handles) as all_cache_tensors, self._peft_module.using_adapter(
+            inference_infos[0].active_adapter
+        ):
+            session_caches, offset = [], 0
+            for info, session_hypo_ids in zip(inference_infos, hypo_ids):
+                cache_tensors = all_cache_tensors[offset : offset + len(info.cache_handles)]
+                offset += len(info.cache_handles)
+                self._reorder_cache_inplace(cache_tensors, session_hypo_ids, info.prefix_length + info.num_evicted)
+                if info.num_evicted:
+                    self._evict_tokens(cache_tensors, info)
+                session_caches.append(cache_tensors)
+
+            layer_past = self._gather_layer_past(session_caches, prefix_lengths)
+            attention_mask = None
+            if len(set(prefix_lengths)) > 1:
+                batch_sizes = [cache_tensors[0].shape[0] for cache_tensors in session_caches]
+                attention_mask = self._make_padding_mask(batch_sizes, prefix_lengths, seq_len, hidden_states.device)
+            output_hidden_states, new_kvs = self.module.forward(
+                hidden_states, layer_past=layer_past, attention_mask=attention_mask, use_cache=True
+            )
+            self._scatter_new_kvs(session_caches, new_kvs, prefix_lengths, seq_len)
             return (output_hidden_states,)
 
+    def _gather_layer_past(
+        self, session_caches: Sequence[Sequence[torch.Tensor]], prefix_lengths: Sequence[int]
+    ) -> Sequence[torch.Tensor]:
+        """Stack the first {prefix_length} tokens of each session's cache into one batch, right-padded with zeros"""
+        max_prefix_length = max(prefix_lengths)
+        if self.is_cache_quantized:
+            session_caches = [self._dequantize_cache(c, length) for c, length in zip(session_caches, prefix_lengths)]
+        layer_past = []
+        for i in range(len(session_caches[0])):
+            is_transposed = self._is_transposed_key(i)
+            parts = []
+            for cache_tensors, prefix_length in zip(session_caches, prefix_lengths):
+                part = cache_tensors[i].flatten(0, 1)
+                part = part[:, :, :prefix_length] if is_transposed else part[:, :prefix_length]
+                num_padded = max_prefix_length - prefix_length
+                if num_padded > 0:
+                    part = torch.nn.functional.pad(part, (0, num_padded) if is_transposed else (0, 0, 0, num_padded))
+                parts.append(part)
+            layer_past.append(torch.cat(parts, dim=0))
+            # BLOOM keys: [total_batch * num_kv_heads, head_dim, kv_length], others: [..., kv_length, head_dim]
+        return PerDeviceTensors(*layer_past) if len(self.module.module_shards) > 1 else tuple(layer_past)
+
+    @staticmethod
+    def _make_padding_mask(
+        batch_sizes: Sequence[int], prefix_lengths: Sequence[int], seq_len: int, device: torch.device
+    ) -> torch.Tensor:
+        """Create a [total_batch, max_prefix_length + seq_len] mask that is False for padded cache positions"""
+        max_prefix_length = max(prefix_lengths)
+        attention_mask = torch.ones(sum(batch_sizes), max_prefix_length + seq_len, dtype=torch.bool, device=device)
+        row = 0
+        for batch_size, prefix_length in zip(batch_sizes, prefix_lengths):
+            attention_mask[row : row + batch_size, prefix_length:max_prefix_length] = False
+            row += batch_size
+        return attention_mask
+
+    def _scatter_new_kvs(
+        self,
+        session_caches: Sequence[Sequence[torch.Tensor]],
+        new_kvs: Sequence[torch.Tensor],
+        prefix_lengths: Sequence[int],
+        seq_len: int,
+    ):
+        """Write the keys/values of the new tokens back into each session's cache, works in-place"""
+        max_prefix_length = max(prefix_lengths)
+        new_positions = slice(max_prefix_length, max_prefix_length + seq_len)
+        for i, new_kv in enumerate(new_kvs):
+            is_transposed = self._is_transposed_key(i)
+            row = 0
+            for cache_tensors, prefix_length in zip(session_caches, prefix_lengths):
+                cache_tensor = cache_tensors[i]
+                num_rows = cache_tensor.shape[0] * cache_tensor.shape[1]
+                session_kv = new_kv[row : row + num_rows]
+                row += num_rows
+                if is_transposed:
+                    session_kv = session_kv[:, :, new_positions].view(*cache_tensor.shape[:3], seq_len)
+                else:
+                    session_kv = session_kv[:, new_positions].view(*cache_tensor.shape[:2], seq_len, -1)
+                self._write_tokens(i, cache_tensors, session_kv, prefix_length)
+
     def _estimate_max_chunk_length(self, hidden_states: torch.Tensor, inference_info: InferenceMetadata) -> int:
         # We assume that attention logit matrices are the main thing that consumes memory, given that
         # the model uses multi-query attention
         batch_size, seq_length, hidden_size = hidden_states.shape
         worst_case_length = inference_info.prefix_length + seq_length
-        attn_bytes_per_token = max(self.shard_num_heads) * batch_size * self.dtype_bytes * worst_case_length
+        if self._relies_on_efficient_sdpa(hidden_states):
+            # Memory-efficient SDPA kernels do not materialize attention logits, so the largest tensor is the additive
+            # attention mask. It is shared by all heads, but is expanded to each group of query heads (if any)
+            attn_bytes_per_token = self.config.num_key_value_groups * batch_size * self.dtype_bytes * worst_case_length
+        else:
+            attn_bytes_per_token = max(self.shard_num_heads) * batch_size * self.dtype_bytes * worst_case_length
         return max(1, self.max_chunk_size_bytes // attn_bytes_per_token)
 
-    def _reorder_cache_inplace(self, cache_tensors: torch.Tensor, hypo_ids: torch.Tensor):
-        """If hypo_ids is specified, reorder elements of each cache tensor in-place by taking indices from hypo_ids"""
-        if not is_dummy(hypo_ids):
-            for cache_tensor in cache_tensors:
-                cache_tensor[...] = cache_tensor[hypo_ids.to(cache_tensor.device)]  # in-place reorder cache by hypo ids
+    def _relies_on_efficient_sdpa(self, hidden_states: torch.Tensor) -> bool:
+        return self.uses_sdpa and hidden_states.device.type == "cuda"
+
+    def _reorder_cache_inplace(self, cache_tensors: Sequence[torch.Tensor], hypo_ids: torch.Tensor, length: int):
+        """
+        If hypo_ids is specified, reorder elements of each cache tensor in-place by taking indices from hypo_ids.
+        We only copy the first {length} tokens (the rest of the cache is not filled yet) of the rows that take
+        another row's hypothesis, so a beam search step costs O(prefix) instead of O(max_length) copies.
+        """
+        if is_dummy(hypo_ids) or length == 0:
+            return
+        changed_rows = torch.nonzero(hypo_ids != torch.arange(len(hypo_ids), device=hypo_ids.device)).flatten()
+        if len(changed_rows) == 0:
+            return  # every hypothesis stays in its row, e.g. when beams do not diverge
+        source_rows = hypo_ids[changed_rows]
+        for i, cache_tensor in enumerate(cache_tensors):
+            prefix = self._select_tokens(i, cache_tensor, 0, length)
+            target, source = changed_rows.to(cache_tensor.device), source_rows.to(cache_tensor.device)
+            prefix[target] = prefix[source]  # the right-hand side is a copy, so rows may be sources and targets
+
+    def _evict_tokens(self, cache_tensors: Sequence[torch.Tensor], inference_info: InferenceMetadata):
+        """
+        Drop {num_evicted} tokens that follow the first {attention_sinks} tokens of the cache and move the remaining
+        tokens to their place, works in-place. Moved keys are re-rotated, as if they were computed at new positions.
+        """
+        assert self.supports_attention_sinks, f"{type(self.module)} does not support sliding-window sessions"
+        start, num_evicted = inference_info.attention_sinks, inference_info.num_evicted
+        end = inference_info.prefix_length + num_evicted
+        num_tensors = len(cache_tensors) // 2 if self.is_cache_quantized else len(cache_tensors)
+        for i in range(num_tensors):
+            kept = self._select_tokens(i, cache_tensors[i], start + num_evicted, end)
+            if self.is_cache_quantized:
+                scales = self._select_tokens(i, cache_tensors[num_tensors + i], start + num_evicted, end)
+                kept = dequantize_kv(kept, scales, self.dtype)
+            else:
+                kept = kept.clone()  # the kept tokens may overlap with the positions they are moved to
+            if i % 2 == 0:  # keys and values alternate, shard i // 2 owns both
+                kept = self.module.module_shards[i // 2].shift_key_positions(kept, -num_evicted)
+            self._write_tokens(i, cache_tensors, kept, start)
 
     def _select_layer_past(self, cache_tensors: Sequence[torch.Tensor], prefix_length: int) -> Sequence[torch.Tensor]:
         """Extract first {prefix_length} tokens and reshape them such that they can be used as layer_past"""
-        key_cache, value_cache = list(cache_tensors[0::2]), list(cache_tensors[1::2])
-        for i in range(len(key_cache)):
-            key_cache[i] = key_cache[i].flatten(0, 1)[:, :, :prefix_length]
-            # shape: [batch * num_kv_heads, head_dim, kv_length]
-            value_cache[i] = value_cache[i].flatten(0, 1)[:, :prefix_length]
-            # shape: [batch * num_kv_heads, kv_length, head_dim]
-        layer_past = tuple(chain(*zip(key_cache, value_cache)))
-        return PerDeviceTensors(*layer_past) if len(self.module.module_shards) > 1 else layer_past
+        if self.is_cache_quantized:
+            cache_tensors = self._dequantize_cache(cache_tensors, prefix_length)
+        layer_past = []
+        for i, cache_tensor in enumerate(cache_tensors):
+            if self._is_transposed_key(i):
+                layer_past.append(cache_tensor.flatten(0, 1)[:, :, :prefix_length])
+                # shape: [batch * num_kv_heads, head_dim, kv_length]
+            else:
+                layer_past.append(cache_tensor.flatten(0, 1)[:, :prefix_length])
+                # shape: [batch * num_kv_heads, kv_length, head_dim]
+        return PerDeviceTensors(*layer_past) if len(self.module.module_shards) > 1 else tuple(layer_past)
 
     def _update_cache_inplace(
         self, cache_tensors: Sequence[torch.Tensor], new_kvs: Sequence[torch.Tensor], prefix_length: int
     ):
         """Writes new key/value tensors back into cache, works in-place"""
-        _batch_size_times_num_kv_heads, head_dim, new_length = new_kvs[0].shape
-        for cache_key, new_key in zip(cache_tensors[0::2], new_kvs[0::2]):
-            new_key = new_key.view(*cache_key.shape[:3], new_length)
-            cache_key[:, :, :, prefix_length:new_length] = new_key[:, :, :, prefix_length:new_length]
-        for cache_value, new_value in zip(cache_tensors[1::2], new_kvs[1::2]):
-            new_value = new_value.view(*cache_value.shape[:2], new_length, head_dim)
-            cache_value[:, :, prefix_length:new_length, :] = new_value[:, :, prefix_length:new_length, :]
+        _batch_size_times_num_kv_heads, new_length, head_dim = new_kvs[1].shape
+        for i, (cache_tensor, new_kv) in enumerate(zip(cache_tensors, new_kvs)):
+            if self._is_transposed_key(i):
+                new_kv = new_kv.view(*cache_tensor.shape[:3], new_length)
+                self._write_tokens(i, cache_tensors, new_kv[:, :, :, prefix_length:new_length], prefix_length)
+            else:
+                new_kv = new_kv.view(*cache_tensor.shape[:2], new_length, head_dim)
+                self._write_tokens(i, cache_tensors, new_kv[:, :, prefix_length:new_length, :], prefix_length)
+
+    def _write_tokens(self, index: int, cache_tensors: Sequence[torch.Tensor], new_kv: torch.Tensor, start: int):
+        """Write keys/values of new tokens to the i-th cache tensor starting from position {start}, works in-place"""
+        end = start + new_kv.shape[3 if self._is_transposed_key(index) else 2]
+        if self.is_cache_quantized:
+            quantized, scales = quantize_kv(new_kv, dim=self._get_head_dim_index(index))
+            self._select_tokens(index, cache_tensors[index], start, end).copy_(quantized)
+            self._select_tokens(index, cache_tensors[len(cache_tensors) // 2 + index], start, end).copy_(scales)
+        else:
+            self._select_tokens(index, cache_tensors[index], start, end).copy_(new_kv)
+
+    def _dequantize_cache(self, cache_tensors: Sequence[torch.Tensor], prefix_length: int) -> List[torch.Tensor]:
+        """Restore the first {prefix_length} tokens of int8 keys/values (followed by their scales) in backend dtype"""
+        num_tensors = len(cache_tensors) // 2
+        return [
+            dequantize_kv(
+                self._select_tokens(i, cache_tensors[i], 0, prefix_length),
+                self._select_tokens(i, cache_tensors[num_tensors + i], 0, prefix_length),
+                self.dtype,
+            )
+            for i in range(num_tensors)
+        ]
+
+    def _select_tokens(self, index: int, cache_tensor: torch.Tensor, start: int, end: int) -> torch.Tensor:
+        """Return a view of tokens [start, end) of the i-th cache tensor"""
+        if self._is_transposed_key(index):
+            return cache_tensor[:, :, :, start:end]
+        return cache_tensor[:, :, start:end, :]
+
+    def _is_transposed_key(self, index: int) -> bool:
+        """Check if the i-th cache tensor (keys and values alternate) stores tokens along its last dimension"""
+        return index % 2 == 0 and self.cache_layout == CacheLayout.BLOOM
+
+    def _get_head_dim_index(self, index: int) -> int:
+        """Return the dimension of the i-th cache tensor that corresponds to head_dim"""
+        return 2 if self._is_transposed_key(index) else 3
 
     def get_pools(self) -> Sequence[PrioritizedTaskPool]:
         return self.forward_pool, self.backward_pool, self.inference_pool
@@ -198,15 +531,57 @@ class TransformerBackend(ModuleBackend):
             p.data = dummy
 
 
-def merge_inference_pools_inplace(backends: Dict[ExpertUID, TransformerBackend]): # type: ignore
-    """Replace each backend's rpc_inference pools with a combined pool runs multiple blocks in one call"""
+def get_coalescing_group(task: Task) -> Hashable:
+    """
+    Forward/backward tasks can be coalesced if they use the same adapter and have similar lengths.
+    Shorter sequences are padded on the right: blocks use causal attention, so padding does not change the outputs
+    (or the gradients) of real tokens. We allow lengths that waste at most ~1/4 of the tokens on padding.
+    """
+    *inputs, active_adapter = task.args
+    length = inputs[0].shape[1]
+    granularity = max(1, 2 ** (length.bit_length() - 3))
+    return active_adapter, (length + granularity - 1) // granularity * granularity  # rounded up length
+
+
+def _concat_padded(tensors: Sequence[torch.Tensor]) -> torch.Tensor:
+    """Concatenate [batch_size, seq_length, hidden_size] tensors along batch, padding them with zeros on the right"""
+    if len(tensors) == 1:
+        return tensors[0]
+    max_length = max(tensor.shape[1] for tensor in tensors)
+    return torch.cat([F.pad(tensor, (0, 0, 0, max_length - tensor.shape[1])) for tensor in tensors], dim=0)
+
+
+def _split_padded(batch: torch.Tensor, like: Sequence[torch.Tensor]) -> Tuple[torch.Tensor, ...]:
+    """Split the outputs of _concat_padded into tensors of the same shapes as its inputs"""
+    outputs, row = [], 0
+    for tensor in like:
+        outputs.append(batch[row : row + tensor.shape[0], : tensor.shape[1]].contiguous())
+        row += tensor.shape[0]
+    return tuple(outputs)
+
+
+def merge_inference_pools_inplace(
+    backends: Dict[ExpertUID, TransformerBackend], *, max_batched_sessions: int = 1
+): # type: ignore
+    """
+    Replace each backend's rpc_inference pools with a combined pool runs multiple blocks in one call
+
+    :param max_batched_sessions: if greater than 1, the merged pool runs steps from up to this many concurrent
+      inference sessions as one batched forward pass (continuous batching)
+    """
     assert len(backends) != 0 and all(isinstance(b, TransformerBackend) for b in backends.values())
     first_pool = next(iter(backends.values())).inference_pool
+    if max_batched_sessions > 1:
+        merged_step = _BatchedMergedInferenceStep(backends)
+        batching_kwargs = dict(max_tasks_per_batch=max_batched_sessions, get_task_group=merged_step.get_task_group)
+    else:
+        merged_step, batching_kwargs = _MergedInferenceStep(backends), {}
     merged_pool = PrioritizedTaskPool(
-        _MergedInferenceStep(backends),
+        merged_step,
         max_batch_size=first_pool.max_batch_size,
         device=first_pool.device,
         name=f"merged_inference",
+        **batching_kwargs,
     )
     for backend in backends.values():
         assert not backend.inference_pool.is_alive()
@@ -228,8 +603,54 @@ class _MergedInferenceStep:
         assert len(inference_infos) == len(
             optional_prompts
         ), f"found {len(inference_infos)} blocks but {len(optional_prompts)} prompts"
-        for inference_info, optional_prompt in zip(inference_infos, optional_prompts):
+        for block_index, (inference_info, optional_prompt) in enumerate(zip(inference_infos, optional_prompts)):
+            if block_index > 0 and is_current_batch_cancelled():
+                break  # the client does not wait for the outputs anymore, so we skip the remaining blocks
             if optional_prompt is not None:
                 hidden_states[:, : optional_prompt.shape[1]] += optional_prompt
             (hidden_states,) = self.backends[inference_info.uid].inference_step(hidden_states, hypo_ids, inference_info)
         return (hidden_states,)
+
+
+class _BatchedMergedInferenceStep(_MergedInferenceStep):
+    """Runs inference steps of several sessions that use the same chain of blocks as one batched forward pass"""
+
+    def get_task_group(self, task: Task) -> Hashable:
+        """Sessions can be batched if they use the same blocks, adapter and step length"""
+        hidden_states, _hypo_ids, inference_infos, *_ = task.args
+        group = (tuple(info.uid for info in inference_infos), inference_infos[0].active_adapter, hidden_states.shape[1])
+        if not self.backends[inference_infos[0].uid].supports_padded_batching:
+            group += (inference_infos[0].prefix_length,)
+        if any(info.prefix_keys for info in inference_infos):
+            group += (task.uid,)  # batched_inference_step() doesn't use the prefix cache, so we run this step alone
+        return group
+
+    @torch.inference_mode()
+    def __call__(self, *task_args: Sequence[Any]) -> Tuple[torch.Tensor, ...]:
+        if len(task_args) == 1:
+            return super().__call__(*task_args[0])
+
+        hidden_states, hypo_ids, inference_infos, prompts = [], [], [], []
+        for task_hidden_states, task_hypo_ids, task_inference_infos, *task_prompts in task_args:
+            assert len(task_inference_infos) == len(
+                task_prompts
+            ), f"found {len(task_inference_infos)} blocks but {len(task_prompts)} prompts"
+            hidden_states.append(task_hidden_states)
+            hypo_ids.append(task_hypo_ids)
+            inference_infos.append(task_inference_infos)
+            prompts.append(task_prompts)
+
+        batch_sizes = [task_hidden_states.shape[0] for task_hidden_states in hidden_states]
+        hidden_states = torch.cat(hidden_states, dim=0)
+        for block_index, uid in enumerate(info.uid for info in inference_infos[0]):
+            if block_index > 0 and is_current_batch_cancelled():
+                break  # all clients stopped waiting for the outputs, so we skip the remaining blocks
+            row = 0
+            for batch_size, task_prompts in zip(batch_sizes, prompts):
+                optional_prompt = task_prompts[block_index]
+                if optional_prompt is not None:
+                    hidden_states[row : row + batch_size, : optional_prompt.shape[1]] += optional_prompt
+                row += batch_size
+            block_infos = [task_inference_infos[block_index] for task_inference_infos in inference_infos]
+            (hidden_states,) = self.backends[uid].batched_inference_step(hidden_states, hypo_ids, block_infos)
+        return tuple(hidden_states.split(batch_sizes, dim=0))
@@ -0,0 +1,179 @@
+"""
+A persistent on-disk cache of converted blocks, so that restarting a server doesn't convert its blocks again.
+
+We store the state dict of a block after convert_block() (tensor-parallel shards, cast and quantized weights)
+in a safetensors file under {cache_dir}/converted_blocks. On restart, we build the structure of the converted block
+from uninitialized weights (without quantizing them, see convert_block(empty_weights=True)) and load the cached tensors
+into it. The cached file is memory-mapped, so the tensors are copied from the page cache directly into the block.
+
+The cache key includes the model, its revision (the resolved commit hash when the model is in the HF Hub cache,
+or the sizes and modification times of the checkpoint files when the model is a local directory), the block index,
+the dtype, the quantization type, and the tensor parallelism layout. Adapters are not cached and are applied after
+loading a block. Cached blocks are evicted with the HF Hub files in least recently used order,
+see free_disk_space_for().
+"""
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+from typing import Dict, Optional, Sequence, Union
+
+import safetensors
+import torch
+import torch.nn as nn
+from accelerate import init_empty_weights
+from accelerate.utils import set_module_tensor_to_device
+from hypermind.utils.logging import get_logger
+from safetensors.torch import save_file
+from transformers import PretrainedConfig
+
+from subnet.server.block_utils import get_model_block
+from subnet.utils.convert_block import QuantType
+from subnet.utils.disk_cache import (
+    CONVERTED_BLOCKS_DIR,
+    DEFAULT_CACHE_DIR,
+    allow_cache_reads,
+    allow_cache_writes,
+    free_disk_space_for,
+)
+
+logger = get_logger(__name__)
+
+CACHE_FORMAT_VERSION = 1
+
+StateDict = Dict[str, torch.Tensor]
+
+
+class ConvertedBlockCache:
+    """
+    :param model_name: the model the blocks are loaded from (a HF Hub repo or a local path)
+    :param torch_dtype: the dtype of the converted blocks (must be resolved already, not "auto")
+    :param tensor_parallel_devices: the devices the blocks are split between, see convert_block()
+    :param output_device: the device where the outputs of tensor-parallel blocks are gathered
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        *,
+        revision: Optional[str] = None,
+        torch_dtype: torch.dtype,
+        quant_type: QuantType,
+        tensor_parallel_devices: Sequence[torch.device],
+        output_device: Union[str, torch.device],
+        cache_dir: Optional[str] = None,
+        max_disk_space: Optional[int] = None,
+    ):
+        assert self.is_supported(quant_type), f"Converted blocks with quant_type={quant_type} can't be cached"
+        if cache_dir is None:
+            cache_dir = DEFAULT_CACHE_DIR
+        self.model_name, self.cache_dir, self.max_disk_space = model_name, cache_dir, max_disk_space
+        self._key_fields = dict(
+            format_version=CACHE_FORMAT_VERSION,
+            model_name=model_name,
+            revision=_resolve_revision(model_name, revision, cache_dir),
+            local_checkpoint=_get_local_checkpoint_fingerprint(model_name),
+            torch_dtype=str(torch_dtype),
+            quant_type=quant_type.name,
+            tensor_parallel_devices=[str(device) for device in tensor_parallel_devices],
+            output_device=str(output_device),
+        )
+        if quant_type != QuantType.NONE:
+            import bitsandbytes as bnb
+
+            self._key_fields["bitsandbytes_version"] = bnb.__version__  # The quantized format may change
+
+    @staticmethod
+    def is_supported(quant_type: QuantType) -> bool:
+        # bitsandbytes==0.41.1 can save 8-bit quantized weights (with their scales) but not the 4-bit quantization state
+        return quant_type in (QuantType.NONE, QuantType.INT8)
+
+    def get_path(self, block_index: int) -> Path:
+        key = json.dumps(dict(self._key_fields, block_index=block_index), sort_keys=True)
+        key_hash = hashlib.sha256(key.encode()).hexdigest()[:16]
+        model_name = self.model_name.strip("/").replace("/", "--")
+        return Path(self.cache_dir, CONVERTED_BLOCKS_DIR, f"{model_name}.{block_index}.{key_hash}.safetensors")
+
+    def load(self, block_index: int) -> Optional[StateDict]:
+        """Return the memory-mapped state dict of a converted block, or None if the block is not cached"""
+        path = self.get_path(block_index)
+        try:
+            with allow_cache_reads(self.cache_dir):
+                if not path.exists():
+                    return None
+                with safetensors.safe_open(str(path), framework="pt", device="cpu") as f:
+                    state_dict = {key: f.get_tensor(key) for key in f.keys()}
+                now = time.time()
+                os.utime(path, (now, path.stat().st_mtime))  # Mark as recently used for LRU eviction
+        except Exception:
+            logger.warning(f"Failed to load cached block {block_index} from {path}, it will be converted again")
+            self.remove(block_index)
+            return None
+        logger.debug(f"Found converted block {block_index} in {path}")
+        return state_dict
+
+    def save(self, block_index: int, block: nn.Module):
+        """Save the state dict of a converted block, log a warning on failure (e.g., if the disk is full)"""
+        state_dict, storages = {}, set()
+        for key, tensor in block.state_dict().items():
+            tensor = tensor.detach().to("cpu", copy=False).contiguous()
+            storage = (tensor.untyped_storage().data_ptr(), tensor.device)
+            if storage in storages:
+                tensor = tensor.clone()  # safetensors can't save tensors that share memory
+            storages.add(storage)
+            state_dict[key] = tensor
+        size = sum(tensor.numel() * tensor.element_size() for tensor in state_dict.values())
+
+        path = self.get_path(block_index)
+        tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+        try:
+            with allow_cache_writes(self.cache_dir):
+                free_disk_space_for(size, cache_dir=self.cache_dir, max_disk_space=self.max_disk_space)
+                os.makedirs(path.parent, exist_ok=True)
+                metadata = {key: str(value) for key, value in self._key_fields.items()}
+                save_file(state_dict, str(tmp_path), metadata=metadata)
+                os.replace(tmp_path, path)
+            logger.debug(f"Saved converted block {block_index} to {path}")
+        except Exception as e:
+            logger.warning(f"Failed to save converted block {block_index} to the cache: {e}")
+            if tmp_path.exists():
+                tmp_path.unlink()
+
+    def remove(self, block_index: int):
+        with allow_cache_writes(self.cache_dir):
+            path = self.get_path(block_index)
+            if path.exists():
+                path.unlink()
+
+
+def make_empty_block(config: PretrainedConfig, block_index: int, torch_dtype: torch.dtype) -> nn.Module:
+    """Create a block with uninitialized parameters, as load_pretrained_block() would create it (without reading)"""
+    with init_empty_weights():
+        block = get_model_block(config, layer_idx=block_index)
+    for param_name, param in block.named_parameters():
+        dtype = param.dtype if str(param.dtype).startswith(("torch.uint", "torch.int", "torch.bool")) else torch_dtype
+        set_module_tensor_to_device(block, param_name, "cpu", value=torch.empty(param.shape, dtype=dtype), dtype=dtype)
+    return block
+
+
+def _resolve_revision(model_name: str, revision: Optional[str], cache_dir: str) -> Optional[str]:
+    """If the HF Hub cache knows which commit a branch or tag points to, return the commit hash"""
+    if os.path.isdir(model_name):
+        return revision
+    ref_path = Path(cache_dir, f"models--{model_name.replace('/', '--')}", "refs", revision or "main")
+    if ref_path.is_file():
+        return ref_path.read_text().strip()
+    return revision
+
+
+def _get_local_checkpoint_fingerprint(model_name: str) -> Optional[str]:
+    """If the model is a local directory, return a hash of the names, sizes, and mtimes of its weights and configs"""
+    if not os.path.isdir(model_name):
+        return None
+    fingerprint = hashlib.sha256()
+    for entry in sorted(os.scandir(model_name), key=lambda entry: entry.name):
+        if entry.is_file() and entry.name.endswith((".safetensors", ".bin", ".json")):
+            stat = entry.stat()
+            fingerprint.update(f"{entry.name} {stat.st_size} {stat.st_mtime_ns}\n".encode())
+    return fingerprint.hexdigest()
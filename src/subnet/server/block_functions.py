@@ -3,9 +3,12 @@ This module implements server-side computations on served blocks: forward, backw
 """
 from __future__ import annotations
 
+import time
+from itertools import chain
 from typing import Any, AsyncIterator, Dict, Optional, Sequence, Tuple, Union
 
 import torch
+from hypermind import PeerID
 from hypermind.compression.serialization import deserialize_torch_tensor, serialize_torch_tensor
 from hypermind.moe.expert_uid import ExpertUID
 from hypermind.proto import runtime_pb2
@@ -13,11 +16,13 @@ from hypermind.utils.logging import get_logger
 from hypermind.utils.nested import nested_flatten
 
 from subnet.data_structures import Handle, InferenceMetadata
+from subnet.server.activation_cache import ActivationCache
 from subnet.server.backend import TransformerBackend
+from subnet.server.prefix_cache import make_prefix_keys
 from subnet.server.task_pool import PrioritizedTaskPool
 from subnet.server.task_prioritizer import TaskPrioritizerBase
 from subnet.utils.convert_block import QuantType
-from subnet.utils.misc import DUMMY, is_dummy
+from subnet.utils.misc import DUMMY, DUMMY_INT64, is_dummy
 from subnet.utils.packaging import unpack_args_kwargs
 
 # We prioritize short inference requests and make them use a *merged* inference pool,
@@ -26,15 +31,33 @@ from subnet.utils.packaging import unpack_args_kwargs
 MAX_SHORT_INFERENCE_TOKENS = 128
 MAX_NF4_SHORT_INFERENCE_TOKENS = 1
 
+# Sliding-window sessions keep this many first tokens by default, since attention concentrates on them ("sinks").
+# When the window is full, we evict at least a fraction of it at once: each eviction moves (and re-rotates) the entire
+# window, so this bounds the amortized cost per token and the rounding errors accumulated by repeatedly moved keys
+DEFAULT_ATTENTION_SINKS = 4
+MIN_EVICTED_WINDOW_FRACTION = 1 / 8
+
 logger = get_logger(__name__)
 
 
+def get_deadline(metadata: dict, default: Optional[float] = None) -> Optional[float]:
+    """Get the number of seconds within which the client needs the outputs (None means no deadline)"""
+    deadline = metadata.get("deadline", default)
+    if deadline is not None and not (isinstance(deadline, (float, int)) and deadline > 0):
+        raise ValueError(f"deadline must be a positive number of seconds, got {deadline}")
+    return deadline
+
+
 async def run_rpc_forward(
     *flat_tensors: torch.Tensor,
     requested_backends: Sequence[TransformerBackend],
     active_adapter: str = "",
     prioritizer: TaskPrioritizerBase,
     points: int = 0,
+    deadline: Optional[float] = None,
+    peer_id: Optional[PeerID] = None,
+    activation_cache: Optional[ActivationCache] = None,
+    activation_cache_key: Optional[str] = None,
     args_structure: Any = None,
 ) -> torch.Tensor:
     """
@@ -43,12 +66,19 @@ async def run_rpc_forward(
     :param flat_tensors: a list of tensors that includes first layer inputs, optional prompts and extra tensors
     :note: some input tensors can be missing, in which case they will be replaced with dummy tensors (see is_dummy)
     :param requested_backends: a sequence of transformer blocks in the same order as they appear in forward pass
+    :param deadline: if specified, the outputs must be ready within this many seconds, otherwise the request fails
+      with ServerBusyError as soon as a pool expects to miss it (see PrioritizedTaskPool.submit_task)
+    :param peer_id: the client that sent the request, passed to the prioritizer (see FairShareTaskPrioritizer)
+    :param activation_cache: if specified along with activation_cache_key, save the inputs of each block there,
+      so that rpc_backward with the same key can skip the forward pass (see run_rpc_backward)
     :returns: hidden states after the last layer [batch_size, seq_length, hid_size]
     """
     if args_structure is not None:
         # TODO: kwargs currently is unused, it can be used later for peft-like adaptation
         flat_tensors, kwargs = unpack_args_kwargs(flat_tensors, args_structure)
     hidden_states, prompts, *_ = flat_tensors
+    all_prompts = prompts
+    deadline_time = time.monotonic() + deadline if deadline is not None else None
 
     dtype = requested_backends[0].dtype
     # check parse input tensors and cast dtypes
@@ -59,25 +89,35 @@ async def run_rpc_forward(
     else:
         prompts = [p.squeeze(0) for p in prompts.to(requested_backends[0].dtype).split(1, dim=0)]
 
+    cache_activations = activation_cache is not None and activation_cache_key is not None
+    cache_activations = cache_activations and len(requested_backends) > 1  # with one block, there is nothing to skip
+    block_inputs = []
+
     # Run a chain of requested backends
     for backend, prompt in zip(requested_backends, prompts):
+        if cache_activations:
+            # Save the inputs before adding prompts (in-place), since rpc_backward receives them this way
+            block_inputs.append(hidden_states.clone() if not is_dummy(prompt) else hidden_states)
         if not is_dummy(prompt):
             hidden_states[:, : prompt.shape[1]] += prompt
 
         assert isinstance(backend.inference_pool, PrioritizedTaskPool), "petals support only prioritized pools"
         priority = prioritizer.prioritize(
-            hidden_states, points=points / len(requested_backends), backend=backend, type="forward"
+            hidden_states, points=points / len(requested_backends), backend=backend, type="forward", peer_id=peer_id
         )
         (hidden_states,) = await backend.forward_pool.submit_task(
             hidden_states,
             active_adapter,
             priority=priority,
+            deadline=deadline_time,
         )
         assert isinstance(hidden_states, torch.Tensor)
         assert (
             hidden_states.ndim == 3
         ), f"inputs to {type(backend)} must be a list with a single 3d tensor of hidden states"
 
+    if cache_activations:
+        activation_cache.store(activation_cache_key, block_inputs, prompts=all_prompts)
     return hidden_states
 
 
@@ -87,12 +127,25 @@ async def run_rpc_backward(
     active_adapter: str = "",
     prioritizer: TaskPrioritizerBase,
     points: int = 0,
+    deadline: Optional[float] = None,
+    peer_id: Optional[PeerID] = None,
+    activation_cache: Optional[ActivationCache] = None,
+    activation_cache_key: Optional[str] = None,
     args_structure: Any = None,
 ) -> Union[torch.Tensor, Sequence[torch.Tensor]]:
+    """
+    Run backward pass on deserialized inputs, grad outputs, and prompts, used by rpc_backward and rpc_backward_stream
+
+    :param activation_cache: if specified along with activation_cache_key, reuse the inputs of each block saved by
+      run_rpc_forward with the same key and inputs instead of running the forward pass again (recompute on a miss)
+    :returns: gradients w.r.t. inputs and (if any) prompts
+    """
     if args_structure is not None:
         # TODO: kwargs currently is unused, it can be used later for peft-like adaptation
         flat_tensors, kwargs = unpack_args_kwargs(flat_tensors, args_structure)
     inputs, grad_outputs, prompts, *_ = flat_tensors
+    all_prompts = prompts
+    deadline_time = time.monotonic() + deadline if deadline is not None else None
 
     # Cast inputs & grad outputs to backend dtype
     inputs = inputs.to(requested_backends[0].dtype)
@@ -103,19 +156,33 @@ async def run_rpc_backward(
     else:
         prompts = [p.squeeze(0) for p in prompts.to(requested_backends[0].dtype).split(1, dim=0)]
 
-    # Run a forward chain to collect intermediate inputs
+    cached_inputs = None
+    if activation_cache is not None and activation_cache_key is not None and len(requested_backends) > 1:
+        cached_inputs = activation_cache.pop(activation_cache_key, inputs, prompts=all_prompts)
+
+    # Run a forward chain to collect intermediate inputs (or take them from the activation cache)
     # Note that we do not forward for the last module since we do not need its output
     inter_inputs = []
-    for backend, prompt in zip(requested_backends[:-1], prompts[:-1]):
+    for i, (backend, prompt) in enumerate(zip(requested_backends[:-1], prompts[:-1])):
         assert inputs.ndim == 3, f"inputs to {type(backend)} must be a single 3d tensor of hidden states"
         if not is_dummy(prompt):
             inputs[:, : prompt.shape[1]] += prompt
         inter_inputs.append(inputs)
+        if cached_inputs is not None:
+            inputs = cached_inputs[i + 1]
+            continue
+
         assert isinstance(backend.inference_pool, PrioritizedTaskPool), "petals support only prioritized pools"
         priority = prioritizer.prioritize(
-            inputs, points=points / len(requested_backends), backend=backend, type="forward_in_backward"
+            inputs,
+            points=points / len(requested_backends),
+            backend=backend,
+            type="forward_in_backward",
+            peer_id=peer_id,
+        )
+        (inputs,) = await backend.forward_pool.submit_task(
+            inputs, active_adapter, priority=priority, deadline=deadline_time
         )
-        (inputs,) = await backend.forward_pool.submit_task(inputs, active_adapter, priority=priority)
 
         assert isinstance(inputs, torch.Tensor)
 
@@ -129,9 +196,16 @@ async def run_rpc_backward(
     for inp, prompt, backend in zip(*map(reversed, (inter_inputs, prompts, requested_backends))):
         assert isinstance(backend.inference_pool, PrioritizedTaskPool), "petals support only prioritized pools"
         priority = prioritizer.prioritize(
-            inp, grad_outputs, points=points / len(requested_backends), backend=backend, type="backward"
+            inp,
+            grad_outputs,
+            points=points / len(requested_backends),
+            backend=backend,
+            type="backward",
+            peer_id=peer_id,
+        )
+        (grad_outputs,) = await backend.backward_pool.submit_task(
+            inp, grad_outputs, active_adapter, priority=priority, deadline=deadline_time
         )
-        (grad_outputs,) = await backend.backward_pool.submit_task(inp, grad_outputs, active_adapter, priority=priority)
 
         assert isinstance(grad_outputs, torch.Tensor)
         if not is_dummy(prompt):
@@ -148,23 +222,44 @@ async def iterate_rpc_inference(
     input_iterator: AsyncIterator[Tuple[runtime_pb2.ExpertRequest, dict]],
     cache_handles: Sequence[Sequence[Handle]],
     *,
+    cache_length: int,
     max_length: int,
     prioritizer: TaskPrioritizerBase,
     points: int,
     quant_type: QuantType,
+    max_prefill_chunk_tokens: Optional[int] = None,
+    attention_sinks: int = 0,
+    sliding_window: Optional[int] = None,
+    deadline: Optional[float] = None,
+    peer_id: Optional[PeerID] = None,
     args_structure: Any = None,
 ) -> AsyncIterator[Tuple[Sequence[runtime_pb2.Tensor], bool, Dict]]:
+    """
+    :param max_length: the maximum number of tokens in the attention cache
+    :param sliding_window: if specified, the session is not limited by max_length: once the cache is full, we evict
+      the oldest tokens except for the first {attention_sinks} ones, so that the cache holds at most
+      {attention_sinks + sliding_window} tokens (see "Efficient Streaming Language Models with Attention Sinks")
+    :param deadline: if specified, each step must be completed within this many seconds after the server receives it,
+      unless the step metadata specifies its own "deadline"; otherwise, the step fails with ServerBusyError
+    """
     assert len(cache_handles) == len(requested_backends)
+    assert sliding_window is None or attention_sinks + sliding_window <= max_length
 
-    prefix_length = 0
+    prefix_length = 0  # the number of tokens processed in this session
+    total_evicted = 0  # the number of tokens evicted from the cache, so it holds {prefix_length - total_evicted}
+    memory_cache = requested_backends[0].memory_cache
     point_per_piece = points / max_length if max_length > 0 else 0.0
 
     async for request, step_metadata in input_iterator:
+        step_deadline = get_deadline(step_metadata, default=deadline)
+        step_deadline_time = time.monotonic() + step_deadline if step_deadline is not None else None
         if "start_from_position" in step_metadata:
             start_from_position = step_metadata["start_from_position"]
             assert (
                 prefix_length >= start_from_position,
             ), f"prefix_length={prefix_length}, start_from_position={start_from_position}"
+            if total_evicted > 0 and start_from_position - total_evicted < attention_sinks:
+                raise ValueError(f"Cannot start from position {start_from_position}, it was evicted from the cache")
             prefix_length = start_from_position
 
         flat_tensors = tuple(deserialize_torch_tensor(tensor) for tensor in request.tensors)
@@ -190,40 +285,80 @@ async def iterate_rpc_inference(
         if not (len(requested_backends) == len(prompts)):
             raise ValueError(f"Received {len(prompts)} prompts for {len(requested_backends)} backends")
 
-        if prefix_length + length_increment > max_length:
+        cache_prefix_length, num_evicted = prefix_length - total_evicted, 0
+        if sliding_window is not None:
+            if length_increment > sliding_window:
+                raise ValueError(f"Inference step of {length_increment} tokens exceeds sliding window {sliding_window}")
+            num_overflowing = cache_prefix_length + length_increment - (attention_sinks + sliding_window)
+            if num_overflowing > 0:
+                min_evicted = max(num_overflowing, int(sliding_window * MIN_EVICTED_WINDOW_FRACTION))
+                num_evicted = min(cache_prefix_length - attention_sinks, min_evicted)
+                cache_prefix_length -= num_evicted
+                total_evicted += num_evicted
+        elif prefix_length + length_increment > max_length:
             raise ValueError(
                 f"Maximum length exceeded: prefix {prefix_length} + current {length_increment}"
                 f" exceeds pre-allocated maximum {max_length}"
             )
+        if cache_prefix_length + length_increment > cache_length:
+            # Grow the cache by whole pages; the session is admitted already, so this waits for up to max_alloc_timeout
+            cache_length = min(max_length, memory_cache.round_to_pages(cache_prefix_length + length_increment))
+            await _resize_cache(requested_backends, cache_handles, batch_size, cache_length)
+        if memory_cache.offloader.enabled:
+            # The cache of an idle session may be offloaded, make sure it fits into the device memory before the step
+            await memory_cache.reserve_offloaded_cache(tuple(chain(*cache_handles)))
+
+        # The first step of a session often contains a prefix shared with other sessions, e.g. a system prompt
+        prefix_keys = [()] * len(requested_backends)
+        if memory_cache.prefix_cache.enabled and prefix_length == 0 and not has_prompts:
+            prefix_keys = make_prefix_keys(hidden_states, requested_uids, active_adapter, memory_cache.page_size)
 
         merge_max_tokens = MAX_NF4_SHORT_INFERENCE_TOKENS if quant_type == QuantType.NF4 else MAX_SHORT_INFERENCE_TOKENS
         can_merge_pools = batch_size * length_increment <= merge_max_tokens
-        priority = prioritizer.prioritize(
-            hidden_states,
-            hypo_ids,
-            points=point_per_piece,
-            requested_uids=requested_uids,
-            type="inference",
-        )
 
         # A client may pass a tensor with 0 tokens. This is a special case that occurs, e.g.
         # when user wants to pre-allocate cache or check that server *can* allocate that cache.
         if hidden_states.numel() > 0:
             assert hidden_states.ndim == 3, f"hidden states must be a single 3d tensor"
             if can_merge_pools:
+                priority = prioritizer.prioritize(
+                    hidden_states,
+                    hypo_ids,
+                    points=point_per_piece,
+                    requested_uids=requested_uids,
+                    type="inference",
+                    num_tokens=batch_size * length_increment,
+                    processed_tokens=prefix_length,
+                    peer_id=peer_id,
+                )
                 inference_infos = tuple(
-                    InferenceMetadata(uid, prefix_length, tuple(handles), active_adapter)
-                    for uid, handles in zip(requested_uids, cache_handles)
+                    InferenceMetadata(
+                        uid, cache_prefix_length, tuple(handles), active_adapter, keys, attention_sinks, num_evicted
+                    )
+                    for uid, handles, keys in zip(requested_uids, cache_handles, prefix_keys)
                 )
                 (hidden_states,) = await requested_backends[0].inference_pool.submit_task(
-                    hidden_states, hypo_ids, inference_infos, *prompts, priority=priority
+                    hidden_states, hypo_ids, inference_infos, *prompts, priority=priority, deadline=step_deadline_time
                 )
             else:
-                for backend, uid, handles, prompt in zip(requested_backends, requested_uids, cache_handles, prompts):
-                    inference_infos = (InferenceMetadata(uid, prefix_length, tuple(handles), active_adapter),)
-                    (hidden_states,) = await backend.inference_pool.submit_task(
-                        hidden_states, hypo_ids, inference_infos, prompt, priority=priority
-                    )
+                hidden_states = await _run_prefill_in_chunks(
+                    hidden_states,
+                    hypo_ids,
+                    prompts,
+                    requested_uids=requested_uids,
+                    requested_backends=requested_backends,
+                    active_adapter=active_adapter,
+                    cache_handles=cache_handles,
+                    prefix_length=cache_prefix_length,
+                    prefix_keys=prefix_keys,
+                    attention_sinks=attention_sinks,
+                    num_evicted=num_evicted,
+                    max_chunk_tokens=max_prefill_chunk_tokens if not has_prompts else None,
+                    prioritizer=prioritizer,
+                    points=point_per_piece,
+                    deadline_time=step_deadline_time,
+                    peer_id=peer_id,
+                )
 
         # serialize and send last layer outputs
         output_tensors = [
@@ -235,3 +370,88 @@ async def iterate_rpc_inference(
 
         # prepare for next step
         prefix_length += length_increment
+
+
+async def _run_prefill_in_chunks(
+    hidden_states: torch.Tensor,
+    hypo_ids: torch.Tensor,
+    prompts: Sequence[Optional[torch.Tensor]],
+    *,
+    requested_uids: Sequence[ExpertUID],
+    requested_backends: Sequence[TransformerBackend],
+    active_adapter: Optional[str],
+    cache_handles: Sequence[Sequence[Handle]],
+    prefix_length: int,
+    prefix_keys: Sequence[Tuple[bytes, ...]],
+    attention_sinks: int = 0,
+    num_evicted: int = 0,
+    max_chunk_tokens: Optional[int],
+    prioritizer: TaskPrioritizerBase,
+    points: float,
+    deadline_time: Optional[float] = None,
+    peer_id: Optional[PeerID] = None,
+) -> torch.Tensor:
+    """
+    Run a long inference step through per-block pools, splitting it into chunks of at most {max_chunk_tokens} tokens.
+    Each chunk is a separate task, so the runtime may process decode steps of other sessions between the chunks.
+
+    :param max_chunk_tokens: the token budget of one chunk (batch_size * chunk_length); None runs the step in one go
+    :param deadline_time: time.monotonic() by which all chunks must be processed, see PrioritizedTaskPool.submit_task
+    :note: hypo_ids, prefix keys and evictions are only applied to the first chunk, since later chunks continue it
+    """
+    batch_size, length_increment, _ = hidden_states.shape
+    chunk_length = length_increment
+    if max_chunk_tokens is not None:
+        chunk_length = max(1, min(length_increment, max_chunk_tokens // batch_size))
+
+    output_chunks = []
+    for offset in range(0, length_increment, chunk_length):
+        chunk = hidden_states[:, offset : offset + chunk_length]
+        chunk_hypo_ids = hypo_ids if offset == 0 else DUMMY_INT64
+        chunk_prefix_keys = prefix_keys if offset == 0 else [()] * len(requested_backends)
+        chunk_num_evicted = num_evicted if offset == 0 else 0
+        if chunk.shape[1] < length_increment:
+            page_size = requested_backends[0].memory_cache.page_size
+            chunk_prefix_keys = [keys[: chunk.shape[1] // page_size] for keys in chunk_prefix_keys]
+        priority = prioritizer.prioritize(
+            chunk,
+            chunk_hypo_ids,
+            points=points,
+            requested_uids=requested_uids,
+            type="inference",
+            num_tokens=batch_size * chunk.shape[1],
+            processed_tokens=prefix_length + offset,
+            peer_id=peer_id,
+        )
+
+        for backend, uid, handles, prompt, keys in zip(
+            requested_backends, requested_uids, cache_handles, prompts, chunk_prefix_keys
+        ):
+            inference_infos = (
+                InferenceMetadata(
+                    uid,
+                    prefix_length + offset,
+                    tuple(handles),
+                    active_adapter,
+                    keys,
+                    attention_sinks,
+                    chunk_num_evicted,
+                ),
+            )
+            (chunk,) = await backend.inference_pool.submit_task(
+                chunk, chunk_hypo_ids, inference_infos, prompt, priority=priority, deadline=deadline_time
+            )
+        output_chunks.append(chunk)
+    return output_chunks[0] if len(output_chunks) == 1 else torch.cat(output_chunks, dim=1)
+
+
+async def _resize_cache(
+    requested_backends: Sequence[TransformerBackend],
+    cache_handles: Sequence[Sequence[Handle]],
+    batch_size: int,
+    length: int,
+) -> None:
+    """Grow the attention caches of all requested blocks to hold {length} tokens"""
+    descriptors = [backend.get_inference_cache_descriptors(batch_size, length) for backend in requested_backends]
+    memory_cache = requested_backends[0].memory_cache
+    await memory_cache.resize_cache(tuple(chain(*cache_handles)), *chain(*descriptors))
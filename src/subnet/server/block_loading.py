@@ -0,0 +1,188 @@
+"""
+A pipeline that loads transformer blocks for ModuleContainer.create() with different blocks in different stages.
+
+Loading a block consists of stages that use different resources:
+ 1. read and deserialize the weights, cast them to the server's dtype (disk/network-bound, see load_pretrained_block)
+ 2. quantize the block and move it to the device (CPU- and PCIe-bound, see convert_block)
+ 3. wrap the block into a TransformerBackend (in the caller's thread)
+
+Loading blocks one at a time leaves the disk, CPU, and device idle most of the time. Instead, stage 1 runs on a pool
+of I/O threads and stage 2 runs in a separate thread, so that adjacent blocks overlap: while block i is being
+converted, blocks i + 1, i + 2, ... are being read. Blocks are yielded in the order of block_indices.
+
+Blocks that were read but not converted yet are kept in host memory, so we limit the total size of such blocks
+with max_in_flight_bytes. A block is always allowed to start loading if no other blocks are in flight.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Iterator, Optional, Sequence, Tuple
+
+import torch.nn as nn
+from hypermind.utils.logging import get_logger
+
+logger = get_logger(__name__)
+
+
+class LoadingCancelled(Exception):
+    """Raised in the pipeline threads when the consumer has stopped iterating over blocks"""
+
+
+class _MemoryBudget:
+    """A semaphore measured in bytes: acquire() waits until the in-flight blocks fit into max_bytes"""
+
+    def __init__(self, max_bytes: Optional[int]):
+        self.max_bytes, self.used_bytes = max_bytes, 0
+        self._cond = threading.Condition()
+        self._cancelled = False
+
+    def acquire(self, num_bytes: int):
+        with self._cond:
+            while self.max_bytes is not None and self.used_bytes > 0 and self.used_bytes + num_bytes > self.max_bytes:
+                if self._cancelled:
+                    raise LoadingCancelled()
+                self._cond.wait()
+            if self._cancelled:
+                raise LoadingCancelled()
+            self.used_bytes += num_bytes
+
+    def release(self, num_bytes: int):
+        with self._cond:
+            self.used_bytes -= num_bytes
+            self._cond.notify_all()
+
+    def cancel(self):
+        with self._cond:
+            self._cancelled = True
+            self._cond.notify_all()
+
+
+def load_blocks_pipelined(
+    block_indices: Sequence[int],
+    *,
+    load_block: Callable[[int], Any],
+    convert_block: Callable[[int, Any], nn.Module],
+    block_size: int,
+    max_in_flight_bytes: Optional[int] = None,
+    num_io_threads: int = 4,
+) -> Iterator[Tuple[int, nn.Module]]:
+    """
+    Load and convert blocks in a pipeline, yield (block_index, converted_block) in the order of block_indices
+
+    :param load_block: a blocking function that reads a block from disk/network and returns it in host memory
+      (it may return anything that convert_block accepts, e.g. a block with extra data)
+    :param convert_block: a blocking function that converts a loaded block (quantizes it, moves it to the device, etc.)
+    :param block_size: an estimate of the host memory taken by one loaded block, in bytes
+    :param max_in_flight_bytes: the maximum total size of blocks that were read but not converted yet
+      (default: no limit, but at most about num_io_threads + 2 blocks are in flight)
+    :param num_io_threads: the number of blocks read concurrently
+    :note: if the caller stops iterating (e.g., due to an exception), blocks that are being loaded are discarded
+    """
+    assert num_io_threads > 0, "num_io_threads must be positive"
+    assert max_in_flight_bytes is None or max_in_flight_bytes > 0, "max_in_flight_bytes must be positive"
+    if max_in_flight_bytes is not None and max_in_flight_bytes < block_size:
+        logger.warning(
+            f"Memory limit for loading blocks ({max_in_flight_bytes / 2**20:.0f} MiB) is less than the block size "
+            f"({block_size / 2**20:.0f} MiB), blocks will be loaded one at a time"
+        )
+
+    budget = _MemoryBudget(max_in_flight_bytes)
+    # Bounds the number of blocks that were read but not converted yet even if max_in_flight_bytes is unlimited
+    loading_queue = queue.Queue(maxsize=num_io_threads)
+    converted_queue = queue.Queue()  # converted blocks already reside on the device, so this queue is unbounded
+    stop_event = threading.Event()
+    io_pool = ThreadPoolExecutor(max_workers=num_io_threads, thread_name_prefix="BlockLoader")
+    stage_times, stage_times_lock = dict(read=0.0, convert=0.0, wait=0.0, consume=0.0), threading.Lock()
+
+    def _read(block_index: int) -> Any:
+        if stop_event.is_set():
+            raise LoadingCancelled()
+        start_time = time.perf_counter()
+        block = load_block(block_index)
+        elapsed = time.perf_counter() - start_time
+        with stage_times_lock:
+            stage_times["read"] += elapsed
+        logger.debug(f"Read block {block_index} in {elapsed:.1f} sec")
+        return block
+
+    def _schedule_reads():
+        try:
+            for block_index in block_indices:
+                budget.acquire(block_size)
+                future = io_pool.submit(_read, block_index)
+                while not stop_event.is_set():
+                    try:
+                        loading_queue.put((block_index, future), timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+        except LoadingCancelled:
+            pass
+        except BaseException as e:
+            _fail(e)
+
+    def _convert():
+        try:
+            for _ in block_indices:
+                block_index, future = None, None
+                while future is None:
+                    if stop_event.is_set():
+                        return
+                    try:
+                        block_index, future = loading_queue.get(timeout=0.1)
+                    except queue.Empty:
+                        pass
+                try:
+                    block = future.result()
+                    start_time = time.perf_counter()
+                    block = convert_block(block_index, block)
+                finally:
+                    budget.release(block_size)
+                elapsed = time.perf_counter() - start_time
+                with stage_times_lock:
+                    stage_times["convert"] += elapsed
+                logger.debug(f"Converted block {block_index} in {elapsed:.1f} sec")
+                converted_queue.put((block_index, block, None))
+        except LoadingCancelled:
+            pass
+        except BaseException as e:
+            _fail(e)
+
+    def _fail(e: BaseException):
+        stop_event.set()
+        budget.cancel()
+        converted_queue.put((None, None, e))
+
+    start_time = time.perf_counter()
+    threads = [
+        threading.Thread(target=_schedule_reads, name="BlockLoadScheduler", daemon=True),
+        threading.Thread(target=_convert, name="BlockConverter", daemon=True),
+    ]
+    for thread in threads:
+        thread.start()
+
+    try:
+        for _ in block_indices:
+            wait_start = time.perf_counter()
+            block_index, block, exception = converted_queue.get()
+            stage_times["wait"] += time.perf_counter() - wait_start
+            if exception is not None:
+                raise exception
+
+            consume_start = time.perf_counter()
+            yield block_index, block
+            stage_times["consume"] += time.perf_counter() - consume_start
+
+        logger.info(
+            f"Loaded {len(block_indices)} blocks in {time.perf_counter() - start_time:.1f} sec "
+            f"(reading: {stage_times['read']:.1f} sec in {num_io_threads} threads, "
+            f"converting: {stage_times['convert']:.1f} sec, creating backends: {stage_times['consume']:.1f} sec, "
+            f"waiting for blocks: {stage_times['wait']:.1f} sec)"
+        )
+    finally:
+        stop_event.set()
+        budget.cancel()
+        for thread in threads:
+            thread.join()
+        io_pool.shutdown(wait=True)
@@ -1,4 +1,5 @@
-from typing import Dict, List
+import heapq
+from typing import Dict, List, Optional
 
 import numpy as np
 from hypermind import PeerID, get_logger
@@ -21,13 +22,56 @@ def compute_throughputs(spans: Dict[PeerID, RemoteSpanInfo], *, total_blocks: in
 
 
 def _choose_best_start(throughputs: np.ndarray, num_blocks: int) -> int:
-    options = ((sorted(throughputs[i : i + num_blocks]), i) for i in range(0, len(throughputs) - num_blocks + 1))
-    return min(options)[-1]
-
-
-def choose_best_blocks(num_blocks: int, module_infos: List[RemoteModuleInfo]) -> List[int]:
+    """
+    Find the window of num_blocks consecutive blocks whose sorted throughputs are lexicographically smallest,
+    same as min((sorted(throughputs[i : i + num_blocks]), i) for all i) but in O(n log n) instead of O(n k log k)
+
+    We slide the window along the blocks and maintain the difference between the multisets of throughputs in
+    the current window and in the best window found so far. The current window is better iff the smallest value
+    whose counts differ occurs in it more times than in the best window.
+    """
+    throughputs = throughputs.tolist()
+    num_windows = len(throughputs) - num_blocks + 1
+    if num_windows <= 0:
+        raise ValueError(f"Cannot choose {num_blocks} blocks out of {len(throughputs)}")
+
+    best_start = 0
+    count_diff: Dict[float, int] = {}  # value -> count in the current window - count in the best window (non-zero)
+    diff_heap: List[float] = []  # a min-heap with the keys of count_diff, may also contain stale keys
+    for start in range(1, num_windows):
+        _update_count_diff(count_diff, diff_heap, throughputs[start + num_blocks - 1], +1)
+        _update_count_diff(count_diff, diff_heap, throughputs[start - 1], -1)
+        while diff_heap and diff_heap[0] not in count_diff:
+            heapq.heappop(diff_heap)
+        if diff_heap and count_diff[diff_heap[0]] > 0:
+            best_start = start  # ties keep the leftmost window, since equal windows have no differing values
+            count_diff.clear()
+            diff_heap.clear()
+    return best_start
+
+
+def _update_count_diff(count_diff: Dict[float, int], diff_heap: List[float], value: float, delta: int):
+    count = count_diff.get(value, 0) + delta
+    if count == 0:
+        del count_diff[value]
+        return
+    if value not in count_diff:
+        heapq.heappush(diff_heap, value)
+    count_diff[value] = count
+
+
+def choose_best_blocks(
+    num_blocks: int, module_infos: List[RemoteModuleInfo], local_peer_id: Optional[PeerID] = None
+) -> List[int]:
+    """
+    :param local_peer_id: if this server already serves some blocks, choose as if it didn't (preferring the current
+      span if other things are almost equal), see should_choose_other_blocks()
+    """
     spans = compute_spans(module_infos, min_state=ServerState.JOINING)
     throughputs = compute_throughputs(spans, total_blocks=len(module_infos))
+    if local_peer_id is not None and local_peer_id in spans:
+        local_span = spans[local_peer_id]
+        throughputs[local_span.start : local_span.end] -= local_span.throughput * (1 + 1e-3)
 
     start = _choose_best_start(throughputs, num_blocks)
     return list(range(start, start + num_blocks))
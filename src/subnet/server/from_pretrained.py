@@ -7,9 +7,13 @@ If necessary, one can rewrite this to implement a different behavior, such as:
 
 """
 import json
+import os
+import struct
+import threading
 import time
+from collections import defaultdict
 from contextlib import suppress
-from typing import Dict, Optional, Union
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, TypeVar, Union
 
 import safetensors
 import torch
@@ -42,11 +46,22 @@ def load_pretrained_block(
     token: Optional[Union[str, bool]] = None,
     cache_dir: Optional[str] = None,
     max_disk_space: Optional[int] = None,
+    weight_index: Optional["ModelWeightIndex"] = None,
 ) -> nn.Module:
+    """
+    Load one transformer block of a model to CPU
+
+    :param weight_index: an index of the model's weights shared across blocks (created for this block if None);
+      the index must be created for the same model_name, revision, and cache_dir
+    """
     if config is None:
         config = AutoDistributedConfig.from_pretrained(model_name, use_auth_token=token)
     if cache_dir is None:
         cache_dir = DEFAULT_CACHE_DIR
+    if weight_index is None:
+        weight_index = ModelWeightIndex(
+            model_name, revision=revision, token=token, cache_dir=cache_dir, max_disk_space=max_disk_space
+        )
 
     assert torch_dtype in DTYPE_MAP.values(), f"torch_dtype must be one of {list(DTYPE_MAP.values())}"
     torch_dtype = resolve_block_dtype(config, torch_dtype)
@@ -55,20 +70,14 @@ def load_pretrained_block(
         block = get_model_block(config, layer_idx=block_index)
 
     block_prefix = f"{config.block_prefix}.{block_index}."
-    state_dict = _load_state_dict_from_repo(
-        model_name,
-        block_prefix,
-        revision=revision,
-        token=token,
-        cache_dir=cache_dir,
-        max_disk_space=max_disk_space,
-    )
+    state_dict = weight_index.load_block_state_dict(block_prefix)
 
     for param_name, _ in block.named_parameters():
         assert param_name in state_dict, f"{param_name} not in state dict"
         param = state_dict[param_name]
-        if not str(param.dtype).startswith(("torch.uint", "torch.int", "torch.bool")):
+        if param.dtype != torch_dtype and not str(param.dtype).startswith(("torch.uint", "torch.int", "torch.bool")):
             param = param.to(torch_dtype)
+        # If dtypes match, the parameter is a view of the memory-mapped shard (pages are read from disk on first use)
         set_module_tensor_to_device(block, param_name, "cpu", value=param, dtype=param.dtype)
 
     logger.info(f"Loaded {model_name} block {block_index}")
@@ -78,54 +87,159 @@ def load_pretrained_block(
 StateDict = Dict[str, torch.Tensor]
 
 
-def _load_state_dict_from_repo(
-    model_name: str,
-    block_prefix: str,
-    *,
-    revision: Optional[str] = None,
-    token: Optional[Union[str, bool]] = None,
-    cache_dir: str,
-    max_disk_space: Optional[int] = None,
-) -> StateDict:
-    if always_needs_auth(model_name) and token is None:
-        token = True
-
-    index_file = _find_index_file(model_name, revision=revision, token=token, cache_dir=cache_dir)
-    if index_file.endswith(".index.json"):  # Sharded model
-        path = get_file_from_repo(model_name, filename=index_file, use_auth_token=token, cache_dir=cache_dir)
-        if path is None:
-            # _find_index_file() told that a file exists but we can't get it (e.g., it just disappeared)
-            raise ValueError(f"Failed to get file {index_file}")
-
-        with open(path) as f:
-            index = json.load(f)
+class ModelWeightIndex:
+    """
+    Locates the weights of a model's blocks, downloading the files when necessary. Created once per server,
+    so that we find the index file, parse it, and open each safetensors shard only once instead of for every block.
+
+    Safetensors shards are kept open and memory-mapped, so the tensors of a block are views of the mapped files
+    (no copies are made until the block is cast, quantized, or moved to a device). Before returning a block, we ask
+    the OS to read its byte ranges in background, so that the disk reads overlap with converting the previous blocks.
+    Pickled (.bin) weights can't be memory-mapped, so each block still loads the whole file as before.
+    This class is thread-safe.
+
+    :param model_name: a Hugging Face Hub repo with the model (or a path in the cache)
+    :param max_disk_space: if downloading a file requires more space, remove the least recently used files
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        *,
+        revision: Optional[str] = None,
+        token: Optional[Union[str, bool]] = None,
+        cache_dir: Optional[str] = None,
+        max_disk_space: Optional[int] = None,
+    ):
+        if always_needs_auth(model_name) and token is None:
+            token = True
+        if cache_dir is None:
+            cache_dir = DEFAULT_CACHE_DIR
+        self.model_name, self.revision, self.token = model_name, revision, token
+        self.cache_dir, self.max_disk_space = cache_dir, max_disk_space
+
+        self._lock = threading.Lock()
+        self._index_file: Optional[str] = None
+        self._weight_map: Optional[Dict[str, str]] = None  # param name -> filename, None for non-sharded models
+        self._file_locks: Dict[str, threading.Lock] = defaultdict(threading.Lock)
+        self._open_shards: Dict[str, Tuple[Any, str, Dict[str, Tuple[int, int]]]] = {}  # filename -> see _open_shard
+
+    def load_block_state_dict(self, block_prefix: str) -> StateDict:
+        """Load the parameters starting with block_prefix, return them with block_prefix removed from their names"""
+        filenames = self._find_block_files(block_prefix)
+        logger.debug(f"Loading {block_prefix}* from {filenames}")
+
+        state_dict = {}
+        for filename in filenames:
+            if filename.endswith(".safetensors"):
+                shard, path, tensor_ranges = self._open_shard(filename)
+                keys = [key for key in shard.keys() if key.startswith(block_prefix)]
+                _read_ahead(path, [tensor_ranges[key] for key in keys])
+                shard_state_dict = {key: shard.get_tensor(key) for key in keys}
+            else:
+                shard_state_dict = _load_state_dict_from_repo_file(
+                    self.model_name,
+                    filename,
+                    block_prefix=block_prefix,
+                    revision=self.revision,
+                    token=self.token,
+                    cache_dir=self.cache_dir,
+                    max_disk_space=self.max_disk_space,
+                )
+            shard_state_dict = {
+                param_name[len(block_prefix) :]: param
+                for param_name, param in shard_state_dict.items()
+                if param_name.startswith(block_prefix)
+            }  # Remove unused parameters from memory
+            state_dict.update(shard_state_dict)
+        return state_dict
+
+    def _find_block_files(self, block_prefix: str) -> Set[str]:
+        with self._lock:
+            if self._index_file is None:
+                index_file = _find_index_file(
+                    self.model_name, revision=self.revision, token=self.token, cache_dir=self.cache_dir
+                )
+                if index_file.endswith(".index.json"):  # Sharded model
+                    path = get_file_from_repo(
+                        self.model_name, filename=index_file, use_auth_token=self.token, cache_dir=self.cache_dir
+                    )
+                    if path is None:
+                        # _find_index_file() told that a file exists but we can't get it (e.g., it just disappeared)
+                        raise ValueError(f"Failed to get file {index_file}")
+                    with open(path) as f:
+                        self._weight_map = json.load(f)["weight_map"]
+                self._index_file = index_file
+
+        if self._weight_map is None:  # Non-sharded model
+            return {self._index_file}
         filenames = {
-            filename for param_name, filename in index["weight_map"].items() if param_name.startswith(block_prefix)
+            filename for param_name, filename in self._weight_map.items() if param_name.startswith(block_prefix)
         }
         if not filenames:
-            raise RuntimeError(f"Block {block_prefix}* not found in the index: {index['weight_map']}")
-    else:  # Non-sharded model
-        filenames = {index_file}
-    logger.debug(f"Loading {block_prefix}* from {filenames}")
-
-    state_dict = {}
-    for filename in filenames:
-        shard_state_dict = _load_state_dict_from_repo_file(
-            model_name,
-            filename,
-            block_prefix=block_prefix,
-            revision=revision,
-            token=token,
-            cache_dir=cache_dir,
-            max_disk_space=max_disk_space,
-        )
-        shard_state_dict = {
-            param_name[len(block_prefix) :]: param
-            for param_name, param in shard_state_dict.items()
-            if param_name.startswith(block_prefix)
-        }  # Remove unused parameters from memory
-        state_dict.update(shard_state_dict)
-    return state_dict
+            raise RuntimeError(f"Block {block_prefix}* not found in the index: {self._weight_map}")
+        return filenames
+
+    def _open_shard(self, filename: str) -> Tuple[Any, str, Dict[str, Tuple[int, int]]]:
+        """Returns an open safetensors handle, the local path, and the byte ranges of tensors in this file"""
+        with self._lock:
+            file_lock = self._file_locks[filename]
+        with file_lock:  # Other threads may load blocks from other shards meanwhile
+            if filename not in self._open_shards:
+                self._open_shards[filename] = _open_repo_file(
+                    self.model_name,
+                    filename,
+                    open_local_file=lambda path: (
+                        safetensors.safe_open(path, framework="pt", device="cpu"),
+                        path,
+                        _get_safetensors_ranges(path),
+                    ),
+                    revision=self.revision,
+                    token=self.token,
+                    cache_dir=self.cache_dir,
+                    max_disk_space=self.max_disk_space,
+                )
+            return self._open_shards[filename]
+
+    def close(self):
+        """Close the open shards (tensors that were already loaded remain valid)"""
+        with self._lock:
+            self._open_shards.clear()
+
+
+def _get_safetensors_ranges(path: str) -> Dict[str, Tuple[int, int]]:
+    """Parse the header of a safetensors file, return the byte range of each tensor within the file"""
+    with open(path, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+    data_start = 8 + header_size
+    return {
+        key: (data_start + info["data_offsets"][0], data_start + info["data_offsets"][1])
+        for key, info in header.items()
+        if key != "__metadata__"
+    }
+
+
+def _read_ahead(path: str, byte_ranges: List[Tuple[int, int]]):
+    """Ask the OS to read byte ranges of a file into the page cache in background (no-op if not supported)"""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        for start, end in _merge_ranges(byte_ranges):
+            os.posix_fadvise(fd, start, end - start, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+def _merge_ranges(byte_ranges: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    merged = []
+    for start, end in sorted(byte_ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
 
 
 INDEX_FILES = ["model.safetensors.index.json", "model.safetensors", "pytorch_model.bin.index.json", "pytorch_model.bin"]
@@ -170,6 +284,32 @@ def _load_state_dict_from_repo_file(
     max_disk_space: Optional[int] = None,
     delay: float = 30,
 ) -> StateDict:
+    return _open_repo_file(
+        model_name,
+        filename,
+        open_local_file=lambda path: _load_state_dict_from_local_file(path, block_prefix=block_prefix),
+        revision=revision,
+        token=token,
+        cache_dir=cache_dir,
+        max_disk_space=max_disk_space,
+        delay=delay,
+    )
+
+
+T = TypeVar("T")
+
+
+def _open_repo_file(
+    model_name: str,
+    filename: str,
+    *,
+    open_local_file: Callable[[str], T],
+    revision: Optional[str] = None,
+    token: Optional[Union[str, bool]] = None,
+    cache_dir: str,
+    max_disk_space: Optional[int] = None,
+    delay: float = 30,
+) -> T:
     # First, try to find the weights locally
     try:
         with allow_cache_reads(cache_dir):
@@ -182,7 +322,7 @@ def _load_state_dict_from_repo_file(
                 local_files_only=True,
             )
             if path is not None:
-                return _load_state_dict_from_local_file(path, block_prefix=block_prefix)
+                return open_local_file(path)
     except Exception:
         logger.warning(f"Cache for file {filename} is corrupted, it will be downloaded again", exc_info=True)
 
@@ -207,7 +347,7 @@ def _load_state_dict_from_repo_file(
                 )
                 if path is None:
                     raise RuntimeError(f"File {filename} does not exist in repo {model_name}")
-                return _load_state_dict_from_local_file(path, block_prefix=block_prefix)
+                return open_local_file(path)
         except Exception as e:
             logger.warning(f"Failed to load file {filename} from HF Hub (retry in {delay:.0f} sec)", exc_info=True)
             time.sleep(delay)
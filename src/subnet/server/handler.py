@@ -2,6 +2,7 @@ from __future__ import annotations
 
 import asyncio
 import contextlib
+import ctypes
 import multiprocessing as mp
 import sys
 from enum import Enum
@@ -31,8 +32,17 @@ from hypermind.utils.streaming import split_for_streaming
 import subnet
 from subnet.data_structures import CHAIN_DELIMITER, UID_DELIMITER, Handle, ModuleUID
 from subnet.server.backend import TransformerBackend
-from subnet.server.block_functions import iterate_rpc_inference, run_rpc_backward, run_rpc_forward
-from subnet.server.task_prioritizer import DummyTaskPrioritizer, TaskPrioritizerBase
+from subnet.server.activation_cache import ActivationCache
+from subnet.server.block_functions import (
+    DEFAULT_ATTENTION_SINKS,
+    get_deadline,
+    iterate_rpc_inference,
+    run_rpc_backward,
+    run_rpc_forward,
+)
+from subnet.server.session_directory import SessionDirectory
+from subnet.server.shared_memory import SharedTensorRing, set_local_ring
+from subnet.server.task_prioritizer import TaskPrioritizerBase, TokenAwareTaskPrioritizer
 from subnet.utils.convert_block import QuantType
 
 logger = get_logger(__name__)
@@ -46,10 +56,9 @@ CACHE_TOKENS_AVAILABLE = "cache_tokens_available"
 
 
 class Event(Enum):
-    NEW_SESSION = 0
-    END_SESSION = 1
     PUSH = 2
     SHUTDOWN = 3
+    STOP_ACCEPTING = 4
 
 
 class TransformerConnectionHandler(ConnectionHandler):
@@ -70,8 +79,13 @@ class TransformerConnectionHandler(ConnectionHandler):
         request_timeout: float,
         session_timeout: float,
         step_timeout: float,
-        task_prioritizer: TaskPrioritizerBase = DummyTaskPrioritizer(),
+        task_prioritizer: TaskPrioritizerBase = TokenAwareTaskPrioritizer(),
+        max_prefill_chunk_tokens: Optional[int] = None,
         quant_type: QuantType,
+        draining: Optional[mp.Event] = None,
+        shared_tensor_ring: Optional[SharedTensorRing] = None,
+        session_directory: Optional[SessionDirectory] = None,
+        activation_cache: Optional[ActivationCache] = None,
     ):
         super().__init__(dht, module_backends)
         for module_backend in self.module_backends.values():
@@ -83,13 +97,24 @@ class TransformerConnectionHandler(ConnectionHandler):
         self._own_event_queue = handler_event_queues[handler_index]
         self._listener_task: Optional[asyncio.Task] = None
         self._session_queues: Dict[str, asyncio.Queue] = {}
-        self._session_handlers: Dict[str, int] = {}
+        # Maps sessions of all handlers to their handler indices, should be shared by all handlers of a server
+        self._session_directory = session_directory if session_directory is not None else SessionDirectory()
 
         self.inference_max_length = inference_max_length
         self.request_timeout = request_timeout
         self.session_timeout, self.step_timeout = session_timeout, step_timeout
         self._prioritizer = task_prioritizer
+        self.max_prefill_chunk_tokens = max_prefill_chunk_tokens
         self.quant_type = quant_type
+        self._draining = draining  # if set, the server is retiring these blocks and only finishes existing sessions
+        self.stopped_accepting = mp.Event()  # set once the handler removed its RPC handlers, see ModuleContainer
+        self._num_sessions = mp.Value(ctypes.c_int64, 0, lock=False)  # only changed by this handler's event loop
+        self._shared_tensor_ring = shared_tensor_ring
+        self._activation_cache = activation_cache  # should be shared by all handlers, like the session directory
+
+    def run(self):
+        set_local_ring(self._shared_tensor_ring)  # tasks submitted by this process pass tensors through the ring
+        super().run()
 
     async def add_p2p_handlers(self, *args, **kwargs) -> None:
         if self._listener_task is None:
@@ -97,6 +122,20 @@ class TransformerConnectionHandler(ConnectionHandler):
             self._listener_task = asyncio.create_task(self._listen_to_event_queue())
         await super().add_p2p_handlers(*args, **kwargs)
 
+    async def remove_p2p_handlers(self, *args, **kwargs) -> None:
+        if not self.stopped_accepting.is_set():  # otherwise, they were removed by stop_accepting_requests()
+            await super().remove_p2p_handlers(*args, **kwargs)
+
+    @property
+    def num_sessions(self) -> int:
+        """The number of inference sessions that this handler runs (or that wait for memory), visible to any process"""
+        return self._num_sessions.value
+
+    def stop_accepting_requests(self):
+        """Remove the RPC handlers, so that new requests go to other processes, while the current ones continue"""
+        if self.is_alive():
+            self._own_event_queue.put((Event.STOP_ACCEPTING, None, None))
+
     def shutdown(self):
         if self.is_alive():
             self._outer_pipe.send("_shutdown")
@@ -144,7 +183,10 @@ class TransformerConnectionHandler(ConnectionHandler):
 
             requested_uids = self._check_uids(request.uid)
             self._log_request("rpc_inference.open", requested_uids, context)
+            self._num_sessions.value += 1
             try:
+                if self._draining is not None and self._draining.is_set():
+                    raise RuntimeError("This server is moving to other blocks and does not accept new sessions")
                 metadata = MSGPackSerializer.loads(request.metadata) if request.metadata else {}
                 requested_backends = tuple(self.module_backends[uid] for uid in requested_uids)
                 max_length = metadata.get("max_length")
@@ -152,6 +194,8 @@ class TransformerConnectionHandler(ConnectionHandler):
                 session_id = metadata.get("session_id")
                 alloc_timeout = float(metadata.get("alloc_timeout", 0.0))
                 args_structure = metadata.get("args_structure")
+                sliding_window = metadata.get("sliding_window")
+                attention_sinks = 0
                 if not requested_uids:
                     raise ValueError("User must specify at least one block for inference, but got none")
                 assert isinstance(
@@ -160,15 +204,28 @@ class TransformerConnectionHandler(ConnectionHandler):
                 assert isinstance(
                     points, (float, int)
                 ), f"rpc_inference should have number of points as a number or None, got {points}"
+                if sliding_window is not None:
+                    # The session may be longer than max_length, since its cache only keeps sinks and recent tokens
+                    attention_sinks = metadata.get("attention_sinks", DEFAULT_ATTENTION_SINKS)
+                    assert isinstance(sliding_window, int) and isinstance(
+                        attention_sinks, int
+                    ), f"sliding_window and attention_sinks must be int, got {sliding_window}, {attention_sinks}"
+                    if sliding_window <= 0 or attention_sinks < 0:
+                        raise ValueError(f"Invalid sliding_window={sliding_window}, attention_sinks={attention_sinks}")
+                    if not all(backend.supports_attention_sinks for backend in requested_backends):
+                        raise ValueError("Requested blocks do not support sliding-window sessions")
+                    max_length = attention_sinks + sliding_window
                 if not 0 <= max_length <= self.inference_max_length:
                     raise ValueError(
                         f"Cannot allocate KV cache for {max_length} tokens, max = {self.inference_max_length}"
                     )
 
                 batch_size = request.tensors[0].size[0] if request.tensors else 1
+                # The cache starts with one page and grows on demand, see iterate_rpc_inference
+                cache_length = min(max_length, requested_backends[0].memory_cache.page_size)
 
                 async with self._allocate_cache(
-                    requested_backends, batch_size=batch_size, max_length=max_length, timeout=alloc_timeout
+                    requested_backends, batch_size=batch_size, length=cache_length, timeout=alloc_timeout
                 ) as cache_handles:
                     background_tasks = set()
                     async for output_tensors, can_push, step_metadata in iterate_rpc_inference(
@@ -179,10 +236,16 @@ class TransformerConnectionHandler(ConnectionHandler):
                             request, requests, session_id, requested_uids, context
                         ),
                         cache_handles=cache_handles,
+                        cache_length=cache_length,
                         max_length=max_length,
                         prioritizer=self._prioritizer,
                         points=points,
                         quant_type=self.quant_type,
+                        max_prefill_chunk_tokens=self.max_prefill_chunk_tokens,
+                        attention_sinks=attention_sinks,
+                        sliding_window=sliding_window,
+                        deadline=get_deadline(metadata),
+                        peer_id=context.remote_id,
                         args_structure=args_structure,
                     ):
                         if can_push:
@@ -192,6 +255,7 @@ class TransformerConnectionHandler(ConnectionHandler):
                         yield runtime_pb2.ExpertResponse(tensors=output_tensors)
 
             finally:
+                self._num_sessions.value -= 1
                 self._log_request("rpc_inference.close", requested_uids, context)
 
     @contextlib.contextmanager
@@ -199,20 +263,17 @@ class TransformerConnectionHandler(ConnectionHandler):
         assert session_id not in self._session_queues, f"session id {session_id} is not unique"
         try:
             self._session_queues[session_id] = asyncio.Queue()
-            self._session_handlers[session_id] = self._handler_index
-            for other_index, other_queue in enumerate(self._handler_event_queues):
-                if other_index != self._handler_index:
-                    other_queue.put_nowait((Event.NEW_SESSION, session_id, self._handler_index))
+            self._session_directory.add(session_id, self._handler_index)
             yield
         finally:
             self._session_queues.pop(session_id).put_nowait(None)  # put None so that the get task will not hang
-            del self._session_handlers[session_id]
-            for other_index, other_queue in enumerate(self._handler_event_queues):
-                if other_index != self._handler_index:
-                    other_queue.put_nowait((Event.END_SESSION, session_id, self._handler_index))
+            self._session_directory.remove(session_id)
 
     def _put_into_session_queue(self, session_id: str, request: runtime_pb2.ExpertRequest):
-        handler_index = self._session_handlers.get(session_id)
+        if session_id in self._session_queues:
+            handler_index = self._handler_index  # no need to look up our own sessions in shared memory
+        else:
+            handler_index = self._session_directory.get(session_id)
         if handler_index is None:
             logger.debug(f"Ignored rpc_push to unknown session ID: {session_id}")
         elif handler_index == self._handler_index:
@@ -221,7 +282,7 @@ class TransformerConnectionHandler(ConnectionHandler):
             self._handler_event_queues[handler_index].put_nowait((Event.PUSH, session_id, request))
 
     async def _get_from_session_queue(self, session_id: str) -> Optional[runtime_pb2.ExpertRequest]:
-        assert self._session_handlers[session_id] == self._handler_index, "session belongs to another handler"
+        assert session_id in self._session_queues, "session belongs to another handler"
         return await self._session_queues[session_id].get()
 
     async def _listen_to_event_queue(self):
@@ -231,10 +292,9 @@ class TransformerConnectionHandler(ConnectionHandler):
                 event, session_id, payload = await loop.run_in_executor(None, self._own_event_queue.get)
                 if event == Event.SHUTDOWN:
                     break
-                elif event == Event.NEW_SESSION:
-                    self._session_handlers[session_id] = payload  # index of the handler that owns that session
-                elif event == Event.END_SESSION:
-                    self._session_handlers.pop(session_id, None)
+                elif event == Event.STOP_ACCEPTING:
+                    await self.remove_p2p_handlers(self._p2p)
+                    self.stopped_accepting.set()
                 elif event == Event.PUSH:
                     maybe_session_queue = self._session_queues.get(session_id)
                     if maybe_session_queue is not None:
@@ -371,6 +431,10 @@ class TransformerConnectionHandler(ConnectionHandler):
                 prioritizer=self._prioritizer,
                 active_adapter=active_adapter,
                 points=points,
+                deadline=get_deadline(metadata),
+                peer_id=context.remote_id,
+                activation_cache=self._activation_cache,
+                activation_cache_key=self._get_activation_cache_key(metadata, requested_uids, active_adapter, context),
                 args_structure=args_structure,
             )
             return runtime_pb2.ExpertResponse(
@@ -400,6 +464,10 @@ class TransformerConnectionHandler(ConnectionHandler):
                 prioritizer=self._prioritizer,
                 active_adapter=active_adapter,
                 points=points,
+                deadline=get_deadline(metadata),
+                peer_id=context.remote_id,
+                activation_cache=self._activation_cache,
+                activation_cache_key=self._get_activation_cache_key(metadata, requested_uids, active_adapter, context),
                 args_structure=args_structure,
             )
 
@@ -453,6 +521,10 @@ class TransformerConnectionHandler(ConnectionHandler):
                 prioritizer=self._prioritizer,
                 active_adapter=active_adapter,
                 points=points,
+                deadline=get_deadline(metadata),
+                peer_id=context.remote_id,
+                activation_cache=self._activation_cache,
+                activation_cache_key=self._get_activation_cache_key(metadata, requested_uids, active_adapter, context),
                 args_structure=args_structure,
             )
 
@@ -480,6 +552,10 @@ class TransformerConnectionHandler(ConnectionHandler):
                 prioritizer=self._prioritizer,
                 active_adapter=active_adapter,
                 points=points,
+                deadline=get_deadline(metadata),
+                peer_id=context.remote_id,
+                activation_cache=self._activation_cache,
+                activation_cache_key=self._get_activation_cache_key(metadata, requested_uids, active_adapter, context),
                 args_structure=args_structure,
             )
             # Split the serialized_grad_inputs for streaming and respond
@@ -487,6 +563,17 @@ class TransformerConnectionHandler(ConnectionHandler):
                 for part in split_for_streaming(tensor, DEFAULT_MAX_MSG_SIZE):
                     yield runtime_pb2.ExpertResponse(tensors=[part])
 
+    def _get_activation_cache_key(
+        self, metadata: dict, requested_uids: Sequence[ModuleUID], active_adapter: str, context: P2PContext
+    ) -> Optional[str]:
+        """Combine the client's activation_cache_key with the client's peer id and the span it requested"""
+        request_key = metadata.get("activation_cache_key")
+        if self._activation_cache is None or request_key is None:
+            return None
+        if not isinstance(request_key, str):
+            raise ValueError(f"activation_cache_key must be a string, got {type(request_key)}")
+        return f"{context.remote_id} {request_key} {CHAIN_DELIMITER.join(requested_uids)} {active_adapter}"
+
     def _get_active_adapter(self, metadata: dict) -> str:
         active_adapter = metadata.get("active_adapter", "")
         if active_adapter and (active_adapter not in self.adapters):
@@ -535,14 +622,15 @@ class TransformerConnectionHandler(ConnectionHandler):
         backends: Sequence[TransformerBackend],
         *,
         batch_size: int,
-        max_length: int,
+        length: int,
         timeout: Optional[float],
     ) -> Sequence[Sequence[Handle]]: # type: ignore
         """
         Allocate memory cache for all transformer blocks, return cache handle
+        :param length: the initial number of tokens in the cache, it can be grown later with resize_cache
         :returns: a list of {len(backends)} elements, where i-th element is a tuple of cache handles for i-th backend
         """
-        descriptors = [backend.get_inference_cache_descriptors(batch_size, max_length) for backend in backends]
+        descriptors = [backend.get_inference_cache_descriptors(batch_size, length) for backend in backends]
         async with backends[0].memory_cache.allocate_cache(*chain(*descriptors), timeout=timeout) as handles:
             yield nested_pack(handles, descriptors)
 
@@ -579,8 +667,19 @@ class TransformerConnectionHandler(ConnectionHandler):
         result = {
             "version": subnet.__version__,
             "dht_client_mode": self.dht.client_mode,
-            CACHE_TOKENS_AVAILABLE: backend.memory_cache.bytes_left // max(backend.cache_bytes_per_token.values()),
+            CACHE_TOKENS_AVAILABLE: backend.memory_cache.get_tokens_left(max(backend.cache_bytes_per_token.values())),
         }
+        if backend.memory_cache.prefix_cache.enabled:
+            result.update(backend.memory_cache.prefix_cache.get_stats())
+        if backend.memory_cache.offloader.enabled:
+            result.update(backend.memory_cache.offloader.get_stats())
+        pools = {pool for module_backend in self.module_backends.values() for pool in module_backend.get_pools()}
+        result["cancelled_tasks_skipped"] = sum(pool.num_skipped_tasks for pool in pools)
+        if self._activation_cache is not None:
+            result.update(self._activation_cache.get_stats())
+        if backend.forward_pool.max_tasks_per_batch > 1:
+            result["forward_batching"] = backend.forward_pool.get_batching_stats()
+            result["backward_batching"] = backend.backward_pool.get_batching_stats()
 
         if request.uid:
             block_info = self.module_backends[request.uid].get_info()
@@ -0,0 +1,402 @@
+"""
+Tiered offloading of attention caches that belong to idle inference sessions.
+
+A client may keep an inference session open for minutes between steps (e.g., while a user reads the output), and its
+attention cache keeps taking device memory that other sessions wait for. CacheOffloader moves the caches of sessions
+that did not run a step for a while to pinned host memory and, once the host tier is full, to files on local disk.
+When such a session runs its next step (or resizes its cache), the runtime moves the cache back to the device before
+TransformerBackend.inference_step uses it, so the offloading is transparent for the client.
+
+Only the runtime process moves the tensors. The device memory of an offloaded cache is returned to the MemoryCache,
+and the cache is registered in a SessionDirectory shared with ConnectionHandlers: before a step, a handler that finds
+its cache offloaded waits until the cache fits into the device memory (like a new allocation), takes it out of the
+directory, and accounts for the memory it will take when the runtime moves it back (see reserve_offloaded_cache).
+Both sides update the directory under MemoryCache._lock_metadata, so each byte is accounted for exactly once.
+If the runtime has to restore a cache nobody reserved memory for (e.g., it was offloaded after the handler checked),
+it offloads other caches to make room, and fails the step if that is not enough.
+"""
+from __future__ import annotations
+
+import ctypes
+import dataclasses
+import multiprocessing as mp
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Set, Tuple
+
+import torch
+from hypermind.utils import TensorDescriptor, get_logger
+
+from subnet.data_structures import Handle
+from subnet.server.session_directory import SessionDirectory
+from subnet.utils.misc import get_size_in_bytes
+
+if TYPE_CHECKING:
+    from subnet.server.memory_cache import MemoryCache
+
+logger = get_logger(__name__)
+
+OFFLOAD_POLICIES = ("idle", "on_demand")
+_HOST_TIER, _DISK_TIER = 1, 2
+_TIER_NAMES = {_HOST_TIER: "host memory", _DISK_TIER: "disk"}
+
+
+@dataclasses.dataclass
+class _OffloadedCache:
+    """The tensors of one allocate_cache call, along with where they are stored at the moment"""
+
+    handles: Tuple[Handle, ...]
+    size_bytes: int  # device memory accounted by MemoryCache for these tensors
+    last_used: float
+    tier: Optional[int] = None  # None if the tensors are on the device
+    host_tensors: Optional[List[torch.Tensor]] = None
+    disk_path: Optional[str] = None
+    shapes: Optional[List[torch.Size]] = None
+    dtypes: Optional[List[torch.dtype]] = None
+    devices: Optional[List[torch.device]] = None
+
+    @property
+    def key(self) -> str:
+        return str(self.handles[0])
+
+    @property
+    def nbytes(self) -> int:
+        return sum(shape.numel() * get_size_in_bytes(dtype) for shape, dtype in zip(self.shapes, self.dtypes))
+
+
+class CacheOffloader:
+    """
+    Moves attention caches of idle sessions to host memory and disk in the runtime process, see the module docstring
+
+    :param memory_cache: the MemoryCache that holds the caches on the device
+    :param max_host_bytes: offloaded caches take at most this many bytes of pinned host memory
+    :param max_disk_bytes: caches that don't fit into host memory take at most this many bytes on disk
+    :param offload_dir: a directory for the files of caches offloaded to disk
+    :param idle_timeout: caches of sessions that did not run a step for this many seconds may be offloaded
+    :param policy: "idle" offloads all caches that are idle for longer than idle_timeout, "on_demand" only offloads
+      them (least recently used first) when other sessions wait for memory
+    """
+
+    def __init__(
+        self,
+        memory_cache: MemoryCache,
+        max_host_bytes: int = 0,
+        max_disk_bytes: int = 0,
+        offload_dir: Optional[str] = None,
+        idle_timeout: float = 60.0,
+        policy: str = "idle",
+    ):
+        assert policy in OFFLOAD_POLICIES, f"policy must be one of {OFFLOAD_POLICIES}, got {policy}"
+        assert max_disk_bytes == 0 or offload_dir is not None, "offload_dir is required to offload caches to disk"
+        self.memory_cache = memory_cache
+        self.max_host_bytes, self.max_disk_bytes = max_host_bytes, max_disk_bytes
+        self.offload_dir, self.idle_timeout, self.policy = offload_dir, idle_timeout, policy
+
+        self._caches: OrderedDict[Tuple[Handle, ...], _OffloadedCache] = OrderedDict()  # only valid inside runtime
+        self._handle_to_cache: Dict[Handle, _OffloadedCache] = {}  # only valid inside runtime
+        self._directory = SessionDirectory() if self.enabled else None  # caches offloaded at the moment
+
+        self._host_bytes = mp.Value(ctypes.c_int64, 0, lock=False)
+        self._disk_bytes = mp.Value(ctypes.c_int64, 0, lock=False)
+        self._swap_out_bytes = mp.Value(ctypes.c_int64, 0, lock=False)
+        self._swap_in_bytes = mp.Value(ctypes.c_int64, 0, lock=False)
+        self._num_swap_outs = mp.Value(ctypes.c_int64, 0, lock=False)
+        self._num_swap_ins = mp.Value(ctypes.c_int64, 0, lock=False)
+        self._swap_out_seconds = mp.Value(ctypes.c_double, 0.0, lock=False)
+        self._swap_in_seconds = mp.Value(ctypes.c_double, 0.0, lock=False)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_host_bytes > 0 or self.max_disk_bytes > 0
+
+    @property
+    def bytes_left(self) -> int:
+        """The free space in host memory and on disk for offloaded caches, works anywhere"""
+        return max(0, self.max_host_bytes - self._host_bytes.value) + max(
+            0, self.max_disk_bytes - self._disk_bytes.value
+        )
+
+    def get_stats(self) -> Dict[str, float]:
+        """Return the sizes of the offload tiers and the bytes and time spent on moving caches, works anywhere"""
+        return dict(
+            kv_offload_host_bytes=self._host_bytes.value,
+            kv_offload_disk_bytes=self._disk_bytes.value,
+            kv_swap_outs=self._num_swap_outs.value,
+            kv_swap_out_bytes=self._swap_out_bytes.value,
+            kv_swap_out_seconds=self._swap_out_seconds.value,
+            kv_swap_ins=self._num_swap_ins.value,
+            kv_swap_in_bytes=self._swap_in_bytes.value,
+            kv_swap_in_seconds=self._swap_in_seconds.value,
+        )
+
+    def is_offloaded(self, handles: Tuple[Handle, ...]) -> bool:
+        """Check if a cache is offloaded and no handler has reserved device memory for it yet, works anywhere"""
+        return self.enabled and self._directory.get(str(handles[0])) is not None
+
+    def reclaim(self, handles: Tuple[Handle, ...]) -> bool:
+        """
+        Take an offloaded cache out of the directory before a handler frees or resizes it (must hold _lock_metadata)
+
+        :returns: True if the cache was offloaded, so that its memory is no longer accounted for by MemoryCache
+        """
+        if not self.enabled or self._directory.get(str(handles[0])) is None:
+            return False
+        self._directory.remove(str(handles[0]))
+        return True
+
+    def track(self, handles: Tuple[Handle, ...], size_bytes: int):
+        """Remember that the runtime has allocated or resized these tensors"""
+        assert os.getpid() == self.memory_cache.runtime_pid, "must be called by runtime"
+        if not self.enabled:
+            return
+        cache = self._caches.get(handles)
+        if cache is None:
+            cache = self._caches[handles] = _OffloadedCache(handles, size_bytes, last_used=time.perf_counter())
+            self._handle_to_cache.update((handle, cache) for handle in handles)
+        cache.size_bytes, cache.last_used = size_bytes, time.perf_counter()
+        self._caches.move_to_end(handles)
+
+    def forget(self, handles: Tuple[Handle, ...]) -> bool:
+        """Drop the offloaded copy of the tensors freed by a handler, return True if they were offloaded"""
+        assert os.getpid() == self.memory_cache.runtime_pid, "must be called by runtime"
+        cache = self._caches.pop(handles, None) if self.enabled else None
+        if cache is None:
+            return False
+        for handle in handles:
+            self._handle_to_cache.pop(handle, None)
+        was_offloaded = cache.tier is not None
+        self._drop_offloaded_copy(cache)
+        return was_offloaded
+
+    def restore(self, handles: Sequence[Handle], new_descriptors: Optional[Sequence[TensorDescriptor]] = None) -> bool:
+        """
+        Move the caches that contain any of these handles back to the device and mark them as recently used
+
+        :param new_descriptors: if specified, the handles are being resized to these descriptors, so an offloaded cache
+          is moved straight into new zero-initialized tensors of these shapes instead of copying it on the device
+        :returns: True if the cache was restored into the new tensors (only if new_descriptors are specified)
+        """
+        assert os.getpid() == self.memory_cache.runtime_pid, "must be called by runtime"
+        if not self.enabled:
+            return False
+        now = time.perf_counter()
+        used_caches = {id(self._handle_to_cache[handle]) for handle in handles if handle in self._handle_to_cache}
+        resized = False
+        for handle in handles:
+            cache = self._handle_to_cache.get(handle)
+            if cache is None:
+                continue  # unknown handles are reported by MemoryCache.use_cache
+            if cache.tier is not None:
+                if new_descriptors is not None:
+                    assert cache.handles == tuple(handles), "a resize must include all handles of an allocation"
+                self._swap_in(cache, exclude=used_caches, new_descriptors=new_descriptors)
+                resized = new_descriptors is not None
+            cache.last_used = now
+            self._caches.move_to_end(cache.handles)
+        return resized
+
+    def offload_idle(self, exclude: Sequence[Handle] = ()):
+        """Offload the caches of idle sessions according to the policy, except for the caches with these handles"""
+        assert os.getpid() == self.memory_cache.runtime_pid, "must be called by runtime"
+        if not self.enabled:
+            return
+        excluded = {id(self._handle_to_cache[handle]) for handle in exclude if handle in self._handle_to_cache}
+        deadline = time.perf_counter() - self.idle_timeout
+        for cache in list(self._caches.values()):  # from the least recently used to the most recently used
+            if cache.last_used > deadline:
+                break
+            if self.policy == "on_demand" and self.memory_cache.bytes_requested_by_sessions <= 0:
+                break
+            if cache.tier is None and id(cache) not in excluded and not self._swap_out(cache):
+                break  # no space left in the offload tiers or the cache was resized in the meantime
+
+    def close(self):
+        """Remove the files of caches offloaded to disk"""
+        for cache in self._caches.values():
+            self._drop_offloaded_copy(cache)
+        self._caches.clear()
+        self._handle_to_cache.clear()
+
+    def _swap_out(self, cache: _OffloadedCache) -> bool:
+        tensors = [self.memory_cache._allocated_tensors[handle] for handle in cache.handles]
+        cache.shapes = [tensor.shape for tensor in tensors]
+        cache.dtypes = [tensor.dtype for tensor in tensors]
+        cache.devices = [tensor.device for tensor in tensors]
+        nbytes = cache.nbytes
+        tier = self._reserve(nbytes, exclude=cache)
+        if tier is None:
+            return False
+
+        start_time = time.perf_counter()
+        cache.host_tensors = [_copy_to_host(tensor) for tensor in tensors]
+        _synchronize(cache.devices)
+        if tier == _DISK_TIER:
+            self._write_to_disk(cache)
+
+        with self.memory_cache._lock_metadata:
+            if self.memory_cache._pipe_recv.poll():
+                # A handler may have resized or freed this cache, so its size may differ from what the handler knows
+                self._drop_offloaded_copy(cache, tier)
+                return False
+            self._directory.add(cache.key, tier)
+            self.memory_cache.current_size_bytes -= cache.size_bytes
+        for handle in cache.handles:
+            del self.memory_cache._allocated_tensors[handle]
+        cache.tier = tier
+        self.memory_cache._memory_freed_event.set()
+
+        elapsed_time = time.perf_counter() - start_time
+        self._num_swap_outs.value += 1
+        self._swap_out_bytes.value += nbytes
+        self._swap_out_seconds.value += elapsed_time
+        logger.debug(f"Offloaded {nbytes} bytes of attention cache to {_TIER_NAMES[tier]} in {elapsed_time:.3f} sec")
+        return True
+
+    def _swap_in(
+        self, cache: _OffloadedCache, exclude: Set[int], new_descriptors: Optional[Sequence[TensorDescriptor]] = None
+    ):
+        self._reserve_device_memory(cache, exclude)
+        start_time = time.perf_counter()
+        nbytes, tier = cache.nbytes, cache.tier
+        if tier == _DISK_TIER:
+            self._read_from_disk(cache)
+        if new_descriptors is None:
+            tensors = [
+                host_tensor.to(device, non_blocking=True)
+                for host_tensor, device in zip(cache.host_tensors, cache.devices)
+            ]
+        else:
+            tensors = [descr.make_zeros() for descr in new_descriptors]
+            for tensor, host_tensor in zip(tensors, cache.host_tensors):
+                tensor[tuple(slice(0, size) for size in host_tensor.shape)].copy_(host_tensor, non_blocking=True)
+        _synchronize(cache.devices)
+        self._drop_offloaded_copy(cache)
+        self.memory_cache._allocated_tensors.update(zip(cache.handles, tensors))
+
+        elapsed_time = time.perf_counter() - start_time
+        self._num_swap_ins.value += 1
+        self._swap_in_bytes.value += nbytes
+        self._swap_in_seconds.value += elapsed_time
+        logger.debug(f"Restored {nbytes} bytes of attention cache from {_TIER_NAMES[tier]} in {elapsed_time:.3f} sec")
+
+    def _reserve_device_memory(self, cache: _OffloadedCache, exclude: Set[int]):
+        """
+        Make sure the device memory of an offloaded cache is accounted for before moving it back. Usually, the handler
+        has done it already (see MemoryCache.reserve_offloaded_cache). Otherwise, we take the free memory or offload
+        other caches (least recently used first, except for the ones in exclude) to make room.
+        """
+        if not self.is_offloaded(cache.handles):
+            return  # a handler has accounted for this memory
+        for other_cache in list(self._caches.values()):
+            if self.memory_cache.try_reserve(cache.size_bytes):
+                break
+            if other_cache.tier is None and id(other_cache) not in exclude:
+                self._swap_out(other_cache)
+        else:
+            if not self.memory_cache.try_reserve(cache.size_bytes):
+                from subnet.server.memory_cache import AllocationFailed  # avoid a circular import
+
+                raise AllocationFailed(f"Could not restore {cache.size_bytes} bytes of offloaded attention cache")
+
+        with self.memory_cache._lock_metadata:
+            reserved_by_handler = self._directory.get(cache.key) is None
+            if not reserved_by_handler:
+                self._directory.remove(cache.key)
+        if reserved_by_handler:  # a handler has accounted for this memory in the meantime
+            self.memory_cache.release(cache.size_bytes)
+
+    def _reserve(self, nbytes: int, exclude: _OffloadedCache) -> Optional[int]:
+        """Take nbytes in host memory or on disk, moving the least recently used caches from host memory to disk"""
+        if nbytes <= self.max_host_bytes:
+            for cache in list(self._caches.values()):
+                if self._host_bytes.value + nbytes <= self.max_host_bytes:
+                    break
+                if cache.tier == _HOST_TIER and cache is not exclude:
+                    if self._disk_bytes.value + cache.nbytes > self.max_disk_bytes:
+                        break
+                    self._move_to_disk(cache)
+            if self._host_bytes.value + nbytes <= self.max_host_bytes:
+                self._host_bytes.value += nbytes
+                return _HOST_TIER
+        if self._disk_bytes.value + nbytes <= self.max_disk_bytes:
+            self._disk_bytes.value += nbytes
+            return _DISK_TIER
+        return None
+
+    def _move_to_disk(self, cache: _OffloadedCache):
+        start_time = time.perf_counter()
+        self._write_to_disk(cache)
+        self._host_bytes.value -= cache.nbytes
+        self._disk_bytes.value += cache.nbytes
+        cache.tier = _DISK_TIER
+        self._directory.add(cache.key, _DISK_TIER)
+        logger.debug(
+            f"Moved {cache.nbytes} bytes of attention cache to disk in {time.perf_counter() - start_time:.3f} sec"
+        )
+
+    def _write_to_disk(self, cache: _OffloadedCache):
+        """Write cache.host_tensors to a memory-mapped file and free them"""
+        os.makedirs(self.offload_dir, exist_ok=True)
+        cache.disk_path = os.path.join(self.offload_dir, f"{os.getpid()}_{cache.key}.bin")
+        mapped = torch.from_file(cache.disk_path, shared=True, size=cache.nbytes, dtype=torch.uint8)
+        offset = 0
+        for tensor in cache.host_tensors:
+            tensor_bytes = tensor.numel() * tensor.element_size()
+            mapped[offset : offset + tensor_bytes].view(tensor.dtype).view(tensor.shape).copy_(tensor)
+            offset += tensor_bytes
+        cache.host_tensors = None
+
+    def _read_from_disk(self, cache: _OffloadedCache):
+        mapped = torch.from_file(cache.disk_path, shared=False, size=cache.nbytes, dtype=torch.uint8)
+        cache.host_tensors, offset = [], 0
+        for shape, dtype in zip(cache.shapes, cache.dtypes):
+            tensor_bytes = shape.numel() * get_size_in_bytes(dtype)
+            cache.host_tensors.append(mapped[offset : offset + tensor_bytes].view(dtype).view(shape))
+            offset += tensor_bytes
+
+    def _drop_offloaded_copy(self, cache: _OffloadedCache, tier: Optional[int] = None):
+        """Free the host memory or the file of the cache and return its space to the tier"""
+        tier = tier if tier is not None else cache.tier
+        if tier == _HOST_TIER:
+            self._host_bytes.value -= cache.nbytes
+        elif tier == _DISK_TIER:
+            self._disk_bytes.value -= cache.nbytes
+        if cache.disk_path is not None:
+            try:
+                os.remove(cache.disk_path)
+            except OSError as e:
+                logger.warning(f"Failed to remove offloaded attention cache {cache.disk_path}: {e}")
+        cache.host_tensors, cache.disk_path, cache.tier = None, None, None
+
+
+class CacheOffloadThread(threading.Thread):
+    """Periodically offloads the caches of idle sessions, so that it happens even if the runtime has no other work"""
+
+    def __init__(self, memory_cache: MemoryCache, period: float = 1.0):
+        super().__init__(daemon=True)
+        self.memory_cache, self.period = memory_cache, period
+        self.stop = threading.Event()
+
+    def run(self):
+        while not self.stop.wait(self.period):
+            try:
+                self.memory_cache.offload_idle_sessions()
+            except Exception as e:
+                logger.warning(f"Failed to offload attention caches: {e}", exc_info=True)
+
+    def shutdown(self):
+        self.stop.set()
+        self.join()
+
+
+def _copy_to_host(tensor: torch.Tensor) -> torch.Tensor:
+    host_tensor = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=tensor.device.type == "cuda")
+    return host_tensor.copy_(tensor, non_blocking=True)
+
+
+def _synchronize(devices: Sequence[torch.device]):
+    for device in set(devices):
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
@@ -3,42 +3,95 @@ A pytorch memory cache that can be allocated by ConnectionHandler (on cpu) and u
 
 For now, the only purpose of this code is to ensure that allocated memory will be deleted properly.
 
+Attention caches are allocated in pages: a session starts with a small buffer that is resized (see resize_cache) by
+whole pages of tokens as its prefix grows, so that the cache only accounts for the memory that is actually used.
+The runtime resizes a buffer by copying it into a new one, so a resize also reserves the size of the old buffer
+until the copy is done: the cache never takes more device memory than max_size_bytes, even for a moment.
+The same memory is shared with the prefix cache (see prefix_cache.py) that keeps pages of common prefixes.
+Caches of idle sessions may be moved to host memory and disk to make room for other sessions (see kv_offload.py).
+
 """
 import asyncio
 import contextlib
 import ctypes
 import multiprocessing as mp
 import os
+import threading
 import time
-from typing import AsyncContextManager, Dict, Optional, Sequence
+from typing import AsyncContextManager, Dict, Optional, Sequence, Tuple
 
 import async_timeout
 import torch
 from hypermind.utils import TensorDescriptor, enter_asynchronously, get_logger
 
 from subnet.data_structures import Handle
+from subnet.server.kv_offload import CacheOffloader
+from subnet.server.prefix_cache import PrefixCache
 from subnet.utils.asyncio import shield_and_wait
 from subnet.utils.misc import get_size_in_bytes
 
 logger = get_logger(__name__)
 
+DEFAULT_PAGE_SIZE = 128  # tokens
 
-class MemoryCache:
-    """A shared cache for storing tensors that persist across calls. Main use case: storing past attention KVs"""
 
-    def __init__(self, max_size_bytes: Optional[int], max_alloc_timeout: Optional[float] = None):
+class MemoryCache:
+    """
+    A shared cache for storing tensors that persist across calls. Main use case: storing past attention KVs
+
+    :param max_size_bytes: maximum total size of allocated tensors, None means unlimited
+    :param max_alloc_timeout: if specified, never wait for allocation longer than this many seconds
+    :param page_size: attention caches are allocated and resized in pages of this many tokens
+    :param max_prefix_cache_bytes: pages of common prefixes shared across sessions may take up to this many bytes of
+      the cache while sessions do not need this memory (see PrefixCache); 0 (default) disables prefix sharing
+    :param offload_host_bytes: caches of idle sessions may take up to this many bytes of pinned host memory
+      (see CacheOffloader); 0 (default) disables offloading to host memory
+    :param offload_disk_bytes: caches of idle sessions that don't fit into host memory may take up to this many bytes
+      in offload_dir; 0 (default) disables offloading to disk
+    :param offload_dir: a directory for the caches offloaded to disk
+    :param offload_idle_timeout: caches of sessions that did not run a step for this many seconds may be offloaded
+    :param offload_policy: "idle" offloads the caches of all idle sessions, "on_demand" only offloads them
+      when other sessions wait for memory
+    """
+
+    def __init__(
+        self,
+        max_size_bytes: Optional[int],
+        max_alloc_timeout: Optional[float] = None,
+        page_size: int = DEFAULT_PAGE_SIZE,
+        max_prefix_cache_bytes: int = 0,
+        offload_host_bytes: int = 0,
+        offload_disk_bytes: int = 0,
+        offload_dir: Optional[str] = None,
+        offload_idle_timeout: float = 60.0,
+        offload_policy: str = "idle",
+    ):
+        assert page_size > 0, "page_size must be positive"
         self.max_size_bytes = max_size_bytes if max_size_bytes is not None else (2**64 - 1)
         self.max_alloc_timeout = max_alloc_timeout
+        self.page_size = page_size
         self._lock_metadata = mp.Lock()
         self._current_size = mp.Value(ctypes.c_int64, 0, lock=False)
         self._enqueued_size = mp.Value(ctypes.c_int64, 0, lock=True)
         self._handle_counter = mp.Value(ctypes.c_int64, 0, lock=False)
-        self._allocated_tensors: Dict[Handle, torch.Tensor] = {}
+        self._allocated_tensors: Dict[Handle, torch.Tensor] = {}  # only valid inside runtime
+        self._allocation_sizes: Dict[Tuple[Handle, ...], int] = {}  # only valid inside the allocating process
+        self._allocation_descriptors: Dict[Tuple[Handle, ...], Sequence[TensorDescriptor]] = {}  # same as above
         self.runtime_pid = os.getpid()
 
         self._pipe_recv, self._pipe_send = mp.Pipe(duplex=False)  # any ConnectionHandler -> runtime
         self._lock_acquire_memory = mp.Lock()
         self._memory_freed_event = mp.Event()
+        self.prefix_cache = PrefixCache(self, max_prefix_cache_bytes)
+        self.offloader = CacheOffloader(
+            self,
+            max_host_bytes=offload_host_bytes,
+            max_disk_bytes=offload_disk_bytes,
+            offload_dir=offload_dir,
+            idle_timeout=offload_idle_timeout,
+            policy=offload_policy,
+        )
+        self._runtime_lock = threading.RLock()  # use_cache() vs. CacheOffloadThread, only valid inside runtime
 
     @property
     def current_size_bytes(self) -> int:
@@ -60,6 +113,24 @@ class MemoryCache:
     def bytes_left(self) -> int:
         return self.max_size_bytes - self.current_size_bytes
 
+    @property
+    def bytes_requested_by_sessions(self) -> int:
+        """The number of bytes that pending allocations are waiting for, beyond the free memory"""
+        return max(0, self.current_size_bytes + self.enqueued_size_bytes - self.max_size_bytes)
+
+    def get_tokens_left(self, bytes_per_token: int) -> int:
+        """
+        Return the number of tokens that fit into the free pages, given the cache size of one token.
+        This includes the free space for offloaded caches, since idle sessions can make room for new ones.
+        """
+        page_bytes = max(1, bytes_per_token * self.page_size)
+        bytes_left = max(0, self.bytes_left) + (self.offloader.bytes_left if self.offloader.enabled else 0)
+        return bytes_left // page_bytes * self.page_size
+
+    def round_to_pages(self, num_tokens: int) -> int:
+        """Round the number of tokens up to a whole number of pages"""
+        return -(-num_tokens // self.page_size) * self.page_size
+
     @property
     def handle_counter(self) -> int:
         return self._handle_counter.value
@@ -104,7 +175,66 @@ class MemoryCache:
             logger.info(f"rpc_inference.alloc_done(size={max_alloc_size / gib:.2f} GiB)")
             yield handles
         finally:
-            self._free(max_alloc_size, alloc_task)
+            self._free(alloc_task)
+
+    async def resize_cache(
+        self, handles: Sequence[Handle], *descriptors: TensorDescriptor, timeout: Optional[float] = None
+    ) -> None:
+        """
+        Grow tensors previously allocated with allocate_cache, keeping their contents. If cache full, raises
+        AllocationFailed. The new tensors are zero-initialized beyond the old shapes.
+
+        :param handles: all handles yielded by one allocate_cache call, in the same order
+        :param descriptors: new descriptors for these handles, one per handle; each new shape must be
+          at least as large as the old one in every dimension (e.g. the same cache with more tokens),
+          otherwise raises ValueError
+        :param timeout: optional maximum time to wait for the additional memory; None (default) waits for up to
+          max_alloc_timeout, since the session using these tensors has been admitted already
+
+        :note: This function should be called by the same ConnectionHandler that allocated the handles
+        """
+        assert os.getpid() != self.runtime_pid, "must be called by a ConnectionHandler, not runtime"
+        handles = tuple(handles)
+        assert handles in self._allocation_sizes, "handles must be allocated with allocate_cache by this process"
+        assert len(handles) == len(descriptors), f"expected {len(handles)} descriptors, got {len(descriptors)}"
+        for old_descr, new_descr in zip(self._allocation_descriptors[handles], descriptors):
+            if (
+                new_descr.dtype != old_descr.dtype
+                or new_descr.device != old_descr.device
+                or len(new_descr.shape) != len(old_descr.shape)
+                or any(new_size < old_size for new_size, old_size in zip(new_descr.shape, old_descr.shape))
+            ):
+                raise ValueError(
+                    f"Cannot resize a cache tensor from {tuple(old_descr.shape)} ({old_descr.dtype}) to "
+                    f"{tuple(new_descr.shape)} ({new_descr.dtype}), it can only grow (e.g., the batch size must not "
+                    f"change within an inference session)"
+                )
+        if self.max_alloc_timeout is not None:
+            timeout = self.max_alloc_timeout if timeout is None else min(timeout, self.max_alloc_timeout)
+        extra_alloc_size = self.get_allocation_size(*descriptors) - self._allocation_sizes[handles]
+        if extra_alloc_size <= 0:
+            return
+
+        resize_task = asyncio.create_task(
+            self._schedule_resize(handles, extra_alloc_size, *descriptors, timeout=timeout)
+        )
+        await shield_and_wait(resize_task)
+
+    async def reserve_offloaded_cache(self, handles: Sequence[Handle]) -> None:
+        """
+        If the cache allocated with these handles was offloaded (see kv_offload.py), wait until it fits into the cache
+        again and account for it, so that the runtime can move it back to the device before the next step.
+        Since the session is already admitted, this waits for up to max_alloc_timeout instead of the client's timeout.
+
+        :note: This function should be called by the same ConnectionHandler that allocated the handles
+        """
+        assert os.getpid() != self.runtime_pid, "must be called by a ConnectionHandler, not runtime"
+        handles = tuple(handles)
+        assert handles in self._allocation_sizes, "handles must be allocated with allocate_cache by this process"
+        if not self.offloader.is_offloaded(handles):
+            return
+        reserve_task = asyncio.create_task(self._schedule_restore(handles, timeout=self.max_alloc_timeout))
+        await shield_and_wait(reserve_task)
 
     @staticmethod
     def get_allocation_size(*descriptors: TensorDescriptor) -> int:
@@ -128,11 +258,51 @@ class MemoryCache:
                     handles = tuple(int(self.handle_counter) + i for i in range(len(descriptors)))
                     self.current_size_bytes += alloc_size
                     self.handle_counter += len(handles)  # note: this will eventually overflow and it is okay
+                    self._allocation_sizes[handles] = alloc_size
+                    self._allocation_descriptors[handles] = descriptors
                     self._pipe_send.send((handles, descriptors))
                     return handles
         except TimeoutError:
             raise AllocationFailed(f"Could not allocate {alloc_size} (timeout={timeout})")
 
+    async def _schedule_resize(
+        self,
+        handles: Tuple[Handle, ...],
+        extra_alloc_size: int,
+        *descriptors: TensorDescriptor,
+        timeout: Optional[float],
+    ) -> None:
+        """
+        Same as _schedule_alloc, but for additional pages of existing handles. Until the runtime copies the old tensors
+        into the new ones, both of them take memory, so we reserve the old size as well (the runtime releases it).
+        An offloaded cache is copied straight into the new tensors, so its old size is taken by the restored tensors.
+        """
+        old_alloc_size = self._allocation_sizes[handles]
+        try:
+            async with self._wait_for_free_memory(old_alloc_size + extra_alloc_size, timeout):
+                with self._lock_metadata:
+                    self.offloader.reclaim(handles)  # if it was offloaded, runtime will restore it into the new tensors
+                    self.current_size_bytes += old_alloc_size + extra_alloc_size
+                    self._allocation_sizes[handles] += extra_alloc_size
+                    self._allocation_descriptors[handles] = descriptors
+                    self._pipe_send.send((handles, descriptors))
+        except TimeoutError:
+            raise AllocationFailed(
+                f"Could not grow the attention cache by {extra_alloc_size} bytes in {timeout} seconds, "
+                f"the server is out of memory for attention caches"
+            )
+
+    async def _schedule_restore(self, handles: Tuple[Handle, ...], timeout: Optional[float]) -> None:
+        """Same as _schedule_alloc, but for the memory of an offloaded cache that the runtime will restore"""
+        alloc_size = self._allocation_sizes[handles]
+        try:
+            async with self._wait_for_free_memory(alloc_size, timeout):
+                with self._lock_metadata:
+                    if self.offloader.reclaim(handles):  # otherwise, the runtime has restored it in the meantime
+                        self.current_size_bytes += alloc_size
+        except TimeoutError:
+            raise AllocationFailed(f"Could not restore {alloc_size} bytes of offloaded cache (timeout={timeout})")
+
     @contextlib.asynccontextmanager
     async def _wait_for_free_memory(self, alloc_size: int, timeout: Optional[float]):
         start_time = time.perf_counter()
@@ -166,14 +336,17 @@ class MemoryCache:
                 with self._enqueued_size.get_lock():
                     self._enqueued_size.value -= alloc_size
 
-    def _free(self, alloc_size: int, alloc_task: asyncio.Task):
+    def _free(self, alloc_task: asyncio.Task):
         if alloc_task.exception() is not None:
             return
         handles = alloc_task.result()
+        alloc_size = self._allocation_sizes.pop(handles)
+        del self._allocation_descriptors[handles]
 
         with self._lock_metadata:
             self._pipe_send.send((handles, None))  # signal runtime to free these handles
-            self.current_size_bytes -= alloc_size
+            if not self.offloader.reclaim(handles):  # offloaded caches don't take device memory
+                self.current_size_bytes -= alloc_size
         self._memory_freed_event.set()
 
     def _wait_until_available(self, allocated_size: int, timeout: Optional[float] = None):
@@ -192,6 +365,29 @@ class MemoryCache:
                 )
             self._memory_freed_event.clear()
 
+    def try_reserve(self, size_bytes: int) -> bool:
+        """
+        Account for {size_bytes} of memory used by the runtime itself (e.g., by the prefix cache) if it is free and
+        no connection handler is waiting for memory at the moment; the memory must be returned with release()
+        """
+        assert os.getpid() == self.runtime_pid, "must be called by runtime"
+        if not self._lock_acquire_memory.acquire(block=False):
+            return False  # some handler is waiting for free memory
+        try:
+            with self._lock_metadata:
+                if self.current_size_bytes + self.enqueued_size_bytes + size_bytes > self.max_size_bytes:
+                    return False
+                self.current_size_bytes += size_bytes
+                return True
+        finally:
+            self._lock_acquire_memory.release()
+
+    def release(self, size_bytes: int):
+        """Return the memory previously taken with try_reserve()"""
+        with self._lock_metadata:
+            self.current_size_bytes -= size_bytes
+        self._memory_freed_event.set()
+
     @contextlib.contextmanager
     def use_cache(self, *handles: Handle) -> Sequence[torch.Tensor]: # type: ignore
         """
@@ -202,23 +398,54 @@ class MemoryCache:
         """
         assert os.getpid() == self.runtime_pid
         # note: this specific function is not concurrent, so you can safely allocate/offload/defragment data here
-
-        # read creation/deletion requests from connection handlers
+        with self._runtime_lock:
+            self._process_requests()
+            if self.prefix_cache.enabled:
+                self.prefix_cache.evict_under_pressure()
+            if self.offloader.enabled:
+                self.offloader.restore(handles)
+                self.offloader.offload_idle(exclude=handles)
+            yield tuple(self._allocated_tensors[handle] for handle in handles)
+
+    def offload_idle_sessions(self):
+        """Offload the caches of idle sessions between the calls to use_cache (see CacheOffloadThread)"""
+        assert os.getpid() == self.runtime_pid, "must be called by runtime"
+        with self._runtime_lock:
+            self._process_requests()
+            self.offloader.offload_idle()
+
+    def _process_requests(self):
+        """Read creation/deletion requests from connection handlers"""
         while self._pipe_recv.poll():
             recv_handles, recv_data = self._pipe_recv.recv()
-            if recv_data is not None:  # create new tensors
+            if recv_data is not None:  # create new tensors or resize existing ones
                 assert len(recv_handles) == len(recv_data)
-                for handle, descr in zip(recv_handles, recv_data):
-                    self._allocated_tensors[handle] = descr.make_zeros()
-                    assert handle in self._allocated_tensors, f"Sanity check failed: no such handle ({handle})"
+                if not self.offloader.restore(recv_handles, new_descriptors=recv_data):
+                    self._resize_tensors(recv_handles, recv_data)
+                self.offloader.track(recv_handles, self.get_allocation_size(*recv_data))
             else:  # delete tensors by handle
+                was_offloaded = self.offloader.forget(recv_handles)
                 for handle in recv_handles:
-                    if handle not in self._allocated_tensors:
+                    if handle not in self._allocated_tensors and not was_offloaded:
                         logger.warning(
                             f"Sanity check failed: asked to delete handle {handle}, but there is no such handle"
                         )
                     self._allocated_tensors.pop(handle, None)
-        yield tuple(self._allocated_tensors[handle] for handle in handles)
+
+    def _resize_tensors(self, handles: Sequence[Handle], descriptors: Sequence[TensorDescriptor]):
+        """Create new tensors (if the handles are new) or copy the existing tensors into larger ones"""
+        old_tensors = [self._allocated_tensors.get(handle) for handle in handles]
+        for handle, descr, old_tensor in zip(handles, descriptors, old_tensors):
+            new_tensor = descr.make_zeros()
+            if old_tensor is not None:
+                new_tensor[tuple(slice(0, size) for size in old_tensor.shape)] = old_tensor
+            self._allocated_tensors[handle] = new_tensor
+
+        old_tensors = [tensor for tensor in old_tensors if tensor is not None]
+        if old_tensors:
+            # The old tensors are freed once we return, give back the memory reserved for them by _schedule_resize
+            old_alloc_size = self.get_allocation_size(*map(TensorDescriptor.from_tensor, old_tensors))
+            self.release(old_alloc_size)
 
 
 class AllocationFailed(Exception):
@@ -0,0 +1,153 @@
+"""
+A server-side cache of attention keys/values for prefixes (e.g., system prompts) shared by many inference sessions.
+
+Prefixes are split into pages of MemoryCache.page_size tokens. Each page is identified by a key that hashes the span's
+input hidden states of this page *and all previous pages*, the chain of blocks up to the current one and the adapter
+(see make_prefix_keys). Thus, a page key identifies the entire prefix up to the end of that page, and a session that
+starts with the same prefix can reuse the longest chain of cached pages instead of recomputing them.
+
+Cached pages are immutable and shared: when a session reuses a page, its keys/values are copied into the session's own
+attention cache (copy-on-write), so the session can append to and diverge from the prefix without affecting others.
+The pages count towards the MemoryCache size limit and are evicted in LRU order when sessions need this memory.
+"""
+from __future__ import annotations
+
+import ctypes
+import dataclasses
+import hashlib
+import multiprocessing as mp
+import os
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Tuple
+
+import torch
+from hypermind.utils import get_logger
+
+from subnet.data_structures import ModuleUID
+
+if TYPE_CHECKING:
+    from subnet.server.memory_cache import MemoryCache
+
+logger = get_logger(__name__)
+
+PrefixKey = bytes
+
+
+@dataclasses.dataclass(frozen=True)
+class PrefixPage:
+    """Keys/values of one page of tokens for one block, along with the block's outputs for these tokens"""
+
+    cache_tensors: Tuple[torch.Tensor, ...]
+    outputs: torch.Tensor
+    size_bytes: int
+
+
+def make_prefix_keys(
+    hidden_states: torch.Tensor, requested_uids: Sequence[ModuleUID], active_adapter: Optional[str], page_size: int
+) -> List[Tuple[PrefixKey, ...]]:
+    """
+    Hash full pages of a span's input hidden states into prefix keys for each requested block
+
+    :param hidden_states: the inputs of the first block of the span, [batch_size, seq_length, hidden_size]
+    :param requested_uids: the uids of the blocks in the span, in the same order as they are applied
+    :returns: for each block, a tuple of keys, one per full page of hidden_states
+    """
+    batch_size, seq_length, hidden_size = hidden_states.shape
+    prefix_hash = hashlib.blake2b(digest_size=16)
+    prefix_hash.update(f"{batch_size} {hidden_size} {hidden_states.dtype} {active_adapter or ''}".encode())
+
+    page_digests = []
+    for start in range(0, seq_length - page_size + 1, page_size):
+        page = hidden_states[:, start : start + page_size].contiguous()
+        prefix_hash.update(page.view(torch.uint8).numpy().tobytes())
+        page_digests.append(prefix_hash.digest())  # note: this digest covers all pages up to the current one
+
+    block_keys, chain_hash = [], hashlib.blake2b(digest_size=16)
+    for uid in requested_uids:
+        chain_hash.update(f"{uid} ".encode())  # the block's inputs depend on all previous blocks of the span
+        chain_digest = chain_hash.digest()
+        block_keys.append(
+            tuple(hashlib.blake2b(digest + chain_digest, digest_size=16).digest() for digest in page_digests)
+        )
+    return block_keys
+
+
+class PrefixCache:
+    """
+    Stores PrefixPage-s in the runtime process, see the module docstring for details
+
+    :param memory_cache: the MemoryCache whose size limit also accounts for the cached pages
+    :param max_size_bytes: the cached pages never take more than this many bytes; 0 disables the cache
+    """
+
+    def __init__(self, memory_cache: MemoryCache, max_size_bytes: int):
+        self.memory_cache = memory_cache
+        self.max_size_bytes = max_size_bytes
+        self._pages: OrderedDict[PrefixKey, PrefixPage] = OrderedDict()  # only valid inside runtime, in LRU order
+        self._current_size = mp.Value(ctypes.c_int64, 0, lock=False)
+        self._num_hits = mp.Value(ctypes.c_int64, 0, lock=False)
+        self._num_misses = mp.Value(ctypes.c_int64, 0, lock=False)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size_bytes > 0
+
+    @property
+    def current_size_bytes(self) -> int:
+        return self._current_size.value
+
+    def get_stats(self) -> Dict[str, int]:
+        """Return the number of pages reused by sessions (hits) or computed from scratch (misses), works anywhere"""
+        return dict(prefix_cache_hits=self._num_hits.value, prefix_cache_misses=self._num_misses.value)
+
+    def lookup(self, keys: Sequence[PrefixKey]) -> List[PrefixPage]:
+        """Find the longest chain of cached pages for the given page keys and mark them as recently used"""
+        assert os.getpid() == self.memory_cache.runtime_pid, "must be called by runtime"
+        pages = []
+        for key in keys:
+            page = self._pages.get(key)
+            if page is None:
+                break
+            self._pages.move_to_end(key)
+            pages.append(page)
+        self._num_hits.value += len(pages)
+        self._num_misses.value += len(keys) - len(pages)
+        return pages
+
+    def store(self, key: PrefixKey, cache_tensors: Sequence[torch.Tensor], outputs: torch.Tensor) -> bool:
+        """
+        Save a copy of one page of keys/values and block outputs, evicting least recently used pages if needed
+
+        :returns: True if the page was stored, False if there is not enough memory for it
+        """
+        assert os.getpid() == self.memory_cache.runtime_pid, "must be called by runtime"
+        if key in self._pages:
+            self._pages.move_to_end(key)
+            return True
+        size_bytes = sum(tensor.numel() * tensor.element_size() for tensor in (*cache_tensors, outputs))
+        if size_bytes > self.max_size_bytes:
+            return False
+        self._evict(self.current_size_bytes + size_bytes - self.max_size_bytes)
+        if not self.memory_cache.try_reserve(size_bytes):
+            return False  # sessions need this memory more than the prefix cache does
+        self._pages[key] = PrefixPage(
+            tuple(tensor.clone() for tensor in cache_tensors), outputs.clone(), size_bytes=size_bytes
+        )
+        self._current_size.value += size_bytes
+        return True
+
+    def evict_under_pressure(self):
+        """Free the least recently used pages if some sessions are waiting for memory"""
+        assert os.getpid() == self.memory_cache.runtime_pid, "must be called by runtime"
+        if self._pages:
+            self._evict(self.memory_cache.bytes_requested_by_sessions)
+
+    def _evict(self, num_bytes: int):
+        freed_bytes = 0
+        while freed_bytes < num_bytes and self._pages:
+            _key, page = self._pages.popitem(last=False)
+            freed_bytes += page.size_bytes
+        if freed_bytes > 0:
+            self._current_size.value -= freed_bytes
+            self.memory_cache.release(freed_bytes)
+            logger.debug(f"Evicted {freed_bytes} bytes from the prefix cache")
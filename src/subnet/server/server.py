@@ -13,7 +13,7 @@ import random
 import sys
 import threading
 import time
-from typing import Dict, List, Optional, Sequence, Union
+from typing import Callable, Collection, Dict, List, Optional, Sequence, Tuple, Union
 
 import hypermind
 import psutil
@@ -37,16 +37,24 @@ import subnet
 from subnet.constants import DTYPE_MAP, PUBLIC_INITIAL_PEERS
 from subnet.data_structures import CHAIN_DELIMITER, UID_DELIMITER, ModelInfo, ServerInfo, ServerState, parse_uid
 from subnet.server import block_selection
+from subnet.server.activation_cache import ActivationCache
 from subnet.server.backend import TransformerBackend, merge_inference_pools_inplace
+from subnet.server.block_cache import ConvertedBlockCache, make_empty_block
+from subnet.server.block_loading import load_blocks_pipelined
 from subnet.server.block_utils import get_block_size, resolve_block_dtype
-from subnet.server.from_pretrained import load_pretrained_block
+from subnet.server.from_pretrained import ModelWeightIndex, load_pretrained_block
 from subnet.server.handler import TransformerConnectionHandler
+from subnet.server.kv_offload import CacheOffloadThread
 from subnet.server.memory_cache import MemoryCache
 from subnet.server.reachability import ReachabilityProtocol, check_direct_reachability, validate_reachability
+from subnet.server.session_directory import SessionDirectory
+from subnet.server.shared_memory import SharedTensorRing
+from subnet.server.task_prioritizer import FairShareTaskPrioritizer, TaskPrioritizerBase, TokenAwareTaskPrioritizer
 from subnet.server.throughput import get_dtype_name, get_server_throughput
 from subnet.utils.auto_config import AutoDistributedConfig
-from subnet.utils.convert_block import QuantType, check_device_balance, convert_block
+from subnet.utils.convert_block import QuantType, apply_adapters, check_device_balance, convert_block
 from subnet.utils.dht import declare_active_modules, get_remote_module_infos
+from subnet.utils.disk_cache import DEFAULT_CACHE_DIR
 from subnet.utils.misc import get_size_in_bytes
 from subnet.utils.ping import PingAggregator
 from subnet.utils.random import sample_up_to
@@ -79,10 +87,33 @@ class Server:
         max_chunk_size_bytes: int = 256 * 1024 * 1024,
         max_alloc_timeout: float = 600,
         attn_cache_tokens: Optional[int] = None,
+        continuous_batching: bool = False,
+        max_batched_sessions: int = 16,
+        max_coalesced_tasks: int = 1,
+        coalescing_window: float = 0.005,
+        attn_impl: Optional[str] = None,
+        prefix_cache_fraction: float = 0.0,
+        kv_offload_host_bytes: int = 0,
+        kv_offload_disk_bytes: int = 0,
+        kv_offload_idle_timeout: float = 60,
+        kv_offload_policy: str = "idle",
+        kv_cache_dtype: Optional[str] = None,
+        max_prefill_chunk_tokens: Optional[int] = 1024,
+        activation_cache_bytes: int = 0,
+        activation_cache_ttl: float = 60,
+        fair_share_rate: Optional[float] = None,
+        fair_share_burst: Optional[float] = None,
+        get_peer_weights: Optional[Callable[[], Dict[str, float]]] = None,
         torch_dtype: str = "auto",
         revision: Optional[str] = None,
         cache_dir: Optional[str] = None,
         max_disk_space: Optional[int] = None,
+        num_loading_threads: int = 4,
+        max_loading_memory: Optional[int] = None,
+        use_converted_block_cache: bool = True,
+        incremental_rebalancing: bool = True,
+        num_shm_slots: int = 8,
+        shm_slot_tokens: int = 16,
         device: Optional[Union[str, torch.device]] = None,
         compression=CompressionType.NONE,
         stats_report_interval: Optional[int] = None,
@@ -129,6 +160,9 @@ class Server:
             revision=revision,
             identity_path=identity_path,
         )
+        if attn_impl is not None:
+            assert attn_impl in ("eager", "sdpa"), f"Unsupported attn_impl={attn_impl}"
+            self.block_config._attn_implementation = attn_impl  # read by the blocks and TransformerBackend
 
         if dht_prefix is None:
             dht_prefix = self.block_config.dht_prefix
@@ -232,6 +266,24 @@ class Server:
         self.inference_max_length = inference_max_length
         self.max_chunk_size_bytes = max_chunk_size_bytes
         self.max_alloc_timeout = max_alloc_timeout
+        self.max_batched_sessions = max_batched_sessions if continuous_batching else 1
+        assert max_coalesced_tasks >= 1 and coalescing_window >= 0, "invalid forward/backward coalescing settings"
+        self.max_coalesced_tasks, self.coalescing_window = max_coalesced_tasks, coalescing_window
+        assert 0 <= prefix_cache_fraction <= 1, "prefix_cache_fraction must be between 0 and 1"
+        self.prefix_cache_fraction = prefix_cache_fraction
+        self.kv_offload_host_bytes, self.kv_offload_disk_bytes = kv_offload_host_bytes, kv_offload_disk_bytes
+        self.kv_offload_idle_timeout, self.kv_offload_policy = kv_offload_idle_timeout, kv_offload_policy
+        assert max_prefill_chunk_tokens is None or max_prefill_chunk_tokens > 0, "max_prefill_chunk_tokens must be > 0"
+        self.max_prefill_chunk_tokens = max_prefill_chunk_tokens
+        self.activation_cache_bytes, self.activation_cache_ttl = activation_cache_bytes, activation_cache_ttl
+        self.task_prioritizer = TokenAwareTaskPrioritizer()
+        if fair_share_rate is not None:
+            if fair_share_burst is None:
+                fair_share_burst = 10 * fair_share_rate
+            # Created before the handlers are forked, so that they share the token buckets of each peer
+            self.task_prioritizer = FairShareTaskPrioritizer(
+                self.task_prioritizer, rate=fair_share_rate, burst=fair_share_burst, get_peer_weights=get_peer_weights
+            )
 
         # For attention cache in GPU or RAM
         if attn_cache_tokens is None:
@@ -239,12 +291,35 @@ class Server:
         cache_values_per_block = 2 * self.block_config.hidden_size * attn_cache_tokens
         cache_values_per_block //= self.block_config.num_key_value_groups
         self._cache_bytes_per_block = cache_values_per_block * get_size_in_bytes(self.torch_dtype)
+        assert kv_cache_dtype in (None, "int8"), f"Unsupported kv_cache_dtype: {kv_cache_dtype}"
+        self.kv_cache_dtype = torch.int8 if kv_cache_dtype == "int8" else None
+        if self.kv_cache_dtype is not None:
+            # Each value takes 1 byte, plus a scale in torch_dtype for each head_dim values (see kv_quantization.py)
+            head_dim = self.block_config.hidden_size // self.block_config.num_attention_heads
+            dtype_bytes = get_size_in_bytes(self.torch_dtype)
+            ratio = dtype_bytes / (1 + dtype_bytes / head_dim)
+            logger.info(
+                f"Attention caches are stored in int8, they fit {ratio:.2f}x more tokens (sessions): "
+                f"~{int(attn_cache_tokens * ratio)} tokens per block instead of {attn_cache_tokens}"
+            )
 
         # For disk cache
         self.cache_dir = cache_dir
         self.max_disk_space = max_disk_space
         self.adapters = adapters
 
+        assert num_loading_threads > 0, "num_loading_threads must be positive"
+        self.num_loading_threads, self.max_loading_memory = num_loading_threads, max_loading_memory
+        self.use_converted_block_cache = use_converted_block_cache
+        self.num_shm_slots, self.shm_slot_tokens = num_shm_slots, shm_slot_tokens
+        self.weight_index = ModelWeightIndex(
+            converted_model_name_or_path,
+            revision=revision,
+            token=token,
+            cache_dir=cache_dir,
+            max_disk_space=max_disk_space,
+        )
+
         assert num_blocks is None or block_indices is None, "Please specify num_blocks or block_indices, not both"
         if num_blocks is None and block_indices is None:
             num_blocks = self._choose_num_blocks()
@@ -302,7 +377,9 @@ class Server:
         self.mean_balance_check_period = mean_balance_check_period
         self.mean_block_selection_delay = mean_block_selection_delay
 
+        self.incremental_rebalancing = incremental_rebalancing
         self.module_container = None
+        self.retiring_containers: List[Tuple[ModuleContainer, threading.Thread]] = []
         self.stop = threading.Event()
 
     def _choose_num_blocks(self) -> int:
@@ -365,42 +442,7 @@ class Server:
     def run(self):
         while True:
             block_indices = self._choose_blocks()
-            self.module_container = ModuleContainer.create(
-                dht=self.dht,
-                dht_prefix=self.dht_prefix,
-                converted_model_name_or_path=self.converted_model_name_or_path,
-                block_config=self.block_config,
-                attn_cache_bytes=self.attn_cache_bytes,
-                server_info=self.server_info,
-                model_info=self.model_info,
-                block_indices=block_indices,
-                num_handlers=self.num_handlers,
-                min_batch_size=self.min_batch_size,
-                max_batch_size=self.max_batch_size,
-                max_chunk_size_bytes=self.max_chunk_size_bytes,
-                max_alloc_timeout=self.max_alloc_timeout,
-                inference_max_length=self.inference_max_length,
-                torch_dtype=self.torch_dtype,
-                cache_dir=self.cache_dir,
-                max_disk_space=self.max_disk_space,
-                device=self.device,
-                compression=self.compression,
-                stats_report_interval=self.stats_report_interval,
-                update_period=self.update_period,
-                expiration=self.expiration,
-                request_timeout=self.request_timeout,
-                session_timeout=self.session_timeout,
-                step_timeout=self.step_timeout,
-                prefetch_batches=self.prefetch_batches,
-                sender_threads=self.sender_threads,
-                revision=self.revision,
-                token=self.token,
-                quant_type=self.quant_type,
-                tensor_parallel_devices=self.tensor_parallel_devices,
-                should_validate_reachability=self.should_validate_reachability,
-                record_validator=self.record_validator,
-                start=True,
-            )
+            self.module_container = self._create_module_container(block_indices)
             try:
                 self.module_container.ready.wait()
 
@@ -416,12 +458,150 @@ class Server:
 
                     if self._should_choose_other_blocks():
                         logger.info("Swarm is imbalanced, server will load other blocks")
-                        break  # Stop serving this set of modules
+                        if not self._move_to_other_blocks():
+                            break  # Stop serving this set of modules
             finally:
+                self._shutdown_retiring_containers()
                 self.module_container.shutdown()
 
             self._clean_memory_and_fds()
 
+    def _create_module_container(
+        self, block_indices: List[int], previous_container: Optional[ModuleContainer] = None, start: bool = True
+    ) -> ModuleContainer:
+        return ModuleContainer.create(
+            dht=self.dht,
+            dht_prefix=self.dht_prefix,
+            converted_model_name_or_path=self.converted_model_name_or_path,
+            block_config=self.block_config,
+            attn_cache_bytes=self.attn_cache_bytes,
+            server_info=self.server_info,
+            model_info=self.model_info,
+            block_indices=block_indices,
+            previous_container=previous_container,
+            num_handlers=self.num_handlers,
+            num_shm_slots=self.num_shm_slots,
+            shm_slot_tokens=self.shm_slot_tokens,
+            min_batch_size=self.min_batch_size,
+            max_batch_size=self.max_batch_size,
+            max_chunk_size_bytes=self.max_chunk_size_bytes,
+            max_alloc_timeout=self.max_alloc_timeout,
+            max_batched_sessions=self.max_batched_sessions,
+            max_coalesced_tasks=self.max_coalesced_tasks,
+            coalescing_window=self.coalescing_window,
+            prefix_cache_fraction=self.prefix_cache_fraction,
+            kv_offload_host_bytes=self.kv_offload_host_bytes,
+            kv_offload_disk_bytes=self.kv_offload_disk_bytes,
+            kv_offload_idle_timeout=self.kv_offload_idle_timeout,
+            kv_offload_policy=self.kv_offload_policy,
+            kv_cache_dtype=self.kv_cache_dtype,
+            max_prefill_chunk_tokens=self.max_prefill_chunk_tokens,
+            activation_cache_bytes=self.activation_cache_bytes,
+            activation_cache_ttl=self.activation_cache_ttl,
+            task_prioritizer=self.task_prioritizer,
+            inference_max_length=self.inference_max_length,
+            torch_dtype=self.torch_dtype,
+            cache_dir=self.cache_dir,
+            max_disk_space=self.max_disk_space,
+            num_loading_threads=self.num_loading_threads,
+            max_loading_memory=self.max_loading_memory,
+            weight_index=self.weight_index,
+            use_converted_block_cache=self.use_converted_block_cache,
+            device=self.device,
+            compression=self.compression,
+            stats_report_interval=self.stats_report_interval,
+            update_period=self.update_period,
+            expiration=self.expiration,
+            request_timeout=self.request_timeout,
+            session_timeout=self.session_timeout,
+            step_timeout=self.step_timeout,
+            prefetch_batches=self.prefetch_batches,
+            sender_threads=self.sender_threads,
+            revision=self.revision,
+            token=self.token,
+            quant_type=self.quant_type,
+            tensor_parallel_devices=self.tensor_parallel_devices,
+            should_validate_reachability=self.should_validate_reachability,
+            record_validator=self.record_validator,
+            start=start,
+        )
+
+    def _move_to_other_blocks(self) -> bool:
+        """
+        Start serving other blocks without interrupting the blocks that stay in the span: load the new blocks while
+        the current container keeps serving, then switch the announcement to the new span and retire the current
+        container once its inference sessions finish. Returns False if the server must be restarted instead.
+        """
+        if not self.incremental_rebalancing:
+            return False
+        self.retiring_containers = [item for item in self.retiring_containers if item[1].is_alive()]
+        if self.retiring_containers:
+            # Handlers of at most two containers may run at the same time, see ModuleContainer.__init__
+            logger.info("The previous blocks are still finishing their inference sessions, will move later")
+            return True
+
+        previous_container = self.module_container
+        block_indices = self._choose_blocks(exclude_local_span=True)
+        module_uids = [f"{self.dht_prefix}{UID_DELIMITER}{block_index}" for block_index in block_indices]
+        kept_uids = set(module_uids) & set(previous_container.module_backends.keys())
+        num_new_blocks = len(module_uids) - len(kept_uids)
+        if num_new_blocks == 0:
+            return True
+        if not self._has_memory_for_new_blocks(num_new_blocks):
+            logger.info(f"Not enough memory to load {num_new_blocks} blocks while serving the current ones")
+            return False
+
+        logger.info(f"Loading {num_new_blocks} new blocks, keeping {len(kept_uids)} blocks that stay in the span")
+        try:
+            module_container = self._create_module_container(
+                block_indices, previous_container=previous_container, start=False
+            )
+        except Exception as e:
+            logger.warning(f"Failed to load the new blocks, restarting the server: {e}", exc_info=True)
+            return False
+        try:
+            module_container.take_over(previous_container, kept_uids)
+        except Exception as e:
+            logger.warning(f"Failed to start serving the new blocks, restarting the server: {e}", exc_info=True)
+            module_container.shutdown()
+            return False
+
+        module_container.dht_announcer.move_to(module_uids, module_container.memory_cache)
+        logger.info(f"Announced that blocks {block_indices} are online, retiring the previous blocks")
+
+        retiring_thread = threading.Thread(
+            target=self._retire_container, args=(previous_container,), name="RetireModuleContainer", daemon=True
+        )
+        retiring_thread.start()
+        self.retiring_containers.append((previous_container, retiring_thread))
+        self.module_container = module_container
+        return True
+
+    def _has_memory_for_new_blocks(self, num_blocks: int) -> bool:
+        # The new container shares the attention cache of the current one, so we only need memory for the weights
+        block_size = get_block_size(self.block_config, "memory", dtype=self.torch_dtype, quant_type=self.quant_type)
+        required_memory = num_blocks * block_size
+        if self.device.type == "cuda":
+            devices = self.tensor_parallel_devices if self.tensor_parallel_devices else (self.device,)
+            free_memory = sum(torch.cuda.mem_get_info(device)[0] for device in devices)
+        elif self.device.type == "cpu":
+            free_memory = psutil.virtual_memory().available
+        else:
+            return False  # We can't measure free memory reliably, so we restart the server to be safe
+        return free_memory >= required_memory
+
+    def _retire_container(self, module_container: ModuleContainer):
+        module_container.shutdown_when_drained(timeout=self.session_timeout)
+        gc.collect()
+        if self.device.type == "cuda":
+            torch.cuda.empty_cache()
+
+    def _shutdown_retiring_containers(self):
+        for module_container, retiring_thread in self.retiring_containers:
+            module_container.shutdown()
+            retiring_thread.join()
+        self.retiring_containers.clear()
+
     def _clean_memory_and_fds(self):
         self.module_container = None
         gc.collect()  # In particular, this closes unused file descriptors
@@ -439,7 +619,7 @@ class Server:
         elif self.device.type == "mps":
             torch.mps.empty_cache()
 
-    def _choose_blocks(self) -> List[int]:
+    def _choose_blocks(self, exclude_local_span: bool = False) -> List[int]:
         if self.strict_block_indices is not None:
             return self.strict_block_indices
 
@@ -449,7 +629,8 @@ class Server:
 
         module_infos = get_remote_module_infos(self.dht, self.module_uids, latest=True)
 
-        return block_selection.choose_best_blocks(self.num_blocks, module_infos)
+        local_peer_id = self.dht.peer_id if exclude_local_span else None
+        return block_selection.choose_best_blocks(self.num_blocks, module_infos, local_peer_id=local_peer_id)
 
     def _should_choose_other_blocks(self) -> bool:
         if self.strict_block_indices is not None:
@@ -465,6 +646,7 @@ class Server:
 
         if self.reachability_protocol is not None:
             self.reachability_protocol.shutdown()
+        self.weight_index.close()
         self.dht.shutdown()
         self.dht.join()
 
@@ -489,6 +671,10 @@ class ModuleContainer(threading.Thread):
         max_batch_size: int,
         max_chunk_size_bytes: int,
         max_alloc_timeout: float,
+        max_batched_sessions: int,
+        max_coalesced_tasks: int,
+        coalescing_window: float,
+        prefix_cache_fraction: float,
         torch_dtype: torch.dtype,
         cache_dir: str,
         max_disk_space: int,
@@ -501,63 +687,160 @@ class ModuleContainer(threading.Thread):
         quant_type: QuantType,
         tensor_parallel_devices: Sequence[torch.device],
         should_validate_reachability: bool,
+        num_loading_threads: int = 4,
+        max_loading_memory: Optional[int] = None,
+        weight_index: Optional[ModelWeightIndex] = None,
+        use_converted_block_cache: bool = True,
         record_validator: Optional[Ed25519SignatureValidator] = None,
+        previous_container: Optional[ModuleContainer] = None,
+        num_shm_slots: int = 0,
+        shm_slot_tokens: int = 0,
+        kv_offload_host_bytes: int = 0,
+        kv_offload_disk_bytes: int = 0,
+        kv_offload_idle_timeout: float = 60,
+        kv_offload_policy: str = "idle",
+        kv_cache_dtype: Optional[torch.dtype] = None,
         **kwargs,
     ) -> ModuleContainer:
+        """
+        :param previous_container: if specified, reuse the blocks it serves and its announcer instead of loading
+          the blocks again. The previous container keeps serving while the other blocks are loaded, and it is up to
+          the caller to switch the announcement to the new blocks (see ModuleAnnouncerThread.move_to) and retire it.
+          Both containers share the attention and activation caches, so they never take more than one cache budget.
+        """
         module_uids = [f"{dht_prefix}{UID_DELIMITER}{block_index}" for block_index in block_indices]
-        memory_cache = MemoryCache(attn_cache_bytes, max_alloc_timeout)
 
-        server_info.state = ServerState.JOINING
-        dht_announcer = ModuleAnnouncerThread(
-            module_uids,
-            dht,
-            server_info,
-            model_info,
-            block_config=block_config,
-            memory_cache=memory_cache,
-            update_period=update_period,
-            expiration=expiration,
-            record_validator=record_validator,
-            daemon=True,
-        )
-        dht_announcer.start()
-        logger.info(f"Announced that blocks {block_indices} are joining")
+        reused_blocks = {}
+        if previous_container is not None:
+            reused_blocks = {
+                module_uid: previous_container.module_backends[module_uid].module
+                for module_uid in module_uids
+                if module_uid in previous_container.module_backends
+            }
+            # The sessions of both containers take memory from the same budget until the previous one retires
+            memory_cache = previous_container.memory_cache
+            dht_announcer = previous_container.dht_announcer
+        else:
+            memory_cache = MemoryCache(
+                attn_cache_bytes,
+                max_alloc_timeout,
+                max_prefix_cache_bytes=int(attn_cache_bytes * prefix_cache_fraction),
+                offload_host_bytes=kv_offload_host_bytes,
+                offload_disk_bytes=kv_offload_disk_bytes,
+                offload_dir=os.path.join(cache_dir if cache_dir is not None else DEFAULT_CACHE_DIR, "kv_offload"),
+                offload_idle_timeout=kv_offload_idle_timeout,
+                offload_policy=kv_offload_policy,
+            )
+            server_info.state = ServerState.JOINING
+            dht_announcer = ModuleAnnouncerThread(
+                module_uids,
+                dht,
+                server_info,
+                model_info,
+                block_config=block_config,
+                memory_cache=memory_cache,
+                update_period=update_period,
+                expiration=expiration,
+                record_validator=record_validator,
+                daemon=True,
+            )
+            dht_announcer.start()
+            logger.info(f"Announced that blocks {block_indices} are joining")
 
         assert len(tensor_parallel_devices) >= 1 and all(isinstance(d, torch.device) for d in tensor_parallel_devices)
 
-        blocks = {}
-        try:
-            for module_uid, block_index in zip(module_uids, block_indices):
-                block = load_pretrained_block(
-                    converted_model_name_or_path,
-                    block_index,
-                    config=block_config,
-                    torch_dtype=torch_dtype,
-                    revision=revision,
-                    token=token,
-                    cache_dir=cache_dir,
-                    max_disk_space=max_disk_space,
-                )
-                block = convert_block(
+        block_cache = None
+        if use_converted_block_cache and ConvertedBlockCache.is_supported(quant_type):
+            block_cache = ConvertedBlockCache(
+                converted_model_name_or_path,
+                revision=revision,
+                torch_dtype=torch_dtype,
+                quant_type=quant_type,
+                tensor_parallel_devices=tensor_parallel_devices,
+                output_device=device,
+                cache_dir=cache_dir,
+                max_disk_space=max_disk_space,
+            )
+
+        def _load_block(block_index: int) -> Tuple[torch.nn.Module, Optional[Dict[str, torch.Tensor]]]:
+            if block_cache is not None:
+                converted_state_dict = block_cache.load(block_index)
+                if converted_state_dict is not None:
+                    return make_empty_block(block_config, block_index, torch_dtype), converted_state_dict
+            return _load_pretrained_block(block_index), None
+
+        def _load_pretrained_block(block_index: int) -> torch.nn.Module:
+            return load_pretrained_block(
+                converted_model_name_or_path,
+                block_index,
+                config=block_config,
+                torch_dtype=torch_dtype,
+                revision=revision,
+                token=token,
+                cache_dir=cache_dir,
+                max_disk_space=max_disk_space,
+                weight_index=weight_index,
+            )
+
+        def _convert_block(
+            block_index: int, loaded: Tuple[torch.nn.Module, Optional[Dict[str, torch.Tensor]]]
+        ) -> torch.nn.Module:
+            block, converted_state_dict = loaded
+            block = convert_block(
+                block,
+                block_index,
+                block_config,
+                tensor_parallel_devices,
+                device,
+                quant_type,
+                empty_weights=converted_state_dict is not None,
+            )
+            if converted_state_dict is not None:
+                try:
+                    block.load_state_dict(converted_state_dict)
+                except Exception as e:
+                    logger.warning(f"Cached block {block_index} does not match the model ({e}), converting it again")
+                    block_cache.remove(block_index)
+                    return _convert_block(block_index, (_load_pretrained_block(block_index), None))
+            elif block_cache is not None:
+                block_cache.save(block_index, block)
+
+            if server_info.adapters:
+                apply_adapters(
                     block,
                     block_index,
-                    block_config,
-                    tensor_parallel_devices,
-                    device,
-                    quant_type,
-                    adapters=server_info.adapters,
-                    freeze=True,
+                    server_info.adapters,
                     token=token,
                     cache_dir=cache_dir,
                     max_disk_space=max_disk_space,
                 )
+            return block
+
+        blocks = {}
+        loaded_blocks = load_blocks_pipelined(
+            [block_index for block_index, uid in zip(block_indices, module_uids) if uid not in reused_blocks],
+            load_block=_load_block,
+            convert_block=_convert_block,
+            block_size=get_block_size(block_config, "memory", dtype=torch_dtype, quant_type=QuantType.NONE),
+            max_in_flight_bytes=max_loading_memory,
+            num_io_threads=num_loading_threads,
+        )
+        try:
+            modules = dict(reused_blocks)
+            for block_index, block in loaded_blocks:
+                modules[f"{dht_prefix}{UID_DELIMITER}{block_index}"] = block
+
+            for module_uid in module_uids:
                 blocks[module_uid] = TransformerBackend(
                     module_uid,
-                    block,
+                    modules[module_uid],
                     config=block_config,
                     memory_cache=memory_cache,
                     backend_dtype=torch_dtype,
                     max_chunk_size_bytes=max_chunk_size_bytes,
+                    kv_cache_dtype=kv_cache_dtype,
+                    max_coalesced_tasks=max_coalesced_tasks,
+                    coalescing_window=coalescing_window,
                     args_schema=(
                         BatchTensorDescriptor(
                             1, 2048, block_config.hidden_size, dtype=torch_dtype, compression=compression
@@ -573,19 +856,24 @@ class ModuleContainer(threading.Thread):
                     max_batch_size=max_batch_size,
                 )
 
-            merge_inference_pools_inplace(blocks)
+            merge_inference_pools_inplace(blocks, max_batched_sessions=max_batched_sessions)
 
             if should_validate_reachability:
                 validate_reachability(dht.peer_id)
         except:
+            loaded_blocks.close()  # stop loading the remaining blocks
             logger.debug("Shutting down backends")
-            for backend in blocks.values():
-                backend.shutdown()
+            for module_uid, backend in blocks.items():
+                if module_uid not in reused_blocks:  # these blocks are still served by previous_container
+                    backend.shutdown()
 
-            dht_announcer.announce(ServerState.OFFLINE)
-            logger.info(f"Announced that blocks {module_uids} are offline")
+            if previous_container is None:
+                dht_announcer.announce(ServerState.OFFLINE)
+                logger.info(f"Announced that blocks {module_uids} are offline")
             raise
 
+        # Hidden states of shm_slot_tokens tokens (inputs and outputs) and small tensors like hypo_ids fit into a slot
+        shm_slot_size = 2 * shm_slot_tokens * block_config.hidden_size * get_size_in_bytes(torch_dtype) + 4096
         return cls(
             dht,
             dht_prefix,
@@ -594,6 +882,9 @@ class ModuleContainer(threading.Thread):
             server_info=server_info,
             update_period=update_period,
             expiration=expiration,
+            num_shm_slots=num_shm_slots,
+            shm_slot_size=shm_slot_size,
+            previous_container=previous_container,
             **kwargs,
         )
 
@@ -604,6 +895,8 @@ class ModuleContainer(threading.Thread):
         module_backends: Dict[str, TransformerBackend],
         *,
         inference_max_length: int,
+        max_prefill_chunk_tokens: Optional[int],
+        task_prioritizer: TaskPrioritizerBase,
         num_handlers: int,
         dht_announcer: ModuleAnnouncerThread,
         server_info: ServerInfo,
@@ -613,27 +906,78 @@ class ModuleContainer(threading.Thread):
         session_timeout: float,
         step_timeout: float,
         start: bool,
+        num_shm_slots: int = 0,
+        shm_slot_size: int = 0,
+        activation_cache_bytes: int = 0,
+        activation_cache_ttl: float = 60,
+        previous_container: Optional[ModuleContainer] = None,
         **kwargs,
     ):
         super().__init__()
 
         self.dht, self.module_backends = dht, module_backends
         self.server_info, self.update_period, self.expiration = server_info, update_period, expiration
+        self.memory_cache = next(iter(module_backends.values())).memory_cache
+
+        if previous_container is None:
+            self.offload_thread = CacheOffloadThread(self.memory_cache) if self.memory_cache.offloader.enabled else None
+        else:
+            self.offload_thread = previous_container.offload_thread  # the cache is shared, see ModuleContainer.create
+        self._owns_caches = previous_container is None  # the owner closes the shared caches, see take_over
+        self.draining = mp.Event()  # if set, handlers finish existing inference sessions but don't accept new ones
+        self._kept_uids = set()  # modules that are handed over to another container and must not be freed
+        self._shutdown_lock = threading.Lock()
+        self._is_shut_down = False
+
+        self.shared_tensor_rings = [None] * num_handlers
+        if num_shm_slots > 0:
+            try:
+                self.shared_tensor_rings = [SharedTensorRing(num_shm_slots, shm_slot_size) for _ in range(num_handlers)]
+            except Exception as e:
+                logger.warning(f"Failed to allocate shared memory for tensors, they will be sent by default means: {e}")
+
+        self.activation_cache = None
+        if previous_container is not None:
+            self.activation_cache = previous_container.activation_cache
+        elif activation_cache_bytes > 0:
+            try:
+                self.activation_cache = ActivationCache(activation_cache_bytes, ttl=activation_cache_ttl)
+            except Exception as e:
+                logger.warning(f"Failed to allocate shared memory for the activation cache, it will be disabled: {e}")
+
+        if previous_container is None:
+            # Handlers of two containers run at the same time while one replaces the other (see take_over).
+            # rpc_push may reach any of them, so they share the session directory and use two halves of the queues.
+            self.session_directory = SessionDirectory()
+            self.handler_event_queues = [mp.Queue() for _ in range(2 * num_handlers)]
+            self.first_handler_index = 0
+        else:
+            self.session_directory = previous_container.session_directory
+            self.handler_event_queues = previous_container.handler_event_queues
+            self.first_handler_index = num_handlers - previous_container.first_handler_index
+            for queue in self.handler_event_queues[self.first_handler_index : self.first_handler_index + num_handlers]:
+                while not queue.empty():  # drop the events left by the handlers of a container that shut down
+                    queue.get()
 
-        handler_event_queues = [mp.Queue() for _ in range(num_handlers)]
         self.conn_handlers = [
             TransformerConnectionHandler(
                 dht,
                 self.module_backends,
                 adapters=server_info.adapters,
                 dht_prefix=dht_prefix,
-                handler_event_queues=handler_event_queues,
-                handler_index=i,
+                handler_event_queues=self.handler_event_queues,
+                session_directory=self.session_directory,
+                handler_index=self.first_handler_index + i,
                 inference_max_length=inference_max_length,
                 request_timeout=request_timeout,
                 session_timeout=session_timeout,
                 step_timeout=step_timeout,
+                max_prefill_chunk_tokens=max_prefill_chunk_tokens,
+                task_prioritizer=task_prioritizer,
                 quant_type=QuantType[server_info.quant_type.upper()],
+                draining=self.draining,
+                shared_tensor_ring=self.shared_tensor_rings[i],
+                activation_cache=self.activation_cache,
             )
             for i in range(num_handlers)
         ]
@@ -654,6 +998,8 @@ class ModuleContainer(threading.Thread):
         """
         for handler in self.conn_handlers:
             handler.run_in_background()
+        if self.offload_thread is not None and self._owns_caches:  # otherwise, it is run by the previous container
+            self.offload_thread.start()
 
         self.runtime.run()
 
@@ -684,12 +1030,56 @@ class ModuleContainer(threading.Thread):
             pool.is_alive() for pool in self.runtime.pools
         )
 
+    def take_over(self, previous_container: ModuleContainer, kept_uids: Collection[str] = ()) -> None:
+        """
+        Start serving instead of previous_container, which keeps running its inference sessions until they finish.
+        All handlers of this peer share the RPC protocols, so the previous handlers stop accepting requests before
+        ours are registered. Otherwise, requests for new blocks or new sessions could reach the previous handlers.
+
+        :param kept_uids: modules of previous_container that this container serves as well
+        """
+        previous_container.start_draining(kept_uids)
+        self.run_in_background(await_ready=True)
+        previous_container._owns_caches, self._owns_caches = False, True
+
+    def start_draining(self, kept_uids: Collection[str] = ()) -> None:
+        """
+        Stop accepting new requests, while the existing inference sessions continue until they finish.
+        The modules listed in kept_uids are served by another container and will not be freed on shutdown.
+        """
+        self._kept_uids = set(kept_uids)
+        self.draining.set()
+        for handler in self.conn_handlers:
+            handler.stop_accepting_requests()
+        for handler in self.conn_handlers:
+            if handler.is_alive() and not handler.stopped_accepting.wait(handler.shutdown_timeout):
+                logger.warning(f"{handler.__class__.__name__} did not stop accepting requests in time")
+
+    @property
+    def is_used_by_sessions(self) -> bool:
+        """True if our handlers run any inference sessions (the memory cache may be used by the next container too)"""
+        return any(handler.num_sessions > 0 for handler in self.conn_handlers)
+
+    def shutdown_when_drained(self, timeout: float, check_period: float = 1.0) -> None:
+        """Wait until the inference sessions finish (for at most timeout seconds), then shut down the container"""
+        deadline = time.perf_counter() + timeout
+        while self.is_used_by_sessions and time.perf_counter() < deadline and not self._is_shut_down:
+            time.sleep(check_period)
+        if self.is_used_by_sessions and not self._is_shut_down:
+            logger.warning(f"Inference sessions did not finish in {timeout} sec, terminating them")
+        self.shutdown()
+
     def shutdown(self):
         """
         Gracefully terminate the container, process-safe.
         Please note that terminating container otherwise (e.g. by killing processes) may result in zombie processes.
         If you did already cause a zombie outbreak, your only option is to kill them with -9 (SIGKILL).
         """
+        with self._shutdown_lock:
+            if self._is_shut_down:
+                return
+            self._is_shut_down = True
+
         # self.dht_announcer.announce(ServerState.OFFLINE)
         logger.info(f"Announced that blocks {list(self.module_backends.keys())} are offline")
 
@@ -705,11 +1095,19 @@ class ModuleContainer(threading.Thread):
                 pool.shutdown()
 
         logger.debug(f"Shutting down runtime")
+        if self._owns_caches and self.offload_thread is not None and self.offload_thread.is_alive():
+            self.offload_thread.shutdown()
         self.runtime.shutdown()
+        if self._owns_caches:  # otherwise, the caches were handed over to the next container
+            self.memory_cache.offloader.close()
+        for ring in self.shared_tensor_rings:
+            if ring is not None:
+                ring.close()
 
         logger.debug("Shutting down backends")
-        for backend in self.module_backends.values():
-            backend.shutdown()
+        for module_uid, backend in self.module_backends.items():
+            if module_uid not in self._kept_uids:
+                backend.shutdown()
 
         logger.info("Module container shut down successfully")
 
@@ -747,23 +1145,28 @@ class ModuleAnnouncerThread(threading.Thread):
         self.trigger = threading.Event()
 
         self.dht_prefix = parse_uid(module_uids[0])[0]
+        self._lock = threading.Lock()
+        self._retired_uids: List[str] = []
+        self._set_span(module_uids)
+
+        self.max_pinged = max_pinged
+        self.ping_aggregator = PingAggregator(self.dht)
+        self.record_validator = record_validator
+
+    def _set_span(self, module_uids: List[str]) -> None:
         block_indices = [parse_uid(uid)[1] for uid in module_uids]
         self.server_info.start_block = min(block_indices)
         self.server_info.end_block = max(block_indices) + 1
-
-        self.max_pinged = max_pinged
         self.next_uids = [
             f"{self.dht_prefix}{UID_DELIMITER}{i}"
             for i in range(self.server_info.start_block + 1, self.server_info.end_block + 1)
         ]
-        self.ping_aggregator = PingAggregator(self.dht)
-        self.record_validator = record_validator
 
     def run(self) -> None:
         while True:
             start_time = time.perf_counter()
 
-            self.server_info.cache_tokens_left = self.memory_cache.bytes_left // self.bytes_per_token
+            self.server_info.cache_tokens_left = self.memory_cache.get_tokens_left(self.bytes_per_token)
             if self.server_info.state != ServerState.OFFLINE:
                 self._ping_next_servers()
                 self.server_info.next_pings = {
@@ -772,13 +1175,16 @@ class ModuleAnnouncerThread(threading.Thread):
             else:
                 self.server_info.next_pings = None  # No need to ping if we're disconnecting
 
-            declare_active_modules(
-                self.dht,
-                self.module_uids,
-                self.server_info,
-                expiration_time=get_dht_time() + self.expiration,
-                record_validator=self.record_validator,
-            )
+            with self._lock:  # see move_to()
+                declare_active_modules(
+                    self.dht,
+                    self.module_uids,
+                    self.server_info,
+                    expiration_time=get_dht_time() + self.expiration,
+                    record_validator=self.record_validator,
+                    offline_uids=self._retired_uids,
+                )
+                self._retired_uids = []
             if self.server_info.state == ServerState.OFFLINE:
                 break
             if not self.dht_prefix.startswith("_"):  # Not private
@@ -803,6 +1209,19 @@ class ModuleAnnouncerThread(threading.Thread):
         if state == ServerState.OFFLINE:
             self.join()
 
+    def move_to(self, module_uids: List[str], memory_cache: MemoryCache) -> None:
+        """
+        Announce that this server serves module_uids instead of the current modules. The new modules and the modules
+        that are no longer served (declared offline) are stored to the DHT in one batch, so that clients never see
+        the server serving both spans or neither of them.
+        """
+        with self._lock:
+            retired_uids = set(self._retired_uids) | set(self.module_uids)
+            self._retired_uids = sorted(retired_uids - set(module_uids))
+            self.module_uids, self.memory_cache = module_uids, memory_cache
+            self._set_span(module_uids)
+        self.trigger.set()
+
     def _ping_next_servers(self) -> Dict[hypermind.PeerID, float]:
         module_infos = get_remote_module_infos(self.dht, self.next_uids, latest=True)
         middle_servers = {peer_id for info in module_infos[:-1] for peer_id in info.servers}
@@ -33,6 +33,7 @@ from subnet.server.from_pretrained import load_pretrained_block
 from subnet.server.handler import TransformerConnectionHandler
 from subnet.server.memory_cache import MemoryCache
 from subnet.server.reachability import ReachabilityProtocol, check_direct_reachability, validate_reachability
+from subnet.server.session_directory import SessionDirectory
 from subnet.server.throughput import get_dtype_name, get_server_throughput
 from subnet.substrate.consensus import Consensus
 from subnet.utils.auto_config import AutoDistributedConfig
@@ -69,6 +70,8 @@ class Server:
         max_chunk_size_bytes: int = 256 * 1024 * 1024,
         max_alloc_timeout: float = 600,
         attn_cache_tokens: Optional[int] = None,
+        continuous_batching: bool = False,
+        max_batched_sessions: int = 16,
         torch_dtype: str = "auto",
         revision: Optional[str] = None,
         cache_dir: Optional[str] = None,
@@ -233,6 +236,7 @@ class Server:
         self.inference_max_length = inference_max_length
         self.max_chunk_size_bytes = max_chunk_size_bytes
         self.max_alloc_timeout = max_alloc_timeout
+        self.max_batched_sessions = max_batched_sessions if continuous_batching else 1
 
         # For attention cache in GPU or RAM
         if attn_cache_tokens is None:
@@ -385,6 +389,7 @@ class Server:
                 max_batch_size=self.max_batch_size,
                 max_chunk_size_bytes=self.max_chunk_size_bytes,
                 max_alloc_timeout=self.max_alloc_timeout,
+                max_batched_sessions=self.max_batched_sessions,
                 inference_max_length=self.inference_max_length,
                 torch_dtype=self.torch_dtype,
                 cache_dir=self.cache_dir,
@@ -554,6 +559,7 @@ class ModuleContainer(threading.Thread):
         max_batch_size: int,
         max_chunk_size_bytes: int,
         max_alloc_timeout: float,
+        max_batched_sessions: int,
         torch_dtype: torch.dtype,
         cache_dir: str,
         max_disk_space: int,
@@ -636,7 +642,7 @@ class ModuleContainer(threading.Thread):
                     max_batch_size=max_batch_size,
                 )
 
-            merge_inference_pools_inplace(blocks)
+            merge_inference_pools_inplace(blocks, max_batched_sessions=max_batched_sessions)
 
             if should_validate_reachability:
                 validate_reachability(dht.peer_id)
@@ -684,6 +690,7 @@ class ModuleContainer(threading.Thread):
         self.server_info, self.update_period, self.expiration = server_info, update_period, expiration
 
         handler_event_queues = [mp.Queue() for _ in range(num_handlers)]
+        session_directory = SessionDirectory()
         self.conn_handlers = [
             TransformerConnectionHandler(
                 dht,
@@ -691,6 +698,7 @@ class ModuleContainer(threading.Thread):
                 adapters=server_info.adapters,
                 dht_prefix=dht_prefix,
                 handler_event_queues=handler_event_queues,
+                session_directory=session_directory,
                 handler_index=i,
                 inference_max_length=inference_max_length,
                 request_timeout=request_timeout,
@@ -824,7 +832,7 @@ class ModuleAnnouncerThread(threading.Thread):
         while True:
             start_time = time.perf_counter()
 
-            self.server_info.cache_tokens_left = self.memory_cache.bytes_left // self.bytes_per_token
+            self.server_info.cache_tokens_left = self.memory_cache.get_tokens_left(self.bytes_per_token)
             if self.server_info.state != ServerState.OFFLINE:
                 self._ping_next_servers()
                 self.server_info.next_pings = {
@@ -31,6 +31,7 @@ from subnet.server.from_pretrained import load_pretrained_block
 from subnet.server.handler import TransformerConnectionHandler
 from subnet.server.memory_cache import MemoryCache
 from subnet.server.reachability import ReachabilityProtocol, check_direct_reachability, validate_reachability
+from subnet.server.session_directory import SessionDirectory
 from subnet.server.throughput import get_dtype_name, get_server_throughput
 from subnet.utils.auto_config import AutoDistributedConfig
 from subnet.utils.convert_block import QuantType, check_device_balance, convert_block
@@ -645,6 +646,7 @@ class ModuleContainer(threading.Thread):
         self.server_info, self.update_period, self.expiration = server_info, update_period, expiration
 
         handler_event_queues = [mp.Queue() for _ in range(num_handlers)]
+        session_directory = SessionDirectory()
         self.conn_handlers = [
             TransformerConnectionHandler(
                 dht,
@@ -652,6 +654,7 @@ class ModuleContainer(threading.Thread):
                 adapters=server_info.adapters,
                 dht_prefix=dht_prefix,
                 handler_event_queues=handler_event_queues,
+                session_directory=session_directory,
                 handler_index=i,
                 inference_max_length=inference_max_length,
                 request_timeout=request_timeout,
@@ -785,7 +788,7 @@ class ModuleAnnouncerThread(threading.Thread):
         while True:
             start_time = time.perf_counter()
 
-            self.server_info.cache_tokens_left = self.memory_cache.bytes_left // self.bytes_per_token
+            self.server_info.cache_tokens_left = self.memory_cache.get_tokens_left(self.bytes_per_token)
             if self.server_info.state != ServerState.OFFLINE:
                 self._ping_next_servers()
                 self.server_info.next_pings = {
@@ -0,0 +1,94 @@
+"""
+A directory of inference sessions shared by all ConnectionHandlers of a server.
+
+A client may send rpc_push requests for a session to any handler, so a handler needs to know which handler owns
+the session. We keep a hash table in shared memory that maps session ids to handler indices: opening and closing
+a session updates one entry, and a push to another handler's session costs one lookup and one message to that handler.
+
+The table uses open addressing with linear probing over 64-bit hashes of session ids. Entries are removed with
+backward shift deletion, so the table does not accumulate tombstones while sessions come and go.
+"""
+import ctypes
+import hashlib
+import multiprocessing as mp
+from typing import Optional
+
+from hypermind.utils.logging import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_CAPACITY = 2**16  # sessions open at the same time
+_EMPTY = 0
+
+
+class SessionDirectory:
+    """
+    Maps inference session ids to the indices of handlers that own the sessions, can be used by any process
+
+    :param capacity: the maximum number of sessions registered at the same time (rounded up to a power of two)
+    """
+
+    def __init__(self, capacity: int = DEFAULT_CAPACITY):
+        assert capacity > 0, "capacity must be positive"
+        self.capacity = 1 << (capacity - 1).bit_length()
+        self._mask = self.capacity - 1
+        self._keys = mp.RawArray(ctypes.c_uint64, self.capacity)  # _EMPTY marks a free slot
+        self._values = mp.RawArray(ctypes.c_int32, self.capacity)
+        self._size = mp.RawValue(ctypes.c_int64, 0)
+        self._lock = mp.Lock()
+
+    def __len__(self) -> int:
+        return self._size.value
+
+    def add(self, session_id: str, handler_index: int) -> bool:
+        """Register a session, return False if the directory is full"""
+        key = _hash_session_id(session_id)
+        with self._lock:
+            index = self._find(key)
+            if self._keys[index] == _EMPTY:
+                if self._size.value >= self.capacity - 1:  # keep a free slot, so that lookups always terminate
+                    logger.warning(f"Too many inference sessions ({self._size.value}), rpc_push will not find new ones")
+                    return False
+                self._size.value += 1
+            self._values[index] = handler_index
+            self._keys[index] = key
+            return True
+
+    def get(self, session_id: str) -> Optional[int]:
+        """Return the index of the handler that owns the session, or None if the session is unknown"""
+        key = _hash_session_id(session_id)
+        with self._lock:
+            index = self._find(key)
+            return self._values[index] if self._keys[index] == key else None
+
+    def remove(self, session_id: str):
+        key = _hash_session_id(session_id)
+        with self._lock:
+            hole = self._find(key)
+            if self._keys[hole] != key:
+                return
+            self._size.value -= 1
+
+            # Move back the entries that were placed after the removed one because of collisions
+            index = hole
+            while True:
+                index = (index + 1) & self._mask
+                if self._keys[index] == _EMPTY:
+                    break
+                home = self._keys[index] & self._mask
+                if (index - home) & self._mask >= (index - hole) & self._mask:
+                    self._keys[hole], self._values[hole] = self._keys[index], self._values[index]
+                    hole = index
+            self._keys[hole] = _EMPTY
+
+    def _find(self, key: int) -> int:
+        """Return the slot that holds the key, or the empty slot where it would be inserted"""
+        index = key & self._mask
+        while self._keys[index] != _EMPTY and self._keys[index] != key:
+            index = (index + 1) & self._mask
+        return index
+
+
+def _hash_session_id(session_id: str) -> int:
+    key = int.from_bytes(hashlib.blake2b(session_id.encode(), digest_size=8).digest(), "little")
+    return key if key != _EMPTY else 1
@@ -0,0 +1,224 @@
+"""
+Shared memory that ConnectionHandlers and Runtime use to pass small tensors (e.g., hidden states of inference steps).
+
+By default, PrioritizedTaskPool passes the tensors of a task through pickling: torch.multiprocessing moves every input
+tensor to a new shared memory segment and sends its file descriptor to the runtime, and the outputs go back the same
+way. For 1-token inference steps, creating, sending, and unlinking these segments takes a large share of step latency.
+
+Instead, each ConnectionHandler owns a SharedTensorRing: one shared buffer split into fixed-size slots, allocated before
+the handler process is forked. When the handler submits a task, it copies the inputs into a free slot and sends small
+SharedTensorRef-s instead of the tensors. The runtime reads the inputs from the slot and writes the outputs into the
+same slot after the inputs, then the handler copies the outputs out and returns the slot to the ring.
+Tasks that don't fit into a slot (e.g., long prefills) or are submitted while all slots are busy use the default path.
+"""
+import collections
+import functools
+import itertools
+import math
+import threading
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import torch
+from hypermind.utils.logging import get_logger
+from hypermind.utils.mpfuture import MPFuture
+
+logger = get_logger(__name__)
+
+ALIGNMENT = 64  # bytes, enough to view any slot region as a tensor of any dtype
+
+_rings: Dict[int, "SharedTensorRing"] = {}  # all rings created by this process and inherited by forked handlers
+_ring_ids = itertools.count()
+_local_ring: Optional["SharedTensorRing"] = None  # the ring used for tasks submitted by this process, if any
+
+
+@dataclass(frozen=True)
+class SharedTensorRef:
+    """A tensor stored in a slot of a SharedTensorRing, sent instead of the tensor itself"""
+
+    ring_id: int
+    offset: int
+    shape: Tuple[int, ...]
+    dtype: torch.dtype
+    requires_grad: bool = False
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    @property
+    def nbytes(self) -> int:
+        return _get_nbytes(self.shape, self.dtype)
+
+
+@dataclass(frozen=True)
+class SharedMemorySlot:
+    """A slot that holds the inputs of a task; the runtime writes the outputs starting from outputs_offset"""
+
+    ring_id: int
+    index: int
+    outputs_offset: int
+
+
+class SharedTensorRing:
+    """
+    A shared buffer with a fixed number of fixed-size slots, each holding the inputs and outputs of one task.
+    Create it before forking the process that submits tasks, then call set_local_ring() in that process.
+    Only that process acquires and releases the slots, the runtime reads and writes the slots of the tasks it processes.
+
+    :param num_slots: the maximum number of tasks that use the ring at the same time
+    :param slot_size: the maximum total size of inputs and outputs of one task, in bytes
+    """
+
+    def __init__(self, num_slots: int, slot_size: int):
+        assert num_slots > 0 and slot_size > 0, "num_slots and slot_size must be positive"
+        self.num_slots, self.slot_size = num_slots, _align(slot_size)
+        self.buffer = torch.empty(num_slots * self.slot_size, dtype=torch.uint8).share_memory_()
+        self._free_slots = collections.deque(range(num_slots))
+        self._lock = threading.Lock()
+
+        self.ring_id = next(_ring_ids)
+        _rings[self.ring_id] = self
+
+    def write_inputs(self, args: Sequence[Any]) -> Tuple[Sequence[Any], Optional[SharedMemorySlot]]:
+        """Copy the tensors from args to a free slot and replace them with references, if they fit into a slot"""
+        tensors = [arg for arg in args if isinstance(arg, torch.Tensor)]
+        if not tensors or any(tensor.device.type != "cpu" for tensor in tensors):
+            return args, None
+        if sum(_align(tensor.numel() * tensor.element_size()) for tensor in tensors) > self.slot_size:
+            return args, None
+        with self._lock:
+            if not self._free_slots:
+                return args, None
+            index = self._free_slots.popleft()
+
+        offset = index * self.slot_size
+        shared_args = []
+        for arg in args:
+            if isinstance(arg, torch.Tensor):
+                shared_args.append(self._write(arg, offset))
+                offset += _align(shared_args[-1].nbytes)
+            else:
+                shared_args.append(arg)
+        return shared_args, SharedMemorySlot(self.ring_id, index, offset - index * self.slot_size)
+
+    def write_outputs(self, slot: SharedMemorySlot, outputs: Sequence[torch.Tensor]) -> Optional[List[Any]]:
+        """Copy the outputs of a task to its slot (may be called by the runtime), return None if they don't fit"""
+        tensors = [output for output in outputs if isinstance(output, torch.Tensor)]
+        if sum(_align(tensor.numel() * tensor.element_size()) for tensor in tensors) > (
+            self.slot_size - slot.outputs_offset
+        ):
+            return None
+
+        offset = slot.index * self.slot_size + slot.outputs_offset
+        shared_outputs = []
+        for output in outputs:
+            if isinstance(output, torch.Tensor):
+                shared_outputs.append(self._write(output, offset))
+                offset += _align(shared_outputs[-1].nbytes)
+            else:
+                shared_outputs.append(output)
+        return shared_outputs
+
+    def read(self, ref: SharedTensorRef) -> torch.Tensor:
+        """Return a view of the referenced tensor; it is only valid until the slot is released"""
+        return self._view(ref).requires_grad_(ref.requires_grad)
+
+    def release(self, slot: SharedMemorySlot):
+        with self._lock:
+            self._free_slots.append(slot.index)
+
+    def close(self):
+        _rings.pop(self.ring_id, None)
+
+    def _write(self, tensor: torch.Tensor, offset: int) -> SharedTensorRef:
+        ref = SharedTensorRef(self.ring_id, offset, tuple(tensor.shape), tensor.dtype, tensor.requires_grad)
+        with torch.no_grad():
+            self._view(ref).copy_(tensor)
+        return ref
+
+    def _view(self, ref: SharedTensorRef) -> torch.Tensor:
+        return self.buffer[ref.offset : ref.offset + ref.nbytes].view(ref.dtype).view(ref.shape)
+
+
+class SharedMemoryResult:
+    """A wrapper for MPFuture that copies the task outputs from a shared memory slot and releases the slot"""
+
+    def __init__(self, future: MPFuture, slot: SharedMemorySlot):
+        self.future, self.slot = future, slot
+        self._ring = get_ring(slot.ring_id)
+        self._released = False
+
+    def __await__(self):
+        try:
+            outputs = yield from self.future.__await__()
+        except BaseException:
+            self._release_when_done()
+            raise
+        return self._copy_outputs_and_release(outputs)
+
+    def result(self, timeout: Optional[float] = None) -> List[Any]:
+        try:
+            outputs = self.future.result(timeout)
+        except BaseException:
+            self._release_when_done()
+            raise
+        return self._copy_outputs_and_release(outputs)
+
+    def done(self) -> bool:
+        return self.future.done()
+
+    def _copy_outputs_and_release(self, outputs: Sequence[Any]) -> List[Any]:
+        try:
+            return [self._copy(item) if isinstance(item, SharedTensorRef) else item for item in outputs]
+        finally:
+            self._release()
+
+    def _copy(self, ref: SharedTensorRef) -> torch.Tensor:
+        return self._ring.read(ref).detach().clone().requires_grad_(ref.requires_grad)
+
+    def _release_when_done(self):
+        # If the task was not processed yet (e.g., the caller was cancelled), the runtime may still write to the slot
+        if self.future.done():
+            self._release()
+        else:
+            self.future.add_done_callback(lambda _: self._release())
+
+    def _release(self):
+        if not self._released:
+            self._released = True
+            self._ring.release(self.slot)
+
+
+def set_local_ring(ring: Optional[SharedTensorRing]):
+    """Use this ring for the tasks submitted by the current process (e.g., a ConnectionHandler)"""
+    global _local_ring
+    _local_ring = ring
+
+
+def get_local_ring() -> Optional[SharedTensorRing]:
+    return _local_ring
+
+
+def resolve_shared_tensor(arg: Any) -> Any:
+    """If arg is a SharedTensorRef, return a view of the tensor it refers to"""
+    if isinstance(arg, SharedTensorRef):
+        return get_ring(arg.ring_id).read(arg)
+    return arg
+
+
+def get_ring(ring_id: int) -> SharedTensorRing:
+    return _rings[ring_id]
+
+
+def _align(num_bytes: int) -> int:
+    return -(-num_bytes // ALIGNMENT) * ALIGNMENT
+
+
+def _get_nbytes(shape: Sequence[int], dtype: torch.dtype) -> int:
+    return math.prod(shape) * _get_element_size(dtype)
+
+
+@functools.lru_cache(maxsize=None)
+def _get_element_size(dtype: torch.dtype) -> int:
+    return torch.empty((), dtype=dtype).element_size()
@@ -1,25 +1,100 @@
+import asyncio
 import ctypes
 import multiprocessing as mp
+import re
 import threading
 import time
+from collections import OrderedDict, deque
 from concurrent.futures._base import PENDING
 from dataclasses import dataclass, field
-from queue import PriorityQueue
-from typing import Any, List, Optional, Sequence, Tuple, Union
+from queue import Empty, PriorityQueue
+from typing import Any, Callable, Dict, Hashable, List, Optional, Sequence, Tuple, Union
 
 import torch
 from hypermind import get_logger
 from hypermind.utils.mpfuture import ALL_STATES, MPFuture
 
+from subnet.server.shared_memory import (
+    SharedMemoryResult,
+    SharedMemorySlot,
+    get_local_ring,
+    get_ring,
+    resolve_shared_tensor,
+)
+from subnet.utils.misc import DUMMY
+
 logger = get_logger(__name__)
 
+MAX_CANCELLED_UIDS = 4096  # forget cancellations of tasks that finished before the runtime noticed them
+_processing = threading.local()  # the pool and the tasks that the current thread is processing, see process_func
+
+COST_EMA_RATE = 0.05  # the weight of each new batch in the moving averages of processing costs, see process_func
+_RETRY_AFTER_PATTERN = re.compile(r"retry after (\d+(?:\.\d+)?) s")
+
+
+class ServerBusyError(Exception):
+    """The pool refused a task since it would not complete the task before its deadline"""
+
+    def __init__(self, pool_name: str, estimated_time: float, time_left: float):
+        self.retry_after = estimated_time - time_left  # by then, the queue is expected to be short enough
+        super().__init__(
+            f"Server is busy: {pool_name} would complete the task in {estimated_time:.3f} s, but the deadline is in "
+            f"{time_left:.3f} s, retry after {self.retry_after:.3f} s"
+        )
+
+
+def get_retry_after(exception: BaseException) -> Optional[float]:
+    """Extract the retry-after hint of a ServerBusyError, including the errors reported by remote servers"""
+    match = _RETRY_AFTER_PATTERN.search(str(exception))
+    return float(match.group(1)) if match is not None else None
+
+
+class TaskCancelledError(Exception):
+    """The task was skipped (or interrupted) by the runtime, since the caller stopped waiting for its outputs"""
+
+
+class TaskFuture(MPFuture):
+    """An MPFuture for the outputs of a pool task that asks the runtime to skip the task if the caller stops awaiting"""
+
+    def __init__(self, cancelled_tasks: mp.SimpleQueue):
+        super().__init__()
+        self._cancelled_tasks = cancelled_tasks
+
+    def __await__(self):
+        try:
+            return (yield from super().__await__())
+        except asyncio.CancelledError:
+            # The client closed the stream or the request deadline expired, so nobody needs the outputs
+            if not self.done():
+                self._cancelled_tasks.put(self._uid)
+            raise
+
+    def __getstate__(self):
+        state = dict(super().__getstate__())
+        state.pop("_cancelled_tasks", None)  # the runtime side does not need the queue
+        return state
+
+
+def is_current_batch_cancelled() -> bool:
+    """
+    Check if all tasks of the batch that this thread is processing were cancelled by their callers.
+    A process_func may call this between expensive stages and return early, since its outputs will be discarded.
+    """
+    pool = getattr(_processing, "pool", None)
+    if pool is None or not pool._are_cancelled(_processing.task_uids):
+        return False
+    _processing.interrupted = True
+    return True
+
 
 @dataclass(order=True, frozen=True)
 class Task:
     priority: float
+    deadline: float  # time.monotonic() by which the caller needs the outputs, tasks with equal priority go in EDF order
     time_submitted: float
     future: MPFuture = field(compare=False)
     args: Sequence[torch.Tensor] = field(compare=False)
+    shared_memory_slot: Optional[SharedMemorySlot] = field(default=None, compare=False)  # see shared_memory.py
 
     @property
     def uid(self) -> int:
@@ -32,8 +107,9 @@ class PrioritizedTaskPool(threading.Thread):
     returns results (or exception) to the corresponding ConnectionHandler. Runs a background process.
     A single PrioritizedTaskPool services a specific function (e.g. layer1.forward, layer2.forward or layer1.backward)
 
-    :note: unlike hypermind.moe TaskPool, this pool does *not* combine incoming requests into batches.
-      This would require grouping requests of different length.
+    :note: unlike hypermind.moe TaskPool, this pool does *not* concatenate incoming requests into batches by default.
+      This would require grouping requests of different length. Instead, if max_tasks_per_batch > 1, the pool hands
+      several compatible tasks (see get_task_group) to process_func at once and lets it decide how to batch them.
 
     :param process_func: function to be applied to every formed batch; called by Runtime
         Note that process_func should accept only positional args (Tensors) and return a flat tuple of Tensors
@@ -43,7 +119,20 @@ class PrioritizedTaskPool(threading.Thread):
     :param name: pool name, used for logging
     :param min_batch_size: process at least this many inputs in a batch, otherwise wait for more
     :param device: if specified, input tensors will be moved to that device by default
+    :param max_tasks_per_batch: if greater than 1, the pool may hand up to this many tasks to process_func at once.
+      In this mode, process_func receives one tuple of arguments per task and returns a flat tuple of tensors
+      that contains the outputs of every task, in order (each task must produce the same number of outputs)
+    :param get_task_group: a function that returns a hashable key for a task; only tasks with equal keys
+      can be processed together. By default, all tasks are considered compatible
+    :param max_batch_wait: if max_tasks_per_batch > 1, hold new tasks back from the runtime for up to this many seconds
+      while more compatible tasks arrive, unless they already fill a batch (see get_batching_stats for the added delay).
+      The pool thread does the waiting, so the runtime keeps processing other pools in the meantime
     :param start: if True, start automatically at the end of __init__
+
+    :note: if a ConnectionHandler stops awaiting a task (e.g., the client disconnected), the task is marked as cancelled
+      and the runtime skips it instead of processing it; see TaskFuture and is_current_batch_cancelled
+    :note: tasks with a deadline are refused in submit_task if the pool does not expect to complete them in time,
+      based on the queued tasks and the measured processing costs (see estimate_completion_time)
     """
 
     def __init__(
@@ -53,37 +142,117 @@ class PrioritizedTaskPool(threading.Thread):
         name: str,
         min_batch_size=1,
         device: Optional[torch.device] = None,
+        max_tasks_per_batch: int = 1,
+        get_task_group: Optional[Callable[[Task], Hashable]] = None,
+        max_batch_wait: float = 0.0,
         daemon=True,
         start=False,
     ):
         super().__init__(daemon=daemon, name=name)
-        self.process_func = process_func
+        self._process_func = process_func
         # the lower the priority is, the more urgent it is to process this pool
         self._priority = mp.Value(ctypes.c_double, 1.0)
 
         self.min_batch_size, self.max_batch_size = min_batch_size, max_batch_size
         self.device = device
+        assert max_tasks_per_batch >= 1, "max_tasks_per_batch must be positive"
+        self.max_tasks_per_batch = max_tasks_per_batch
+        self.get_task_group = get_task_group if get_task_group is not None else (lambda task: None)
+        self.max_batch_wait = max_batch_wait
+        self._batching_stats = mp.Array(ctypes.c_double, 4)  # batches, tasks, tokens, seconds spent waiting for tasks
+        self._stages_tasks = max_tasks_per_batch > 1 and max_batch_wait > 0
+        self._staged_tasks: List[Task] = []  # tasks held back until compatible ones arrive - only valid inside Runtime
+        self._staged_tasks_changed = threading.Condition()
+        self._staging_stopped = False
+        self._staging_delays: Dict[int, float] = {}  # how long the released tasks were held back, by task uid
 
         self.submitted_tasks = mp.SimpleQueue()  # interaction with ConnectionHandlers
         self._ordered_tasks = PriorityQueue()  # interaction with Runtime - only valid inside Runtime
 
         self._dispatched_tasks = {}
+        self._loaded_batches = deque()  # task uids and sizes of the batches loaded to Runtime, in processing order
+
+        self.cancelled_tasks = mp.SimpleQueue()  # uids of tasks that ConnectionHandlers no longer wait for
+        self._cancelled_uids = OrderedDict()  # cancellations received by Runtime - only valid inside Runtime
+        self._cancelled_uids_lock = threading.Lock()
+        self._num_skipped_tasks = mp.Value(ctypes.c_int64, 0)
+
+        # Processing costs are measured by Runtime and used by ConnectionHandlers to refuse tasks with deadlines
+        self._queued_tasks, self._queued_tokens = mp.Value(ctypes.c_int64, 0), mp.Value(ctypes.c_int64, 0)
+        self._seconds_per_batch, self._seconds_per_token = mp.Value(ctypes.c_double, 0), mp.Value(ctypes.c_double, 0)
+        self._cost_stats = None  # moving averages of tokens, seconds, tokens ** 2, tokens * seconds per batch
+
         self.batch_receiver, self.batch_sender = mp.Pipe(duplex=False)
+        self._earliest_deadline = mp.Value(ctypes.c_double, 1.0)
         self._oldest_undispatched_timestamp = mp.Value(ctypes.c_double, 1.0)
-        self.priority = float("inf"), float("inf")  # (first task priority, first task timestamp)
+        self.priority = float("inf"), float("inf"), float("inf")  # (first task priority, deadline, timestamp)
 
         if start:
             self.start()
 
     def run(self):
         """Read tasks from incoming queue and put them into a local priority queue"""
+        if self._stages_tasks:
+            threading.Thread(target=self._release_staged_tasks, name=f"{self.name}_staging", daemon=True).start()
         while True:
             task = self.submitted_tasks.get()
             if task is None:
                 logger.debug("Shutting down prioritizer thread")
+                with self._staged_tasks_changed:
+                    self._staging_stopped = True  # shuts down self._release_staged_tasks()
+                    self._staged_tasks_changed.notify()
                 break
 
-            self._ordered_tasks.put(task, block=True)
+            if self._stages_tasks:
+                with self._staged_tasks_changed:
+                    self._staged_tasks.append(task)
+                    self._staged_tasks_changed.notify()
+            else:
+                self._ordered_tasks.put(task, block=True)
+
+    def _release_staged_tasks(self):
+        """Pass staged tasks to the runtime once they fill a batch or waited for max_batch_wait (see __init__)"""
+        while True:
+            with self._staged_tasks_changed:
+                while True:
+                    if self._staging_stopped:
+                        return
+                    released_tasks, time_left = self._pop_releasable_tasks()
+                    if released_tasks:
+                        break
+                    self._staged_tasks_changed.wait(time_left)
+
+            # Queue all tasks before signaling the runtime, so that it can take them into one batch
+            current_time = time.monotonic()
+            for task in released_tasks:
+                self._staging_delays[task.uid] = current_time - task.time_submitted
+                self._ordered_tasks.put(task)
+            first_task = min(released_tasks)
+            if (first_task.priority, first_task.deadline, first_task.time_submitted) < self.priority:
+                self.priority = (first_task.priority, first_task.deadline, first_task.time_submitted)
+            for _ in released_tasks:
+                self.batch_sender.send(None)
+
+    def _pop_releasable_tasks(self) -> Tuple[List[Task], Optional[float]]:
+        """Take the staged groups of tasks that fill a batch or waited enough, return them and the time to wait"""
+        groups: Dict[Hashable, List[Task]] = {}
+        for task in self._staged_tasks:
+            groups.setdefault(self.get_task_group(task), []).append(task)
+
+        current_time, released_tasks, time_left = time.monotonic(), [], None
+        for tasks in groups.values():
+            group_time_left = min(task.time_submitted for task in tasks) + self.max_batch_wait - current_time
+            is_full = len(tasks) >= self.max_tasks_per_batch
+            is_full = is_full or sum(self.get_task_size(task) for task in tasks) >= self.max_batch_size
+            if is_full or group_time_left <= 0:
+                released_tasks.extend(tasks)
+            else:
+                time_left = group_time_left if time_left is None else min(time_left, group_time_left)
+
+        if released_tasks:
+            released_uids = {task.uid for task in released_tasks}
+            self._staged_tasks = [task for task in self._staged_tasks if task.uid not in released_uids]
+        return released_tasks, time_left
 
     def terminate(self):
         """An alias for hypermind.Runtime that assumes that each TaskPool is a process"""
@@ -92,22 +261,44 @@ class PrioritizedTaskPool(threading.Thread):
     def shutdown(self):
         self.submitted_tasks.put(None)  # Shuts down self.run()
 
-    def submit_task(self, *args: Any, priority: float = 0.0) -> MPFuture:
-        """Add task to this pool's queue, return Future for its output"""
-        future = MPFuture()
+    def submit_task(
+        self, *args: Any, priority: float = 0.0, deadline: Optional[float] = None
+    ) -> Union[MPFuture, SharedMemoryResult]:
+        """
+        Add task to this pool's queue, return Future for its output.
+        If this process has a SharedTensorRing (see shared_memory.py), the tensors are passed through its slots.
+
+        :param deadline: time.monotonic() by which the caller needs the outputs; if the pool does not expect
+          to complete the task by then, the future fails with ServerBusyError right away
+        """
+        future = TaskFuture(self.cancelled_tasks)
         # Remove shmem from MPFuture. This disables the .cancel() feature but
         # saves the server from "could not unlink the shared memory file" crashes during rebalancing
         future._shared_state_code = torch.tensor([ALL_STATES.index(PENDING)], dtype=torch.uint8)
 
-        task = Task(priority, time.monotonic(), future, args)
-        if self.get_task_size(task) > self.max_batch_size:
+        shared_memory_slot = None
+        ring = get_local_ring()
+        if ring is not None:
+            args, shared_memory_slot = ring.write_inputs(args)
+
+        deadline = deadline if deadline is not None else float("inf")
+        task = Task(priority, deadline, time.monotonic(), future, args, shared_memory_slot)
+        task_size = self.get_task_size(task)
+        estimated_time = self.estimate_completion_time(task_size)
+        if task_size > self.max_batch_size:
             exc = ValueError(f"Task size greater than max_batch_size ({self.max_batch_size}), it can't be processed")
             task.future.set_exception(exc)
+        elif estimated_time > task.deadline - task.time_submitted:
+            task.future.set_exception(ServerBusyError(self.name, estimated_time, task.deadline - task.time_submitted))
         else:
+            self._add_queued_tasks(1, task_size)
             self.submitted_tasks.put(task)
-            self.batch_sender.send(None)  # use this pipe to count the number of unfinished batches
-            if (task.priority, task.time_submitted) < self.priority:
-                self.priority = (task.priority, task.time_submitted)
+            if not self._stages_tasks:  # otherwise, the pool thread does this once it passes the task to the runtime
+                self.batch_sender.send(None)  # use this pipe to count the number of unfinished batches
+                if (task.priority, task.deadline, task.time_submitted) < self.priority:
+                    self.priority = (task.priority, task.deadline, task.time_submitted)
+        if shared_memory_slot is not None:
+            return SharedMemoryResult(task.future, shared_memory_slot)
         return task.future
 
     def get_task_size(self, task: Task) -> int:
@@ -116,55 +307,221 @@ class PrioritizedTaskPool(threading.Thread):
             return task.args[0].shape[0] * task.args[0].shape[1]
         return 1
 
+    def estimate_completion_time(self, task_size: int) -> float:
+        """
+        Estimate how many seconds a new task of this size would take to complete, including the queued tasks.
+        This is an upper bound as long as the runtime is busy with this pool only: more urgent tasks may go first,
+        but we do not count the tasks of other pools. Returns 0 until the pool has processed a batch.
+        """
+        num_tasks, num_tokens = self._queued_tasks.value + 1, self._queued_tokens.value + task_size
+        return num_tasks * self._seconds_per_batch.value + num_tokens * self._seconds_per_token.value
+
+    def _add_queued_tasks(self, num_tasks: int, num_tokens: int):
+        with self._queued_tasks.get_lock(), self._queued_tokens.get_lock():
+            self._queued_tasks.value += num_tasks
+            self._queued_tokens.value += num_tokens
+
     def load_batch_to_runtime(
         self, timeout: Optional[float] = None, device: Optional[torch.device] = None
     ) -> Tuple[Any, List[torch.Tensor]]:
         """receive next batch of arrays"""
         device = device if device is not None else self.device
-        task = self._ordered_tasks.get(block=True, timeout=timeout)
-        batch_inputs = [_move_to_device_if_tensor(arg, device, share_memory=False) for arg in task.args]
-        self._dispatched_tasks[task.uid] = task
-        self.batch_receiver.recv()  # reduce the number of active batches
+        first_task = self._ordered_tasks.get(block=True, timeout=timeout)
+        tasks = [first_task]
+        if self.max_tasks_per_batch > 1:
+            tasks.extend(self._take_compatible_tasks(first_task))
+        wait_time = self._staging_delays.pop(first_task.uid, 0.0)
+
+        for task in tasks:
+            self._staging_delays.pop(task.uid, None)
+            self._dispatched_tasks[task.uid] = task
+            self.batch_receiver.recv()  # reduce the number of active batches
         if not self._ordered_tasks.empty():
             first_remaining_task: Task = self._ordered_tasks.queue[0]
-            self.priority = (first_remaining_task.priority, first_remaining_task.time_submitted)
-        return task.uid, batch_inputs
+            self.priority = (
+                first_remaining_task.priority,
+                first_remaining_task.deadline,
+                first_remaining_task.time_submitted,
+            )
+        batch_size = sum(self.get_task_size(task) for task in tasks)
+        self._add_queued_tasks(-len(tasks), -batch_size)
+        with self._batching_stats.get_lock():
+            for i, value in enumerate((1, len(tasks), batch_size, wait_time)):
+                self._batching_stats[i] += value
+        self._loaded_batches.append((tuple(task.uid for task in tasks), batch_size))
+
+        if self.max_tasks_per_batch == 1:
+            batch_inputs = [_load_arg_to_runtime(arg, device) for arg in first_task.args]
+            return first_task.uid, batch_inputs
+        batch_inputs = [tuple(_load_arg_to_runtime(arg, device) for arg in task.args) for task in tasks]
+        return tuple(task.uid for task in tasks), batch_inputs
+
+    def process_func(self, *batch: Any) -> Tuple[torch.Tensor, ...]:
+        """
+        Process the next batch from load_batch_to_runtime unless all its tasks were cancelled, called by Runtime.
+        We also measure the processing time to estimate the completion time of new tasks, see submit_task.
+        """
+        task_uids, batch_size = self._loaded_batches.popleft()
+        if self._are_cancelled(task_uids):
+            self._count_skipped_tasks(len(task_uids))
+            return (DUMMY,) * len(task_uids)  # outputs of cancelled tasks are discarded in send_outputs_from_runtime
+
+        _processing.pool, _processing.task_uids, _processing.interrupted = self, task_uids, False
+        try:
+            start_time = time.perf_counter()
+            outputs = self._process_func(*batch)
+            if not _processing.interrupted:
+                if self.device is not None and torch.device(self.device).type == "cuda":
+                    torch.cuda.synchronize(self.device)  # otherwise, we would only measure the time of kernel launches
+                self._record_processing_time(batch_size, time.perf_counter() - start_time)
+            return outputs
+        finally:
+            if _processing.interrupted:
+                self._count_skipped_tasks(len(task_uids))
+            _processing.pool = None
+
+    def _record_processing_time(self, batch_size: int, elapsed: float):
+        """Fit processing time as (seconds per batch + batch size * seconds per token) with moving averages"""
+        sample = (batch_size, elapsed, batch_size**2, batch_size * elapsed)
+        if self._cost_stats is None:
+            self._cost_stats = sample
+        else:
+            self._cost_stats = tuple(old + COST_EMA_RATE * (new - old) for old, new in zip(self._cost_stats, sample))
+        mean_size, mean_time, mean_squared_size, mean_size_time = self._cost_stats
+
+        size_variance = mean_squared_size - mean_size**2
+        if size_variance > 1e-3 * mean_size**2:
+            seconds_per_token = max(0.0, (mean_size_time - mean_size * mean_time) / size_variance)
+            seconds_per_batch = max(0.0, mean_time - seconds_per_token * mean_size)
+        else:
+            seconds_per_token, seconds_per_batch = mean_time / mean_size, 0.0  # all batches have the same size
+        self._seconds_per_token.value, self._seconds_per_batch.value = seconds_per_token, seconds_per_batch
+
+    def get_batching_stats(self) -> Dict[str, float]:
+        """
+        :returns: the mean number of tasks in a batch, the mean fraction of max_batch_size tokens it uses
+          and the mean time the first task of a batch was held back for more tasks to arrive (see max_batch_wait)
+        """
+        with self._batching_stats.get_lock():
+            num_batches, num_tasks, num_tokens, wait_time = self._batching_stats[:]
+        num_batches = max(num_batches, 1)
+        return dict(
+            mean_tasks_per_batch=num_tasks / num_batches,
+            mean_batch_occupancy=num_tokens / (num_batches * self.max_batch_size),
+            mean_batch_wait=wait_time / num_batches,
+        )
+
+    @property
+    def num_skipped_tasks(self) -> int:
+        """The number of cancelled tasks that were skipped or interrupted by the runtime"""
+        return self._num_skipped_tasks.value
+
+    def _count_skipped_tasks(self, num_tasks: int):
+        with self._num_skipped_tasks.get_lock():
+            self._num_skipped_tasks.value += num_tasks
+        logger.debug(f"Pool {self.name}: skipped {num_tasks} cancelled tasks")
+
+    def _are_cancelled(self, task_uids: Sequence[int]) -> bool:
+        """Check if all of the given tasks were cancelled, receiving new cancellations from ConnectionHandlers"""
+        with self._cancelled_uids_lock:
+            while not self.cancelled_tasks.empty():
+                self._cancelled_uids[self.cancelled_tasks.get()] = True
+                if len(self._cancelled_uids) > MAX_CANCELLED_UIDS:
+                    self._cancelled_uids.popitem(last=False)
+            return all(uid in self._cancelled_uids for uid in task_uids)
+
+    def _forget_cancellation(self, uid: int) -> bool:
+        """Stop tracking the cancellation of a finished task, return True if it was cancelled"""
+        with self._cancelled_uids_lock:
+            return self._cancelled_uids.pop(uid, None) is not None
 
-    def send_outputs_from_runtime(self, uid: int, batch_outputs: List[torch.Tensor]):
+    def _take_compatible_tasks(self, first_task: Task) -> List[Task]:
+        """Take already queued tasks that can be processed together with first_task, most urgent first (never waits)"""
+        group = self.get_task_group(first_task)
+        total_size = self.get_task_size(first_task)
+        taken_tasks, skipped_tasks = [], []
+        while len(taken_tasks) + 1 < self.max_tasks_per_batch and total_size < self.max_batch_size:
+            try:
+                task = self._ordered_tasks.get_nowait()
+            except Empty:
+                break
+            task_size = self.get_task_size(task)
+            if total_size + task_size <= self.max_batch_size and self.get_task_group(task) == group:
+                taken_tasks.append(task)
+                total_size += task_size
+            else:
+                skipped_tasks.append(task)
+
+        for task in skipped_tasks:
+            self._ordered_tasks.put(task)
+        return taken_tasks
+
+    def send_outputs_from_runtime(self, uid: Union[int, Tuple[int, ...]], batch_outputs: List[torch.Tensor]):
         """send results for a processed batch, previously loaded through load_batch_to_runtime"""
-        batch_outputs = [_move_to_device_if_tensor(output, device="cpu", share_memory=True) for output in batch_outputs]
+        if not isinstance(uid, tuple):
+            self._set_task_result(uid, batch_outputs)
+            return
+
+        assert len(batch_outputs) % len(uid) == 0, f"expected an equal number of outputs for each of {len(uid)} tasks"
+        outputs_per_task = len(batch_outputs) // len(uid)
+        for i, task_uid in enumerate(uid):
+            self._set_task_result(task_uid, batch_outputs[i * outputs_per_task : (i + 1) * outputs_per_task])
+
+    def _set_task_result(self, uid: int, task_outputs: List[torch.Tensor]):
         task = self._dispatched_tasks.pop(uid, None)
         if task is None:
             logger.error(
                 f"Internal error: task task with index {uid} is missing from the dictionary; " f"Could not set result"
             )
-        else:
-            task.future.set_result(batch_outputs)
+            return
+        if self._forget_cancellation(uid):
+            # The outputs may be incomplete (see is_current_batch_cancelled), but nobody waits for them anyway
+            task.future.set_exception(TaskCancelledError(f"Task {uid} was cancelled by the caller"))
+            return
 
-    def send_exception_from_runtime(self, uid: int, exception: BaseException):
-        task = self._dispatched_tasks.pop(uid, None)
-        if task is None:
-            logger.error(
-                f"Internal error: task task with index {uid} is missing from the dictionary; "
-                f"Could not set exception {exception}"
-            )
-        else:
-            task.future.set_exception(exception)
+        shared_outputs = None
+        if task.shared_memory_slot is not None:
+            ring = get_ring(task.shared_memory_slot.ring_id)
+            shared_outputs = ring.write_outputs(task.shared_memory_slot, task_outputs)  # None if they don't fit
+        if shared_outputs is None:
+            shared_outputs = [_move_to_device_if_tensor(out, device="cpu", share_memory=True) for out in task_outputs]
+        task.future.set_result(shared_outputs)
+
+    def send_exception_from_runtime(self, uid: Union[int, Tuple[int, ...]], exception: BaseException):
+        for task_uid in uid if isinstance(uid, tuple) else (uid,):
+            task = self._dispatched_tasks.pop(task_uid, None)
+            if task is None:
+                logger.error(
+                    f"Internal error: task task with index {task_uid} is missing from the dictionary; "
+                    f"Could not set exception {exception}"
+                )
+            else:
+                self._forget_cancellation(task_uid)
+                task.future.set_exception(exception)
 
     @property
     def empty(self):
         return not self.batch_receiver.poll()
 
     @property
-    def priority(self) -> Tuple[float, float]:
-        """The priority of this pool equals the (priority, timestamp) of the most important task in it."""
-        return float(self._priority.value), float(self._oldest_undispatched_timestamp.value)
+    def priority(self) -> Tuple[float, float, float]:
+        """The priority of this pool equals the (priority, deadline, timestamp) of the most important task in it."""
+        return (
+            float(self._priority.value),
+            float(self._earliest_deadline.value),
+            float(self._oldest_undispatched_timestamp.value),
+        )
 
     @priority.setter
-    def priority(self, item: Tuple[float, float]):
-        assert len(item) == 2
+    def priority(self, item: Tuple[float, float, float]):
+        assert len(item) == 3
         self._priority.value = float(item[0])
-        self._oldest_undispatched_timestamp.value = float(item[1])
+        self._earliest_deadline.value = float(item[1])
+        self._oldest_undispatched_timestamp.value = float(item[2])
+
+
+def _load_arg_to_runtime(arg: Any, device: Optional[torch.device]):
+    return _move_to_device_if_tensor(resolve_shared_tensor(arg), device, share_memory=False)
 
 
 def _move_to_device_if_tensor(arg: Any, device: Union[torch.device, str], share_memory: bool = False):
@@ -1,6 +1,19 @@
+import ctypes
+import hashlib
+import multiprocessing as mp
+import os
+import threading
+import time
 from abc import ABC, abstractmethod
+from typing import Any, Callable, Dict, Optional
 
 import torch
+from hypermind.utils.logging import get_logger
+
+logger = get_logger(__name__)
+
+_EMPTY = 0
+_EVICTION_CANDIDATES = 16  # a new peer in a full table replaces one of this many buckets that follow its slot
 
 
 class TaskPrioritizerBase(ABC):
@@ -18,3 +31,203 @@ class DummyTaskPrioritizer(TaskPrioritizerBase):
         if kwargs.get("type") == "inference":
             return 1.0
         return 2.0  # Forward, backward
+
+
+class TokenAwareTaskPrioritizer(TaskPrioritizerBase):
+    """
+    Orders inference steps by the number of new tokens and the number of tokens their session has already processed.
+
+    Decode steps (a few new tokens) go first since they are the most latency-sensitive. Next go the chunks of long
+    prefills (see iterate_rpc_inference): the fewer tokens a session has processed, the sooner its next chunk runs,
+    so a session with a huge prompt cannot delay the first tokens of other sessions. Forward and backward go last.
+
+    :param max_decode_tokens: inference steps with at most this many new tokens (batch_size * length) are decode steps
+    :param prefill_tokens_scale: a prefill chunk of a session that has processed this many tokens gets a priority
+      halfway between a fresh prefill and forward/backward; larger values make prefills more first-come-first-served
+    """
+
+    def __init__(self, max_decode_tokens: int = 128, prefill_tokens_scale: int = 1024):
+        self.max_decode_tokens, self.prefill_tokens_scale = max_decode_tokens, prefill_tokens_scale
+
+    def prioritize(self, *input: torch.Tensor, points: float = 0.0, **kwargs) -> float:
+        if kwargs.get("type") != "inference":
+            return 3.0  # Forward, backward
+
+        num_tokens = kwargs.get("num_tokens")
+        if num_tokens is None:
+            hidden_states = input[0]
+            num_tokens = hidden_states.shape[0] * hidden_states.shape[1]
+        if num_tokens <= self.max_decode_tokens:
+            return 1.0
+
+        processed_tokens = kwargs.get("processed_tokens", 0)
+        return 2.0 + processed_tokens / (processed_tokens + self.prefill_tokens_scale)  # in [2.0, 3.0)
+
+
+class FairShareTaskPrioritizer(TaskPrioritizerBase):
+    """
+    Shares the server between remote peers, so that one aggressive peer can't starve the others.
+
+    Each peer has a token bucket that refills at {rate * weight} token-blocks per second up to {burst * weight},
+    where a task processing N tokens in M blocks costs N * M. While the bucket of a peer is not empty, its tasks get
+    the priority from the base prioritizer. Otherwise, they go after the tasks of all peers within their share,
+    ordered by how many seconds it takes the peer's bucket to pay off the debt (weighted fair queuing).
+
+    :param base_prioritizer: evaluates the priority of tasks within a peer's share (e.g., decode steps first),
+      TokenAwareTaskPrioritizer by default
+    :param rate: the number of token-blocks per second each peer (of weight 1) may use before it loses its priority
+    :param burst: the number of token-blocks a peer that was idle for a while may use at once
+    :param get_peer_weights: an optional function returning a dict {peer id (base58): weight}, e.g. based on
+      on-chain stake (see subnet.substrate.utils.get_peer_stake_weights); peers missing from the dict have weight 1.
+      It is called in a background thread once in {weights_update_period} seconds.
+    :param over_share_priority: the priority offset of tasks exceeding the peer's share, must be larger than
+      the priorities returned by the base prioritizer
+    :param max_tracked_peers: once we track this many peers, a new peer replaces the bucket closest to full among
+      its neighbors in the hash table, so that many new peer ids can't make each lookup scan the whole table
+    :note: a peer's requests are spread over the handlers, which are separate processes. The buckets live in a hash
+      table in shared memory (like SessionDirectory), so all handlers enforce one budget per peer. Create the
+      prioritizer before forking the handlers.
+    """
+
+    def __init__(
+        self,
+        base_prioritizer: Optional[TaskPrioritizerBase] = None,
+        *,
+        rate: float,
+        burst: float,
+        get_peer_weights: Optional[Callable[[], Dict[str, float]]] = None,
+        weights_update_period: float = 600,
+        over_share_priority: float = 10.0,
+        max_tracked_peers: int = 10_000,
+    ):
+        assert rate > 0 and burst >= 0, "rate must be positive and burst must be non-negative"
+        assert max_tracked_peers > 0, "max_tracked_peers must be positive"
+        if base_prioritizer is None:
+            base_prioritizer = TokenAwareTaskPrioritizer()
+        self.base_prioritizer, self.rate, self.burst = base_prioritizer, rate, burst
+        self.get_peer_weights, self.weights_update_period = get_peer_weights, weights_update_period
+        self.over_share_priority, self.max_tracked_peers = over_share_priority, max_tracked_peers
+        self._peer_weights: Dict[str, float] = {}
+        self._weights_thread_pid = None
+
+        # A hash table with linear probing: peer key -> [number of token-blocks left, time.monotonic(), weight]
+        self._capacity = 1 << (2 * max_tracked_peers - 1).bit_length()  # keep it at most half full
+        self._mask = self._capacity - 1
+        self._keys = mp.RawArray(ctypes.c_uint64, self._capacity)  # _EMPTY marks a free slot
+        self._tokens_left = mp.RawArray(ctypes.c_double, self._capacity)
+        self._last_updated = mp.RawArray(ctypes.c_double, self._capacity)
+        self._weights = mp.RawArray(ctypes.c_double, self._capacity)
+        self._num_peers = mp.RawValue(ctypes.c_int64, 0)
+        self._lock = mp.Lock()
+
+    def prioritize(self, *input: torch.Tensor, points: float = 0.0, **kwargs) -> float:
+        priority = self.base_prioritizer.prioritize(*input, points=points, **kwargs)
+        peer_id = kwargs.get("peer_id")
+        if peer_id is None:
+            return priority
+
+        num_tokens = kwargs.get("num_tokens")
+        if num_tokens is None:
+            num_tokens = input[0].shape[0] * input[0].shape[1] if input and input[0].ndim >= 2 else 1
+        requested_uids = kwargs.get("requested_uids")
+        num_blocks = len(requested_uids) if requested_uids is not None else 1
+
+        weight = self._get_weight(peer_id)
+        key = _hash_peer_id(peer_id)
+        with self._lock:
+            index = self._refill_bucket(key, weight)
+            if index is None:
+                return priority  # should not happen since _evict_fullest_bucket() keeps the table half empty
+            tokens_left = self._tokens_left[index] - num_tokens * num_blocks
+            self._tokens_left[index] = tokens_left
+        if tokens_left >= 0:
+            return priority
+        return self.over_share_priority + priority + (-tokens_left) / (self.rate * weight)
+
+    def _refill_bucket(self, key: int, weight: float) -> Optional[int]:
+        """Find or add the bucket of a peer and refill it, return its slot (the caller must hold the lock)"""
+        now = time.monotonic()
+        index = self._find(key)
+        if self._keys[index] == _EMPTY:
+            if self._num_peers.value >= self.max_tracked_peers:
+                self._evict_fullest_bucket(key & self._mask, now)
+                index = self._find(key)
+            if self._num_peers.value >= self._capacity - 1:  # keep a free slot, so that lookups always terminate
+                logger.warning(f"Too many peers ({self._num_peers.value}), fair share is not enforced for new ones")
+                return None
+            self._keys[index] = key
+            self._tokens_left[index], self._last_updated[index] = self.burst * weight, now
+            self._num_peers.value += 1
+
+        self._weights[index] = weight
+        tokens_left = self._tokens_left[index] + (now - self._last_updated[index]) * self.rate * weight
+        self._tokens_left[index], self._last_updated[index] = min(self.burst * weight, tokens_left), now
+        return index
+
+    def _evict_fullest_bucket(self, start: int, now: float):
+        """
+        Forget the peer whose bucket is closest to full among the first buckets after a slot, since forgetting a full
+        bucket changes nothing and other peers lose the least of their debt (the caller must hold the lock)
+        """
+        best_index, best_fill = None, None
+        index, num_candidates = start, 0
+        for _ in range(self._capacity):
+            if self._keys[index] != _EMPTY:
+                weight = self._weights[index]
+                tokens_left = self._tokens_left[index] + (now - self._last_updated[index]) * self.rate * weight
+                fill = tokens_left / max(self.burst * weight, 1e-9)
+                if best_fill is None or fill > best_fill:
+                    best_index, best_fill = index, fill
+                num_candidates += 1
+                if num_candidates >= _EVICTION_CANDIDATES:
+                    break
+            index = (index + 1) & self._mask
+        if best_index is not None:
+            self._remove(best_index)
+
+    def _remove(self, index: int):
+        """Free a slot and move the following keys back, so that lookups don't stop early (backward shift deletion)"""
+        next_index = index
+        while True:
+            next_index = (next_index + 1) & self._mask
+            key = self._keys[next_index]
+            if key == _EMPTY:
+                break
+            # The key may fill the free slot only if the slot is between the key's home slot and its current slot
+            if (next_index - key) & self._mask >= (next_index - index) & self._mask:
+                self._keys[index], self._tokens_left[index] = key, self._tokens_left[next_index]
+                self._last_updated[index] = self._last_updated[next_index]
+                self._weights[index] = self._weights[next_index]
+                index = next_index
+        self._keys[index] = _EMPTY
+        self._num_peers.value -= 1
+
+    def _find(self, key: int) -> int:
+        """Return the slot that holds the key, or the empty slot where it would be inserted"""
+        index = key & self._mask
+        while self._keys[index] != _EMPTY and self._keys[index] != key:
+            index = (index + 1) & self._mask
+        return index
+
+    def _get_weight(self, peer_id: Any) -> float:
+        if self.get_peer_weights is None:
+            return 1.0
+        if self._weights_thread_pid != os.getpid():
+            # Start the thread in each handler process, since threads are not inherited by forked processes
+            self._weights_thread_pid = os.getpid()
+            threading.Thread(target=self._update_weights_periodically, name="PeerWeightsUpdater", daemon=True).start()
+        return self._peer_weights.get(str(peer_id), 1.0)
+
+    def _update_weights_periodically(self):
+        while True:
+            try:
+                self._peer_weights = dict(self.get_peer_weights())
+                logger.debug(f"Updated weights of {len(self._peer_weights)} peers")
+            except Exception as e:
+                logger.warning(f"Failed to update peer weights: {e}")
+            time.sleep(self.weights_update_period)
+
+
+def _hash_peer_id(peer_id: Any) -> int:
+    key = int.from_bytes(hashlib.blake2b(str(peer_id).encode(), digest_size=8).digest(), "little")
+    return key if key != _EMPTY else 1
@@ -1,6 +1,6 @@
 from typing import List, Dict
 from subnet.substrate.chain_data import SubnetNode
-from subnet.substrate.chain_functions import get_subnet_nodes_included, get_subnet_nodes_submittable
+from subnet.substrate.chain_functions import get_subnet_nodes_included, get_subnet_nodes_submittable, get_subnet_stake_balance
 from substrateinterface import SubstrateInterface
 from subnet.health.state_updater import ScoringProtocol
 from hypermind.utils import get_logger
@@ -352,6 +352,23 @@ def get_included_nodes(substrate: SubstrateInterface, subnet_id: int) -> List:
 
   return subnet_nodes_data
 
+def get_peer_stake_weights(substrate: SubstrateInterface, subnet_id: int) -> Dict[str, float]:
+  """
+  Weights of subnet nodes for FairShareTaskPrioritizer: 1 + stake / mean stake, so that peers
+  without stake (e.g. clients) have weight 1 and nodes with the mean stake have weight 2
+
+  :returns: {peer_id: weight}
+  """
+  stakes = {}
+  for subnet_node in get_included_nodes(substrate, subnet_id):
+    stake = get_subnet_stake_balance(substrate, subnet_id, subnet_node.hotkey)
+    stakes[subnet_node.peer_id] = int(str(stake)) if stake is not None else 0
+
+  mean_stake = sum(stakes.values()) / len(stakes) if stakes else 0
+  if mean_stake == 0:
+    return {peer_id: 1.0 for peer_id in stakes}
+  return {peer_id: 1.0 + stake / mean_stake for peer_id, stake in stakes.items()}
+
 def get_eligible_consensus_block(
   epochs_interval: int, 
   initialized: int, 
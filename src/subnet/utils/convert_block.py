@@ -31,6 +31,7 @@ def convert_block(
     quant_type: QuantType,
     freeze: bool = True,
     adapters: Optional[Sequence[str]] = None,
+    empty_weights: bool = False,
     **kwargs,
 ) -> tp.TensorParallel:
     """
@@ -44,6 +45,8 @@ def convert_block(
     :param output_device: if tensor_parallel_devices is True, output
     :param quant_type: quantization type
     :param freeze: if True (default), make all module parameters non-trainable
+    :param empty_weights: if True, the block has uninitialized weights that will be replaced with load_state_dict()
+      of an already converted block, so we only build the structure of the converted block and don't quantize them
     :return: a module that acts like the original block, but runs with all specified optimizations
 
     """
@@ -53,26 +56,35 @@ def convert_block(
     block = make_tensor_parallel(block, config, tensor_parallel_devices, output_device=output_device)
 
     if quant_type != QuantType.NONE:
-        block = quantize_module(block, quant_type=quant_type)
+        if empty_weights:
+            for shard, device in zip(block.module_shards, block.devices):
+                make_empty_quantized_module(shard, quant_type=quant_type, device=device)
+        else:
+            block = quantize_module(block, quant_type=quant_type)
 
     for shard, device in zip(block.module_shards, block.devices):
         shard.to(device)
 
     if adapters:
-        from subnet.utils.peft import add_adapter_to_block, create_lora_adapter, load_peft
-
-        create_lora_adapter(block)
-        for adapter_name in adapters:
-            adapter_config, adapter_state_dict = load_peft(
-                adapter_name,
-                block_idx=block_index,
-                **kwargs,
-            )
-            add_adapter_to_block(block, block_index, adapter_name, adapter_config, adapter_state_dict)
+        apply_adapters(block, block_index, adapters, **kwargs)
 
     return block
 
 
+def apply_adapters(block: tp.TensorParallel, block_index: int, adapters: Sequence[str], **kwargs):
+    """Add LoRA adapters to a converted block in-place, kwargs are passed to load_peft"""
+    from subnet.utils.peft import add_adapter_to_block, create_lora_adapter, load_peft
+
+    create_lora_adapter(block)
+    for adapter_name in adapters:
+        adapter_config, adapter_state_dict = load_peft(
+            adapter_name,
+            block_idx=block_index,
+            **kwargs,
+        )
+        add_adapter_to_block(block, block_index, adapter_name, adapter_config, adapter_state_dict)
+
+
 def quantize_module(model: nn.Module, *, quant_type: QuantType) -> nn.Module:
     # Import bitsandbytes only when necessary, so Petals runs on platforms not supported by bitsandbytes
     import bitsandbytes as bnb
@@ -115,6 +127,41 @@ def quantize_module(model: nn.Module, *, quant_type: QuantType) -> nn.Module:
     return model
 
 
+def make_empty_quantized_module(model: nn.Module, *, quant_type: QuantType, device: torch.device) -> nn.Module:
+    """
+    Replace linear layers like quantize_module() does, but allocate their weights on the device directly in the quantized
+    format and leave them uninitialized (to be filled with load_state_dict()) instead of quantizing the original weights
+    """
+    import bitsandbytes as bnb
+
+    if quant_type != QuantType.INT8:
+        raise ValueError(f"Can't create empty quantized weights for quant_type='{quant_type}'")
+
+    for n, module in model.named_children():
+        if len(list(module.children())) > 0:
+            make_empty_quantized_module(module, quant_type=quant_type, device=device)
+
+        if isinstance(module, torch.nn.Linear) and n not in ["lm_head", "score"]:
+            model._modules[n] = bnb.nn.Linear8bitLt(
+                module.in_features,
+                module.out_features,
+                module.bias is not None,
+                has_fp16_weights=False,
+                threshold=6.0,  # Default from the LLM.int8() paper
+                device="meta",  # Don't allocate the fp16 weights replaced below
+            )
+            weight = bnb.nn.Int8Params(
+                torch.empty(module.out_features, module.in_features, dtype=torch.int8, device=device),
+                requires_grad=False,
+                has_fp16_weights=False,
+            )
+            # This is the state of Int8Params after .cuda(), so moving the block to the device won't quantize it again
+            weight.CB, weight.SCB = weight.data, torch.empty(module.out_features, dtype=torch.float32, device=device)
+            model._modules[n].weight = weight
+            model._modules[n].bias = module.bias
+    return model
+
+
 def make_tensor_parallel(
     block: nn.Module, model_config: PretrainedConfig, devices: Sequence[torch.device], output_device: torch.device
 ) -> nn.Module:
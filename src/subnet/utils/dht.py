@@ -3,6 +3,7 @@ Utilities for declaring and retrieving active model layers using a shared DHT.
 """
 from __future__ import annotations
 
+import dataclasses
 import math
 from functools import partial
 import re
@@ -35,11 +36,13 @@ def declare_active_modules(
     expiration_time: DHTExpiration,
     wait: bool = True,
     record_validator: Optional[Ed25519SignatureValidator] = None,
+    offline_uids: Sequence[ModuleUID] = (),
 ) -> Union[Dict[ModuleUID, bool], MPFuture[Dict[ModuleUID, bool]]]:
     """
     Declare that your node serves the specified modules; update timestamps if declared previously
 
     :param uids: a list of module ids to declare
+    :param offline_uids: module ids that your node stopped serving, they are declared offline in the same batch
     :param wait: if True, awaits for declaration to finish, otherwise runs in background
     :param throughput: specify your performance in terms of compute throughput
     :param expiration_time: declared modules will be visible for this many seconds
@@ -49,7 +52,8 @@ def declare_active_modules(
         uids = [uids]
     if not isinstance(uids, list):
         uids = list(uids)
-    for uid in uids:
+    offline_uids = [uid for uid in offline_uids if uid not in uids]
+    for uid in uids + offline_uids:
         assert isinstance(uid, ModuleUID) and UID_DELIMITER in uid and CHAIN_DELIMITER not in uid
 
     return dht.run_coroutine(
@@ -57,7 +61,8 @@ def declare_active_modules(
             uids=uids, 
             server_info=server_info, 
             expiration_time=expiration_time, 
-            record_validator=record_validator
+            record_validator=record_validator,
+            offline_uids=offline_uids,
         ),
         return_future=not wait,
     )
@@ -70,14 +75,20 @@ async def _declare_active_modules(
     server_info: ServerInfo,
     expiration_time: DHTExpiration,
     record_validator: Optional[Ed25519SignatureValidator] = None,
+    offline_uids: Sequence[ModuleUID] = (),
 ) -> Dict[ModuleUID, bool]:
+    values = [server_info.to_tuple()] * len(uids)
+    if offline_uids:
+        offline_info = dataclasses.replace(server_info, state=ServerState.OFFLINE)
+        uids, values = uids + list(offline_uids), values + [offline_info.to_tuple()] * len(offline_uids)
+
     num_workers = len(uids) if dht.num_workers is None else min(len(uids), dht.num_workers)
     subkeys = [dht.peer_id.to_base58()] * len(uids) if record_validator is None else [dht.peer_id.to_base58().encode() + record_validator.local_public_key] * len(uids)
     # print("subkeys", subkeys)
     return await node.store_many(
         keys=uids,
         subkeys=subkeys,
-        values=[server_info.to_tuple()] * len(uids),
+        values=values,
         expiration_time=expiration_time,
         num_workers=num_workers,
     )
@@ -2,8 +2,9 @@ import fcntl
 import os
 import shutil
 from contextlib import contextmanager
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 
 import huggingface_hub
 from hypermind.utils.logging import get_logger
@@ -13,6 +14,7 @@ logger = get_logger(__name__)
 DEFAULT_CACHE_DIR = os.getenv("PETALS_CACHE", Path(Path.home(), ".cache", "petals"))
 
 BLOCKS_LOCK_FILE = "blocks.lock"
+CONVERTED_BLOCKS_DIR = "converted_blocks"  # See subnet.server.block_cache
 
 
 @contextmanager
@@ -48,25 +50,33 @@ def free_disk_space_for(
     if cache_dir is None:
         cache_dir = DEFAULT_CACHE_DIR
     cache_info = huggingface_hub.scan_cache_dir(cache_dir)
+    converted_blocks = _scan_converted_blocks(cache_dir)
+    size_on_disk = cache_info.size_on_disk + sum(file.size_on_disk for file in converted_blocks)
 
     available_space = shutil.disk_usage(cache_dir).free - os_quota
     if max_disk_space is not None:
-        available_space = min(available_space, max_disk_space - cache_info.size_on_disk)
+        available_space = min(available_space, max_disk_space - size_on_disk)
 
     gib = 1024**3
     logger.debug(f"Disk space: required {size / gib:.1f} GiB, available {available_space / gib:.1f} GiB")
     if size <= available_space:
         return
 
-    cached_files = [file for repo in cache_info.repos for revision in repo.revisions for file in revision.files]
+    cached_files = [
+        _CachedFile([file.file_path, file.blob_path], file.size_on_disk, file.blob_last_accessed)
+        for repo in cache_info.repos
+        for revision in repo.revisions
+        for file in revision.files
+    ]
+    cached_files += converted_blocks
 
-    # Remove as few least recently used files as possible
+    # Remove as few least recently used files as possible (both HF Hub files and converted blocks)
     removed_files = []
     freed_space = 0
     extra_space_needed = size - available_space
-    for file in sorted(cached_files, key=lambda file: file.blob_last_accessed):
-        os.remove(file.file_path)  # Remove symlink
-        os.remove(file.blob_path)  # Remove contents
+    for file in sorted(cached_files, key=lambda file: file.last_accessed):
+        for path in file.paths:
+            os.remove(path)  # For HF Hub files, remove the symlink and the contents
 
         removed_files.append(file)
         freed_space += file.size_on_disk
@@ -74,10 +84,28 @@ def free_disk_space_for(
             break
     if removed_files:
         logger.info(f"Removed {len(removed_files)} files to free {freed_space / gib:.1f} GiB of disk space")
-        logger.debug(f"Removed paths: {[str(file.file_path) for file in removed_files]}")
+        logger.debug(f"Removed paths: {[str(file.paths[0]) for file in removed_files]}")
 
     if freed_space < extra_space_needed:
         raise RuntimeError(
             f"Insufficient disk space to load a block. Please free {(extra_space_needed - freed_space) / gib:.1f} GiB "
             f"on the volume for {cache_dir} or increase --max_disk_space if you set it manually"
         )
+
+
+@dataclass
+class _CachedFile:
+    paths: List[Path]  # The first path is the one we show in logs
+    size_on_disk: int
+    last_accessed: float
+
+
+def _scan_converted_blocks(cache_dir: str) -> List[_CachedFile]:
+    converted_blocks = []
+    for path in Path(cache_dir, CONVERTED_BLOCKS_DIR).glob("*.safetensors"):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue  # Removed by another process meanwhile
+        converted_blocks.append(_CachedFile([path], stat.st_blocks * 512, stat.st_atime))
+    return converted_blocks
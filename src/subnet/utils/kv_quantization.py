@@ -0,0 +1,31 @@
+"""
+Helpers for attention caches stored in int8 (see --kv_cache_dtype).
+
+Each cached key/value vector of one head and one token is quantized separately: we store its elements as int8
+along with one scale (absmax / 127) in the backend dtype. With a head dimension of 128, such a cache takes
+1 + 2 / 128 bytes per value instead of 2 bytes for float16/bfloat16, so a server fits ~1.97x more tokens.
+"""
+from typing import Tuple
+
+import torch
+
+INT8_MAX = 127
+
+
+def quantize_kv(tensor: torch.Tensor, dim: int) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Quantize keys or values to int8 with one scale per head and token
+
+    :param tensor: keys or values of any shape, in any floating point dtype
+    :param dim: the dimension of head_dim (e.g., -1 for [..., seq_len, head_dim], -2 for [..., head_dim, seq_len])
+    :returns: int8 tensor of the same shape and scales with the same shape, except for size 1 in dimension dim
+    """
+    scales = tensor.abs().amax(dim=dim, keepdim=True).float().div_(INT8_MAX)
+    scales = scales.clamp_(min=torch.finfo(tensor.dtype).tiny).to(tensor.dtype)  # rounded as they will be stored
+    quantized = (tensor.float() / scales.float()).round_().clamp_(-INT8_MAX, INT8_MAX).to(torch.int8)
+    return quantized, scales
+
+
+def dequantize_kv(quantized: torch.Tensor, scales: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+    """Restore keys or values from the outputs of quantize_kv"""
+    return quantized.to(dtype).mul_(scales)
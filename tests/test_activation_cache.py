@@ -0,0 +1,136 @@
+import multiprocessing as mp
+import time
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from subnet.server.activation_cache import ActivationCache
+from subnet.server.block_functions import run_rpc_backward, run_rpc_forward
+from subnet.server.task_pool import PrioritizedTaskPool
+from subnet.server.task_prioritizer import TokenAwareTaskPrioritizer
+
+
+def test_activation_cache_store_pop():
+    cache = ActivationCache(max_size_bytes=3 * 4096 * 4, ttl=60)
+    tensors = [torch.randn(2, 16, 32) for _ in range(3)]
+    assert cache.store("request-0", tensors)
+    assert not cache.store("request-1", [torch.randn(4, 64, 32) for _ in range(2)])  # does not fit
+
+    assert cache.pop("request-0", torch.randn(2, 16, 32)) is None  # the inputs do not match
+    cached = cache.pop("request-0", tensors[0].clone())  # a mismatching request does not evict the entry
+    assert len(cached) == len(tensors) and all(torch.equal(x, y) for x, y in zip(cached, tensors))
+    assert cache.pop("request-0", tensors[0]) is None  # each entry is used once
+
+    prompts = torch.randn(3, 2, 4, 32)
+    assert cache.store("request-0", tensors, prompts=prompts)
+    assert cache.pop("request-0", tensors[0]) is None  # the activations were computed with other prompts
+    assert cache.pop("request-0", tensors[0], prompts=prompts + 1) is None
+    assert cache.pop("request-0", tensors[0], prompts=prompts.clone()) is not None
+    assert cache.get_stats() == dict(
+        activation_cache_hits=2, activation_cache_misses=4, activation_cache_hit_rate=pytest.approx(1 / 3)
+    )
+
+
+def test_activation_cache_eviction():
+    entries = {f"request-{i}": [torch.full((1, 8, 128), float(i)) for _ in range(2)] for i in range(4)}
+    cache = ActivationCache(max_size_bytes=2**20, max_entries=2)
+    for key in ["request-0", "request-1", "request-2"]:
+        assert cache.store(key, entries[key])
+    assert cache.pop("request-0", entries["request-0"][0]) is None  # the oldest entry is evicted
+
+    cache = ActivationCache(max_size_bytes=5 * 1024 * 4)  # fits two and a half entries
+    for key in ["request-0", "request-1", "request-2", "request-3"]:
+        assert cache.store(key, entries[key])  # the buffer wraps around and overwrites the oldest entries
+    for key in ["request-0", "request-1"]:
+        assert cache.pop(key, entries[key][0]) is None
+    for key in ["request-2", "request-3"]:
+        assert all(torch.equal(x, y) for x, y in zip(cache.pop(key, entries[key][0]), entries[key]))
+
+    cache = ActivationCache(max_size_bytes=2**20, ttl=0.05)
+    assert cache.store("request-0", entries["request-0"])
+    time.sleep(0.1)
+    assert cache.pop("request-0", entries["request-0"][0]) is None
+
+
+def _store_activations(cache: ActivationCache, key: str):
+    torch.manual_seed(0)
+    cache.store(key, [torch.randn(1, 4, 16), torch.randn(1, 4, 16)])
+
+
+def test_activation_cache_is_shared():
+    cache = ActivationCache(max_size_bytes=2**20)
+    process = mp.context.ForkProcess(target=_store_activations, args=(cache, "request-0"))
+    process.start()
+    process.join()
+
+    torch.manual_seed(0)
+    tensors = [torch.randn(1, 4, 16), torch.randn(1, 4, 16)]
+    cached = cache.pop("request-0", tensors[0])
+    assert cached is not None and all(torch.equal(x, y) for x, y in zip(cached, tensors))
+
+
+@pytest.mark.asyncio
+async def test_backward_reuses_cached_activations():
+    forward_calls = []
+
+    class FakeForwardPool:
+        def __init__(self, index: int):
+            self.index = index
+
+        async def submit_task(self, hidden_states, active_adapter, *, priority, deadline=None):
+            forward_calls.append(self.index)
+            return (hidden_states * 2 + self.index,)
+
+    class FakeBackwardPool:
+        async def submit_task(self, inputs, grad_outputs, active_adapter, *, priority, deadline=None):
+            return (grad_outputs * inputs,)  # depends on the inputs, so that we notice if they are wrong
+
+    def dummy_pool_func(*args):
+        raise NotImplementedError()
+
+    backends = [
+        SimpleNamespace(
+            inference_pool=PrioritizedTaskPool(dummy_pool_func, name=f"inference_{i}", max_batch_size=1),
+            forward_pool=FakeForwardPool(i),
+            backward_pool=FakeBackwardPool(),
+            dtype=torch.float32,
+        )
+        for i in range(3)
+    ]
+    inputs, grad_outputs, prompts = torch.randn(2, 5, 8), torch.randn(2, 5, 8), torch.randn(3, 2, 2, 8)
+    kwargs = dict(requested_backends=backends, prioritizer=TokenAwareTaskPrioritizer())
+    cache = ActivationCache(max_size_bytes=2**20)
+
+    reference_grads = await run_rpc_backward(inputs.clone(), grad_outputs, prompts, **kwargs)
+    assert forward_calls == [0, 1]
+
+    forward_calls.clear()
+    await run_rpc_forward(inputs.clone(), prompts, activation_cache=cache, activation_cache_key="request", **kwargs)
+    assert forward_calls == [0, 1, 2]
+
+    # The backward with the same key and inputs skips the forward pass, other requests fall back to recomputing it
+    forward_calls.clear()
+    grads = await run_rpc_backward(
+        inputs.clone(), grad_outputs, prompts, activation_cache=cache, activation_cache_key="request", **kwargs
+    )
+    assert forward_calls == []
+    assert len(grads) == len(reference_grads) and all(torch.allclose(x, y) for x, y in zip(grads, reference_grads))
+
+    grads = await run_rpc_backward(
+        inputs.clone(), grad_outputs, prompts, activation_cache=cache, activation_cache_key="request", **kwargs
+    )
+    assert forward_calls == [0, 1]
+    assert all(torch.allclose(x, y) for x, y in zip(grads, reference_grads))
+
+    # The activations depend on the prompts, so a backward with other prompts recomputes them
+    await run_rpc_forward(inputs.clone(), prompts, activation_cache=cache, activation_cache_key="request", **kwargs)
+    forward_calls.clear()
+    other_prompts = torch.randn_like(prompts)
+    grads = await run_rpc_backward(
+        inputs.clone(), grad_outputs, other_prompts, activation_cache=cache, activation_cache_key="request", **kwargs
+    )
+    assert forward_calls == [0, 1]
+    reference_grads = await run_rpc_backward(inputs.clone(), grad_outputs, other_prompts, **kwargs)
+    assert all(torch.allclose(x, y) for x, y in zip(grads, reference_grads))
+    assert cache.get_stats()["activation_cache_hits"] == 1 and cache.get_stats()["activation_cache_misses"] == 2
@@ -0,0 +1,116 @@
+import contextlib
+import dataclasses
+from types import SimpleNamespace
+
+import pytest
+import torch
+from hypermind import BatchTensorDescriptor
+
+from subnet.data_structures import InferenceMetadata
+from subnet.models.bloom import DistributedBloomConfig
+from subnet.models.llama import DistributedLlamaConfig
+from subnet.server.backend import TransformerBackend, _BatchedMergedInferenceStep
+from subnet.server.block_utils import get_model_block
+from subnet.server.memory_cache import MemoryCache
+from subnet.utils.convert_block import QuantType, convert_block
+
+
+def _make_config(model_type: str):
+    if model_type == "llama":
+        return DistributedLlamaConfig(
+            hidden_size=64, intermediate_size=128, num_attention_heads=4, num_key_value_heads=2, num_hidden_layers=1
+        )
+    return DistributedBloomConfig(hidden_size=64, n_head=4, n_layer=1)
+
+
+def _make_backend(config, kv_cache_dtype: torch.dtype) -> TransformerBackend:
+    device, dtype = torch.device("cpu"), torch.float32
+    block = get_model_block(config).to(dtype)
+    block = convert_block(block, 0, config, (device,), device, quant_type=QuantType.NONE, freeze=True)
+    schema = (BatchTensorDescriptor(1, 2048, config.hidden_size, dtype=dtype),)
+    return TransformerBackend(
+        "batched.0",
+        block,
+        config=config,
+        memory_cache=MemoryCache(max_size_bytes=None),
+        backend_dtype=dtype,
+        max_chunk_size_bytes=256 * 1024 * 1024,
+        kv_cache_dtype=kv_cache_dtype,
+        args_schema=schema,
+        kwargs_schema={},
+        outputs_schema=schema,
+        min_batch_size=1,
+        max_batch_size=2048,
+    )
+
+
+@pytest.mark.forked
+@pytest.mark.asyncio
+@pytest.mark.parametrize("model_type", ["llama", "bloom"])
+@pytest.mark.parametrize("kv_cache_dtype", [None, torch.int8])
+async def test_batched_inference_step(model_type: str, kv_cache_dtype: torch.dtype, max_length: int = 32):
+    torch.manual_seed(0)
+    config = _make_config(model_type)
+    backend = _make_backend(config, kv_cache_dtype)
+    memory_cache = backend.memory_cache
+
+    # Three sessions with different batch sizes and prefix lengths, the second one reorders its beams in this step
+    batch_sizes, prefix_lengths, step_length = [1, 2, 1], [5, 9, 13], 2
+    hypo_ids = [torch.empty(0, dtype=torch.int64), torch.tensor([1, 0]), torch.empty(0, dtype=torch.int64)]
+    prefixes = [
+        torch.randn(batch_size, length, config.hidden_size) for batch_size, length in zip(batch_sizes, prefix_lengths)
+    ]
+    inputs = [torch.randn(batch_size, step_length, config.hidden_size) for batch_size in batch_sizes]
+
+    async with contextlib.AsyncExitStack() as stack:
+        infos = {"sessions": [], "batched": []}
+        memory_cache.runtime_pid += 1  # pretend we're a connection handler
+        for path in infos:
+            for batch_size in batch_sizes:
+                descriptors = backend.get_inference_cache_descriptors(batch_size=batch_size, max_length=max_length)
+                handles = await stack.enter_async_context(memory_cache.allocate_cache(*descriptors, timeout=0))
+                infos[path].append(InferenceMetadata(backend.name, 0, tuple(handles), active_adapter=None))
+        memory_cache.runtime_pid -= 1  # pretend we're the runtime
+
+        # Both copies of each session process the same prefix, then the step runs separately or as one batch
+        for path_infos in infos.values():
+            for prefix, info in zip(prefixes, path_infos):
+                backend.inference_step(prefix, torch.empty(0, dtype=torch.int64), info)
+        for path, path_infos in infos.items():
+            infos[path] = [
+                dataclasses.replace(info, prefix_length=length) for info, length in zip(path_infos, prefix_lengths)
+            ]
+
+        reference = [
+            backend.inference_step(session_inputs, session_hypo_ids, info)[0]
+            for session_inputs, session_hypo_ids, info in zip(inputs, hypo_ids, infos["sessions"])
+        ]
+        (outputs,) = backend.batched_inference_step(torch.cat(inputs), hypo_ids, infos["batched"])
+
+        atol = 1e-5 if kv_cache_dtype is None else 0.05
+        assert torch.allclose(outputs, torch.cat(reference), rtol=0, atol=atol)
+        for info, batched_info, length in zip(infos["sessions"], infos["batched"], prefix_lengths):
+            with memory_cache.use_cache(*info.cache_handles) as cache_tensors, memory_cache.use_cache(
+                *batched_info.cache_handles
+            ) as batched_cache_tensors:
+                for i, (cache_tensor, batched_cache_tensor) in enumerate(zip(cache_tensors, batched_cache_tensors)):
+                    filled = backend._select_tokens(i, cache_tensor, 0, length + step_length)
+                    batched_filled = backend._select_tokens(i, batched_cache_tensor, 0, length + step_length)
+                    assert torch.allclose(filled.float(), batched_filled.float(), rtol=0, atol=atol)
+        memory_cache.runtime_pid += 1  # free the caches as a connection handler
+    memory_cache.runtime_pid -= 1
+
+
+@pytest.mark.forked
+def test_steps_with_prefix_keys_are_not_batched():
+    backend = _make_backend(_make_config("llama"), kv_cache_dtype=None)
+    merged_step = _BatchedMergedInferenceStep({backend.name: backend})
+
+    def make_task(uid: int, prefix_keys=()):
+        info = InferenceMetadata(backend.name, 0, (uid,), active_adapter=None, prefix_keys=prefix_keys)
+        return SimpleNamespace(args=(torch.randn(1, 4, 64), torch.empty(0), (info,), None), uid=uid)
+
+    assert merged_step.get_task_group(make_task(1)) == merged_step.get_task_group(make_task(2))
+    keys = (b"page",)
+    assert merged_step.get_task_group(make_task(3, keys)) != merged_step.get_task_group(make_task(4, keys))
+    assert merged_step.get_task_group(make_task(3, keys)) == merged_step.get_task_group(make_task(3, keys))
@@ -0,0 +1,101 @@
+import os
+import time
+
+import pytest
+import torch
+
+from subnet.models.llama import DistributedLlamaConfig
+from subnet.server.block_cache import ConvertedBlockCache, make_empty_block
+from subnet.server.block_utils import get_model_block
+from subnet.utils.convert_block import QuantType, convert_block
+from subnet.utils.disk_cache import free_disk_space_for
+
+
+@pytest.fixture
+def config():
+    return DistributedLlamaConfig(
+        hidden_size=64, intermediate_size=128, num_attention_heads=4, num_key_value_heads=4, num_hidden_layers=4
+    )
+
+
+def _make_cache(tmp_path, model_name: str = "test/model", **kwargs) -> ConvertedBlockCache:
+    kwargs = dict(
+        dict(
+            revision=None,
+            torch_dtype=torch.float32,
+            quant_type=QuantType.NONE,
+            tensor_parallel_devices=(torch.device("cpu"),),
+            output_device=torch.device("cpu"),
+            cache_dir=str(tmp_path),
+        ),
+        **kwargs,
+    )
+    return ConvertedBlockCache(model_name, **kwargs)
+
+
+def _convert(block, block_index: int, config, **kwargs):
+    return convert_block(
+        block, block_index, config, (torch.device("cpu"),), torch.device("cpu"), QuantType.NONE, **kwargs
+    )
+
+
+@torch.inference_mode()
+def test_converted_block_cache(tmp_path, config):
+    cache = _make_cache(tmp_path)
+    block_index = 1
+    assert cache.load(block_index) is None
+
+    block = _convert(get_model_block(config, layer_idx=block_index), block_index, config)
+    cache.save(block_index, block)
+    assert cache.get_path(block_index).exists()
+
+    # Restore the block without reading the original weights
+    cached_block = _convert(
+        make_empty_block(config, block_index, torch.float32), block_index, config, empty_weights=True
+    )
+    cached_block.load_state_dict(cache.load(block_index))
+
+    inputs = torch.randn(1, 8, config.hidden_size)
+    assert torch.equal(block(inputs)[0], cached_block(inputs)[0])
+
+    # Blocks converted differently are stored separately
+    for other_cache in [_make_cache(tmp_path, torch_dtype=torch.bfloat16), _make_cache(tmp_path, revision="v2")]:
+        assert other_cache.get_path(block_index) != cache.get_path(block_index)
+        assert other_cache.load(block_index) is None
+
+    # A corrupted file is treated as a cache miss and removed
+    with open(cache.get_path(block_index), "wb") as f:
+        f.write(b"garbage")
+    assert cache.load(block_index) is None
+    assert not cache.get_path(block_index).exists()
+
+
+def test_local_checkpoint_changes_are_detected(tmp_path):
+    model_dir = tmp_path / "model"
+    model_dir.mkdir()
+    (model_dir / "config.json").write_text("{}")
+    (model_dir / "model.safetensors").write_bytes(b"weights")
+    path = _make_cache(tmp_path, str(model_dir)).get_path(0)
+    assert _make_cache(tmp_path, str(model_dir)).get_path(0) == path
+
+    # The model was replaced with new weights in the same directory, so the blocks converted before are stale
+    (model_dir / "model.safetensors").write_bytes(b"new weights")
+    assert _make_cache(tmp_path, str(model_dir)).get_path(0) != path
+
+
+def test_converted_blocks_are_evicted(tmp_path, config):
+    cache = _make_cache(tmp_path)
+    block_size = None
+    for block_index in range(3):
+        cache.save(block_index, _convert(get_model_block(config, layer_idx=block_index), block_index, config))
+        block_size = os.stat(cache.get_path(block_index)).st_blocks * 512
+        time.sleep(0.01)
+
+    now = time.time()
+    for block_index, age in [(0, 10), (1, 30), (2, 20)]:
+        path = cache.get_path(block_index)
+        os.utime(path, (now - age, path.stat().st_mtime))
+    assert cache.load(1) is not None  # Loading a block marks it as recently used
+
+    free_disk_space_for(block_size, cache_dir=str(tmp_path), max_disk_space=3 * block_size, os_quota=0)
+    assert [cache.get_path(block_index).exists() for block_index in range(3)] == [True, True, False]
@@ -0,0 +1,102 @@
+import threading
+import time
+
+import pytest
+import torch.nn as nn
+
+from subnet.server.block_loading import load_blocks_pipelined
+
+BLOCK_SIZE = 100
+
+
+class _FakeStages:
+    """Fake load/convert functions that sleep instead of reading and converting blocks and track blocks in flight"""
+
+    def __init__(self, read_time: float, convert_time: float, fail_at: int = None):
+        self.read_time, self.convert_time, self.fail_at = read_time, convert_time, fail_at
+        self.in_flight, self.max_in_flight, self.num_read = 0, 0, 0
+        self.lock = threading.Lock()
+
+    def load_block(self, block_index: int) -> nn.Module:
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            self.num_read += 1
+        time.sleep(self.read_time)
+        if block_index == self.fail_at:
+            raise RuntimeError(f"Failed to read block {block_index}")
+        block = nn.Identity()
+        block.block_index = block_index
+        return block
+
+    def convert_block(self, block_index: int, block: nn.Module) -> nn.Module:
+        assert block.block_index == block_index
+        time.sleep(self.convert_time)
+        with self.lock:
+            self.in_flight -= 1
+        block.converted = True
+        return block
+
+
+@pytest.mark.parametrize("max_in_flight_bytes", [None, 3 * BLOCK_SIZE, BLOCK_SIZE // 2])
+def test_pipelined_loading(max_in_flight_bytes: int):
+    block_indices = list(range(10, 30))
+    stages = _FakeStages(read_time=0.04, convert_time=0.01)
+
+    start_time = time.perf_counter()
+    results = list(
+        load_blocks_pipelined(
+            block_indices,
+            load_block=stages.load_block,
+            convert_block=stages.convert_block,
+            block_size=BLOCK_SIZE,
+            max_in_flight_bytes=max_in_flight_bytes,
+            num_io_threads=4,
+        )
+    )
+    elapsed = time.perf_counter() - start_time
+
+    assert [block_index for block_index, _ in results] == block_indices
+    assert all(block.block_index == block_index and block.converted for block_index, block in results)
+
+    sequential_time = len(block_indices) * (stages.read_time + stages.convert_time)
+    if max_in_flight_bytes is None:
+        assert stages.max_in_flight > 1
+        assert elapsed < sequential_time / 2
+    else:
+        assert stages.max_in_flight <= max(max_in_flight_bytes // BLOCK_SIZE, 1)
+        if max_in_flight_bytes >= 2 * BLOCK_SIZE:
+            assert elapsed < sequential_time * 0.75
+
+
+def test_pipelined_loading_failure():
+    stages = _FakeStages(read_time=0.01, convert_time=0.01, fail_at=5)
+    loaded_indices = []
+    with pytest.raises(RuntimeError, match="Failed to read block 5"):
+        for block_index, _ in load_blocks_pipelined(
+            range(100),
+            load_block=stages.load_block,
+            convert_block=stages.convert_block,
+            block_size=BLOCK_SIZE,
+            num_io_threads=2,
+        ):
+            loaded_indices.append(block_index)
+
+    assert loaded_indices == list(range(5))
+    num_read = stages.num_read
+    time.sleep(0.1)
+    assert stages.num_read == num_read < 100  # the pipeline stops reading blocks after a failure
+
+
+def test_pipelined_loading_stops_when_consumer_stops():
+    stages = _FakeStages(read_time=0.01, convert_time=0.0)
+    loaded_blocks = load_blocks_pipelined(
+        range(100), load_block=stages.load_block, convert_block=stages.convert_block, block_size=BLOCK_SIZE
+    )
+    assert next(loaded_blocks)[0] == 0
+    loaded_blocks.close()
+
+    num_read = stages.num_read
+    time.sleep(0.1)
+    assert stages.num_read == num_read < 100
+    assert not any(thread.name.startswith(("BlockLoader", "BlockConverter")) for thread in threading.enumerate())
@@ -0,0 +1,73 @@
+import hypermind
+import numpy as np
+import pytest
+from hypermind import PeerID, get_dht_time
+
+from subnet.data_structures import UID_DELIMITER, RemoteModuleInfo, ServerInfo, ServerState
+from subnet.server.block_selection import _choose_best_start, choose_best_blocks
+from subnet.utils.dht import declare_active_modules, get_remote_module_infos
+
+
+def _choose_best_start_reference(throughputs: np.ndarray, num_blocks: int) -> int:
+    options = ((sorted(throughputs[i : i + num_blocks]), i) for i in range(0, len(throughputs) - num_blocks + 1))
+    return min(options)[-1]
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_choose_best_start_matches_reference(seed: int):
+    rng = np.random.default_rng(seed)
+    for _ in range(2000):
+        total_blocks = rng.integers(1, 40)
+        num_blocks = rng.integers(1, total_blocks + 1)
+        if rng.random() < 0.5:
+            # few distinct values produce many ties and windows that differ only in later order statistics
+            throughputs = rng.integers(0, 4, size=total_blocks).astype(np.float64)
+        else:
+            throughputs = np.zeros(total_blocks)
+            for _ in range(rng.integers(0, 10)):
+                start = rng.integers(0, total_blocks)
+                throughputs[start : rng.integers(start, total_blocks) + 1] += rng.random()
+
+        expected = _choose_best_start_reference(throughputs, num_blocks)
+        assert _choose_best_start(throughputs, num_blocks) == expected, (throughputs.tolist(), num_blocks)
+
+
+def test_choose_best_start_prefers_leftmost_window():
+    assert _choose_best_start(np.zeros(10), 3) == 0
+    assert _choose_best_start(np.array([1.0, 2.0, 0.0, 2.0, 1.0]), 2) == 1
+    assert _choose_best_start(np.array([5.0, 1.0, 1.0, 5.0, 1.0, 1.0]), 2) == 1
+    with pytest.raises(ValueError):
+        _choose_best_start(np.zeros(3), 4)
+
+
+def _make_module_infos(spans, total_blocks: int):
+    module_infos = [RemoteModuleInfo(f"model{UID_DELIMITER}{i}", {}) for i in range(total_blocks)]
+    for peer_id, (start, end) in spans.items():
+        server_info = ServerInfo(ServerState.ONLINE, throughput=1.0, start_block=start, end_block=end)
+        for i in range(start, end):
+            module_infos[i].servers[peer_id] = server_info
+    return module_infos
+
+
+def test_choose_best_blocks_excludes_local_span():
+    local_peer_id, other_peer_id = PeerID(b"local"), PeerID(b"other")
+    module_infos = _make_module_infos({local_peer_id: (0, 4), other_peer_id: (0, 10)}, total_blocks=10)
+
+    # A new server would join where the throughput is lowest, but the local server already covers blocks 0:4
+    assert choose_best_blocks(4, module_infos) == [4, 5, 6, 7]
+    assert choose_best_blocks(4, module_infos, local_peer_id=local_peer_id) == [0, 1, 2, 3]
+
+
+@pytest.mark.forked
+def test_declare_active_modules_offline_uids():
+    dht = hypermind.DHT(start=True)
+    uids = [f"model{UID_DELIMITER}{i}" for i in range(6)]
+    server_info = ServerInfo(ServerState.ONLINE, throughput=1.0)
+    declare_active_modules(dht, uids[:4], server_info, expiration_time=get_dht_time() + 30)
+
+    # Moving from blocks 0:4 to 2:6 declares the new blocks and retires the old ones in one batch
+    declare_active_modules(dht, uids[2:], server_info, expiration_time=get_dht_time() + 30, offline_uids=uids[:4])
+    module_infos = get_remote_module_infos(dht, uids, latest=True)
+    states = [module_info.servers[dht.peer_id].state for module_info in module_infos]
+    assert states == [ServerState.OFFLINE] * 2 + [ServerState.ONLINE] * 4
+    dht.shutdown()
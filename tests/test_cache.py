@@ -10,6 +10,7 @@ import torch
 from hypermind import TensorDescriptor
 
 from subnet.server.memory_cache import AllocationFailed, MemoryCache
+from subnet.server.prefix_cache import make_prefix_keys
 from subnet.utils.misc import get_size_in_bytes
 
 
@@ -182,3 +183,250 @@ async def test_cache_usage():
     assert cache.current_size_bytes == 0
     assert alloc_process1.exitcode == 0, "allocation process 1 failed or did not finish, see stderr for details"
     assert alloc_process2.exitcode == 0, "allocation process 2 failed or did not finish, see stderr for details"
+
+
+@pytest.mark.asyncio
+async def test_cache_resize():
+    cache = MemoryCache(max_size_bytes=1024, max_alloc_timeout=0.5, page_size=64)
+    cache.runtime_pid += 1  # pretend we're another process
+
+    def _make_cache_descriptor(num_tokens: int):
+        return TensorDescriptor.from_tensor(torch.empty((2, num_tokens), dtype=torch.uint8))  # 2 bytes per token
+
+    assert cache.round_to_pages(1) == cache.round_to_pages(64) == 64 and cache.round_to_pages(65) == 128
+    assert cache.get_tokens_left(bytes_per_token=2) == 512
+
+    async with cache.allocate_cache(_make_cache_descriptor(64), timeout=0) as handles:
+        assert cache.current_size_bytes == 128
+        assert cache.get_tokens_left(bytes_per_token=2) == 448
+
+        await cache.resize_cache(handles, _make_cache_descriptor(128), timeout=0)
+        assert cache.current_size_bytes == 256 + 128, "the old tensor takes memory until it is copied"
+
+        cache.runtime_pid -= 1  # pretend we're the runtime
+        with cache.use_cache(*handles) as (tensor,):
+            assert tensor.shape == (2, 128) and tensor.sum() == 0
+            tensor[:, :100] = 42
+        cache.runtime_pid += 1
+        assert cache.current_size_bytes == 256
+
+        with pytest.raises(AllocationFailed):
+            await cache.resize_cache(handles, _make_cache_descriptor(576), timeout=0)  # exceeds max_size_bytes
+        with pytest.raises(AllocationFailed):
+            await cache.resize_cache(handles, _make_cache_descriptor(512), timeout=0)  # no room to copy the old tensor
+        with pytest.raises(ValueError):
+            await cache.resize_cache(handles, _make_cache_descriptor(64), timeout=0)  # tensors can't shrink
+        with pytest.raises(ValueError):
+            shape = (1, 256)  # e.g., another batch size
+            await cache.resize_cache(handles, TensorDescriptor.from_tensor(torch.empty(shape, dtype=torch.uint8)))
+        assert cache.current_size_bytes == 256
+
+        await cache.resize_cache(handles, _make_cache_descriptor(384), timeout=0)
+        assert cache.current_size_bytes == 768 + 256
+        assert cache.get_tokens_left(bytes_per_token=2) == 0
+
+        cache.runtime_pid -= 1
+        with cache.use_cache(*handles) as (tensor,):
+            assert tensor.shape == (2, 384)
+            assert (tensor[:, :100] == 42).all() and tensor[:, 100:].sum() == 0  # old contents are preserved
+        cache.runtime_pid += 1
+        assert cache.current_size_bytes == 768
+
+    assert cache.current_size_bytes == 0
+
+
+@pytest.mark.asyncio
+async def test_cache_offloading(tmp_path):
+    cache = MemoryCache(
+        max_size_bytes=1024,
+        max_alloc_timeout=1,
+        page_size=64,
+        offload_host_bytes=512,
+        offload_disk_bytes=1024,
+        offload_dir=str(tmp_path),
+        offload_idle_timeout=0,
+        offload_policy="on_demand",
+    )
+    cache.runtime_pid += 1  # pretend we're another process
+    offloader = cache.offloader
+
+    def _make_cache_descriptor(num_tokens: int):
+        return TensorDescriptor.from_tensor(torch.empty((2, num_tokens), dtype=torch.uint8))  # 2 bytes per token
+
+    async def _allocate(num_tokens: int, handles_future: asyncio.Future, free_event: asyncio.Event):
+        async with cache.allocate_cache(_make_cache_descriptor(num_tokens), timeout=1) as handles:
+            handles_future.set_result(handles)
+            await free_event.wait()
+
+    loop = asyncio.get_running_loop()
+    handles_a, free_a = loop.create_future(), asyncio.Event()
+    task_a = asyncio.create_task(_allocate(256, handles_a, free_a))
+    handles_a = await handles_a
+    assert cache.get_tokens_left(bytes_per_token=2) == 256 + 768, "the free space of offload tiers must be counted"
+
+    cache.runtime_pid -= 1  # pretend we're the runtime
+    with cache.use_cache(*handles_a) as (tensor_a,):
+        tensor_a[...] = 42
+    cache.runtime_pid += 1
+
+    # a session that waits for memory makes the runtime offload the idle session to host memory
+    handles_b, free_b = loop.create_future(), asyncio.Event()
+    task_b = asyncio.create_task(_allocate(384, handles_b, free_b))
+    await asyncio.sleep(0.05)
+    assert not handles_b.done(), "the session must wait for memory"
+    cache.runtime_pid -= 1
+    cache.offload_idle_sessions()
+    cache.runtime_pid += 1
+    handles_b = await handles_b
+    assert cache.current_size_bytes == 768
+    assert offloader.get_stats()["kv_offload_host_bytes"] == 512 and offloader.get_stats()["kv_swap_outs"] == 1
+
+    # the offloaded session is restored on its next step, and the other one is offloaded to disk to make room
+    cache.runtime_pid -= 1
+    with cache.use_cache(*handles_b) as (tensor_b,):
+        tensor_b[...] = 43
+    with cache.use_cache(*handles_a) as (tensor_a,):
+        assert tensor_a.shape == (2, 256) and (tensor_a == 42).all()
+    cache.runtime_pid += 1
+    assert cache.current_size_bytes == 512
+    stats = offloader.get_stats()
+    assert stats["kv_offload_host_bytes"] == 0 and stats["kv_offload_disk_bytes"] == 768
+    assert stats["kv_swap_ins"] == 1 and stats["kv_swap_in_bytes"] == 512 and stats["kv_swap_out_bytes"] == 512 + 768
+    assert len(list(tmp_path.iterdir())) == 1
+
+    # freeing an offloaded session does not change the device memory usage and removes its offloaded copy
+    free_b.set()
+    await task_b
+    assert cache.current_size_bytes == 512
+    cache.runtime_pid -= 1
+    cache.offload_idle_sessions()
+    cache.runtime_pid += 1
+    assert offloader.get_stats()["kv_offload_disk_bytes"] == 0 and len(list(tmp_path.iterdir())) == 0
+
+    # resizing an offloaded session accounts for the memory it takes once the runtime restores it
+    offloader.policy = "idle"
+    cache.runtime_pid -= 1
+    cache.offload_idle_sessions()
+    cache.runtime_pid += 1
+    assert cache.current_size_bytes == 0
+    await cache.resize_cache(handles_a, _make_cache_descriptor(320), timeout=0)
+    assert cache.current_size_bytes == 640
+    cache.runtime_pid -= 1
+    with cache.use_cache(*handles_a) as (tensor_a,):
+        assert tensor_a.shape == (2, 320) and (tensor_a[:, :256] == 42).all() and tensor_a[:, 256:].sum() == 0
+    cache.runtime_pid += 1
+    assert cache.current_size_bytes == 640
+
+    free_a.set()
+    await task_a
+    assert cache.current_size_bytes == 0
+
+
+@pytest.mark.asyncio
+async def test_offloaded_cache_is_restored_when_cache_is_full(tmp_path):
+    cache = MemoryCache(
+        max_size_bytes=1024,
+        max_alloc_timeout=1,
+        page_size=64,
+        offload_host_bytes=1024,
+        offload_disk_bytes=1024,
+        offload_dir=str(tmp_path),
+        offload_idle_timeout=0,
+        offload_policy="on_demand",
+    )
+    cache.runtime_pid += 1  # pretend we're another process
+
+    def _make_cache_descriptor(num_tokens: int):
+        return TensorDescriptor.from_tensor(torch.empty((2, num_tokens), dtype=torch.uint8))  # 2 bytes per token
+
+    async def _allocate(num_tokens: int, handles_future: asyncio.Future, free_event: asyncio.Event):
+        async with cache.allocate_cache(_make_cache_descriptor(num_tokens), timeout=1) as handles:
+            handles_future.set_result(handles)
+            await free_event.wait()
+
+    def _use_cache(handles, value: int):
+        cache.runtime_pid -= 1  # pretend we're the runtime
+        with cache.use_cache(*handles) as (tensor,):
+            assert (tensor == value).all() or tensor.sum() == 0
+            tensor[...] = value
+        cache.runtime_pid += 1
+        assert cache.current_size_bytes <= cache.max_size_bytes
+
+    loop = asyncio.get_running_loop()
+    handles_a, free_a = loop.create_future(), asyncio.Event()
+    task_a = asyncio.create_task(_allocate(256, handles_a, free_a))
+    handles_a = await handles_a
+    _use_cache(handles_a, 42)
+
+    # session B takes the whole cache, so the idle session A is offloaded
+    handles_b, free_b = loop.create_future(), asyncio.Event()
+    task_b = asyncio.create_task(_allocate(512, handles_b, free_b))
+    await asyncio.sleep(0.05)
+    cache.runtime_pid -= 1
+    cache.offload_idle_sessions()
+    cache.runtime_pid += 1
+    handles_b = await handles_b
+    _use_cache(handles_b, 43)
+    assert cache.current_size_bytes == 1024
+
+    # the next step of session A waits for memory like a new allocation, until the runtime offloads session B
+    reserve_task = asyncio.create_task(cache.reserve_offloaded_cache(handles_a))
+    await asyncio.sleep(0.05)
+    assert not reserve_task.done() and cache.current_size_bytes == 1024
+    cache.runtime_pid -= 1
+    cache.offload_idle_sessions()
+    cache.runtime_pid += 1
+    await reserve_task
+    assert cache.current_size_bytes == 512
+    _use_cache(handles_a, 42)
+    assert cache.current_size_bytes == 512
+
+    # if nobody reserved memory for an offloaded cache, the runtime offloads other caches before restoring it
+    _use_cache(handles_b, 43)
+    assert cache.current_size_bytes == 1024
+    assert cache.offloader.is_offloaded(handles_a) and not cache.offloader.is_offloaded(handles_b)
+
+    free_a.set()
+    free_b.set()
+    await asyncio.gather(task_a, task_b)
+    assert cache.current_size_bytes == 0
+
+
+def test_prefix_cache():
+    cache = MemoryCache(max_size_bytes=4096, page_size=4, max_prefix_cache_bytes=1024)
+    prefix_cache = cache.prefix_cache
+    uids = ["model.0", "model.1"]
+
+    prompt = torch.randn(1, 10, 8)
+    other_prompt = torch.cat([prompt[:, :4], torch.randn(1, 6, 8)], dim=1)
+    keys = make_prefix_keys(prompt, uids, None, page_size=4)
+    other_keys = make_prefix_keys(other_prompt, uids, None, page_size=4)
+    assert len(keys) == len(uids) and all(len(block_keys) == 2 for block_keys in keys)  # only full pages are hashed
+    assert keys[0] != keys[1], "the same tokens must have different keys for different blocks"
+    assert keys[0][0] == other_keys[0][0] and keys[0][1] != other_keys[0][1], "keys must cover the entire prefix"
+    assert make_prefix_keys(prompt, uids, "adapter", page_size=4)[0][0] != keys[0][0]
+
+    page_tensors = [torch.randn(1, 2, 4, 4), torch.randn(1, 2, 4, 4)]
+    page_outputs = torch.randn(1, 4, 8)
+    page_size_bytes = 2 * 32 * 4 + 32 * 4
+    for key in keys[0]:
+        assert prefix_cache.store(key, page_tensors, page_outputs)
+    page_tensors[0].zero_()  # the cache must keep its own copy of the page
+    assert cache.current_size_bytes == prefix_cache.current_size_bytes == 2 * page_size_bytes
+
+    pages = prefix_cache.lookup(other_keys[0])
+    assert len(pages) == 1 and not torch.all(pages[0].cache_tensors[0] == 0)
+    assert torch.equal(pages[0].outputs, page_outputs)
+    assert len(prefix_cache.lookup(keys[0])) == 2
+    assert prefix_cache.get_stats() == dict(prefix_cache_hits=3, prefix_cache_misses=1)
+
+    # storing more pages than max_prefix_cache_bytes evicts the least recently used ones
+    assert prefix_cache.store(other_keys[0][1], page_tensors, page_outputs)
+    assert len(prefix_cache.lookup(keys[0])) == 0, "the first page must have been evicted"
+    assert prefix_cache.current_size_bytes == 2 * page_size_bytes
+
+    # pages are evicted when sessions wait for memory
+    cache.enqueued_size_bytes = cache.max_size_bytes - cache.current_size_bytes + 1
+    with cache.use_cache():
+        pass
+    assert prefix_cache.current_size_bytes == cache.current_size_bytes == page_size_bytes
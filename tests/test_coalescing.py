@@ -0,0 +1,57 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+from hypermind import BatchTensorDescriptor
+
+from subnet.server.backend import TransformerBackend, get_coalescing_group
+from subnet.server.block_utils import get_model_block
+from subnet.server.memory_cache import MemoryCache
+from subnet.utils.auto_config import AutoDistributedConfig
+from subnet.utils.convert_block import QuantType, convert_block
+from test_utils import MODEL_NAME
+
+
+@pytest.mark.forked
+def test_coalesced_forward_backward(atol: float = 1e-5):
+    config = AutoDistributedConfig.from_pretrained(MODEL_NAME)
+    device, dtype = torch.device("cpu"), torch.float32
+    block = get_model_block(config).to(dtype)
+    block = convert_block(block, 0, config, (device,), device, quant_type=QuantType.NONE, freeze=True)
+
+    schema = (BatchTensorDescriptor(1, 2048, config.hidden_size, dtype=dtype),)
+    backend = TransformerBackend(
+        "coalescing.0",
+        block,
+        config=config,
+        memory_cache=MemoryCache(max_size_bytes=None),
+        backend_dtype=dtype,
+        max_chunk_size_bytes=256 * 1024 * 1024,
+        max_coalesced_tasks=4,
+        args_schema=schema,
+        kwargs_schema={},
+        outputs_schema=schema,
+        min_batch_size=1,
+        max_batch_size=2048,
+    )
+
+    # Tasks of different clients with similar lengths are padded to the longest one and processed together
+    shapes = [(1, 100), (2, 105), (1, 112)]
+    inputs = [torch.randn(*shape, config.hidden_size, dtype=dtype) for shape in shapes]
+    grad_outputs = [torch.randn_like(task_inputs) for task_inputs in inputs]
+    groups = {get_coalescing_group(SimpleNamespace(args=(task_inputs, ""))) for task_inputs in inputs}
+    assert len(groups) == 1
+    assert get_coalescing_group(SimpleNamespace(args=(torch.randn(1, 60, 8), ""))) not in groups
+    assert get_coalescing_group(SimpleNamespace(args=(inputs[0], "adapter"))) not in groups
+
+    outputs = backend.forward_coalesced(*[(task_inputs, "") for task_inputs in inputs])
+    grad_inputs = backend.backward_coalesced(*[(x, grad, "") for x, grad in zip(inputs, grad_outputs)])
+    assert len(outputs) == len(grad_inputs) == len(inputs)
+    for task_inputs, task_grad_outputs, task_outputs, task_grad_inputs in zip(
+        inputs, grad_outputs, outputs, grad_inputs
+    ):
+        (reference_outputs,) = backend.forward(task_inputs, "")
+        (reference_grad_inputs,) = backend.backward(task_inputs, task_grad_outputs, "")
+        assert task_outputs.shape == reference_outputs.shape and task_grad_inputs.shape == task_inputs.shape
+        assert torch.allclose(task_outputs, reference_outputs, rtol=0, atol=atol)
+        assert torch.allclose(task_grad_inputs, reference_grad_inputs, rtol=0, atol=atol)
@@ -0,0 +1,68 @@
+import pytest
+import torch
+from hypermind import BatchTensorDescriptor
+
+from subnet.data_structures import InferenceMetadata
+from subnet.server.backend import TransformerBackend
+from subnet.server.block_utils import get_model_block
+from subnet.server.memory_cache import MemoryCache
+from subnet.utils.auto_config import AutoDistributedConfig
+from subnet.utils.convert_block import QuantType, convert_block
+from test_utils import MODEL_NAME
+
+
+@pytest.mark.forked
+@pytest.mark.asyncio
+async def test_chunks_shrink_without_memory_efficient_sdpa(monkeypatch, seq_length: int = 32):
+    config = AutoDistributedConfig.from_pretrained(MODEL_NAME)
+    device, dtype = torch.device("cpu"), torch.float32
+    block = get_model_block(config).to(dtype)
+    block = convert_block(block, 0, config, (device,), device, quant_type=QuantType.NONE, freeze=True)
+
+    memory_cache = MemoryCache(max_size_bytes=None)
+    schema = (BatchTensorDescriptor(1, 2048, config.hidden_size, dtype=dtype),)
+    backend = TransformerBackend(
+        "chunks.0",
+        block,
+        config=config,
+        memory_cache=memory_cache,
+        backend_dtype=dtype,
+        max_chunk_size_bytes=256 * 1024 * 1024,
+        args_schema=schema,
+        kwargs_schema={},
+        outputs_schema=schema,
+        min_batch_size=1,
+        max_batch_size=2048,
+    )
+    # The attention logits of 8 tokens fit into a chunk, a memory-efficient kernel would process more tokens at once
+    backend.max_chunk_size_bytes = 8 * max(backend.shard_num_heads) * backend.dtype_bytes * seq_length
+
+    # Pretend we're on a GPU where SDPA has no memory-efficient kernel for our attention mask (e.g., with old torch)
+    monkeypatch.setattr(backend, "uses_sdpa", True)
+    monkeypatch.setattr(backend, "_relies_on_efficient_sdpa", lambda hidden_states: backend.uses_sdpa)
+    chunk_lengths, module_forward = [], backend.module.forward
+
+    def forward(hidden_states, **kwargs):
+        if not torch.backends.cuda.math_sdp_enabled():
+            raise RuntimeError("No available kernel. Aborting execution.")
+        chunk_lengths.append(hidden_states.shape[1])
+        return module_forward(hidden_states, **kwargs)
+
+    monkeypatch.setattr(backend.module, "forward", forward)
+
+    inputs = torch.randn(1, seq_length, config.hidden_size, dtype=dtype)
+    descriptors = backend.get_inference_cache_descriptors(batch_size=1, max_length=seq_length)
+    memory_cache.runtime_pid += 1  # pretend we're a connection handler
+    async with memory_cache.allocate_cache(*descriptors, timeout=0) as handles:
+        memory_cache.runtime_pid -= 1  # pretend we're the runtime
+        info = InferenceMetadata(backend.name, 0, tuple(handles), active_adapter=None)
+        (outputs,) = backend.inference_step(inputs, torch.empty(0, dtype=torch.int64), info)
+        memory_cache.runtime_pid += 1
+    memory_cache.runtime_pid -= 1
+
+    # The step is processed again in chunks that fit the attention logits, and the backend stops relying on SDPA
+    assert not backend.uses_sdpa and torch.backends.cuda.math_sdp_enabled()
+    assert chunk_lengths == [8] * (seq_length // 8)
+    with torch.inference_mode():
+        reference, _ = block(inputs, use_cache=True)
+    assert torch.allclose(outputs, reference, rtol=0, atol=1e-5)
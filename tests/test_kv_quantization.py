@@ -0,0 +1,92 @@
+import pytest
+import torch
+from hypermind import BatchTensorDescriptor
+
+from subnet.data_structures import InferenceMetadata
+from subnet.server.backend import TransformerBackend
+from subnet.server.block_utils import get_model_block
+from subnet.server.memory_cache import MemoryCache
+from subnet.utils.auto_config import AutoDistributedConfig
+from subnet.utils.convert_block import QuantType, convert_block
+from subnet.utils.kv_quantization import dequantize_kv, quantize_kv
+from test_utils import MODEL_NAME
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.float16, torch.bfloat16])
+@pytest.mark.parametrize("dim", [-1, -2])
+def test_quantize_kv(dtype: torch.dtype, dim: int):
+    tensor = torch.randn(2, 4, 64, 64, dtype=dtype) * torch.rand(2, 4, 64, 1, dtype=dtype) * 10
+    tensor[0, 0] = 0  # all-zero vectors must not produce NaNs
+    original = tensor.clone()
+
+    quantized, scales = quantize_kv(tensor, dim=dim)
+    assert torch.equal(tensor, original), "quantize_kv must not modify its inputs"
+    assert quantized.dtype == torch.int8 and quantized.shape == tensor.shape
+    assert scales.dtype == dtype and scales.shape[dim] == 1 and scales.numel() == tensor.numel() // 64
+
+    restored = dequantize_kv(quantized, scales, dtype)
+    assert restored.dtype == dtype and torch.all(restored[0, 0] == 0)
+    max_error = (restored.float() - tensor.float()).abs().amax(dim=dim, keepdim=True)
+    absmax = tensor.float().abs().amax(dim=dim, keepdim=True)
+    # The error is within a half of the quantization step, plus the rounding error of the restored values
+    assert torch.all(max_error <= absmax * (0.5 / 127 + torch.finfo(dtype).eps))
+
+
+@pytest.mark.forked
+@pytest.mark.asyncio
+@pytest.mark.parametrize("batch_size", [1, 2])  # with batch_size > 1, the prefill's new keys are not contiguous
+async def test_int8_kv_cache_inference(batch_size: int, max_relative_error: float = 0.02):
+    config = AutoDistributedConfig.from_pretrained(MODEL_NAME)
+    device, dtype = torch.device("cpu"), torch.float32
+    block = get_model_block(config).to(dtype)
+    block = convert_block(block, 0, config, (device,), device, quant_type=QuantType.NONE, freeze=True)
+
+    memory_cache = MemoryCache(max_size_bytes=None)
+    schema = (BatchTensorDescriptor(1, 2048, config.hidden_size, dtype=dtype),)
+    ref_backend, int8_backend = (
+        TransformerBackend(
+            name,
+            block,
+            config=config,
+            memory_cache=memory_cache,
+            backend_dtype=dtype,
+            max_chunk_size_bytes=256 * 1024 * 1024,
+            kv_cache_dtype=kv_cache_dtype,
+            args_schema=schema,
+            kwargs_schema={},
+            outputs_schema=schema,
+            min_batch_size=1,
+            max_batch_size=2048,
+        )
+        for name, kv_cache_dtype in [("reference.0", None), ("int8.0", torch.int8)]
+    )
+    sessions_ratio = sum(ref_backend.cache_bytes_per_token.values()) / sum(int8_backend.cache_bytes_per_token.values())
+    print(f"An int8 cache fits {sessions_ratio:.2f}x more tokens than a {dtype} cache")
+    head_dim = config.hidden_size // config.num_attention_heads
+    assert sessions_ratio == pytest.approx(4 / (1 + 4 / head_dim))  # 1 byte per value + a float32 scale per head
+
+    inputs = torch.randn(batch_size, 16, config.hidden_size, dtype=dtype)
+    with torch.inference_mode():
+        outputs_forward, _ = block(inputs, use_cache=True)
+
+    outputs_inference = {}
+    for backend in (ref_backend, int8_backend):
+        descriptors = backend.get_inference_cache_descriptors(batch_size=batch_size, max_length=inputs.shape[1])
+        memory_cache.runtime_pid += 1  # pretend we're a connection handler
+        async with memory_cache.allocate_cache(*descriptors, timeout=0) as handles:
+            memory_cache.runtime_pid -= 1  # pretend we're the runtime
+            outputs, prefix_length = [], 0
+            for length in [10, 1, 1, 1, 3]:
+                info = InferenceMetadata(backend.name, prefix_length, tuple(handles), active_adapter=None)
+                hidden_states = inputs[:, prefix_length : prefix_length + length]
+                (step_outputs,) = backend.inference_step(hidden_states, torch.empty(0, dtype=torch.int64), info)
+                outputs.append(step_outputs)
+                prefix_length += length
+            outputs_inference[backend.name] = torch.cat(outputs, dim=1)
+            memory_cache.runtime_pid += 1
+        memory_cache.runtime_pid -= 1
+
+    assert torch.allclose(outputs_inference["reference.0"], outputs_forward, rtol=0, atol=1e-4)
+    error = (outputs_inference["int8.0"] - outputs_forward).norm() / outputs_forward.norm()
+    print(f"Relative error of outputs with an int8 cache: {error.item():.5f}")
+    assert error < max_relative_error
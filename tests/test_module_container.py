@@ -0,0 +1,152 @@
+import time
+
+import hypermind
+import pytest
+import torch
+from hypermind.proto import runtime_pb2
+from hypermind.proto.runtime_pb2 import CompressionType
+
+from subnet import AutoDistributedConfig
+from subnet.data_structures import UID_DELIMITER, ModelInfo, ServerInfo, ServerState
+from subnet.server.handler import CACHE_TOKENS_AVAILABLE, TransformerConnectionHandler
+from subnet.server.memory_cache import AllocationFailed
+from subnet.server.server import ModuleContainer
+from subnet.server.task_prioritizer import TokenAwareTaskPrioritizer
+from subnet.utils.convert_block import QuantType
+from subnet.utils.misc import DUMMY
+from test_utils import *
+
+
+def _create_container(dht: hypermind.DHT, config, block_indices, **kwargs) -> ModuleContainer:
+    return ModuleContainer.create(
+        dht=dht,
+        dht_prefix=config.dht_prefix,
+        converted_model_name_or_path=MODEL_NAME,
+        block_config=config,
+        attn_cache_bytes=2**26,
+        server_info=ServerInfo(ServerState.JOINING, throughput=1.0, torch_dtype="float32", quant_type="none"),
+        model_info=ModelInfo(num_blocks=config.num_hidden_layers),
+        block_indices=block_indices,
+        min_batch_size=1,
+        max_batch_size=2048,
+        max_chunk_size_bytes=256 * 1024 * 1024,
+        max_alloc_timeout=600,
+        max_batched_sessions=1,
+        max_coalesced_tasks=1,
+        coalescing_window=0,
+        prefix_cache_fraction=0,
+        torch_dtype=torch.float32,
+        cache_dir=None,
+        max_disk_space=None,
+        device=torch.device("cpu"),
+        compression=CompressionType.NONE,
+        update_period=60,
+        expiration=None,
+        revision=None,
+        token=None,
+        quant_type=QuantType.NONE,
+        tensor_parallel_devices=(torch.device("cpu"),),
+        should_validate_reachability=False,
+        use_converted_block_cache=False,
+        inference_max_length=128,
+        max_prefill_chunk_tokens=None,
+        task_prioritizer=TokenAwareTaskPrioritizer(),
+        num_handlers=2,
+        request_timeout=30,
+        session_timeout=60,
+        step_timeout=30,
+        **kwargs,
+    )
+
+
+@pytest.mark.forked
+@pytest.mark.asyncio
+async def test_container_takes_over_handlers():
+    config = AutoDistributedConfig.from_pretrained(MODEL_NAME)
+    uids = [f"{config.dht_prefix}{UID_DELIMITER}{i}" for i in range(3)]
+    server_dht = hypermind.DHT(start=True)
+    client_dht = hypermind.DHT(initial_peers=server_dht.get_visible_maddrs(), client_mode=True, start=True)
+    stub = TransformerConnectionHandler.get_stub(await client_dht.replicate_p2p(), server_dht.peer_id)
+
+    async def is_served(uid: str) -> bool:
+        try:
+            info = await stub.rpc_info(runtime_pb2.ExpertUID(uid=uid))
+            return CACHE_TOKENS_AVAILABLE in hypermind.MSGPackSerializer.loads(info.serialized_info)
+        except Exception:
+            return False
+
+    async def forward(uid: str) -> torch.Tensor:
+        hidden_states = torch.randn(1, 4, config.hidden_size)
+        request = runtime_pb2.ExpertRequest(
+            uid=uid,
+            tensors=[hypermind.serialize_torch_tensor(tensor) for tensor in (hidden_states, DUMMY)],
+        )
+        response = await stub.rpc_forward(request)
+        return hypermind.deserialize_torch_tensor(response.tensors[0])
+
+    first_container = _create_container(server_dht, config, [0, 1], start=True)
+    assert all([await is_served(uids[0]) for _ in range(10)])
+
+    # Both containers run at the same time: the first one finishes its sessions, the second one serves new requests
+    second_container = _create_container(server_dht, config, [1, 2], previous_container=first_container, start=False)
+    second_container.take_over(first_container, kept_uids=[uids[1]])
+    try:
+        assert first_container.is_alive() and second_container.is_alive()
+        assert second_container.session_directory is first_container.session_directory
+        assert {handler._handler_index for handler in first_container.conn_handlers}.isdisjoint(
+            handler._handler_index for handler in second_container.conn_handlers
+        )
+
+        # Every request reaches the handlers of the second container, so new blocks are found and old ones are not
+        assert all([await is_served(uids[2]) for _ in range(10)])
+        assert not any([await is_served(uids[0]) for _ in range(10)])
+        for _ in range(10):
+            assert (await forward(uids[2])).shape == (1, 4, config.hidden_size)
+    finally:
+        first_container.shutdown()
+        second_container.shutdown()
+        client_dht.shutdown()
+        server_dht.shutdown()
+
+
+@pytest.mark.forked
+@pytest.mark.asyncio
+async def test_containers_share_cache_budget(attn_cache_bytes: int = 2**26):
+    config = AutoDistributedConfig.from_pretrained(MODEL_NAME)
+    server_dht = hypermind.DHT(start=True)
+    first_container = _create_container(server_dht, config, [0, 1], activation_cache_bytes=2**20, start=True)
+    second_container = _create_container(
+        server_dht, config, [1, 2], activation_cache_bytes=2**20, previous_container=first_container, start=False
+    )
+    second_container.take_over(first_container, kept_uids=[f"{config.dht_prefix}{UID_DELIMITER}1"])
+    try:
+        assert second_container.memory_cache is first_container.memory_cache
+        assert second_container.activation_cache is first_container.activation_cache
+        memory_cache = second_container.memory_cache
+        assert memory_cache.max_size_bytes == attn_cache_bytes
+
+        # A session of the previous container holds most of the budget, so the next container can't exceed it
+        backend = next(iter(second_container.module_backends.values()))
+        bytes_per_token = memory_cache.get_allocation_size(*backend.get_inference_cache_descriptors(1, 1))
+        old_session_length = attn_cache_bytes // bytes_per_token * 3 // 4
+        memory_cache.runtime_pid += 1  # pretend we're a connection handler
+        async with memory_cache.allocate_cache(
+            *backend.get_inference_cache_descriptors(1, old_session_length), timeout=0
+        ):
+            assert memory_cache.current_size_bytes <= attn_cache_bytes
+            with pytest.raises(AllocationFailed):
+                async with memory_cache.allocate_cache(
+                    *backend.get_inference_cache_descriptors(1, old_session_length), timeout=0
+                ):
+                    pass
+
+            # The previous container has no sessions of its own, so it retires while the cache is still in use
+            start_time = time.perf_counter()
+            first_container.shutdown_when_drained(timeout=60, check_period=0.1)
+            assert time.perf_counter() - start_time < 30
+        assert memory_cache.current_size_bytes == 0
+        memory_cache.runtime_pid -= 1
+    finally:
+        first_container.shutdown()
+        second_container.shutdown()
+        server_dht.shutdown()
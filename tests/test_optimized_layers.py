@@ -29,7 +29,7 @@ class UnoptimizedWrappedFalconBlock(FalconDecoderLayer):
         batch_size, seq_length = hidden_states.shape[:2]
 
         if layer_past is not None:
-            layer_past = self._reorder_cache_from_bloom_to_falcon(layer_past)
+            layer_past = self._expand_cache(layer_past)
         past_length = 0 if layer_past is None else layer_past[0].shape[1]
         seq_length_with_past = seq_length + past_length
 
@@ -50,15 +50,14 @@ class UnoptimizedWrappedFalconBlock(FalconDecoderLayer):
 
         if use_cache:
             present_key_value = outputs[-1]
-            present_key_value = self._reorder_cache_from_falcon_to_bloom(present_key_value)
+            present_key_value = self._collapse_cache(present_key_value)
             outputs = outputs[:-1] + (present_key_value,)
 
         return outputs
 
-    def _reorder_cache_from_bloom_to_falcon(self, key_value: KVCache) -> KVCache:
+    def _expand_cache(self, key_value: KVCache) -> KVCache:
         key_states, value_states = key_value
 
-        key_states = key_states.permute(0, 2, 1)
         assert key_states.shape == value_states.shape  # Both are [batch_size * num_kv_heads, seq_len, head_dim]
 
         if self.config.new_decoder_architecture:
@@ -67,7 +66,7 @@ class UnoptimizedWrappedFalconBlock(FalconDecoderLayer):
 
         return (key_states, value_states)
 
-    def _reorder_cache_from_falcon_to_bloom(self, key_value: KVCache) -> KVCache:
+    def _collapse_cache(self, key_value: KVCache) -> KVCache:
         key_states, value_states = key_value
 
         if self.config.new_decoder_architecture:
@@ -75,7 +74,6 @@ class UnoptimizedWrappedFalconBlock(FalconDecoderLayer):
             value_states = self._collapse_states(value_states)
 
         assert key_states.shape == value_states.shape  # Both are [batch_size * num_kv_heads, seq_len, head_dim]
-        key_states = key_states.permute(0, 2, 1)
 
         return (key_states, value_states)
 
@@ -116,9 +114,9 @@ class UnoptimizedWrappedLlamaBlock(LlamaDecoderLayer):
 
         past_key_value = layer_past
         if past_key_value is not None:
-            past_key_values_length = past_key_value[0].shape[2]
+            past_key_values_length = past_key_value[0].shape[1]
             seq_length_with_past = seq_length_with_past + past_key_values_length
-            past_key_value = self._reorder_cache_from_bloom_to_llama(past_key_value, batch_size, past_key_values_length)
+            past_key_value = self._make_dynamic_cache(past_key_value, batch_size, past_key_values_length)
         elif use_cache:
             past_key_value = DynamicCache()
 
@@ -153,18 +151,13 @@ class UnoptimizedWrappedLlamaBlock(LlamaDecoderLayer):
 
         if use_cache:
             present_key_value = outputs[-1]
-            present_key_value = self._reorder_cache_from_llama_to_bloom(
-                present_key_value, batch_size, seq_length_with_past
-            )
+            present_key_value = self._flatten_dynamic_cache(present_key_value, batch_size, seq_length_with_past)
             outputs = outputs[:-1] + (present_key_value,)
 
         return outputs
 
-    def _reorder_cache_from_bloom_to_llama(
-        self, key_value: Tuple[torch.Tensor], batch_size: int, seq_length: int
-    ) -> DynamicCache:
+    def _make_dynamic_cache(self, key_value: Tuple[torch.Tensor], batch_size: int, seq_length: int) -> DynamicCache:
         key_states, value_states = key_value
-        key_states = key_states.permute(0, 2, 1)
         key_states = key_states.view(
             batch_size, self.self_attn.num_key_value_heads, seq_length, self.self_attn.head_dim
         )
@@ -172,15 +165,12 @@ class UnoptimizedWrappedLlamaBlock(LlamaDecoderLayer):
         past_key_values = ((key_states, value_states),)
         return DynamicCache.from_legacy_cache(past_key_values)
 
-    def _reorder_cache_from_llama_to_bloom(
-        self, key_value: DynamicCache, batch_size: int, seq_length: int
-    ) -> Tuple[torch.Tensor]:
+    def _flatten_dynamic_cache(self, key_value: DynamicCache, batch_size: int, seq_length: int) -> Tuple[torch.Tensor]:
         key_states, value_states = key_value.to_legacy_cache()[0]
         value_states = value_states.view(
             batch_size * self.self_attn.num_key_value_heads, seq_length, self.self_attn.head_dim
         )
         key_states = key_states.view(*value_states.shape)
-        key_states = key_states.permute(0, 2, 1)
         return (key_states, value_states)
 
 
@@ -222,3 +212,54 @@ def test_optimized_block(device):
             assert torch.allclose(block_output, unopt_block_output, atol=1e-6, rtol=0), length
             assert torch.allclose(cache[0], unopt_cache[0], atol=1e-6, rtol=0), length
             assert torch.allclose(cache[1], unopt_cache[1], atol=1e-6, rtol=0), length
+
+
+@pytest.mark.parametrize("device", ["cpu", "cuda:0"])
+@pytest.mark.forked
+def test_inplace_cache(device):
+    if device == "cuda:0" and not torch.cuda.is_available():
+        pytest.skip("CUDA tests can be run only in CUDA-enabled setups")
+
+    config = AutoDistributedConfig.from_pretrained(MODEL_NAME)
+    if not getattr(config.block_class, "supports_inplace_cache", False):
+        pytest.skip(f"This test is not applicable to {config.model_type} models")
+
+    dtype = torch.float32
+    block_idx = 1
+    block = get_model_block(config, layer_idx=block_idx).to(dtype)
+    block = convert_block(block, block_idx, config, (device,), device, quant_type=QuantType.NONE, freeze=True)
+
+    num_kv_heads = getattr(config, "num_key_value_heads", config.num_attention_heads)
+    head_dim = config.hidden_size // config.num_attention_heads
+    max_length = 16
+    key_cache = torch.zeros(1, num_kv_heads, max_length, head_dim, device=device, dtype=dtype)
+    value_cache = torch.zeros_like(key_cache)
+    cache = None
+    prefix_length = 0
+
+    with torch.inference_mode():
+        for length in [10, 1, 1, 1]:
+            dummy_input = torch.randn(1, length, config.hidden_size, device=device, dtype=dtype)
+            ref_output, cache = block(dummy_input, layer_past=cache, use_cache=True)
+            (output,) = block(dummy_input, kv_cache=(key_cache, value_cache), prefix_length=prefix_length)
+            prefix_length += length
+            assert torch.allclose(output, ref_output, atol=1e-5, rtol=0), length
+
+
+@pytest.mark.forked
+def test_sdpa_attention():
+    config = AutoDistributedConfig.from_pretrained(MODEL_NAME)
+    if config.model_type != "llama":
+        pytest.skip(f"This test is not applicable to {config.model_type} models")
+
+    block = get_model_block(config, layer_idx=1).to(torch.float32)
+    cache = {"eager": None, "sdpa": None}
+
+    with torch.inference_mode():
+        for length in [10, 1, 1, 1]:
+            dummy_input = torch.randn(1, length, config.hidden_size)
+            outputs = {}
+            for attn_impl in ["eager", "sdpa"]:
+                config._attn_implementation = attn_impl  # read by OptimizedLlamaAttention on every call
+                outputs[attn_impl], cache[attn_impl] = block(dummy_input, layer_past=cache[attn_impl], use_cache=True)
+            assert torch.allclose(outputs["sdpa"], outputs["eager"], atol=1e-5, rtol=0), length
@@ -1,12 +1,24 @@
+import asyncio
 import multiprocessing as mp
 import platform
+import threading
 import time
+from types import SimpleNamespace
 
 import pytest
 import torch
 from hypermind.moe.server.runtime import Runtime
 
-from subnet.server.task_pool import PrioritizedTaskPool
+from subnet.server.block_functions import _run_prefill_in_chunks, get_deadline
+from subnet.server.shared_memory import SharedMemoryResult, SharedTensorRing, set_local_ring
+from subnet.server.task_pool import (
+    PrioritizedTaskPool,
+    ServerBusyError,
+    TaskCancelledError,
+    get_retry_after,
+    is_current_batch_cancelled,
+)
+from subnet.server.task_prioritizer import FairShareTaskPrioritizer, TokenAwareTaskPrioritizer
 
 
 def _submit_tasks(runtime_ready, pools, results_valid):
@@ -80,3 +92,350 @@ def test_priority_pools():
     #                                                  7 - task with priority 11 from pool B
 
     runtime.shutdown()
+
+
+@pytest.mark.forked
+def test_priority_pool_groups_compatible_tasks():
+    pool = PrioritizedTaskPool(
+        lambda *task_args: None,
+        name="C",
+        max_batch_size=16,
+        max_tasks_per_batch=3,
+        get_task_group=lambda task: task.args[0].shape[1],
+        start=True,
+    )
+    try:
+        futures = [
+            pool.submit_task(torch.zeros(1, 1, 2), priority=1),
+            pool.submit_task(torch.zeros(1, 4, 2), priority=2),
+            pool.submit_task(torch.ones(2, 1, 2), priority=3),
+            pool.submit_task(torch.ones(1, 1, 2), priority=4),
+            pool.submit_task(torch.ones(1, 1, 2), priority=5),
+        ]
+        while pool._ordered_tasks.qsize() < len(futures):
+            time.sleep(0.01)
+
+        # the most urgent task is batched with the next tasks of the same length, up to max_tasks_per_batch
+        uids, batch = pool.load_batch_to_runtime()
+        assert len(uids) == len(batch) == 3
+        assert [task_args[0].shape[:2] for task_args in batch] == [(1, 1), (2, 1), (1, 1)]
+        pool.send_outputs_from_runtime(uids, [task_args[0] + 1 for task_args in batch])
+        assert futures[0].result()[0].sum().item() == 2
+        assert futures[2].result()[0].sum().item() == 8
+        assert futures[3].result()[0].sum().item() == 4
+
+        # incompatible tasks stay in the queue and keep their order
+        uids, batch = pool.load_batch_to_runtime()
+        assert len(uids) == 1 and batch[0][0].shape == (1, 4, 2)
+        pool.send_exception_from_runtime(uids, ValueError("expected"))
+        with pytest.raises(ValueError):
+            futures[1].result()
+
+        uids, batch = pool.load_batch_to_runtime()
+        assert len(uids) == 1 and batch[0][0].shape == (1, 1, 2)
+    finally:
+        pool.shutdown()
+
+
+@pytest.mark.forked
+def test_priority_pool_waits_for_tasks_to_coalesce(max_batch_wait: float = 0.2):
+    pool = PrioritizedTaskPool(
+        lambda *task_args: None,
+        name="H",
+        max_batch_size=16,
+        max_tasks_per_batch=4,
+        max_batch_wait=max_batch_wait,
+        start=True,
+    )
+    other_pool = PrioritizedTaskPool(lambda x: None, name="I", max_batch_size=16, start=True)
+
+    def load_batch_when_ready(pool: PrioritizedTaskPool):
+        assert pool.batch_receiver.poll(timeout=5), "the pool did not signal a ready batch"  # as Runtime does
+        start_time = time.monotonic()
+        batch = pool.load_batch_to_runtime()
+        assert time.monotonic() - start_time < max_batch_wait / 4, "the runtime must not wait inside the pool"
+        return batch
+
+    try:
+        pool.submit_task(torch.zeros(1, 4, 2))
+        threading.Timer(max_batch_wait / 4, lambda: pool.submit_task(torch.ones(1, 4, 2))).start()
+        # While the pool waits for more tasks, the runtime does not see them and keeps processing other pools
+        other_pool.submit_task(torch.zeros(1, 1, 2))
+        assert pool.empty
+        load_batch_when_ready(other_pool)
+        assert pool.empty
+        uids, batch = load_batch_when_ready(pool)
+        assert len(uids) == 2  # the second task arrived within the window
+
+        start_time = time.monotonic()
+        futures = [pool.submit_task(torch.zeros(2, 4, 2)) for _ in range(2)]
+        uids, batch = load_batch_when_ready(pool)
+        assert len(uids) == 2 and time.monotonic() - start_time < max_batch_wait / 2  # the batch is full, no waiting
+
+        pool.submit_task(torch.zeros(1, 4, 2))
+        uids, batch = load_batch_when_ready(pool)
+        assert len(uids) == 1
+
+        stats = pool.get_batching_stats()
+        assert stats["mean_tasks_per_batch"] == pytest.approx(5 / 3)
+        assert stats["mean_batch_occupancy"] == pytest.approx((8 + 16 + 4) / (3 * 16))
+        assert max_batch_wait / 12 < stats["mean_batch_wait"] < max_batch_wait
+    finally:
+        pool.shutdown()
+        other_pool.shutdown()
+
+
+@pytest.mark.forked
+def test_priority_pool_shared_memory_ring():
+    ring = SharedTensorRing(num_slots=2, slot_size=512)
+    pool = PrioritizedTaskPool(lambda x: None, name="D", max_batch_size=1024, start=True)
+    set_local_ring(ring)
+    try:
+        inputs = [torch.randn(1, 1, 16), torch.randn(1, 8, 16), torch.randn(1, 1, 16), torch.randn(1, 16, 16)]
+        futures = [pool.submit_task(x) for x in inputs]
+        # The first tasks take both slots, the third one waits for a free slot, the last one is too large for a slot
+        assert [isinstance(future, SharedMemoryResult) for future in futures] == [True, True, False, False]
+        while pool._ordered_tasks.qsize() < len(futures):
+            time.sleep(0.01)
+
+        ring_start, ring_end = ring.buffer.data_ptr(), ring.buffer.data_ptr() + ring.buffer.numel()
+        for i in range(len(futures)):
+            uid, (x,) = pool.load_batch_to_runtime()
+            assert (ring_start <= x.data_ptr() < ring_end) == (i < 2)  # the runtime reads inputs from the slot
+            pool.send_outputs_from_runtime(uid, [x * 2])  # the outputs of the second task don't fit into the slot
+
+        for x, future in zip(inputs, futures):
+            (y,) = future.result()
+            assert torch.equal(y, x * 2)
+            assert not ring_start <= y.data_ptr() < ring_end
+        assert len(ring._free_slots) == ring.num_slots
+        assert isinstance(pool.submit_task(inputs[0]), SharedMemoryResult)  # slots are reused
+    finally:
+        set_local_ring(None)
+        pool.shutdown()
+
+
+@pytest.mark.forked
+@pytest.mark.asyncio
+async def test_priority_pool_skips_cancelled_tasks():
+    processed = []
+
+    def process_func(x):
+        processed.append(x.item())
+        if x.item() == 2:
+            pool.cancelled_tasks.put(futures[2]._uid)  # the caller is cancelled while its task is processed
+            assert is_current_batch_cancelled()
+        return (x + 1,)
+
+    pool = PrioritizedTaskPool(process_func, name="F", max_batch_size=1, start=True)
+    try:
+        futures = [pool.submit_task(torch.tensor([i])) for i in range(3)]
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(futures[0], timeout=0.1)  # the caller stops waiting, e.g. its deadline expires
+        while pool._ordered_tasks.qsize() < len(futures):
+            await asyncio.sleep(0.01)
+
+        for _ in range(len(futures)):
+            uid, batch = pool.load_batch_to_runtime()
+            pool.send_outputs_from_runtime(uid, pool.process_func(*batch))  # this is what Runtime does
+
+        assert processed == [1, 2]  # the first task is skipped, the last one is interrupted while processing
+        assert pool.num_skipped_tasks == 2
+        assert futures[1].result()[0].item() == 2
+        for future in (futures[0], futures[2]):
+            with pytest.raises(TaskCancelledError):
+                future.result()
+        assert not is_current_batch_cancelled()  # outside of process_func
+    finally:
+        pool.shutdown()
+
+
+@pytest.mark.forked
+def test_deadline_is_validated():
+    assert get_deadline({}) is None and get_deadline({}, default=5) == 5
+    assert get_deadline({"deadline": 0.5}, default=5) == 0.5  # a step may override the deadline of its session
+    for invalid_deadline in ["10", 0, -1.0]:
+        with pytest.raises(ValueError, match="deadline must be a positive number"):
+            get_deadline({"deadline": invalid_deadline})
+
+
+def test_priority_pool_deadlines(task_time: float = 0.05):
+    def process_func(x):
+        time.sleep(task_time)
+        return (x,)
+
+    def run_queued_tasks():
+        while pool._ordered_tasks.qsize() < pool._queued_tasks.value:
+            time.sleep(0.01)
+        order = []
+        for _ in range(pool._ordered_tasks.qsize()):
+            uid, batch = pool.load_batch_to_runtime()
+            (outputs,) = pool.process_func(*batch)  # this is what Runtime does, it also measures processing costs
+            pool.send_outputs_from_runtime(uid, [outputs])
+            order.append(outputs[0, 0].item())
+        return order
+
+    pool = PrioritizedTaskPool(process_func, name="G", max_batch_size=16, start=True)
+    try:
+        # Until the pool measured its costs, it admits all tasks. Tasks of equal priority go in EDF order
+        now = time.monotonic()
+        futures = [
+            pool.submit_task(torch.full((1, 4), 0), deadline=None),
+            pool.submit_task(torch.full((1, 4), 1), deadline=now + 1),
+            pool.submit_task(torch.full((1, 4), 2), deadline=now + 10),
+            pool.submit_task(torch.full((1, 4), 3), deadline=now + 5),
+            pool.submit_task(torch.full((1, 4), 4), priority=-1, deadline=None),
+        ]
+        assert run_queued_tasks() == [4, 1, 3, 2, 0]
+        assert all(future.result()[0][0, 0].item() == i for i, future in enumerate(futures))
+        assert pool.estimate_completion_time(4) == pytest.approx(task_time, rel=0.5)
+
+        # Refuse a task if it can't be done in time, with a hint on when the server may be less busy
+        future = pool.submit_task(torch.full((1, 4), 5), deadline=time.monotonic() + task_time / 5)
+        with pytest.raises(ServerBusyError) as exc_info:
+            future.result(timeout=1)
+        assert 0 < get_retry_after(exc_info.value) < 2 * task_time
+        assert get_retry_after(RuntimeError(str(exc_info.value))) == pytest.approx(exc_info.value.retry_after, abs=1e-3)
+        assert get_retry_after(ValueError("unrelated error")) is None
+
+        # The same deadline is feasible for an idle pool but not for a pool with a queue
+        admitted = pool.submit_task(torch.full((1, 4), 6), deadline=time.monotonic() + 20 * task_time)
+        queued = [pool.submit_task(torch.full((1, 4), 7)) for _ in range(30)]
+        refused = pool.submit_task(torch.full((1, 4), 8), deadline=time.monotonic() + 20 * task_time)
+        with pytest.raises(ServerBusyError):
+            refused.result(timeout=1)
+        assert len(run_queued_tasks()) == 1 + len(queued)
+        assert admitted.result()[0][0, 0].item() == 6 and pool._queued_tasks.value == 0
+    finally:
+        pool.shutdown()
+
+
+def test_token_aware_prioritizer():
+    prioritizer = TokenAwareTaskPrioritizer(max_decode_tokens=128, prefill_tokens_scale=1024)
+    hidden_states = torch.zeros(1, 512, 8)
+
+    decode = prioritizer.prioritize(torch.zeros(4, 1, 8), type="inference", num_tokens=4, processed_tokens=4000)
+    fresh_prefill = prioritizer.prioritize(hidden_states, type="inference", processed_tokens=0)
+    late_prefill = prioritizer.prioritize(hidden_states, type="inference", num_tokens=512, processed_tokens=3072)
+    forward = prioritizer.prioritize(hidden_states, type="forward")
+
+    # decode steps go first, then prefill chunks of sessions that processed fewer tokens, then forward/backward
+    assert decode < fresh_prefill < late_prefill < forward
+
+
+def test_fair_share_prioritizer():
+    prioritizer = FairShareTaskPrioritizer(
+        TokenAwareTaskPrioritizer(), rate=100, burst=1000, get_peer_weights=lambda: {"heavy": 3.0}
+    )
+    forward_inputs, decode_inputs = torch.zeros(1, 100, 8), torch.zeros(1, 1, 8)
+    while not prioritizer._peer_weights:
+        prioritizer.prioritize(decode_inputs, type="inference", peer_id="light")  # weights are loaded in background
+        time.sleep(0.01)
+
+    # Two peers flood the server with forward requests through 2 blocks (200 token-blocks each), "heavy" has weight 3
+    flood = []
+    for _ in range(40):
+        for peer_id in ("aggressive", "heavy"):
+            for block_index in range(2):
+                priority = prioritizer.prioritize(forward_inputs, type="forward", backend=block_index, peer_id=peer_id)
+                flood.append((priority, peer_id))
+    decode = prioritizer.prioritize(decode_inputs, type="inference", requested_uids=["a", "b"], peer_id="light")
+
+    # Each peer keeps the base priorities within its burst, then its tasks go after the tasks of well-behaved peers
+    assert decode == prioritizer.base_prioritizer.prioritize(decode_inputs, type="inference")
+    assert sum(priority == 3.0 for priority, peer_id in flood if peer_id == "aggressive") == 1000 // 100
+    assert sum(priority == 3.0 for priority, peer_id in flood if peer_id == "heavy") == 3000 // 100
+    assert all(priority > decode for priority, _ in flood)
+
+    # Once both peers exceed their shares, the runtime serves them in proportion to their weights
+    over_share = sorted(item for item in flood if item[0] > prioritizer.over_share_priority)
+    first_served = [peer_id for _, peer_id in over_share[: len(over_share) // 4]]
+    assert first_served.count("heavy") / first_served.count("aggressive") == pytest.approx(3, rel=0.15)
+
+
+def _flood_from_handler(prioritizer: FairShareTaskPrioritizer, peer_id: str, priorities: mp.SimpleQueue):
+    forward_inputs = torch.zeros(1, 100, 8)
+    for _ in range(5):
+        priorities.put(prioritizer.prioritize(forward_inputs, type="forward", peer_id=peer_id))
+
+
+def test_fair_share_is_enforced_across_handlers():
+    prioritizer = FairShareTaskPrioritizer(rate=1, burst=1000, max_tracked_peers=2)
+    priorities = mp.SimpleQueue()
+
+    # Two handler processes share the budget of one peer: 10 tasks of 100 tokens fit into the burst, the rest don't
+    for _ in range(2):
+        process = mp.context.ForkProcess(target=_flood_from_handler, args=(prioritizer, "aggressive", priorities))
+        process.start()
+        process.join()
+    assert [priorities.get() for _ in range(10)] == [3.0] * 10
+    assert prioritizer.prioritize(torch.zeros(1, 100, 8), type="forward", peer_id="aggressive") > 10.0
+
+    # Once the table is full, peers with full buckets are forgotten, while the debt of busy peers is kept
+    for peer_id in ("idle-1", "idle-2", "idle-3"):
+        assert prioritizer.prioritize(torch.zeros(1, 1, 8), type="inference", peer_id=peer_id, num_tokens=0) == 1.0
+    assert prioritizer._num_peers.value <= 2
+    assert prioritizer.prioritize(torch.zeros(1, 100, 8), type="forward", peer_id="aggressive") > 10.0
+
+
+def test_fair_share_prioritizer_handles_many_peers(max_tracked_peers: int = 4096):
+    prioritizer = FairShareTaskPrioritizer(rate=1, burst=100, max_tracked_peers=max_tracked_peers)
+    forward_inputs = torch.zeros(1, 200, 8)
+
+    # Many peers exceed their shares, so that no bucket is full: new peers must replace busy ones without a full scan
+    start_time = time.perf_counter()
+    for i in range(2 * max_tracked_peers):
+        assert prioritizer.prioritize(forward_inputs, type="forward", peer_id=f"peer-{i}") > 10.0
+    assert (time.perf_counter() - start_time) / (2 * max_tracked_peers) < 1e-3
+    assert prioritizer._num_peers.value == max_tracked_peers
+
+    # The most recent peers are still tracked, so their second request adds to their debt of 100 token-blocks
+    for i in range(2 * max_tracked_peers - 10, 2 * max_tracked_peers):
+        priority = prioritizer.prioritize(forward_inputs, type="forward", peer_id=f"peer-{i}")
+        assert priority > prioritizer.over_share_priority + 250
+    assert prioritizer._num_peers.value == max_tracked_peers
+
+
+@pytest.mark.asyncio
+async def test_prefill_is_split_into_chunks():
+    submitted = []
+
+    class FakePool:
+        def __init__(self, index: int):
+            self.index = index
+
+        async def submit_task(self, hidden_states, hypo_ids, inference_infos, prompt, *, priority, deadline=None):
+            submitted.append((self.index, hidden_states.shape[1], inference_infos[0].prefix_length, priority))
+            return (hidden_states + 1,)
+
+    backends = [
+        SimpleNamespace(inference_pool=FakePool(i), memory_cache=SimpleNamespace(page_size=128)) for i in range(2)
+    ]
+    hidden_states = torch.randn(2, 700, 8)
+    outputs = await _run_prefill_in_chunks(
+        hidden_states,
+        torch.arange(2),
+        [None, None],
+        requested_uids=["test.0", "test.1"],
+        requested_backends=backends,
+        active_adapter=None,
+        cache_handles=[(0,), (1,)],
+        prefix_length=100,
+        prefix_keys=[(), ()],
+        max_chunk_tokens=512,
+        prioritizer=TokenAwareTaskPrioritizer(),
+        points=0.0,
+    )
+    assert torch.allclose(outputs, hidden_states + 2)
+
+    # each chunk of 256 tokens x 2 sequences passes through all blocks before the next chunk is submitted
+    assert [(index, length, prefix_length) for index, length, prefix_length, _ in submitted] == [
+        (0, 256, 100),
+        (1, 256, 100),
+        (0, 256, 356),
+        (1, 256, 356),
+        (0, 188, 612),
+        (1, 188, 612),
+    ]
+    priorities = [priority for *_, priority in submitted[::2]]
+    assert priorities == sorted(priorities) and priorities[0] < priorities[-1]
@@ -0,0 +1,64 @@
+import pytest
+import torch
+from hypermind import BatchTensorDescriptor
+
+from subnet.data_structures import InferenceMetadata
+from subnet.server.backend import TransformerBackend
+from subnet.server.block_utils import get_model_block
+from subnet.server.memory_cache import MemoryCache
+from subnet.utils.auto_config import AutoDistributedConfig
+from subnet.utils.convert_block import QuantType, convert_block
+from test_utils import MODEL_NAME
+
+
+@pytest.mark.forked
+@pytest.mark.asyncio
+@pytest.mark.parametrize("kv_cache_dtype", [None, torch.int8])
+async def test_beam_search_reorder(kv_cache_dtype: torch.dtype, num_beams: int = 4, max_length: int = 64):
+    config = AutoDistributedConfig.from_pretrained(MODEL_NAME)
+    device, dtype = torch.device("cpu"), torch.float32
+    block = get_model_block(config).to(dtype)
+    block = convert_block(block, 0, config, (device,), device, quant_type=QuantType.NONE, freeze=True)
+
+    memory_cache = MemoryCache(max_size_bytes=None)
+    schema = (BatchTensorDescriptor(1, 2048, config.hidden_size, dtype=dtype),)
+    backend = TransformerBackend(
+        "beams.0",
+        block,
+        config=config,
+        memory_cache=memory_cache,
+        backend_dtype=dtype,
+        max_chunk_size_bytes=256 * 1024 * 1024,
+        kv_cache_dtype=kv_cache_dtype,
+        args_schema=schema,
+        kwargs_schema={},
+        outputs_schema=schema,
+        min_batch_size=1,
+        max_batch_size=2048,
+    )
+
+    descriptors = backend.get_inference_cache_descriptors(batch_size=num_beams, max_length=max_length)
+    memory_cache.runtime_pid += 1  # pretend we're a connection handler
+    async with memory_cache.allocate_cache(*descriptors, timeout=0) as handles:
+        memory_cache.runtime_pid -= 1  # pretend we're the runtime
+        sequences = torch.randn(num_beams, 8, config.hidden_size, dtype=dtype)
+        hypo_ids = torch.empty(0, dtype=torch.int64)
+        for step_hypo_ids in [None, [0, 1, 2, 3], [2, 0, 0, 3], [1, 1, 1, 1], [3, 2, 1, 0]]:
+            if step_hypo_ids is not None:
+                hypo_ids = torch.tensor(step_hypo_ids, dtype=torch.int64)
+                new_tokens = torch.randn(num_beams, 1, config.hidden_size, dtype=dtype)
+                sequences = torch.cat([sequences[hypo_ids], new_tokens], dim=1)
+                hidden_states = new_tokens
+            else:
+                hidden_states = sequences
+            prefix_length = sequences.shape[1] - hidden_states.shape[1]
+
+            info = InferenceMetadata(backend.name, prefix_length, tuple(handles), active_adapter=None)
+            (outputs,) = backend.inference_step(hidden_states, hypo_ids, info)
+            with torch.inference_mode():
+                reference, _ = block(sequences, use_cache=True)
+            # int8 caches are exact for reordering, but add their own quantization error to the outputs
+            atol = 1e-4 if kv_cache_dtype is None else 0.05
+            assert torch.allclose(outputs, reference[:, prefix_length:], rtol=0, atol=atol)
+        memory_cache.runtime_pid += 1
+    memory_cache.runtime_pid -= 1
@@ -0,0 +1,166 @@
+import dataclasses
+import heapq
+import random
+
+import numpy as np
+import pytest
+from hypermind import PeerID
+
+from subnet.client.routing.inference_graph import InferenceGraph
+from subnet.client.routing.sequence_info import RemoteSequenceInfo
+from subnet.client.routing.sequence_manager import RemoteSequenceManager
+from subnet.data_structures import RemoteModuleInfo, ServerInfo, ServerState
+from subnet.utils.dht import compute_spans
+
+NUM_BLOCKS = 12
+BLOCK_UIDS = tuple(f"test.{i}" for i in range(NUM_BLOCKS))
+
+
+def _make_block_infos(rng: random.Random, peer_ids, *, states=(ServerState.ONLINE,)):
+    block_infos = [RemoteModuleInfo(uid, {}) for uid in BLOCK_UIDS]
+    for peer_id in peer_ids:
+        start = rng.randrange(NUM_BLOCKS)
+        end = rng.randrange(start + 1, NUM_BLOCKS + 1)
+        server_info = ServerInfo(
+            state=rng.choice(states),
+            throughput=1.0,
+            start_block=start,
+            end_block=end,
+            inference_rps=rng.choice([None, rng.uniform(10, 1000)]),
+            cache_tokens_left=rng.choice([None, rng.randrange(0, 20000)]),
+            next_pings={
+                other.to_base58(): rng.uniform(0.001, 0.3) for other in rng.sample(peer_ids, len(peer_ids) // 2)
+            },
+        )
+        for block_idx in range(start, end):
+            block_infos[block_idx].servers[peer_id] = server_info
+    return block_infos
+
+
+def _sort_spans_reference(block_infos):
+    spans_by_priority = list(compute_spans(block_infos, min_state=ServerState.ONLINE).values())
+    spans_by_priority.sort(key=lambda span: span.length, reverse=True)
+    spans_containing_block = tuple([] for _ in range(len(block_infos)))
+    for span in spans_by_priority:
+        for block_index in range(span.start, span.end):
+            spans_containing_block[block_index].append(span)
+    return spans_by_priority, spans_containing_block
+
+
+def _span_keys(spans):
+    return [(span.peer_id, span.start, span.end, span.server_info) for span in spans]
+
+
+def test_incremental_sequence_info_update():
+    rng = random.Random(0)
+    peer_ids = [PeerID(f"peer{i}".encode()) for i in range(30)]
+    sequence_info = RemoteSequenceInfo.make_empty(BLOCK_UIDS)
+    block_infos = _make_block_infos(rng, peer_ids, states=(ServerState.JOINING, ServerState.ONLINE))
+
+    for _ in range(20):
+        sequence_info.update_([RemoteModuleInfo(info.uid, dict(info.servers)) for info in block_infos])
+        version = sequence_info.version
+        expected_spans, expected_spans_containing_block = _sort_spans_reference(block_infos)
+        assert _span_keys(sequence_info.spans_by_priority) == _span_keys(expected_spans)
+        for spans, expected in zip(sequence_info.spans_containing_block, expected_spans_containing_block):
+            assert _span_keys(spans) == _span_keys(expected)
+
+        # a new copy of the same records does not change spans
+        sequence_info.update_([RemoteModuleInfo(info.uid, dict(info.servers)) for info in block_infos])
+        assert sequence_info.version == version
+
+        # some servers leave, join, move, or update their info
+        changed_peers = rng.sample(peer_ids, 3)
+        new_block_infos = _make_block_infos(rng, changed_peers, states=(ServerState.JOINING, ServerState.ONLINE))
+        for info, new_info in zip(block_infos, new_block_infos):
+            for peer_id in changed_peers:
+                info.servers.pop(peer_id, None)
+                if peer_id in new_info.servers and rng.random() < 0.8:
+                    info.servers[peer_id] = new_info.servers[peer_id]
+
+
+def _find_path_reference(sequence_info, start_index, end_index, client_server_rtts, cache_tokens_needed):
+    """The routing graph built from scratch and searched with Dijkstra, as in the original implementation"""
+    rtt_to_delay, has_cache_for = RemoteSequenceManager._rtt_to_delay, RemoteSequenceManager._has_cache_for
+    overhead_delay, default_inference_rps, alloc_delay = 0.018, 300, 10
+    graph = {}
+
+    def add_edge(u, v, cost):
+        graph.setdefault(u, {})[v] = cost
+
+    for span in sequence_info.spans_containing_block[start_index]:
+        delay = rtt_to_delay(client_server_rtts.get(span.peer_id)) + overhead_delay
+        if not has_cache_for(span, cache_tokens_needed):
+            delay += alloc_delay
+        add_edge("start", (span.peer_id, start_index), delay)
+    for span in sequence_info.spans_containing_block[end_index - 1]:
+        add_edge((span.peer_id, end_index), "end", rtt_to_delay(client_server_rtts.get(span.peer_id)))
+    for block_idx in range(start_index + 1, end_index):
+        for cur_span in sequence_info.spans_containing_block[block_idx - 1]:
+            if cur_span.end != block_idx:
+                continue
+            for next_span in sequence_info.spans_containing_block[block_idx]:
+                rtt = cur_span.server_info.next_pings.get(next_span.peer_id.to_base58())
+                delay = rtt_to_delay(rtt) + overhead_delay
+                if not has_cache_for(next_span, cache_tokens_needed):
+                    delay += alloc_delay
+                add_edge((cur_span.peer_id, block_idx), (next_span.peer_id, block_idx), delay)
+    for span in sequence_info.spans_by_priority:
+        for block_idx in range(max(span.start, start_index), min(span.end, end_index)):
+            inference_rps = span.server_info.inference_rps or default_inference_rps
+            add_edge((span.peer_id, block_idx), (span.peer_id, block_idx + 1), 1.0 / inference_rps)
+
+    distances, queue = {"start": 0.0}, [(0.0, 0, "start")]
+    while queue:
+        distance, _, node = heapq.heappop(queue)
+        if node == "end":
+            return distance
+        if distance > distances[node]:
+            continue
+        for next_node, cost in graph.get(node, {}).items():
+            if distance + cost < distances.get(next_node, np.inf):
+                distances[next_node] = distance + cost
+                heapq.heappush(queue, (distance + cost, id(next_node), next_node))
+    return np.inf
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_inference_graph_finds_shortest_path(seed: int):
+    rng = random.Random(seed)
+    peer_ids = [PeerID(f"peer{i}".encode()) for i in range(40)]
+    sequence_info = RemoteSequenceInfo.make_empty(BLOCK_UIDS)
+    block_infos = _make_block_infos(rng, peer_ids)
+    sequence_info.update_(block_infos)
+
+    graph = InferenceGraph(
+        rtt_to_delay=RemoteSequenceManager._rtt_to_delay, has_cache_for=RemoteSequenceManager._has_cache_for
+    )
+    for step in range(10):
+        if step % 3 == 2:
+            # patch costs of a few servers that have updated their info without moving
+            for span in rng.sample(sequence_info.spans_by_priority, 3):
+                new_info = dataclasses.replace(span.server_info, inference_rps=rng.uniform(10, 1000))
+                for info in block_infos:
+                    if span.peer_id in info.servers:
+                        info.servers[span.peer_id] = new_info
+            sequence_info.update_([RemoteModuleInfo(info.uid, dict(info.servers)) for info in block_infos])
+        graph.update_(sequence_info.spans_by_priority, sequence_info.spans_containing_block)
+
+        client_server_rtts = {peer_id: rng.uniform(0.01, 0.5) for peer_id in rng.sample(peer_ids, 20)}
+        cache_tokens_needed = rng.choice([None, 1000])
+        start_index = rng.randrange(NUM_BLOCKS)
+        end_index = rng.randrange(start_index + 1, NUM_BLOCKS + 1)
+        if any(not sequence_info.spans_containing_block[i] for i in range(start_index, end_index)):
+            continue
+
+        span_sequence, total_cost = graph.find_path(
+            start_index, end_index, client_server_rtts=client_server_rtts, cache_tokens_needed=cache_tokens_needed
+        )
+        expected_cost = _find_path_reference(
+            sequence_info, start_index, end_index, client_server_rtts, cache_tokens_needed
+        )
+        assert total_cost == pytest.approx(expected_cost)
+
+        assert span_sequence[0].start == start_index and span_sequence[-1].end == end_index
+        for span, next_span in zip(span_sequence[:-1], span_sequence[1:]):
+            assert span.end == next_span.start and span.peer_id != next_span.peer_id
@@ -0,0 +1,127 @@
+import asyncio
+import threading
+import time
+
+import numpy as np
+import pytest
+import torch
+
+from subnet.health.rps_measurement import measure_peers_concurrently, time_inference_steps
+
+
+class _FakeServerLoop(threading.Thread):
+    """A shared event loop that serves all fake servers, similar to the client's RemoteExpertWorker"""
+
+    def __init__(self):
+        super().__init__(daemon=True)
+        self.loop = asyncio.new_event_loop()
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.join()
+
+
+class _FakeInferenceSession:
+    """Sends each step to a fake server that replies after {latency} seconds and times the round trip"""
+
+    def __init__(self, server_loop: _FakeServerLoop, latency: float):
+        self.server_loop, self.latency = server_loop, latency
+
+    async def _serve_step(self, inputs: torch.Tensor) -> torch.Tensor:
+        await asyncio.sleep(self.latency)
+        return inputs
+
+    def timed_step(self, inputs: torch.Tensor, max_retries: int = 0):
+        start_time = time.perf_counter()
+        outputs = asyncio.run_coroutine_threadsafe(self._serve_step(inputs), self.server_loop.loop).result()
+        return time.perf_counter() - start_time, outputs
+
+
+@pytest.fixture
+def server_loop():
+    server_loop = _FakeServerLoop()
+    server_loop.start()
+    yield server_loop
+    server_loop.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_concurrent_measurement_timing(server_loop):
+    n_steps, warmup_steps, max_concurrency = 10, 2, 4
+    latencies = {f"peer{i}": 0.02 + 0.003 * i for i in range(12)}
+    num_active, max_active, lock = 0, 0, threading.Lock()
+
+    def measure_peer(server_row: dict, cancel_event: threading.Event):
+        nonlocal num_active, max_active
+        with lock:
+            num_active += 1
+            max_active = max(max_active, num_active)
+        try:
+            session = _FakeInferenceSession(server_loop, latencies[server_row["peer_id"]])
+            time_steps = time_inference_steps(session, torch.zeros(1, 1, 8), n_steps, warmup_steps, cancel_event)
+            return dict(peer_id=server_row["peer_id"], step_time=np.mean(time_steps))
+        finally:
+            with lock:
+                num_active -= 1
+
+    streamed_results = []
+    start_time = time.perf_counter()
+    results = await measure_peers_concurrently(
+        [dict(peer_id=peer_id) for peer_id in latencies],
+        measure_peer,
+        max_concurrency=max_concurrency,
+        peer_timeout=30,
+        on_result=lambda result: streamed_results.append((time.perf_counter(), result)),
+    )
+    elapsed = time.perf_counter() - start_time
+
+    assert max_active == max_concurrency
+    assert [result["peer_id"] for result in results] == list(latencies)
+    for result in results:
+        # concurrent measurements should not distort the step times measured for each peer
+        assert result["step_time"] == pytest.approx(latencies[result["peer_id"]], rel=0.3)
+
+    sequential_time = sum(latencies.values()) * n_steps
+    assert elapsed < sequential_time / 2
+
+    # results are reported as soon as each peer is measured, not after the whole round
+    assert len(streamed_results) == len(latencies)
+    assert streamed_results[0][0] < start_time + elapsed / 2
+
+
+@pytest.mark.asyncio
+async def test_measurement_timeout_cancels_peer(server_loop):
+    latencies = {"fast": 0.01, "slow": 0.2, "broken": None}
+    steps_done = {peer_id: 0 for peer_id in latencies}
+
+    class _CountingSession(_FakeInferenceSession):
+        def __init__(self, peer_id: str):
+            super().__init__(server_loop, latencies[peer_id] or 0.0)
+            self.peer_id = peer_id
+
+        def timed_step(self, inputs: torch.Tensor, max_retries: int = 0):
+            if latencies[self.peer_id] is None:
+                raise RuntimeError("server is unreachable")
+            steps_done[self.peer_id] += 1
+            return super().timed_step(inputs, max_retries)
+
+    def measure_peer(server_row: dict, cancel_event: threading.Event):
+        time_steps = time_inference_steps(
+            _CountingSession(server_row["peer_id"]), torch.zeros(1, 1, 8), 50, 0, cancel_event
+        )
+        return None if time_steps is None else dict(peer_id=server_row["peer_id"])
+
+    start_time = time.perf_counter()
+    results = await measure_peers_concurrently(
+        [dict(peer_id=peer_id) for peer_id in latencies], measure_peer, max_concurrency=3, peer_timeout=1.0
+    )
+    elapsed = time.perf_counter() - start_time
+
+    assert results == [dict(peer_id="fast"), None, None]
+    assert steps_done["fast"] == 50
+    assert steps_done["slow"] < 50  # the slow peer stopped after the step that was running at the timeout
+    assert elapsed < 1.0 + 2 * latencies["slow"] + 0.5
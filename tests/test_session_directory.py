@@ -0,0 +1,52 @@
+import multiprocessing as mp
+import random
+
+from subnet.server.session_directory import SessionDirectory
+
+
+def test_session_directory_matches_dict():
+    directory = SessionDirectory(capacity=64)
+    reference = {}
+    rng = random.Random(0)
+    for step in range(20000):
+        session_id = f"session-{rng.randrange(100)}"
+        if rng.random() < 0.5 and len(reference) < 48:
+            assert directory.add(session_id, step % 8)
+            reference[session_id] = step % 8
+        else:
+            directory.remove(session_id)
+            reference.pop(session_id, None)
+        assert len(directory) == len(reference)
+        if step % 100 == 0:
+            for i in range(100):
+                assert directory.get(f"session-{i}") == reference.get(f"session-{i}")
+
+
+def test_session_directory_is_full():
+    directory = SessionDirectory(capacity=4)
+    assert all(directory.add(f"session-{i}", 0) for i in range(3))
+    assert not directory.add("session-3", 0)
+    assert directory.get("session-3") is None
+    directory.remove("session-0")
+    assert directory.add("session-3", 1) and directory.get("session-3") == 1
+
+
+def _open_sessions(directory: SessionDirectory, handler_index: int):
+    for i in range(100):
+        directory.add(f"session-{handler_index}-{i}", handler_index)
+    for i in range(0, 100, 2):
+        directory.remove(f"session-{handler_index}-{i}")
+
+
+def test_session_directory_is_shared():
+    directory = SessionDirectory()
+    processes = [mp.context.ForkProcess(target=_open_sessions, args=(directory, i)) for i in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+
+    assert len(directory) == 4 * 50
+    for handler_index in range(4):
+        assert directory.get(f"session-{handler_index}-0") is None
+        assert directory.get(f"session-{handler_index}-1") == handler_index
@@ -0,0 +1,69 @@
+import pytest
+import torch
+from hypermind import BatchTensorDescriptor
+
+from subnet.data_structures import InferenceMetadata
+from subnet.server.backend import TransformerBackend
+from subnet.server.block_utils import get_model_block
+from subnet.server.memory_cache import MemoryCache
+from subnet.utils.auto_config import AutoDistributedConfig
+from subnet.utils.convert_block import QuantType, convert_block
+from test_utils import MODEL_NAME
+
+
+@pytest.mark.forked
+@pytest.mark.asyncio
+@pytest.mark.parametrize("kv_cache_dtype, atol", [(None, 1e-4), (torch.int8, 0.05)])
+async def test_sliding_window_eviction(kv_cache_dtype: torch.dtype, atol: float, attention_sinks: int = 4):
+    config = AutoDistributedConfig.from_pretrained(MODEL_NAME)
+    if not getattr(config.block_class, "supports_attention_sinks", False):
+        pytest.skip(f"{config.block_class.__name__} does not support sliding-window sessions")
+    device, dtype = torch.device("cpu"), torch.float32
+    block = get_model_block(config).to(dtype)
+    block = convert_block(block, 0, config, (device,), device, quant_type=QuantType.NONE, freeze=True)
+
+    memory_cache = MemoryCache(max_size_bytes=None)
+    schema = (BatchTensorDescriptor(1, 2048, config.hidden_size, dtype=dtype),)
+    backend = TransformerBackend(
+        "sliding.0",
+        block,
+        config=config,
+        memory_cache=memory_cache,
+        backend_dtype=dtype,
+        max_chunk_size_bytes=256 * 1024 * 1024,
+        kv_cache_dtype=kv_cache_dtype,
+        args_schema=schema,
+        kwargs_schema={},
+        outputs_schema=schema,
+        min_batch_size=1,
+        max_batch_size=2048,
+    )
+
+    inputs = torch.randn(1, 64, config.hidden_size, dtype=dtype)
+    descriptors = backend.get_inference_cache_descriptors(batch_size=1, max_length=20)
+    memory_cache.runtime_pid += 1  # pretend we're a connection handler
+    async with memory_cache.allocate_cache(*descriptors, timeout=0) as handles:
+        memory_cache.runtime_pid -= 1  # pretend we're the runtime
+        kept_positions, position = [], 0
+        for length, num_evicted in [(20, 0), (1, 5), (4, 0), (3, 3), (1, 2), (8, 8), (2, 4)]:
+            # Cached tokens after the sinks are moved to the left, so the new tokens should see them as if the session
+            # consisted of the kept tokens only
+            kept_positions = kept_positions[:attention_sinks] + kept_positions[attention_sinks + num_evicted :]
+            info = InferenceMetadata(
+                backend.name,
+                len(kept_positions),
+                tuple(handles),
+                active_adapter=None,
+                attention_sinks=attention_sinks,
+                num_evicted=num_evicted,
+            )
+            hidden_states = inputs[:, position : position + length]
+            (outputs,) = backend.inference_step(hidden_states, torch.empty(0, dtype=torch.int64), info)
+            kept_positions += list(range(position, position + length))
+            position += length
+
+            with torch.inference_mode():
+                reference, _ = block(inputs[:, kept_positions], use_cache=True)
+            assert torch.allclose(outputs, reference[:, -length:], rtol=0, atol=atol)
+        memory_cache.runtime_pid += 1
+    memory_cache.runtime_pid -= 1
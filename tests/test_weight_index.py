@@ -0,0 +1,81 @@
+import json
+
+import pytest
+import torch
+from safetensors.torch import save_file
+
+import subnet.server.from_pretrained as from_pretrained
+from subnet.models.llama import DistributedLlamaConfig
+from subnet.server.block_utils import get_model_block
+from subnet.server.from_pretrained import ModelWeightIndex, load_pretrained_block
+
+NUM_BLOCKS, BLOCKS_PER_SHARD = 4, 2
+
+
+@pytest.fixture
+def checkpoint(tmp_path):
+    """A synthetic sharded checkpoint of a tiny Llama model with fp16 weights, two blocks per shard"""
+    config = DistributedLlamaConfig(
+        hidden_size=64,
+        intermediate_size=128,
+        num_attention_heads=4,
+        num_key_value_heads=4,
+        num_hidden_layers=NUM_BLOCKS,
+        torch_dtype=torch.float16,
+    )
+    config.save_pretrained(tmp_path)
+
+    state_dict, weight_map = {}, {}
+    for block_index in range(NUM_BLOCKS):
+        filename = f"model-{block_index // BLOCKS_PER_SHARD:05d}.safetensors"
+        for name, param in get_model_block(config, layer_idx=block_index).state_dict().items():
+            key = f"{config.block_prefix}.{block_index}.{name}"
+            state_dict[key] = torch.randn_like(param, dtype=torch.float16)
+            weight_map[key] = filename
+    for filename in set(weight_map.values()):
+        save_file({key: state_dict[key] for key in state_dict if weight_map[key] == filename}, tmp_path / filename)
+    with open(tmp_path / "model.safetensors.index.json", "w") as f:
+        json.dump(dict(metadata={}, weight_map=weight_map), f)
+    return str(tmp_path), config, state_dict
+
+
+@pytest.mark.parametrize("torch_dtype", [torch.float16, torch.float32])
+def test_weight_index_loads_blocks(checkpoint, torch_dtype: torch.dtype, monkeypatch):
+    model_path, config, ref_state_dict = checkpoint
+
+    num_index_lookups = 0
+    find_index_file = from_pretrained._find_index_file
+
+    def _counting_find_index_file(*args, **kwargs):
+        nonlocal num_index_lookups
+        num_index_lookups += 1
+        return find_index_file(*args, **kwargs)
+
+    monkeypatch.setattr(from_pretrained, "_find_index_file", _counting_find_index_file)
+
+    weight_index = ModelWeightIndex(model_path)
+    blocks = [
+        load_pretrained_block(
+            model_path, block_index, config=config, torch_dtype=torch_dtype, weight_index=weight_index
+        )
+        for block_index in range(NUM_BLOCKS)
+    ]
+    assert num_index_lookups == 1
+    assert len(weight_index._open_shards) == NUM_BLOCKS // BLOCKS_PER_SHARD
+
+    for block_index, block in enumerate(blocks):
+        for name, param in block.named_parameters():
+            ref_param = ref_state_dict[f"{config.block_prefix}.{block_index}.{name}"]
+            assert param.dtype == torch_dtype
+            assert torch.equal(param, ref_param.to(torch_dtype))
+
+    # If the dtype matches, parameters are views of the memory-mapped shards, so loading a block again is free
+    block_again = load_pretrained_block(
+        model_path, 0, config=config, torch_dtype=torch_dtype, weight_index=weight_index
+    )
+    for param, param_again in zip(blocks[0].parameters(), block_again.parameters()):
+        assert (param.data_ptr() == param_again.data_ptr()) == (torch_dtype == torch.float16)
+
+    weight_index.close()  # blocks that were already loaded remain valid
+    ref_param = ref_state_dict[f"{config.block_prefix}.0.mlp.up_proj.weight"]
+    assert torch.equal(block_again.mlp.up_proj.weight, ref_param.to(torch_dtype))